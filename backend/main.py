@@ -12,6 +12,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from backend.routers import stocks, scan, ranking, admin, rankings
 from backend.services.db import db_manager
+from backend.services.response_cache import response_cache
+from backend.services.executor import shutdown_executors
 from backend.scheduler import start_scheduler
 
 @asynccontextmanager
@@ -23,6 +25,7 @@ async def lifespan(app: FastAPI):
     yield
     # 關閉時
     print("👋 API 關閉中...")
+    shutdown_executors()
     db_manager.shutdown()
 
 app = FastAPI(
@@ -39,8 +42,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Cache"],
 )
 
+# 回應快取 (掃描/排行/個股 GET，依資料版本戳記與 TTL 失效，支援 ETag/304)
+app.middleware("http")(response_cache.middleware)
+
 # 註冊路由
 app.include_router(stocks.router, prefix="/api", tags=["股票"])
 app.include_router(scan.router, prefix="/api", tags=["掃描"])
@@ -2,11 +2,15 @@
 台灣股市分析系統 - 系統管理 API 路由
 """
 from fastapi import APIRouter, HTTPException, BackgroundTasks
-from typing import Optional
+from typing import Any, Dict, Optional
 from pydantic import BaseModel
 from datetime import datetime
 
 from backend.services.db import get_system_status, get_cloud_status
+from backend.services.response_cache import response_cache, invalidate_responses
+from backend.services.executor import executor_stats
+from backend.services.snapshot_store import snapshot_cache
+from backend.services.db import history_cache
 
 router = APIRouter()
 
@@ -126,6 +130,7 @@ def _load_main_script():
             'step11_verify_backfill': getattr(main_module, 'step11_verify_backfill', None),
             'step12_calc_indicators': getattr(main_module, 'step12_calc_indicators', None),
             'step8_sync_supabase': getattr(main_module, 'step8_sync_supabase', None),
+            'step8_pull_supabase': getattr(main_module, 'step8_pull_supabase', None),
         }
         _main_script_loaded = True
         logger.info("✅ 已成功載入 main_script 模組")
@@ -169,14 +174,17 @@ async def trigger_streaks_update(background_tasks: BackgroundTasks):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def update_task_progress(task_id: str, progress: int, message: str, status: str = "running"):
-    """更新任務進度 helper"""
+def update_task_progress(task_id: str, progress: int, message: str, status: str = "running",
+                         stats: Optional[Dict[str, Any]] = None):
+    """更新任務進度 helper (stats: 上傳吞吐量/失敗筆數等附加資訊)"""
     if task_id in _task_status:
         _task_status[task_id].update({
             "status": status,
             "progress": progress,
             "message": message
         })
+        if stats is not None:
+            _task_status[task_id]["stats"] = stats
 
 def run_streaks_update(task_id: str):
     """背景執行法人連買連賣計算"""
@@ -193,6 +201,7 @@ def run_streaks_update(task_id: str):
         else:
             raise Exception("無法載入 update_streaks 模組")
         
+        invalidate_responses("streaks")
         _task_status[task_id] = {
             "status": "completed",
             "progress": 100,
@@ -282,15 +291,16 @@ def run_daily_update(task_id: str):
         if should_sync:
             update_task_progress(task_id, 95, "Step 13: 同步資料到雲端...")
             
-            def sync_cb(p, msg):
+            def sync_cb(p, msg, stats=None):
                 # Map 0-100 to 95-99
                 overall = 95 + int(p * 0.04)
-                update_task_progress(task_id, overall, msg, "running")
+                update_task_progress(task_id, overall, msg, "running", stats)
                 
             funcs['step8_sync_supabase'](progress_callback=sync_cb)
         else:
             update_task_progress(task_id, 95, "Step 13: 略過雲端同步 (本地模式)")
         
+        invalidate_responses("daily_update")
         update_task_progress(task_id, 100, "每日更新完成", "completed")
         
     except Exception as e:
@@ -513,6 +523,7 @@ async def set_sync_mode(request: SyncModeRequest):
         
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
+        invalidate_responses("sync_mode")   # 讀取來源改變，快取的回應不再適用
         
         return {
             "success": True,
@@ -596,12 +607,16 @@ def run_sync_push(task_id: str):
         # 使用現有的 sync_supabase 功能
         update_task_progress(task_id, 30, "正在同步資料...")
         
-        def sync_cb(p, msg):
+        def sync_cb(p, msg, stats=None):
             # Map 0-100 to 30-90
             overall = 30 + int(p * 0.6)
-            update_task_progress(task_id, overall, msg, "running")
+            update_task_progress(task_id, overall, msg, "running", stats)
             
-        funcs['step8_sync_supabase'](progress_callback=sync_cb)
+        result = funcs['step8_sync_supabase'](progress_callback=sync_cb)
+        if result and result.get('failed'):
+            # 已上傳的批次浮水印已保存，下次推送從失敗處續傳
+            failed = ", ".join(f"{t}: {msg}" for t, msg in result['failed'].items())
+            raise Exception(f"部分資料表同步失敗 ({failed})")
         
         # 更新最後同步時間
         update_task_progress(task_id, 90, "更新同步時間...")
@@ -616,6 +631,7 @@ def run_sync_push(task_id: str):
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
         
+        invalidate_responses("sync_push")
         update_task_progress(task_id, 100, "雲端推送完成", "completed")
         
     except Exception as e:
@@ -630,15 +646,20 @@ def run_sync_pull(task_id: str):
     try:
         update_task_progress(task_id, 10, "正在連線雲端...", "running")
         
-        if not db_manager.supabase:
-            update_task_progress(task_id, 0, "雲端未連線", "failed")
-            return
+        funcs = _load_main_script()
+        if not funcs or not funcs.get('step8_pull_supabase'):
+            raise Exception("無法載入 pull_supabase 模組")
         
-        update_task_progress(task_id, 30, "正在檢查雲端資料...")
+        def pull_cb(p, msg):
+            # Map 0-100 to 10-90
+            update_task_progress(task_id, 10 + int(p * 0.8), msg, "running")
         
-        # 從 Supabase 拉取最新資料
-        # 這裡可以擴展為更複雜的同步邏輯
-        # 目前先實作基本的狀態更新
+        # 只拉取本地高水位之後的列，並重建受影響股票的快照
+        result = funcs['step8_pull_supabase'](progress_callback=pull_cb)
+        if result.get('failed'):
+            # 已寫入的頁已提交，下次拉取從新的高水位續拉
+            failed = ", ".join(f"{t}: {msg}" for t, msg in result['failed'].items())
+            raise Exception(f"部分資料表拉取失敗 ({failed})")
         
         update_task_progress(task_id, 90, "更新同步時間...")
         config_path = Path("config.json")
@@ -652,6 +673,7 @@ def run_sync_pull(task_id: str):
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
         
+        invalidate_responses("sync_pull")
         update_task_progress(task_id, 100, "雲端拉取完成", "completed")
         
     except Exception as e:
@@ -752,6 +774,7 @@ async def set_db_path(request: DBPathRequest):
         
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
+        invalidate_responses("db_path")
         
         return {
             "success": True,
@@ -764,3 +787,46 @@ async def set_db_path(request: DBPathRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+
+
+# ========================================
+# 回應快取 API
+# ========================================
+
+@router.get("/admin/cache", response_model=AdminResponse)
+async def get_cache_stats():
+    """
+    取得回應快取命中率與延遲分佈 (含 SQLite 讀取連線池、執行緒池與雲端記憶體快照統計)
+    """
+    try:
+        return {
+            "success": True,
+            "data": {
+                **response_cache.stats(),
+                "db_pool": db_manager.pool_stats(),
+                "executors": executor_stats(),
+                "snapshot": snapshot_cache.info(),
+                "history": history_cache.info()
+            }
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/admin/cache/clear", response_model=AdminResponse)
+async def clear_cache():
+    """
+    手動使回應快取失效 (改寫資料版本戳記)
+    """
+    try:
+        version = invalidate_responses("manual")
+        snapshot_cache.invalidate()
+        return {
+            "success": True,
+            "data": {
+                "data_version": version
+            },
+            "message": "回應快取已清除"
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -6,6 +6,7 @@ from typing import Optional, List, Dict
 from pydantic import BaseModel
 
 from backend.services.db import db_manager
+from backend.services.executor import run_blocking
 
 router = APIRouter()
 
@@ -99,7 +100,7 @@ async def foreign_buy_ranking(
 ):
     """外資買超排行"""
     try:
-        results = get_institutional_ranking("foreign", "buy", limit, min_days)
+        results = await run_blocking("rankings", get_institutional_ranking, "foreign", "buy", limit, min_days)
         
         return {
             "success": True,
@@ -111,6 +112,8 @@ async def foreign_buy_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -121,7 +124,7 @@ async def foreign_sell_ranking(
 ):
     """外資賣超排行"""
     try:
-        results = get_institutional_ranking("foreign", "sell", limit)
+        results = await run_blocking("rankings", get_institutional_ranking, "foreign", "sell", limit)
         
         return {
             "success": True,
@@ -133,6 +136,8 @@ async def foreign_sell_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -143,7 +148,7 @@ async def trust_buy_ranking(
 ):
     """投信買超排行"""
     try:
-        results = get_institutional_ranking("trust", "buy", limit)
+        results = await run_blocking("rankings", get_institutional_ranking, "trust", "buy", limit)
         
         return {
             "success": True,
@@ -155,6 +160,8 @@ async def trust_buy_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -165,7 +172,7 @@ async def trust_sell_ranking(
 ):
     """投信賣超排行"""
     try:
-        results = get_institutional_ranking("trust", "sell", limit)
+        results = await run_blocking("rankings", get_institutional_ranking, "trust", "sell", limit)
         
         return {
             "success": True,
@@ -177,6 +184,8 @@ async def trust_sell_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -187,7 +196,7 @@ async def dealer_buy_ranking(
 ):
     """自營商買超排行"""
     try:
-        results = get_institutional_ranking("dealer", "buy", limit)
+        results = await run_blocking("rankings", get_institutional_ranking, "dealer", "buy", limit)
         
         return {
             "success": True,
@@ -199,6 +208,8 @@ async def dealer_buy_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -209,7 +220,7 @@ async def dealer_sell_ranking(
 ):
     """自營商賣超排行"""
     try:
-        results = get_institutional_ranking("dealer", "sell", limit)
+        results = await run_blocking("rankings", get_institutional_ranking, "dealer", "sell", limit)
         
         return {
             "success": True,
@@ -221,6 +232,8 @@ async def dealer_sell_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -243,7 +256,7 @@ async def generic_ranking(
         raise HTTPException(status_code=400, detail="無效的買賣方向")
     
     try:
-        results = get_institutional_ranking(entity, direction, limit)
+        results = await run_blocking("rankings", get_institutional_ranking, entity, direction, limit)
         
         entity_names = {
             "foreign": "外資",
@@ -266,5 +279,7 @@ async def generic_ranking(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3,6 +3,8 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import sys
 from backend.services.db import db_manager, get_system_status
+from backend.services.executor import run_blocking
+from core.inst_flow_rollup import rollup_ready, window_cutoff, window_sql
 
 router = APIRouter(prefix="/api/rankings", tags=["rankings"])
 
@@ -53,6 +55,29 @@ async def get_institutional_rankings(
 ):
     """
     Get institutional investor rankings.
+    Runs on the "rankings" executor lane so multi-day aggregations don't block the event loop.
+    """
+    return await run_blocking(
+        "rankings", query_institutional_rankings,
+        type, sort, limit, page, min_foreign_streak, min_trust_streak, min_dealer_streak,
+        sort_by, direction, days
+    )
+
+
+def query_institutional_rankings(
+    type: str,
+    sort: str = "buy",
+    limit: int = 30,
+    page: int = 1,
+    min_foreign_streak: int = 0,
+    min_trust_streak: int = 0,
+    min_dealer_streak: int = 0,
+    sort_by: str = None,
+    direction: str = "desc",
+    days: int = 1
+):
+    """
+    Blocking ranking query (SQLite or Supabase).
     """
     # 雲端模式: 從 Supabase 讀取 stock_snapshot
     if db_manager.is_cloud_mode:
@@ -207,12 +232,15 @@ async def get_institutional_rankings(
     
     sys.stdout.flush()
     
+    # 法人買賣超欄位來源: 多日為區間合計 (agg)，單日為快照 (s)
+    flow = "agg" if days > 1 else "s"
+
     # Map type to column name (for sorting/filtering)
     column_map = {
-        "foreign": "s.foreign_buy",
-        "trust": "s.trust_buy",
-        "dealer": "s.dealer_buy",
-        "total": "(s.foreign_buy + s.trust_buy + s.dealer_buy)"
+        "foreign": f"{flow}.foreign_buy",
+        "trust": f"{flow}.trust_buy",
+        "dealer": f"{flow}.dealer_buy",
+        "total": f"({flow}.foreign_buy + {flow}.trust_buy + {flow}.dealer_buy)"
     }
     
     target_col = column_map.get(type)
@@ -259,9 +287,9 @@ async def get_institutional_rankings(
             "close": "s.close",
             "change_pct": "change_pct",
             "volume": "s.volume",
-            "foreign": "s.foreign_buy",
-            "trust": "s.trust_buy",
-            "dealer": "s.dealer_buy",
+            "foreign": f"{flow}.foreign_buy",
+            "trust": f"{flow}.trust_buy",
+            "dealer": f"{flow}.dealer_buy",
             "streak": streak_col,
             "amount": f"ABS({target_col} * s.close)",
             # Explicit Streak Sorts
@@ -289,48 +317,39 @@ async def get_institutional_rankings(
     offset = (page - 1) * limit
 
     # Query Construction
+    params = ()
     if days > 1:
-        # 1. Get cutoff date
-        date_sql = f"SELECT DISTINCT date_int FROM stock_history ORDER BY date_int DESC LIMIT {days}"
-        dates = db_manager.execute_query(date_sql)
-        if not dates:
+        # 1. 區間合計: 主程式維護的法人前綴和 (最新累計 - 區間前累計) 已涵蓋最新交易日時使用，
+        #    否則退回逐日 SUM ... GROUP BY
+        with db_manager.get_connection() as conn:
+            use_rollup = rollup_ready(conn)
+            cutoff_date = window_cutoff(conn, days) if use_rollup else None
+        if use_rollup:
+            agg_sql, agg_params = window_sql(), (cutoff_date, cutoff_date)
+        else:
+            dates = db_manager.execute_query(
+                "SELECT DISTINCT date_int FROM stock_history ORDER BY date_int DESC LIMIT ?", (days,))
+            cutoff_date = dates[-1]['date_int'] if dates else None
+            agg_sql = """
+                SELECT code, SUM(foreign_buy) as foreign_buy, SUM(trust_buy) as trust_buy,
+                       SUM(dealer_buy) as dealer_buy
+                FROM stock_history
+                WHERE date_int >= ?
+                GROUP BY code"""
+            agg_params = (cutoff_date,)
+        if not cutoff_date:
              return {"success": False, "data": [], "total_count": 0, "total_pages": 0, "current_page": 1}
-        cutoff_date = dates[-1]['date_int']
 
-        # Count Query
-        count_sql = f"""
-        WITH Aggregated AS (
-            SELECT 
-                code,
-                SUM(foreign_buy) as foreign_buy,
-                SUM(trust_buy) as trust_buy,
-                SUM(dealer_buy) as dealer_buy
-            FROM stock_history
-            WHERE date_int >= {cutoff_date}
-            GROUP BY code
-        )
-        SELECT COUNT(*) as count
+        # 2. 資料與總筆數同一次查詢 (COUNT(*) OVER () 為分頁前的筆數)
+        from_clause = f"""
         FROM Aggregated agg
         JOIN stock_snapshot s ON agg.code = s.code
         JOIN stock_meta m ON s.code = m.code
         WHERE m.market_type IN ('TWSE', 'TPEx') 
-          AND {where_clause.replace('s.foreign_buy', 'agg.foreign_buy').replace('s.trust_buy', 'agg.trust_buy').replace('s.dealer_buy', 'agg.dealer_buy').replace('foreign_buy', 'agg.foreign_buy').replace('trust_buy', 'agg.trust_buy').replace('dealer_buy', 'agg.dealer_buy')}
-        """
-        count_res = db_manager.execute_query(count_sql)
-        total_count = count_res[0]['count'] if count_res else 0
-
-        # Data Query
+          AND {where_clause}"""
+        count_sql = f"WITH Aggregated AS ({agg_sql}) SELECT COUNT(*) as count {from_clause}"
         sql = f"""
-        WITH Aggregated AS (
-            SELECT 
-                code,
-                SUM(foreign_buy) as foreign_buy,
-                SUM(trust_buy) as trust_buy,
-                SUM(dealer_buy) as dealer_buy
-            FROM stock_history
-            WHERE date_int >= {cutoff_date}
-            GROUP BY code
-        )
+        WITH Aggregated AS ({agg_sql})
         SELECT 
             s.code, s.name, s.close, 
             ROUND((s.close - s.close_prev) / s.close_prev * 100, 2) as change_pct,
@@ -347,15 +366,13 @@ async def get_institutional_rankings(
             0 as foreign_holding_shares,
             0.0 as foreign_holding_pct,
             0 as trust_holding_shares,
-            0.0 as trust_holding_pct
-        FROM Aggregated agg
-        JOIN stock_snapshot s ON agg.code = s.code
-        JOIN stock_meta m ON s.code = m.code
-        WHERE m.market_type IN ('TWSE', 'TPEx') 
-          AND {where_clause.replace('s.foreign_buy', 'agg.foreign_buy').replace('s.trust_buy', 'agg.trust_buy').replace('s.dealer_buy', 'agg.dealer_buy').replace('foreign_buy', 'agg.foreign_buy').replace('trust_buy', 'agg.trust_buy').replace('dealer_buy', 'agg.dealer_buy')}
-        ORDER BY {order_clause.replace('s.foreign_buy', 'agg.foreign_buy').replace('s.trust_buy', 'agg.trust_buy').replace('s.dealer_buy', 'agg.dealer_buy').replace('foreign_buy', 'agg.foreign_buy').replace('trust_buy', 'agg.trust_buy').replace('dealer_buy', 'agg.dealer_buy')}
-        LIMIT {limit} OFFSET {offset}
+            0.0 as trust_holding_pct,
+            COUNT(*) OVER () as total_count
+        {from_clause}
+        ORDER BY {order_clause}
+        LIMIT ? OFFSET ?
         """
+        params = agg_params + (limit, offset)
     else:
         # Standard 1-day query (from snapshot)
         # Get latest date that has holding data (may be different from latest net buy/sell date)
@@ -407,7 +424,13 @@ async def get_institutional_rankings(
     
     try:
         # print(f"Executing SQL: {sql[:200]}...")
-        results = db_manager.execute_query(sql)
+        results = db_manager.execute_query(sql, params)
+        if days > 1:
+            # 分頁超出範圍時沒有列可帶回總筆數，才另外計數
+            total_count = results[0]['total_count'] if results else (
+                db_manager.execute_query(count_sql, agg_params)[0]['count'] if offset else 0)
+            for row in results:
+                row.pop('total_count', None)
         total_pages = (total_count + limit - 1) // limit
         # print(f"Query returned {len(results)} results")
         
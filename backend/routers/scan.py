@@ -6,7 +6,9 @@ from typing import Optional, List, Dict, Any
 from pydantic import BaseModel
 
 from backend.services.db import db_manager
+from backend.services.executor import run_blocking
 from backend.routers.scan_2560 import execute_2560_scan
+from core.scan_results import SCAN_DEFINITIONS, build_scan_query, lookup_scan_results
 
 router = APIRouter()
 
@@ -71,9 +73,15 @@ def execute_scan_query(
     min_vol: int = 500,
     min_price: Optional[float] = None,
     scan_type: str = "default",
+    result_key: Optional[str] = None,
+    max_score: Optional[float] = None,
     **kwargs
 ) -> List[Dict]:
-    """執行掃描查詢 (支援本地/雲端)"""
+    """
+    執行掃描查詢 (支援本地/雲端)
+    result_key: core.scan_results 登記的掃描鍵，本地模式優先讀取 Step 7 後的物化結果
+    max_score: 物化結果的分數上限 (VP 容忍度)
+    """
     
     # 檢查讀取來源設定
     import json
@@ -92,32 +100,99 @@ def execute_scan_query(
     if read_source == "cloud" or db_manager.is_cloud_mode:
         return execute_scan_query_cloud(scan_type, limit, min_vol, min_price, **kwargs)
     
+    # [優化] 物化結果: (scan_type, generation, rank) 主鍵單次查詢；尚未物化時回傳 None 改走即時 SQL
+    if result_key:
+        with db_manager.get_connection() as conn:
+            cached = lookup_scan_results(conn, result_key, limit, min_vol, min_price, max_score=max_score)
+        if cached is not None:
+            return cached
+    
     extra_conditions = f"AND s.volume >= {min_vol}"
     if min_price:
         extra_conditions += f" AND s.close >= {min_price}"
 
-    query = f"""
-        SELECT 
-            m.code, m.name, m.market_type as market,
-            s.close, ROUND((s.close - s.close_prev) / s.close_prev * 100, 2) as change_pct, s.volume, s.amount,
-            s.ma5, s.ma20, s.ma25, s.ma60, s.ma120, s.ma200,
-            s.rsi, s.rsi as mfi, NULL as k, NULL as d,
-            s.vp_poc, s.vp_high, s.vp_low,
-            s.vol_ma5, s.vol_ma60,
-            s.foreign_buy as "foreign", s.trust_buy as "trust", s.dealer_buy as "dealer",
-            s.major_holders_pct as big_trader, s.total_shareholders as concentration,
-            ROUND(s.amount / NULLIF(s.volume, 0), 2) as vwap
-        FROM stock_meta m
-        JOIN stock_snapshot s ON m.code = s.code
-        WHERE m.code GLOB '[0-9][0-9][0-9][0-9]'
-        {extra_conditions}
-        {conditions}
-        ORDER BY {order_by}
-        LIMIT ?
-    """
+    query = build_scan_query(conditions, order_by, extra_conditions)
     return db_manager.execute_query(query, (limit,))
 
 
+# 雲端快照欄位 (六維共振所需的所有指標)
+CLOUD_SCAN_COLUMNS = (
+    'code', 'name', 'close', 'close_prev', 'volume', 'amount',
+    'ma5', 'ma20', 'ma60', 'ma120', 'ma200', 'rsi', 'mfi14',
+    'vp_poc', 'vp_high', 'vp_low', 'foreign_buy', 'trust_buy', 'dealer_buy',
+    'macd', 'signal', 'daily_k', 'daily_d', 'lwr', 'bbi', 'mtm',
+)
+
+# 各掃描的初步篩選: (不可為 NULL 的欄位, [(欄位, 'lt'/'gt', 值)])；Supabase 查詢與記憶體快照共用
+CLOUD_PREFILTERS = {
+    "vp_support": (('vp_low',), ()),
+    "vp_resistance": (('vp_high',), ()),
+    "mfi_oversold": (('mfi14',), (('mfi14', 'lt', 30),)),
+    "mfi_overbought": (('mfi14',), (('mfi14', 'gt', 70),)),
+    "ma_": (('ma20', 'ma60'), ()),
+    "institutional": (('ma20', 'ma60', 'rsi'), (('rsi', 'lt', 60),)),
+    "six_dim": (('rsi',), ()),
+    "kd_month": (('rsi',), ()),  # 月KD金叉需要 month_k, month_d；使用 RSI 作為基本篩選
+    "vsbc": (('vp_poc', 'ma20', 'ma60'), ()),
+    "smart_money": (('ma200', 'mfi14'), (('mfi14', 'lt', 80),)),  # 聰明錢：價格 > MA200, MFI < 80
+    "2560": (('ma20', 'ma60'), ()),
+    "five_stage": (('rsi',), (('rsi', 'gt', 50),)),
+    "patterns_morning_star": (('close', 'close_prev'), ()),
+    "patterns_evening_star": (('close', 'close_prev'), ()),
+    "pv_div": (('rsi',), ()),
+}
+
+
+def _cloud_prefilter(scan_type: str):
+    if scan_type.startswith("ma_"):
+        return CLOUD_PREFILTERS["ma_"]
+    return CLOUD_PREFILTERS.get(scan_type, ((), ()))
+
+
+def _fetch_cloud_rows_from_snapshot(frame, scan_type: str, min_vol: int, min_price: Optional[float]) -> List[Dict]:
+    """[優化] 記憶體快照上以向量運算套用初步篩選，依成交量排序 (全市場皆在記憶體，不需 limit*5 截斷)"""
+    import numpy as np
+    volume = frame.column('volume')
+    mask = np.ones(len(frame), dtype=bool)
+    if min_vol > 0:
+        mask &= volume >= min_vol
+    if min_price:
+        mask &= frame.column('close') >= min_price
+    not_null, compares = _cloud_prefilter(scan_type)
+    for col in not_null:
+        mask &= ~np.isnan(frame.column(col))
+    for col, op, value in compares:
+        mask &= (frame.column(col) < value) if op == 'lt' else (frame.column(col) > value)
+    return frame.rows(frame.select(mask, order_by='volume'), CLOUD_SCAN_COLUMNS)
+
+
+def _fetch_cloud_rows_from_supabase(scan_type: str, limit: int, min_vol: int, min_price: Optional[float]) -> List[Dict]:
+    """從 Supabase stock_snapshot 查詢初步篩選後的列"""
+    if not db_manager.supabase:
+        return []
+    query = db_manager.supabase.table('stock_snapshot').select(', '.join(CLOUD_SCAN_COLUMNS))
+    
+    # 基本篩選條件
+    if min_vol > 0:
+        query = query.gte('volume', min_vol)
+    if min_price:
+        query = query.gte('close', min_price)
+    
+    # 根據 scan_type 套用特定篩選
+    not_null, compares = _cloud_prefilter(scan_type)
+    for col in not_null:
+        query = query.not_.is_(col, 'null')
+    for col, op, value in compares:
+        query = query.lt(col, value) if op == 'lt' else query.gt(col, value)
+    
+    # 排序與限制 (加大 limit 以便後續 Python 過濾)
+    fetch_limit = limit * 5 if scan_type not in ["default"] else limit
+    query = query.order('volume', desc=True).limit(fetch_limit)
+    
+    response = query.execute()
+    return response.data or []
+
+
 def execute_scan_query_cloud(
     scan_type: str = "default",
     limit: int = 30,
@@ -125,77 +200,22 @@ def execute_scan_query_cloud(
     min_price: Optional[float] = None,
     **kwargs
 ) -> List[Dict]:
-    """雲端掃描查詢 (使用 Supabase) - 支援不同掃描類型"""
-    if not db_manager.supabase:
-        return []
+    """雲端掃描查詢 (記憶體快照優先，否則使用 Supabase) - 支援不同掃描類型"""
+    from backend.services.snapshot_store import snapshot_cache
     
     try:
-        # 從 stock_snapshot 讀取資料 (包含六維共振所需的所有指標)
-        query = db_manager.supabase.table('stock_snapshot').select(
-            'code, name, close, close_prev, volume, amount, '
-            'ma5, ma20, ma60, ma120, ma200, rsi, mfi14, '
-            'vp_poc, vp_high, vp_low, foreign_buy, trust_buy, dealer_buy, '
-            'macd, signal, daily_k, daily_d, lwr, bbi, mtm'
-        )
-        
-        # 基本篩選條件
-        if min_vol > 0:
-            query = query.gte('volume', min_vol)
-        if min_price:
-            query = query.gte('close', min_price)
-        
-        # 根據 scan_type 套用特定篩選
-        if scan_type == "vp_support":
-            query = query.not_.is_('vp_low', 'null')
-        elif scan_type == "vp_resistance":
-            query = query.not_.is_('vp_high', 'null')
-        elif scan_type == "mfi_oversold":
-            query = query.not_.is_('mfi14', 'null').lt('mfi14', 30)
-        elif scan_type == "mfi_overbought":
-            query = query.not_.is_('mfi14', 'null').gt('mfi14', 70)
-        elif scan_type.startswith("ma_"):
-            query = query.not_.is_('ma20', 'null').not_.is_('ma60', 'null')
-        elif scan_type == "institutional":
-            query = query.not_.is_('ma20', 'null').not_.is_('ma60', 'null').not_.is_('rsi', 'null').lt('rsi', 60)
-        elif scan_type == "six_dim":
-            query = query.not_.is_('rsi', 'null')
-        elif scan_type == "kd_month":
-            # 月KD金叉需要 month_k, month_d
-            query = query.not_.is_('rsi', 'null')  # 使用 RSI 作為基本篩選
-        elif scan_type == "vsbc":
-            # VSBC 需要 vp_poc, ma20, ma60
-            query = query.not_.is_('vp_poc', 'null').not_.is_('ma20', 'null').not_.is_('ma60', 'null')
-        elif scan_type == "smart_money":
-            # 聰明錢：價格 > MA200, MFI < 80
-            query = query.not_.is_('ma200', 'null').not_.is_('mfi14', 'null').lt('mfi14', 80)
-        elif scan_type == "2560":
-            # 2560 戰法：需要 ma20, ma60
-            query = query.not_.is_('ma20', 'null').not_.is_('ma60', 'null')
-        elif scan_type == "five_stage":
-            # 五階篩選：RSI > 50
-            query = query.not_.is_('rsi', 'null').gt('rsi', 50)
-        elif scan_type == "patterns_morning_star":
-            # K線型態 - 晨星: 收盤價 > 開盤價 (反轉向上)
-            query = query.not_.is_('close', 'null').not_.is_('close_prev', 'null')
-        elif scan_type == "patterns_evening_star":
-            # K線型態 - 黃昏之星: 收盤價 < 開盤價 (反轉向下)
-            query = query.not_.is_('close', 'null').not_.is_('close_prev', 'null')
-        elif scan_type == "pv_div":
-            # 量價背離: 找價格和成交量走勢不一致的股票
-            query = query.not_.is_('rsi', 'null')
-        
-        # 排序與限制 (加大 limit 以便後續 Python 過濾)
-        fetch_limit = limit * 5 if scan_type not in ["default"] else limit
-        query = query.order('volume', desc=True).limit(fetch_limit)
-        
-        response = query.execute()
+        frame = snapshot_cache.get() if db_manager.is_cloud_mode else None
+        if frame is not None:
+            rows = _fetch_cloud_rows_from_snapshot(frame, scan_type, min_vol, min_price)
+        else:
+            rows = _fetch_cloud_rows_from_supabase(scan_type, limit, min_vol, min_price)
         
-        if not response.data:
+        if not rows:
             return []
         
         # 轉換並進行細部篩選
         results = []
-        for row in response.data:
+        for row in rows:
             # 計算漲跌幅
             change_pct = 0.0
             if row.get('close') and row.get('close_prev'):
@@ -400,6 +420,9 @@ def execute_scan_query_cloud(
             # 量價背離：按背離強度排序
             results.sort(key=lambda x: x.get('_div_score', 0), reverse=True)
         
+        # 掃描命中的股票計入熱度，下次同步後優先預取其歷史
+        from backend.services.db import history_cache
+        history_cache.note_scan_hits(item['code'] for item in results[:limit])
         return results[:limit]
     except Exception as e:
         print(f"⚠️ 雲端掃描查詢錯誤: {e}")
@@ -424,21 +447,13 @@ async def scan_vp(
     - resistance: 接近上緣壓力 (VP Upper)
     """
     try:
-        if direction == "support":
-            conditions = f"""
-                AND s.vp_low IS NOT NULL
-                AND ABS(s.close - s.vp_low) / s.close < {tolerance}
-            """
-            order_by = "ABS(s.close - s.vp_low) / s.close ASC"
-        else:
-            conditions = f"""
-                AND s.vp_high IS NOT NULL
-                AND ABS(s.close - s.vp_high) / s.close < {tolerance}
-            """
-            order_by = "ABS(s.close - s.vp_high) / s.close ASC"
+        key = "vp_support" if direction == "support" else "vp_resistance"
+        scan = SCAN_DEFINITIONS[key]
+        conditions = f"{scan.conditions} AND {scan.score} < {tolerance}"
         
-        results = execute_scan_query(conditions, order_by, limit, min_vol, min_price,
-                                     scan_type=f"vp_{direction}", tolerance=tolerance)
+        results = await run_blocking("scan", execute_scan_query, conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type=f"vp_{direction}", result_key=key,
+                                     max_score=tolerance, tolerance=tolerance)
         
         return {
             "success": True,
@@ -449,6 +464,8 @@ async def scan_vp(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -466,25 +483,13 @@ async def scan_mfi(
     - overbought: MFI 由大→小 (mfi < mfi_prev AND mfi > 70)
     """
     try:
-        if condition == "oversold":
-            # Python: mfi > mfi_prev AND mfi < 30 (資金開始流入)
-            conditions = """
-                AND s.mfi14 IS NOT NULL AND s.mfi14_prev IS NOT NULL
-                AND s.mfi14 > s.mfi14_prev
-                AND s.mfi14 < 30
-            """
-            order_by = "s.mfi14 ASC"
-        else:
-            # Python: mfi < mfi_prev AND mfi > 70 (資金開始流出)
-            conditions = """
-                AND s.mfi14 IS NOT NULL AND s.mfi14_prev IS NOT NULL
-                AND s.mfi14 < s.mfi14_prev
-                AND s.mfi14 > 70
-            """
-            order_by = "s.mfi14 DESC"
+        # Python: oversold = mfi > mfi_prev AND mfi < 30 (資金開始流入)
+        #         overbought = mfi < mfi_prev AND mfi > 70 (資金開始流出)
+        key = "mfi_oversold" if condition == "oversold" else "mfi_overbought"
+        scan = SCAN_DEFINITIONS[key]
         
-        results = execute_scan_query(conditions, order_by, limit, min_vol, min_price,
-                                     scan_type=f"mfi_{condition}")
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type=f"mfi_{condition}", result_key=key)
         
         return {
             "success": True,
@@ -495,6 +500,8 @@ async def scan_mfi(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -513,34 +520,11 @@ async def scan_ma(
     - below_ma200: 低於 MA200 在 0-10% 之間
     """
     try:
-        if pattern == "bull":
-            conditions = """
-                AND s.ma5 IS NOT NULL AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL AND s.ma120 IS NOT NULL
-                AND s.close > s.ma5
-                AND s.ma5 > s.ma20
-                AND s.ma20 > s.ma60
-                AND s.ma60 > s.ma120
-                AND (s.close - s.ma20) / s.ma20 * 100 > 0
-                AND (s.close - s.ma20) / s.ma20 * 100 < 10
-            """
-            order_by = "(s.close - s.ma20) / s.ma20 ASC"
-        elif pattern == "below_ma20":
-            conditions = """
-                AND s.ma20 IS NOT NULL
-                AND s.close < s.ma20
-                AND s.close >= s.ma20 * 0.9
-            """
-            order_by = "(s.close - s.ma20) / s.ma20 DESC"
-        else:  # below_ma200
-            conditions = """
-                AND s.ma200 IS NOT NULL
-                AND s.close < s.ma200
-                AND s.close >= s.ma200 * 0.9
-            """
-            order_by = "(s.close - s.ma200) / s.ma200 DESC"
+        key = f"ma_{pattern}" if pattern in ("bull", "below_ma20") else "ma_below_ma200"
+        scan = SCAN_DEFINITIONS[key]
         
-        results = execute_scan_query(conditions, order_by, limit, min_vol, min_price, 
-                                       scan_type=f"ma_{pattern}")
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type=f"ma_{pattern}", result_key=key)
         
         return {
             "success": True,
@@ -551,6 +535,8 @@ async def scan_ma(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -568,30 +554,13 @@ async def scan_kd_cross(
     - death: 月K < 月D (死叉)
     """
     try:
-        if signal == "golden":
-            # Python Logic: K_prev <= D_prev AND K > D AND K < 80 AND NVI > PVI
-            conditions = """
-                AND s.month_k IS NOT NULL AND s.month_d IS NOT NULL 
-                AND s.month_k_prev IS NOT NULL AND s.month_d_prev IS NOT NULL
-                AND s.nvi IS NOT NULL AND s.pvi IS NOT NULL
-                AND s.month_k_prev <= s.month_d_prev
-                AND s.month_k > s.month_d
-                AND s.month_k < 80
-                AND s.nvi > s.pvi
-            """
-            order_by = "s.month_k ASC"
-        else:
-            # Death Cross (Reverse Logic)
-            conditions = """
-                AND s.month_k IS NOT NULL AND s.month_d IS NOT NULL
-                AND s.month_k_prev IS NOT NULL AND s.month_d_prev IS NOT NULL
-                AND s.month_k_prev >= s.month_d_prev
-                AND s.month_k < s.month_d
-            """
-            order_by = "s.month_k DESC"
+        # Python Logic: golden = K_prev <= D_prev AND K > D AND K < 80 AND NVI > PVI
+        #               death = K_prev >= D_prev AND K < D
+        key = "kd_golden" if signal == "golden" else "kd_death"
+        scan = SCAN_DEFINITIONS[key]
         
-        results = execute_scan_query(conditions, order_by, limit, min_vol, min_price,
-                                     scan_type="kd_month")
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="kd_month", result_key=key)
         
         return {
             "success": True,
@@ -602,6 +571,8 @@ async def scan_kd_cross(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -625,21 +596,12 @@ async def scan_vsbc(
         # 4. ma20 > ma60 (均線多頭)
         # 5. close > ma20 (站上月線)
         
-        conditions = """
-            AND s.vsbc_pct IS NOT NULL AND s.vsbc IS NOT NULL AND s.vsbc_prev IS NOT NULL
-            AND s.vsbc_pct >= 99
-            AND s.vsbc > s.vsbc_prev
-            AND s.vp_poc IS NOT NULL AND s.close >= s.vp_poc
-            AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL AND s.ma20 > s.ma60
-            AND s.close > s.ma20
-        """
-        
-        # Style variations
-        if style == "burst":
-            conditions += " AND (s.close - s.close_prev) / s.close_prev > 0.03"
+        # Style variations: burst 另加當日漲幅 > 3%
+        key = "vsbc_burst" if style == "burst" else "vsbc_steady"
+        scan = SCAN_DEFINITIONS[key]
         
-        results = execute_scan_query(conditions, "s.vsbc_pct DESC, s.volume DESC", limit, min_vol, min_price,
-                                     scan_type="vsbc")
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="vsbc", result_key=key)
         
         return {
             "success": True,
@@ -651,6 +613,8 @@ async def scan_vsbc(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -672,15 +636,9 @@ async def scan_smart_money(
         # 3. mfi < 80 (未過熱)
         # 4. smart_score >= 4 (籌碼評分高)
         
-        conditions = """
-            AND s.vol_prev IS NOT NULL AND s.volume > s.vol_prev * 1.1
-            AND s.ma200 IS NOT NULL AND s.close > s.ma200
-            AND s.mfi14 IS NOT NULL AND s.mfi14 < 80
-            AND s.smart_score IS NOT NULL AND s.smart_score >= 4
-        """
-        
-        results = execute_scan_query(conditions, "s.smart_score DESC", limit, min_vol, min_price,
-                                     scan_type="smart_money")
+        scan = SCAN_DEFINITIONS["smart_money"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="smart_money", result_key="smart_money")
         
         return {
             "success": True,
@@ -691,6 +649,8 @@ async def scan_smart_money(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -732,26 +692,9 @@ async def scan_2560(
         # 3. Validation: close > open AND close > close_prev
         # 4. Proximity: close < ma25 * 1.10
         
-        conditions = """
-            AND s.ma25 IS NOT NULL AND s.ma25_slope IS NOT NULL
-            AND s.vol_ma5 IS NOT NULL AND s.vol_ma60 IS NOT NULL
-            AND s.close > s.ma25
-            AND s.ma25_slope > 0
-            AND s.vol_ma5 > s.vol_ma60
-            AND s.close > s.open
-            AND s.close > s.close_prev
-            AND s.close < s.ma25 * 1.10
-        """
-        # Note: Previous day vol cross check is hard in simple snapshot SQL without joining history or having 'vol_cross' flag.
-        # Assuming 'vol_ma5 > vol_ma60' is the main state we want to catch (active golden cross state).
-        # If strict crossover is needed, we need 'vol_ma5_prev' and 'vol_ma60_prev' which might not be in snapshot or need join.
-        # Schema has vol_prev, but maybe not vol_ma5_prev.
-        # Let's check schema for prev MAs. Schema has 'ma20_prev', 'ma60_prev'. Does it have 'vol_ma5_prev'?
-        # Schema: 'vol_ma5' is there. 'vol_ma5_prev' is NOT in the list I saw (only price MAs).
-        # So I'll stick to state check: vol_ma5 > vol_ma60.
-        
-        results = execute_scan_query(conditions, "s.volume DESC", limit, min_vol, min_price,
-                                     scan_type="2560")
+        scan = SCAN_DEFINITIONS["2560"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="2560", result_key="2560")
         
         return {
             "success": True,
@@ -762,6 +705,8 @@ async def scan_2560(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -783,15 +728,9 @@ async def scan_five_stage(
         # 4. Value (RSI > 50)
         # 5. Trigger (Close > Open)
         
-        conditions = """
-            AND s.mansfield_rs IS NOT NULL AND s.mansfield_rs > 0
-            AND s.ma5 > s.ma20 AND s.ma20 > s.ma60
-            AND s.nvi > s.pvi
-            AND s.rsi > 50
-            AND s.close > s.open
-        """
-        results = execute_scan_query(conditions, "s.mansfield_rs DESC", limit, min_vol, min_price,
-                                     scan_type="five_stage")
+        scan = SCAN_DEFINITIONS["five_stage"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="five_stage", result_key="five_stage")
         
         return {
             "success": True,
@@ -802,6 +741,8 @@ async def scan_five_stage(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -817,15 +758,9 @@ async def scan_institutional_value(
     """
     try:
         # 模擬機構篩選：趨勢向上但未過熱，且有量能支撐
-        conditions = """
-            AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL
-            AND s.ma20 > s.ma60
-            AND s.close > s.ma20
-            AND s.rsi IS NOT NULL AND s.rsi < 60
-            AND s.vol_ma60 > 1000
-        """
-        results = execute_scan_query(conditions, "s.vol_ma60 DESC", limit, min_vol, min_price, 
-                                       scan_type="institutional")
+        scan = SCAN_DEFINITIONS["institutional"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="institutional", result_key="institutional")
         
         return {
             "success": True,
@@ -836,6 +771,8 @@ async def scan_institutional_value(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -859,30 +796,9 @@ async def scan_six_dim(
         # 6. MTM > 0
         # Score >= 5
         
-        conditions = """
-            AND (
-                (CASE WHEN s.macd > s.signal THEN 1 ELSE 0 END) +
-                (CASE WHEN s.daily_k > s.daily_d THEN 1 ELSE 0 END) +
-                (CASE WHEN s.rsi > 50 THEN 1 ELSE 0 END) +
-                (CASE WHEN s.lwr > -50 THEN 1 ELSE 0 END) +
-                (CASE WHEN s.close > s.bbi THEN 1 ELSE 0 END) +
-                (CASE WHEN s.mtm > 0 THEN 1 ELSE 0 END)
-            ) >= 5
-        """
-        # Order by Score (approximated by sum) then Volume
-        order_by = """
-            (
-                (CASE WHEN s.macd > s.signal THEN 1 ELSE 0 END) +
-                (CASE WHEN s.daily_k > s.daily_d THEN 1 ELSE 0 END) +
-                (CASE WHEN s.rsi > 50 THEN 1 ELSE 0 END) +
-                (CASE WHEN s.lwr > -50 THEN 1 ELSE 0 END) +
-                (CASE WHEN s.close > s.bbi THEN 1 ELSE 0 END) +
-                (CASE WHEN s.mtm > 0 THEN 1 ELSE 0 END)
-            ) DESC, s.volume DESC
-        """
-        
-        results = execute_scan_query(conditions, order_by, limit, min_vol, min_price,
-                                     scan_type="six_dim")
+        scan = SCAN_DEFINITIONS["six_dim"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="six_dim", result_key="six_dim")
         
         return {
             "success": True,
@@ -893,6 +809,8 @@ async def scan_six_dim(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -909,15 +827,16 @@ async def scan_patterns(
     """
     try:
         if type == "morning_star":
-            conditions = "AND s.pattern_morning_star = 1"
+            key = "patterns_morning_star"
             desc = "K線型態 (早晨之星)"
         else:
             # Assuming evening star for 'engulfing' or other type for now, or just evening star
-            conditions = "AND s.pattern_evening_star = 1"
+            key = "patterns_evening_star"
             desc = "K線型態 (黃昏之星)"
+        scan = SCAN_DEFINITIONS[key]
 
-        results = execute_scan_query(conditions, "s.volume DESC", limit, min_vol, min_price,
-                                     scan_type=f"patterns_{type}")
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type=f"patterns_{type}", result_key=key)
         
         return {
             "success": True,
@@ -929,6 +848,8 @@ async def scan_patterns(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -944,10 +865,9 @@ async def scan_pv_divergence(
     """
     try:
         # Use pre-calculated divergence columns
-        conditions = "AND (s.div_3day_bull = 1 OR s.div_3day_bear = 1)"
-        
-        results = execute_scan_query(conditions, "s.rsi DESC", limit, min_vol, min_price,
-                                     scan_type="pv_div")
+        scan = SCAN_DEFINITIONS["pv_div"]
+        results = await run_blocking("scan", execute_scan_query, scan.conditions, scan.order_by, limit, min_vol, min_price,
+                                     scan_type="pv_div", result_key="pv_div")
         
         return {
             "success": True,
@@ -958,5 +878,7 @@ async def scan_pv_divergence(
                 "count": len(results)
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
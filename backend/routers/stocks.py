@@ -13,8 +13,10 @@ from backend.services.db import (
     get_tdcc_total_holders,
     get_stock_indicators,
     get_institutional_data,
+    get_market_breadth,
     get_system_status
 )
+from backend.services.executor import run_blocking
 
 router = APIRouter()
 
@@ -94,7 +96,7 @@ async def list_stocks(
     - 支援分頁與市場篩選
     """
     try:
-        stocks = get_all_stocks()
+        stocks = await run_blocking("stocks", get_all_stocks)
         
         # 市場篩選
         if market:
@@ -113,6 +115,8 @@ async def list_stocks(
                 "offset": offset
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -123,7 +127,7 @@ async def get_stock(code: str):
     取得單一股票詳細資料
     """
     try:
-        stock = get_stock_by_code(code)
+        stock = await run_blocking("stocks", get_stock_by_code, code)
         
         if not stock:
             raise HTTPException(status_code=404, detail=f"股票 {code} 不存在")
@@ -147,7 +151,7 @@ async def get_history(
     取得股票歷史 K 線資料
     """
     try:
-        history = get_stock_history(code, limit)
+        history = await run_blocking("stocks", get_stock_history, code, limit)
         
         if not history:
             raise HTTPException(status_code=404, detail=f"股票 {code} 無歷史資料")
@@ -190,10 +194,10 @@ async def get_shareholding(
         min_level = mapping.get(threshold, 15)
         
         # 取得集保總人數 (不分級)
-        total_holders_history = get_tdcc_total_holders(code)
+        total_holders_history = await run_blocking("stocks", get_tdcc_total_holders, code)
         
         # 取得大戶持股 (依門檻篩選)
-        large_holders_history = get_stock_shareholding_history(code, min_level)
+        large_holders_history = await run_blocking("stocks", get_stock_shareholding_history, code, min_level)
         
         return {
             "success": True,
@@ -204,6 +208,8 @@ async def get_shareholding(
                 "large_holders": large_holders_history   # 大戶持股
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -213,7 +219,7 @@ async def get_indicators(code: str):
     取得股票技術指標
     """
     try:
-        indicators = get_stock_indicators(code)
+        indicators = await run_blocking("stocks", get_stock_indicators, code)
         
         if not indicators:
             raise HTTPException(status_code=404, detail=f"股票 {code} 無指標資料")
@@ -237,12 +243,33 @@ async def get_institutional(
     取得法人買賣超資料 (從 Supabase)
     """
     try:
-        data = get_institutional_data(code, limit)
+        data = await run_blocking("stocks", get_institutional_data, code, limit)
         
         return {
             "success": True,
             "data": data
         }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/market/breadth", response_model=APIResponse)
+async def market_breadth(
+    limit: int = Query(120, ge=1, le=2000, description="回傳交易日數")
+):
+    """
+    取得市場寬度 (漲跌家數、52 週新高/新低、上漲/下跌量、ADL、McClellan)
+    """
+    try:
+        data = await run_blocking("stocks", get_market_breadth, limit)
+        return {
+            "success": True,
+            "data": data
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -253,10 +280,12 @@ async def system_status():
     取得系統狀態
     """
     try:
-        status = get_system_status()
+        status = await run_blocking("stocks", get_system_status)
         return {
             "success": True,
             "data": status
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
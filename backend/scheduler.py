@@ -59,6 +59,8 @@ def start_scheduler():
             logger.info("⏰ 觸發排程: 更新加權指數 (0000)")
             subprocess.run([sys.executable, "backend/fetch_0000.py"], check=True)
             logger.info("✅ 加權指數更新完成")
+            from backend.services.response_cache import invalidate_responses
+            invalidate_responses("fetch_0000")
         except Exception as e:
             logger.error(f"❌ 加權指數更新失敗: {e}")
 
@@ -3,6 +3,8 @@
 整合 SQLite (本地資料) 與 Supabase (雲端資料)
 """
 import sqlite3
+import queue
+import threading
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List, Dict, Any
@@ -36,6 +38,110 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "sb_secret_CorHfc7EGXSgBNO1-Y0RLg_
 # 自動偵測雲端模式: 如果 SQLite 檔案不存在，就是雲端模式
 IS_CLOUD_MODE = not DB_PATH.exists()
 
+# SQLite 讀取連線池設定
+READ_POOL_SIZE = 16                 # 讀取連線上限 (涵蓋 backend/services/executor 各 lane 執行緒)
+READ_CACHE_SIZE_KB = 32000          # 每條連線頁快取 (PRAGMA cache_size 以負值表示 KB)
+READ_MMAP_SIZE = 256 * 1024 * 1024  # 記憶體映射讀取上限 (PRAGMA mmap_size)
+STATEMENT_CACHE_SIZE = 256          # 每條連線的預備語句快取 (sqlite3.connect cached_statements)
+
+
+class ReadConnectionPool:
+    """
+    SQLite 讀取連線池
+    - 連線建立時設定一次 WAL / mmap / cache_size / query_only，之後重複使用 (頁快取與預備語句快取都保留)
+    - 同一執行緒巢狀取用時共用同一條連線 (個股頁的基本資料/歷史/指標不再各開一次)
+    - 最多 max_size 條連線；切換資料庫路徑時以世代號淘汰舊連線
+    """
+
+    def __init__(self, db_path: Path, max_size: int = READ_POOL_SIZE):
+        self.db_path = db_path
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.stats = {"created": 0, "reused": 0, "waits": 0, "discarded": 0}
+
+    def _connect(self, timeout: float) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=timeout, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            pass    # 唯讀檔案系統或其他進程持有鎖時維持原日誌模式
+        conn.execute(f"PRAGMA cache_size=-{READ_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={READ_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA query_only=ON")
+        self.stats["created"] += 1
+        return conn
+
+    def _checkout(self, timeout: float):
+        if not self._slots.acquire(blocking=False):
+            self.stats["waits"] += 1
+            if not self._slots.acquire(timeout=timeout):
+                raise sqlite3.OperationalError(f"讀取連線池已滿 ({self.max_size} 條)，等待逾時")
+        try:
+            while True:
+                try:
+                    generation, conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._generation, self._connect(timeout)
+                if generation == self._generation:
+                    self.stats["reused"] += 1
+                    return generation, conn
+                conn.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, generation: int, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if generation == self._generation:
+                self._idle.put((generation, conn))
+            else:
+                conn.close()
+        except sqlite3.Error:
+            self.stats["discarded"] += 1
+            conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float = 30):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+        generation, conn = self._checkout(timeout)
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(generation, conn)
+
+    def reset(self, db_path: Optional[Path] = None):
+        """淘汰所有閒置連線 (使用中的連線歸還時關閉)"""
+        with self._lock:
+            if db_path is not None:
+                self.db_path = db_path
+            self._generation += 1
+        while True:
+            try:
+                _, conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def info(self) -> Dict[str, Any]:
+        return {"max_size": self.max_size, "idle": self._idle.qsize(), **self.stats}
+
+
 class DBManager:
     """資料庫管理器"""
     
@@ -44,6 +150,9 @@ class DBManager:
         self._supabase = None
         self._supabase_initialized = False
         self.is_cloud_mode = IS_CLOUD_MODE
+        self._read_pool = ReadConnectionPool(self.db_path)
+        self._write_lock = threading.Lock()
+        self._write_conn = None
         
         # 嘗試連線 Supabase (無論是否為雲端模式，只要有設定就連線)
         if SUPABASE_URL and SUPABASE_KEY:
@@ -58,7 +167,10 @@ class DBManager:
         new_path = Path(new_path)
         if not new_path.exists():
             return False
-        self.db_path = new_path
+        with self._write_lock:
+            self._close_writer()
+            self.db_path = new_path
+        self._read_pool.reset(new_path)
         return True
 
     @property
@@ -84,13 +196,39 @@ class DBManager:
     
     @contextmanager
     def get_connection(self, timeout: int = 30):
-        """取得 SQLite 連線"""
-        conn = sqlite3.connect(str(self.db_path), timeout=timeout)
-        conn.row_factory = sqlite3.Row
-        try:
+        """取得 SQLite 讀取連線 (連線池，query_only；寫入請用 get_write_connection)"""
+        with self._read_pool.connection(timeout) as conn:
             yield conn
-        finally:
-            conn.close()
+    
+    @contextmanager
+    def get_write_connection(self, timeout: int = 30):
+        """
+        取得 SQLite 寫入連線 (單一寫入者，管理工作使用)
+        整段持有寫入鎖，正常結束時 commit，例外時 rollback
+        """
+        with self._write_lock:
+            if self._write_conn is None:
+                self._write_conn = sqlite3.connect(str(self.db_path), timeout=timeout, check_same_thread=False,
+                                                   cached_statements=STATEMENT_CACHE_SIZE)
+                self._write_conn.row_factory = sqlite3.Row
+                self._write_conn.execute("PRAGMA journal_mode=WAL")
+                self._write_conn.execute("PRAGMA synchronous=NORMAL")
+            conn = self._write_conn
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    
+    def _close_writer(self):
+        if self._write_conn is not None:
+            self._write_conn.close()
+            self._write_conn = None
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """讀取連線池統計 (建立/重用/等待次數)"""
+        return self._read_pool.info()
     
     def execute_query(self, query: str, params: tuple = ()) -> List[Dict]:
         """執行 SQLite 查詢"""
@@ -101,7 +239,9 @@ class DBManager:
     
     def shutdown(self):
         """關閉資料庫連線"""
-        # SQLite connections are closed in context manager
+        self._read_pool.reset()
+        with self._write_lock:
+            self._close_writer()
         # Supabase client doesn't need explicit close
         print("✓ DBManager shutdown complete")
         self._supabase = None
@@ -114,9 +254,8 @@ class DBManager:
 
     def execute_update(self, query: str, params: tuple = ()) -> None:
         """執行 SQLite 更新/刪除/DDL"""
-        with self.get_connection() as conn:
+        with self.get_write_connection() as conn:
             conn.execute(query, params)
-            conn.commit()
 
 # 全域資料庫管理器實例
 db_manager = DBManager()
@@ -149,9 +288,50 @@ def get_all_stocks() -> List[Dict]:
     """
     return db_manager.execute_query(query)
 
+def _stock_detail_from_snapshot(meta: Dict, snap: Dict) -> Dict:
+    """雲端快照列轉成個股詳細資料 (Supabase 查詢與記憶體快照共用)"""
+    close = snap.get('close') or 0
+    prev = snap.get('close_prev') or 0
+    change_pct = 0.0
+    if prev and prev > 0:
+        change_pct = round((close - prev) / prev * 100, 2)
+        
+    return {
+        'code': meta.get('code'),
+        'name': meta.get('name'),
+        'market': meta.get('market_type'),
+        'close': close,
+        'change_pct': change_pct,
+        'volume': snap.get('volume') or 0,
+        'amount': snap.get('amount') or 0,
+        'ma5': snap.get('ma5'),
+        'ma20': snap.get('ma20'),
+        'ma60': snap.get('ma60'),
+        'ma120': snap.get('ma120'),
+        'ma200': snap.get('ma200'),
+        'rsi': snap.get('rsi'),
+        'mfi': snap.get('mfi14'), # 注意欄位名稱映射
+        'k': snap.get('daily_k'),
+        'd': snap.get('daily_d'),
+        'vp_poc': snap.get('vp_poc'),
+        'vp_high': snap.get('vp_high'),
+        'vp_low': snap.get('vp_low'),
+        'foreign_buy': snap.get('foreign_buy') or 0,
+        'trust_buy': snap.get('trust_buy') or 0,
+        'dealer_buy': snap.get('dealer_buy') or 0
+    }
+
 def get_stock_by_code(code: str) -> Optional[Dict]:
     """取得單一股票資料 (支援本地/雲端)"""
     # Force git update
+    # [優化] 雲端模式: 同步流程發佈的記憶體快照 (免 Supabase 往返)，無快照或無此股時才查詢
+    if db_manager.is_cloud_mode:
+        from backend.services.snapshot_store import snapshot_cache
+        frame = snapshot_cache.get()
+        snap = frame.row(code) if frame is not None else None
+        if snap is not None:
+            return _stock_detail_from_snapshot(snap, snap)
+
     # 1. 雲端模式: 從 Supabase 讀取
     if db_manager.is_cloud_mode and db_manager.supabase:
         try:
@@ -183,39 +363,7 @@ def get_stock_by_code(code: str) -> Optional[Dict]:
                 print(f"⚠️ 雲端讀取 Snapshot 失敗 (Code: {code}): {e}")
                 # 不拋出錯誤，僅記錄，讓基本資料能顯示
             
-            # 計算漲跌幅
-            
-            # 計算漲跌幅
-            close = snap.get('close') or 0
-            prev = snap.get('close_prev') or 0
-            change_pct = 0.0
-            if prev and prev > 0:
-                change_pct = round((close - prev) / prev * 100, 2)
-                
-            return {
-                'code': meta.get('code'),
-                'name': meta.get('name'),
-                'market': meta.get('market_type'),
-                'close': close,
-                'change_pct': change_pct,
-                'volume': snap.get('volume') or 0,
-                'amount': snap.get('amount') or 0,
-                'ma5': snap.get('ma5'),
-                'ma20': snap.get('ma20'),
-                'ma60': snap.get('ma60'),
-                'ma120': snap.get('ma120'),
-                'ma200': snap.get('ma200'),
-                'rsi': snap.get('rsi'),
-                'mfi': snap.get('mfi14'), # 注意欄位名稱映射
-                'k': snap.get('daily_k'),
-                'd': snap.get('daily_d'),
-                'vp_poc': snap.get('vp_poc'),
-                'vp_high': snap.get('vp_high'),
-                'vp_low': snap.get('vp_low'),
-                'foreign_buy': snap.get('foreign_buy') or 0,
-                'trust_buy': snap.get('trust_buy') or 0,
-                'dealer_buy': snap.get('dealer_buy') or 0
-            }
+            return _stock_detail_from_snapshot(meta, snap)
         except Exception as e:
             print(f"⚠️ 雲端讀取股票 {code} 失敗: {e}")
             return None
@@ -276,6 +424,11 @@ def get_stock_history(code: str, limit: int = 60) -> List[Dict]:
         # 雲端模式下沒有 SQLite，返回空資料
         return []
     
+    # [優化] 價格立方體與資料庫一致時直接讀取 memmap (免 SQL 查詢)
+    cube_history = get_stock_history_from_cube(code, limit)
+    if cube_history is not None:
+        return cube_history
+    
     query = """
         SELECT date_int, open, high, low, close, volume, amount,
                foreign_buy, trust_buy, dealer_buy,
@@ -288,44 +441,68 @@ def get_stock_history(code: str, limit: int = 60) -> List[Dict]:
     results = db_manager.execute_query(query, (code, limit))
     return list(reversed(results))
 
-def get_stock_history_from_cloud(code: str, limit: int = 60) -> List[Dict]:
-    """從 Supabase 取得股票歷史"""
+HISTORY_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'amount',
+                  'foreign_buy', 'trust_buy', 'dealer_buy',
+                  'tdcc_count', 'large_shareholder_pct')
+
+def get_stock_history_from_cube(code: str, limit: int = 60) -> Optional[List[Dict]]:
+    """從價格立方體 (core/price_cube) 取得股票歷史；未建立、欄位不足或與資料庫不一致時回傳 None"""
+    try:
+        from core.price_cube import open_price_cube, default_cube_dir
+        cube = open_price_cube(default_cube_dir(db_manager.db_path))
+        if cube is None or not cube.has_fields(HISTORY_FIELDS):
+            return None
+        with db_manager.get_connection() as conn:
+            if not cube.is_fresh(conn):
+                return None
+        return cube.history_records(code, limit, HISTORY_FIELDS)
+    except Exception as e:
+        print(f"⚠️ 價格立方體讀取失敗，改用 SQLite: {e}")
+        return None
+
+def fetch_cloud_history_rows(code: str, limit: Optional[int], before: Optional[int] = None,
+                             since: Optional[int] = None) -> List[Dict]:
+    """
+    查詢 Supabase stock_history (歷史快取的差額查詢)
+    before: 只取 date_int < before 的最近 limit 筆；since: 只取 date_int >= since 的全部列 (含重疊的已快取日)
+    """
     if not db_manager.supabase:
         return []
-    
-    # 查詢 stock_history
-    res = db_manager.supabase.table("stock_history") \
-        .select("*") \
-        .eq("code", code) \
-        .order("date_int", desc=True) \
-        .limit(limit) \
-        .execute()
-    
-    data = res.data
-    if not data:
+    query = db_manager.supabase.table("stock_history").select("*").eq("code", code)
+    if before is not None:
+        query = query.lt("date_int", before)
+    if since is not None:
+        query = query.gte("date_int", since)
+    query = query.order("date_int", desc=True)
+    if limit:
+        query = query.limit(limit)
+    return query.execute().data or []
+
+
+def _history_cache_version() -> str:
+    """歷史快取的資料版本 (雲端模式先讓記憶體快照檢查新版本，同步後即可察覺)"""
+    from backend.services.response_cache import current_data_version
+    if db_manager.is_cloud_mode:
+        from backend.services.snapshot_store import snapshot_cache
+        snapshot_cache.get()
+    return current_data_version()
+
+
+from backend.services.history_cache import HistoryCache
+history_cache = HistoryCache(fetch_cloud_history_rows, _history_cache_version)
+
+if IS_CLOUD_MODE:
+    # 同步後新快照一載入 (個股/掃描請求都會觸發檢查) 就預取熱門股歷史，不等第一個開圖請求
+    from backend.services.snapshot_store import snapshot_cache as _snapshot_cache
+    from backend.services.response_cache import current_data_version as _current_data_version
+    _snapshot_cache.add_listener(lambda _version: history_cache.notify_version(_current_data_version()))
+
+
+def get_stock_history_from_cloud(code: str, limit: int = 60) -> List[Dict]:
+    """從 Supabase 取得股票歷史 ([優化] 經後端範圍快取，只補查差額)"""
+    if not db_manager.supabase:
         return []
-        
-    # 轉換格式以符合前端需求
-    formatted = []
-    for row in data:
-        # Supabase 欄位可能略有不同，確保對應
-        item = {
-            "date_int": row.get("date_int"),
-            "open": row.get("open"),
-            "high": row.get("high"),
-            "low": row.get("low"),
-            "close": row.get("close"),
-            "volume": row.get("volume"),
-            "amount": row.get("amount", 0),
-            "foreign_buy": row.get("foreign_buy", 0),
-            "trust_buy": row.get("trust_buy", 0),
-            "dealer_buy": row.get("dealer_buy", 0),
-            "tdcc_count": row.get("tdcc_count", 0),
-            "large_shareholder_pct": row.get("large_shareholder_pct", 0)
-        }
-        formatted.append(item)
-        
-    return list(reversed(formatted))
+    return history_cache.get(code, limit)
 
 def get_stock_shareholding_history(code: str, min_level: int = 15) -> List[Dict]:
     """獲取股票分級持股歷史 (大戶持股)"""
@@ -386,6 +563,15 @@ def get_institutional_data(code: str, limit: int = 30) -> List[Dict]:
         print(f"Error fetching institutional data: {e}")
         return []
 
+def get_market_breadth(limit: int = 120) -> List[Dict]:
+    """取得市場寬度 (漲跌家數 / 新高新低 / ADL / McClellan，讀取主程式維護的 market_breadth)"""
+    # 雲端模式: 表僅存在於本地 SQLite
+    if db_manager.is_cloud_mode:
+        return []
+    from core.market_breadth import read_market_breadth
+    with db_manager.get_connection() as conn:
+        return read_market_breadth(conn, limit)
+
 def get_system_status() -> Dict:
     """取得系統狀態 (支援雲端模式)"""
     # 雲端模式: 從 Supabase 取得狀態
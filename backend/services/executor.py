@@ -0,0 +1,95 @@
+"""
+台灣股市分析系統 - 阻塞式資料存取執行器
+
+SQLite 與 Supabase 用戶端都是同步呼叫，直接在 async 端點內執行會卡住整個事件迴圈。
+此模組把阻塞呼叫依端點群組分派到各自的執行緒池 (lane)：
+- 每個 lane 有獨立的工作執行緒上限，重量級排行不會佔滿個股查詢的執行緒
+- 同時進行的請求數超過上限時排隊，排隊逾時回 503
+- 執行逾時回 504 (執行緒仍會跑完，名額在完成後才歸還，確保上限成立)
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from fastapi import HTTPException
+
+# (工作執行緒數, 同時請求上限, 排隊逾時秒, 執行逾時秒)
+LANES = {
+    "stocks": (6, 32, 5, 15),       # 個股基本資料/歷史/指標 (單鍵查詢)
+    "scan": (3, 12, 10, 30),        # 掃描 (物化結果或即時 SQL)
+    "rankings": (2, 6, 15, 60),     # 法人排行 (多日彙總較重)
+}
+
+
+class BlockingLane:
+    """單一端點群組的執行緒池與並行名額"""
+
+    def __init__(self, name: str, workers: int, concurrency: int, queue_timeout: float, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{name}")
+        self._slots = None  # 第一次使用時於事件迴圈內建立
+        self.stats = {"calls": 0, "active": 0, "rejected": 0, "timeouts": 0, "errors": 0, "total_ms": 0.0}
+
+    def _release(self, _future):
+        self.stats["active"] -= 1
+        self._slots.release()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail=f"伺服器忙碌中 ({self.name})，請稍後再試")
+
+        self.stats["calls"] += 1
+        self.stats["active"] += 1
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise HTTPException(status_code=504, detail=f"查詢逾時 ({self.name}, {self.timeout} 秒)")
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["total_ms"] += (time.perf_counter() - start) * 1000
+
+    def info(self) -> Dict[str, Any]:
+        calls = self.stats["calls"]
+        return {
+            "workers": self._executor._max_workers,
+            "concurrency": self.concurrency,
+            **{k: v for k, v in self.stats.items() if k != "total_ms"},
+            "avg_ms": round(self.stats["total_ms"] / calls, 3) if calls else None,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_lanes = {name: BlockingLane(name, *spec) for name, spec in LANES.items()}
+
+
+async def run_blocking(lane: str, fn: Callable, *args, **kwargs) -> Any:
+    """在指定 lane 的執行緒池執行同步函數 (SQLite / Supabase 呼叫)"""
+    return await _lanes[lane].run(fn, *args, **kwargs)
+
+
+def executor_stats() -> Dict[str, Any]:
+    return {name: lane.info() for name, lane in _lanes.items()}
+
+
+def shutdown_executors():
+    for lane in _lanes.values():
+        lane.shutdown()
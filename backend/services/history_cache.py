@@ -0,0 +1,259 @@
+"""
+台灣股市分析系統 - 雲端歷史 K 線範圍快取
+
+雲端讀取時每次開圖都對 Supabase 查一次 stock_history 並逐列組 dict。此模組在後端保留每檔股票
+已取得的「最近 N 根」歷史 (欄式 NumPy 陣列)：
+- 快取範圍足夠時直接切片回傳，不查 Supabase
+- 要求更長的視窗時只補查較舊的差額 (date_int < 已快取最舊日)，接在前面
+- 資料版本 (同步後改變) 改變時只補查最近 REFRESH_OVERLAP_BARS 根起的列 (date_int >= 重疊起點)，
+  取代快取中同一段 (法人資料晚到、盤後修正會改寫已快取的最近幾天)
+- 總容量依位元組做 LRU 淘汰；同一檔同時只有一個請求查詢雲端
+- 偵測到新版本時，背景預取最常被查看與最近掃描命中的前 N 檔，熱門股開圖不會等 Supabase
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+MAX_BYTES = 64 * 1024 * 1024    # 快取容量上限
+PREFETCH_TOP_N = 50             # 版本更新後預取的熱門股數
+PREFETCH_DAYS = 250             # 預取時未快取股票的視窗 (約一年)
+SCAN_HIT_WEIGHT = 1             # 每次掃描命中計入的熱度 (個股查看為 1)
+REFRESH_OVERLAP_BARS = 5        # 版本更新時重抓的最近 K 棒數 (涵蓋晚到的法人/修正資料)
+
+FIELDS = ('date_int', 'open', 'high', 'low', 'close', 'volume', 'amount',
+          'foreign_buy', 'trust_buy', 'dealer_buy', 'tdcc_count', 'large_shareholder_pct')
+INT_FIELDS = {'date_int', 'volume', 'amount', 'tdcc_count'}
+DEFAULT_ZERO = {'amount', 'foreign_buy', 'trust_buy', 'dealer_buy', 'tdcc_count', 'large_shareholder_pct'}
+
+
+class HistoryRange:
+    """單檔已快取的最近歷史 (依 date_int 升冪)"""
+
+    __slots__ = ('arrays', 'present', 'complete', 'version', 'loaded_at')
+
+    def __init__(self, arrays, present, complete, version):
+        self.arrays = arrays
+        self.present = present          # 雲端回應實際含有的欄位 (缺欄沿用原本的 0 預設值)
+        self.complete = complete        # 已取得該股全部歷史 (較長視窗不需再補查)
+        self.version = version
+        self.loaded_at = time.time()
+
+    @classmethod
+    def from_rows(cls, rows, complete, version):
+        """rows: Supabase 回應列 (任意順序)"""
+        rows = sorted(rows, key=lambda r: r['date_int'])
+        present = set(rows[0]) & set(FIELDS) if rows else set()
+        arrays = {f: np.array([np.nan if r.get(f) is None else r[f] for r in rows], dtype=np.float64)
+                  for f in FIELDS}
+        return cls(arrays, present, complete, version)
+
+    def __len__(self):
+        return len(self.arrays['date_int'])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+    @property
+    def first_date(self):
+        return int(self.arrays['date_int'][0]) if len(self) else None
+
+    @property
+    def last_date(self):
+        return int(self.arrays['date_int'][-1]) if len(self) else None
+
+    def until(self, date_int: int) -> 'HistoryRange':
+        """只保留 date_int 之前 (不含) 的部分"""
+        end = int(np.searchsorted(self.arrays['date_int'], date_int))
+        return HistoryRange({f: a[:end] for f, a in self.arrays.items()}, self.present, self.complete, self.version)
+
+    def merge(self, other: 'HistoryRange') -> 'HistoryRange':
+        """合併另一段 (依日期去重，新資料優先)"""
+        if not len(other):
+            return self
+        dates = np.concatenate([other.arrays['date_int'], self.arrays['date_int']])
+        _, keep = np.unique(dates, return_index=True)   # 第一次出現 (other) 優先，結果依日期排序
+        arrays = {f: np.concatenate([other.arrays[f], self.arrays[f]])[keep] for f in FIELDS}
+        return HistoryRange(arrays, self.present | other.present, self.complete, self.version)
+
+    def records(self, limit: int) -> List[Dict]:
+        """最近 limit 根 (升冪)，格式與原本的雲端查詢相同"""
+        start = max(len(self) - limit, 0)
+        columns = {f: self.arrays[f][start:].tolist() for f in FIELDS}
+        out = []
+        for i in range(len(self) - start):
+            item = {}
+            for f in FIELDS:
+                v = columns[f][i]
+                if v != v:      # NaN
+                    v = 0 if f in DEFAULT_ZERO and f not in self.present else None
+                elif f in INT_FIELDS:
+                    v = int(v)
+                item[f] = v
+            out.append(item)
+        return out
+
+
+class HistoryCache:
+    """
+    依位元組 LRU 的歷史範圍快取
+    :param fetch: fetch(code, limit, before=None, since=None) -> 雲端列
+                  before: 只取 date_int < before (依日期降冪取 limit 筆)；since: 只取 date_int >= since (全部)
+    :param version_source: 目前資料版本 (同步後改變)
+    """
+
+    def __init__(self, fetch: Callable, version_source: Callable[[], str], max_bytes: int = MAX_BYTES,
+                 prefetch_top_n: int = PREFETCH_TOP_N, prefetch_days: int = PREFETCH_DAYS):
+        self.fetch = fetch
+        self.version_source = version_source
+        self.max_bytes = max_bytes
+        self.prefetch_top_n = prefetch_top_n
+        self.prefetch_days = prefetch_days
+        self._entries: 'OrderedDict[str, HistoryRange]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._code_locks: Dict[str, threading.Lock] = {}
+        self._popularity = Counter()
+        self._seen_version = None
+        self._prefetching = False
+        self.stats = {"hits": 0, "misses": 0, "extends": 0, "refreshes": 0, "evicted": 0,
+                      "fetches": 0, "prefetched": 0}
+
+    # ----------------------------------------
+    # LRU
+    # ----------------------------------------
+    def _code_lock(self, code):
+        with self._lock:
+            return self._code_locks.setdefault(code, threading.Lock())
+
+    def _peek(self, code) -> Optional[HistoryRange]:
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None:
+                self._entries.move_to_end(code)
+            return entry
+
+    def _store(self, code, entry: HistoryRange):
+        with self._lock:
+            old = self._entries.pop(code, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[code] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.stats["evicted"] += 1
+
+    def _fetch(self, code, limit, before=None, since=None):
+        self.stats["fetches"] += 1
+        return self.fetch(code, limit, before=before, since=since)
+
+    # ----------------------------------------
+    # 查詢
+    # ----------------------------------------
+    def _load(self, code: str, limit: int, version: str) -> HistoryRange:
+        """取得至少涵蓋 limit 根的範圍 (必要時補查較新/較舊的差額)"""
+        entry = self._peek(code)
+        if entry is None:
+            self.stats["misses"] += 1
+            rows = self._fetch(code, limit)
+            entry = HistoryRange.from_rows(rows, len(rows) < limit, version)
+            self._store(code, entry)
+            return entry
+
+        changed = False
+        if entry.version != version:
+            # 同步後: 從最近 REFRESH_OVERLAP_BARS 根起重抓，取代快取中同一段 (含被改寫或刪除的列)
+            self.stats["refreshes"] += 1
+            if entry.last_date is None:
+                rows = self._fetch(code, limit)
+                entry = entry.merge(HistoryRange.from_rows(rows, False, version))
+            else:
+                since = int(entry.arrays['date_int'][max(len(entry) - REFRESH_OVERLAP_BARS, 0)])
+                rows = self._fetch(code, None, since=since)
+                entry = entry.until(since).merge(HistoryRange.from_rows(rows, False, version))
+            entry.version = version
+            changed = True
+        if len(entry) < limit and not entry.complete:
+            # 更長的視窗: 只補查最舊日之前的差額
+            self.stats["extends"] += 1
+            need = limit - len(entry)
+            older_rows = self._fetch(code, need, before=entry.first_date)
+            complete = len(older_rows) < need
+            entry = entry.merge(HistoryRange.from_rows(older_rows, complete, version))
+            entry.complete = complete
+            changed = True
+        if changed:
+            self._store(code, entry)
+        else:
+            self.stats["hits"] += 1
+        return entry
+
+    def get(self, code: str, limit: int) -> List[Dict]:
+        """最近 limit 根歷史 (升冪)"""
+        version = self.version_source()
+        self._popularity[code] += 1
+        self.notify_version(version)
+        with self._code_lock(code):
+            entry = self._load(code, limit, version)
+        return entry.records(limit)
+
+    # ----------------------------------------
+    # 預取
+    # ----------------------------------------
+    def note_scan_hits(self, codes: Iterable[str]):
+        """掃描結果中的股票計入熱度 (下次版本更新時優先預取)"""
+        for code in codes:
+            if code:
+                self._popularity[code] += SCAN_HIT_WEIGHT
+
+    def popular_codes(self, n: Optional[int] = None) -> List[str]:
+        return [code for code, _ in self._popularity.most_common(n or self.prefetch_top_n)]
+
+    def prefetch(self, codes: Iterable[str], version: Optional[str] = None):
+        """把指定股票的快取推進到目前版本 (未快取者取 prefetch_days 根)"""
+        version = version or self.version_source()
+        for code in codes:
+            try:
+                with self._code_lock(code):
+                    entry = self._peek(code)
+                    if entry is not None and entry.version == version:
+                        continue
+                    self._load(code, len(entry) if entry is not None else self.prefetch_days, version)
+                self.stats["prefetched"] += 1
+            except Exception as e:
+                print(f"⚠️ 歷史預取失敗 ({code}): {e}")
+
+    def notify_version(self, version):
+        """第一次看到新版本 (同步完成) 時於背景預取熱門股；啟動後的第一個版本只記錄，不預取"""
+        with self._lock:
+            if version == self._seen_version:
+                return
+            first = self._seen_version is None
+            self._seen_version = version
+            if first or self._prefetching:
+                return
+            self._prefetching = True
+        codes = self.popular_codes()
+
+        def run():
+            try:
+                self.prefetch(codes, version)
+            finally:
+                self._prefetching = False
+
+        threading.Thread(target=run, name="history-prefetch", daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "top": self.popular_codes(10), **self.stats}
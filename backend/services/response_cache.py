@@ -0,0 +1,229 @@
+"""
+台灣股市分析系統 - API 回應快取 (TTL + ETag + 資料版本)
+
+掃描、排行、個股端點每次請求都重新連線 SQLite (雲端模式還要往返 Supabase)，
+但資料一天只在排程更新時變動。此模組以 HTTP middleware 快取 GET 回應：
+- 快取鍵: 路徑 + 排序後的查詢參數
+- 失效條件: 超過 TTL，或資料版本戳記 (core.data_version) 被更新/同步流程改寫
+- ETag: 回應內容雜湊，請求帶 If-None-Match 且相符時回 304 (前端/行動 App 不必重新下載)
+- 同一鍵同時多個未命中只計算一次 (其餘等待第一個結果)
+- 命中率與延遲分佈由 /api/admin/cache 提供
+"""
+import asyncio
+import bisect
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# ========================================
+# 快取規則
+# ========================================
+
+# (路徑前綴, TTL 秒)；資料版本改變時不論 TTL 立即失效
+CACHE_RULES = (
+    ("/api/scan/", 600),
+    ("/api/rankings/institutional", 600),
+    ("/api/stocks", 600),
+    ("/api/market/", 600),
+)
+MAX_ENTRIES = 1024                          # LRU 上限
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+CACHED_HEADERS = ("content-type",)          # 隨快取保存的原回應標頭
+OUTCOMES = ("hit", "not_modified", "miss", "bypass")
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 可為 * 或逗號分隔的多個 ETag (忽略弱比對前綴 W/)"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class _Entry:
+    __slots__ = ("body", "headers", "etag", "version", "expires")
+
+    def __init__(self, body, headers, etag, version, expires):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.version = version
+        self.expires = expires
+
+
+class ResponseCache:
+    """
+    行程內回應快取
+    version_source: 回傳目前資料版本字串的函數 (每次查詢快取時呼叫，須為輕量操作)
+    """
+
+    def __init__(self, version_source: Callable[[], str], rules=CACHE_RULES, max_entries: int = MAX_ENTRIES):
+        self.version_source = version_source
+        self.rules = tuple(rules)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._reset_metrics()
+
+    # ----------------------------------------
+    # 統計
+    # ----------------------------------------
+    def _reset_metrics(self):
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.invalidations = {"version": 0, "ttl": 0, "evicted": 0}
+        self.latency = {o: [0] * (len(LATENCY_BUCKETS_MS) + 1) for o in OUTCOMES}
+        self.latency_sum = dict.fromkeys(OUTCOMES, 0.0)
+
+    def _record(self, outcome: str, start: float):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.counts[outcome] += 1
+        self.latency[outcome][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.latency_sum[outcome] += elapsed_ms
+
+    def stats(self) -> dict:
+        """命中率與延遲分佈 (桶為毫秒上限，最後一桶為超過最大值)"""
+        served = self.counts["hit"] + self.counts["not_modified"]
+        lookups = served + self.counts["miss"]
+        labels = [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "data_version": self.version_source(),
+            "hit_rate": round(served / lookups, 4) if lookups else None,
+            "counts": dict(self.counts),
+            "invalidations": dict(self.invalidations),
+            "latency_ms": {
+                o: {
+                    "count": self.counts[o],
+                    "avg": round(self.latency_sum[o] / self.counts[o], 3) if self.counts[o] else None,
+                    "histogram": dict(zip(labels, self.latency[o])),
+                }
+                for o in OUTCOMES
+            },
+        }
+
+    def clear(self, reset_metrics: bool = False):
+        self._entries.clear()
+        if reset_metrics:
+            self._reset_metrics()
+
+    # ----------------------------------------
+    # 快取查詢
+    # ----------------------------------------
+    def ttl_for(self, path: str) -> Optional[int]:
+        for prefix, ttl in self.rules:
+            if path.startswith(prefix):
+                return ttl
+        return None
+
+    def _lookup(self, key, version: str, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version:
+            self.invalidations["version"] += 1
+        elif entry.expires <= now:
+            self.invalidations["ttl"] += 1
+        else:
+            self._entries.move_to_end(key)
+            return entry
+        del self._entries[key]
+        return None
+
+    def _store(self, key, entry: _Entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.invalidations["evicted"] += 1
+
+    @staticmethod
+    def _respond(entry: _Entry, if_none_match: Optional[str], cache_status: str) -> Response:
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache", "X-Cache": cache_status}
+        if _etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, headers={**entry.headers, **headers})
+
+    async def middleware(self, request: Request, call_next):
+        """FastAPI http middleware: app.middleware("http")(cache.middleware)"""
+        ttl = self.ttl_for(request.url.path) if request.method == "GET" else None
+        if ttl is None:
+            return await call_next(request)
+
+        start = time.perf_counter()
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+        if_none_match = request.headers.get("if-none-match")
+        version = self.version_source()
+
+        entry = self._lookup(key, version, time.monotonic())
+        if entry is None:
+            # 同一鍵已有請求在計算時等待其結果
+            pending = self._inflight.get(key)
+            if pending is not None:
+                await pending.wait()
+                entry = self._lookup(key, version, time.monotonic())
+        if entry is not None:
+            response = self._respond(entry, if_none_match, "HIT")
+            self._record("not_modified" if response.status_code == 304 else "hit", start)
+            return response
+
+        done = self._inflight[key] = asyncio.Event()
+        try:
+            response = await call_next(request)
+            if response.status_code != 200:
+                self._record("bypass", start)
+                return response
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            headers = {k: v for k, v in response.headers.items() if k in CACHED_HEADERS}
+            entry = _Entry(body, headers, _etag(body), version, time.monotonic() + ttl)
+            self._store(key, entry)
+        finally:
+            self._inflight.pop(key, None)
+            done.set()
+
+        response = self._respond(entry, if_none_match, "MISS")
+        self._record("miss", start)
+        return response
+
+
+# ========================================
+# 後端全域快取 (資料版本戳記位於資料庫旁)
+# ========================================
+
+def _version_path():
+    from core.data_version import default_version_path
+    from backend.services.db import db_manager
+    return default_version_path(db_manager.db_path)
+
+
+def current_data_version() -> str:
+    from core.data_version import read_data_version
+    from backend.services.db import db_manager
+    version = read_data_version(_version_path())
+    if db_manager.is_cloud_mode:
+        # 雲端模式沒有本地戳記更新，改以已載入的記憶體快照版本判斷
+        from backend.services.snapshot_store import snapshot_cache
+        version = f"{version}:{snapshot_cache.version}"
+    return version
+
+
+def invalidate_responses(source: str = "") -> str:
+    """資料已更新: 改寫版本戳記 (其他進程的快取同步失效) 並清空本行程快取"""
+    from core.data_version import bump_data_version
+    version = bump_data_version(_version_path(), source)
+    response_cache.clear()
+    return version
+
+
+response_cache = ResponseCache(current_data_version)
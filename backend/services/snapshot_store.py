@@ -0,0 +1,101 @@
+"""
+台灣股市分析系統 - 雲端模式記憶體快照
+
+雲端模式 (無 SQLite) 下，個股與掃描端點改由同步流程發佈的欄式快照回答 (core/snapshot_export)：
+- 每 CHECK_INTERVAL 秒最多讀一次 manifest，版本改變才下載並載入新快照 (整份換掉，讀取端無鎖)
+- 尚未發佈快照或下載失敗時回傳 None，呼叫端照舊查詢 Supabase；歷史 K 線仍走 Supabase
+- SNAPSHOT_STORE_DIR 環境變數可指定本機目錄 (離線測試或與同步流程共用磁碟)
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from core.snapshot_export import LocalFileStore, SupabaseStorageStore, fetch_snapshot
+
+CHECK_INTERVAL = 60             # manifest 檢查間隔 (秒)
+SNAPSHOT_BUCKET = os.environ.get("SNAPSHOT_BUCKET", "snapshots")
+
+
+class SnapshotCache:
+    """依 manifest 版本載入一次的記憶體快照"""
+
+    def __init__(self, store_factory, check_interval: float = CHECK_INTERVAL):
+        self._store_factory = store_factory
+        self._store = None
+        self.check_interval = check_interval
+        self._frame = None
+        self._manifest = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "checks": 0, "errors": 0, "last_error": None}
+        self._listeners = []
+
+    def _refresh(self):
+        self.stats["checks"] += 1
+        try:
+            if self._store is None:
+                self._store = self._store_factory()
+            known = self._frame.version if self._frame is not None else None
+            manifest, frame = fetch_snapshot(self._store, known)
+        except Exception as e:
+            self.stats["errors"] += 1
+            self.stats["last_error"] = str(e)
+            return
+        if frame is not None:
+            self._frame, self._manifest = frame, manifest
+            self.stats["loads"] += 1
+            for listener in self._listeners:
+                try:
+                    listener(frame.version)
+                except Exception as e:
+                    self.stats["last_error"] = str(e)
+        elif manifest is None:
+            self._frame = self._manifest = None
+
+    def get(self):
+        """目前的 SnapshotFrame (無快照時為 None)；到期時於呼叫端執行緒檢查新版本"""
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and self._lock.acquire(blocking=False):
+            try:
+                if now - self._checked_at >= self.check_interval:
+                    self._refresh()
+                    self._checked_at = time.monotonic()
+            finally:
+                self._lock.release()
+        return self._frame
+
+    @property
+    def version(self) -> Optional[str]:
+        """已載入的快照版本 (不觸發檢查)"""
+        frame = self._frame
+        return frame.version if frame is not None else None
+
+    def add_listener(self, fn):
+        """載入新版本後呼叫 fn(version) (例如歷史快取預取熱門股)"""
+        self._listeners.append(fn)
+
+    def invalidate(self):
+        """下次 get() 立即重新檢查 manifest"""
+        self._checked_at = 0.0
+
+    def info(self) -> Dict[str, Any]:
+        manifest = self._manifest or {}
+        return {
+            "version": self.version,
+            "rows": manifest.get("rows"),
+            "bytes": manifest.get("bytes"),
+            "data_date": manifest.get("data_date"),
+            **self.stats,
+        }
+
+
+def _default_store():
+    local_dir = os.environ.get("SNAPSHOT_STORE_DIR")
+    if local_dir:
+        return LocalFileStore(local_dir)
+    from backend.services.db import SUPABASE_URL, SUPABASE_KEY
+    return SupabaseStorageStore(SUPABASE_URL, SUPABASE_KEY, SNAPSHOT_BUCKET)
+
+
+snapshot_cache = SnapshotCache(_default_store)
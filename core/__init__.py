@@ -4,7 +4,6 @@
 """
 
 from .config import Config
-from .database import DatabaseManager, db_manager, DB_FILE
 from .models import StockPrice, InstitutionalData, MarginData, StockMeta
 
 __all__ = [
@@ -21,3 +20,16 @@ __all__ = [
     'StockMeta',
 ]
 
+_LAZY_DATABASE_ATTRS = ('DatabaseManager', 'db_manager', 'DB_FILE')
+
+
+def __getattr__(name):
+    """
+    [優化] 延遲載入資料庫單例
+    匯入 core 子模組 (例如指標引擎) 時不再順帶建立連線池與清除 WAL 檔，
+    只有真正存取 core.db_manager 時才初始化。
+    """
+    if name in _LAZY_DATABASE_ATTRS:
+        from . import database
+        return getattr(database, name)
+    raise AttributeError(f"module 'core' has no attribute '{name}'")
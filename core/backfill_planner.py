@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 依日期回補規劃 (backfill_planner)
+
+原本的回補 (step6_verify_and_backfill) 一次一檔向 FinMind / twstock 下載整段歷史；
+一週的全市場停機需要上千次請求。交易所另有「某一天全市場」的行情檔 (TWSE MI_INDEX、
+TPEx 每日收盤行情)，一次請求涵蓋該市場所有股票。此模組依缺漏位元索引 (core/gap_index)：
+- 同一天缺漏的股票數足以抵過該日的請求數 (上市 + 上櫃各一次) 時，整天用全市場檔回補
+- 其餘零星缺漏留給逐檔來源 (FinMind 一次請求涵蓋一檔的整段期間)
+- 日期工作以少量執行緒並行下載 (各主機限速由 core/http_client 的令牌桶負責)；寫入在呼叫端執行緒依序進行
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from core.gap_index import GapIndex, TradingCalendar, date_of, iter_bits
+
+REQUESTS_PER_DATE = 2           # 一天的全市場檔 = TWSE + TPEx 各一次
+MAX_DATE_JOBS = 120             # 單次最多依日期回補的天數 (取最近的)
+DATE_WORKERS = 3                # 並行下載的日期數
+
+GAP_DATASETS = ('stock_history', 'amount_missing')
+
+
+@dataclass
+class BackfillPlan:
+    """回補計畫：依日期的全市場工作與逐檔工作"""
+    by_date: Dict[int, List[str]] = field(default_factory=dict)     # {日期: [需要的代號]}
+    per_stock: Dict[str, List[int]] = field(default_factory=dict)   # {代號: [缺漏日期]}
+
+    @property
+    def requests(self) -> int:
+        """預估請求數"""
+        return len(self.by_date) * REQUESTS_PER_DATE + len(self.per_stock)
+
+    @property
+    def naive_requests(self) -> int:
+        """全部逐檔回補時的請求數"""
+        return len({code for codes in self.by_date.values() for code in codes} | set(self.per_stock))
+
+
+def plan_backfill(gaps: GapIndex, calendar: TradingCalendar, datasets: Iterable[str] = GAP_DATASETS,
+                  requests_per_date: int = REQUESTS_PER_DATE, max_dates: int = MAX_DATE_JOBS) -> BackfillPlan:
+    """
+    依缺漏矩陣選擇回補方式
+    :param datasets: 以哪些資料集的缺漏為準 (預設: 缺日行情與有量無額)
+    """
+    missing: Dict[str, int] = {}
+    for dataset in datasets:
+        if dataset in gaps.bitmaps:
+            for code, bits in gaps.missing(dataset, calendar).items():
+                missing[code] = missing.get(code, 0) | bits
+
+    by_date: Dict[int, List[str]] = {}
+    for code, bits in missing.items():
+        for n in iter_bits(bits):
+            by_date.setdefault(n, []).append(code)
+
+    # 缺漏股數 >= 該日請求數的日期改用全市場檔 (最近的優先)
+    date_jobs = sorted((n for n, codes in by_date.items() if len(codes) >= requests_per_date), reverse=True)
+    date_jobs = set(date_jobs[:max_dates])
+
+    plan = BackfillPlan()
+    for n in sorted(date_jobs):
+        plan.by_date[date_of(n)] = sorted(by_date[n])
+    for code, bits in sorted(missing.items()):
+        rest = [date_of(n) for n in iter_bits(bits) if n not in date_jobs]
+        if rest:
+            plan.per_stock[code] = rest
+    return plan
+
+
+def run_date_jobs(by_date: Dict[int, List[str]], fetch_day: Callable[[int], Optional[list]],
+                  apply_day: Callable[[int, list, List[str]], int], workers: int = DATE_WORKERS,
+                  progress: Optional[Callable[[int, int, int, int], None]] = None) -> Dict[str, object]:
+    """
+    並行下載各日期的全市場檔，並在呼叫端執行緒依完成順序寫入
+    :param fetch_day: fetch_day(date_int) -> 全市場列 (失敗或休市時 None/空)
+    :param apply_day: apply_day(date_int, rows, codes) -> 寫入筆數
+    :param progress: progress(已完成天數, 總天數, 日期, 寫入筆數)
+    :return: {'written': 筆數, 'done': [日期], 'failed': [日期]}
+    """
+    result = {'written': 0, 'done': [], 'failed': []}
+    if not by_date:
+        return result
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='backfill-date') as pool:
+        futures = {pool.submit(fetch_day, d): d for d in sorted(by_date, reverse=True)}
+        for i, future in enumerate(as_completed(futures), 1):
+            d = futures[future]
+            written = 0
+            try:
+                rows = future.result()
+                if rows:
+                    written = apply_day(d, rows, by_date[d]) or 0
+                    result['done'].append(d)
+                else:
+                    result['failed'].append(d)
+            except Exception:
+                result['failed'].append(d)
+            result['written'] += written
+            if progress:
+                progress(i, len(futures), d, written)
+    result['done'].sort()
+    result['failed'].sort()
+    return result
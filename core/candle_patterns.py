@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 全市場向量化 K 線型態引擎 (candle_patterns)
+
+原本 scan_candlestick_patterns 逐檔取出最後 3 根 K 棒拆成純量再呼叫 _check_morning_star /
+_check_evening_star，IndicatorCalculator.calculate_pattern_morning_star / evening_star 又以
+pandas shift 各寫一次同樣的條件。此模組把型態定義成登記表：
+- 每個型態由數個「步驟」組成，步驟是對 (股票 x 最近 K 根) 矩陣的布林 NumPy 運算式
+- evaluate() 一次算出全市場每個型態在最後一根的結果，並逐步累積 AND 得到漏斗計數
+- 同一份定義也能沿整段時間軸計算 (pattern_series)，供 IndicatorCalculator 使用
+- stock_snapshot 的 pattern_morning_star / pattern_evening_star 與 CLI 掃描共用此引擎
+確認條件 (confirm，如晨星的爆量) 只在掃描時套用；快照旗標與原 IndicatorCalculator 相同不含確認。
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+class Candles:
+    """
+    K 棒欄位存取 (各欄為 (S, T) 陣列，每檔以自身交易日靠右對齊，無資料為 NaN)
+    c(k) 為 k 根前的收盤 (沿時間軸平移，形狀不變)，其餘欄位同理
+    """
+
+    def __init__(self, open, high, low, close, volume):
+        self.fields = {'open': open, 'high': high, 'low': low, 'close': close, 'volume': volume}
+        self._shifted = {}
+
+    @property
+    def shape(self):
+        return self.fields['close'].shape
+
+    def _get(self, name, k):
+        if k == 0:
+            return self.fields[name]
+        key = (name, k)
+        out = self._shifted.get(key)
+        if out is None:
+            x = self.fields[name]
+            out = np.full(x.shape, np.nan)
+            if k < x.shape[-1]:
+                out[..., k:] = x[..., :-k]
+            self._shifted[key] = out
+        return out
+
+    def o(self, k=0):
+        return self._get('open', k)
+
+    def h(self, k=0):
+        return self._get('high', k)
+
+    def l(self, k=0):
+        return self._get('low', k)
+
+    def c(self, k=0):
+        return self._get('close', k)
+
+    def v(self, k=0):
+        return self._get('volume', k)
+
+    def body(self, k=0):
+        return np.abs(self.c(k) - self.o(k))
+
+    def range(self, k=0):
+        return self.h(k) - self.l(k)
+
+    def mid(self, k=0):
+        """實體中點"""
+        return (self.o(k) + self.c(k)) / 2
+
+    def upper(self, k=0):
+        """上影線"""
+        return self.h(k) - np.maximum(self.o(k), self.c(k))
+
+    def lower(self, k=0):
+        """下影線"""
+        return np.minimum(self.o(k), self.c(k)) - self.l(k)
+
+
+Step = Tuple[str, Callable[[Candles], np.ndarray]]
+
+
+@dataclass(frozen=True)
+class CandlePattern:
+    """型態定義"""
+    name: str
+    label: str
+    direction: str                  # 'bull' / 'bear'
+    bars: int                       # 需要的 K 棒數
+    steps: Tuple[Step, ...]
+    confirm: Tuple[Step, ...] = ()  # 掃描時的確認條件
+
+
+@dataclass
+class PatternResult:
+    """單一型態的評估結果"""
+    pattern: CandlePattern
+    hits: np.ndarray                    # (S,) 最後一根是否成立；last_only=False 時為 (S, T)
+    funnel: List[Tuple[str, int]]       # [(步驟說明, 通過檔數)]
+
+
+PATTERNS: Dict[str, CandlePattern] = {}
+
+
+def register(pattern: CandlePattern) -> CandlePattern:
+    PATTERNS[pattern.name] = pattern
+    return pattern
+
+
+# ==============================
+# 型態登記表
+# ==============================
+register(CandlePattern('morning_star', '早晨之星', 'bull', 3, (
+    ("T-2: 長黑 K (實體 > 0.6 * 總長)", lambda k: (k.c(2) < k.o(2)) & (k.body(2) > k.range(2) * 0.6)),
+    ("T-1: 星線 (實體 < 0.3 * T-2實體)", lambda k: (k.body(1) < k.body(2) * 0.3) & (k.c(1) < k.c(2))),
+    ("T: 長紅 K (收盤 > T-2實體中點)",
+     lambda k: (k.c() > k.o()) & (k.c() > k.mid(2)) & (k.body() > k.range() * 0.6)),
+), confirm=(
+    ("T: 爆量 (> 1.3 倍 T-1)", lambda k: k.v() > k.v(1) * 1.3),
+)))
+
+register(CandlePattern('evening_star', '黃昏之星', 'bear', 3, (
+    ("T-2: 長紅 K (實體 > 0.6 * 總長)", lambda k: (k.c(2) > k.o(2)) & (k.body(2) > k.range(2) * 0.6)),
+    ("T-1: 星線 (實體 < 0.3 * T-2實體)", lambda k: (k.body(1) < k.body(2) * 0.3) & (k.c(1) > k.c(2))),
+    ("T: 長黑 K (收盤 < T-2實體中點)",
+     lambda k: (k.c() < k.o()) & (k.c() < k.mid(2)) & (k.body() > k.range() * 0.6)),
+)))
+
+register(CandlePattern('bullish_engulfing', '多頭吞噬', 'bull', 2, (
+    ("T-1: 黑 K", lambda k: k.c(1) < k.o(1)),
+    ("T: 紅 K 實體包覆 T-1 實體",
+     lambda k: (k.c() > k.o()) & (k.o() <= k.c(1)) & (k.c() >= k.o(1)) & (k.body() > k.body(1))),
+)))
+
+register(CandlePattern('bearish_engulfing', '空頭吞噬', 'bear', 2, (
+    ("T-1: 紅 K", lambda k: k.c(1) > k.o(1)),
+    ("T: 黑 K 實體包覆 T-1 實體",
+     lambda k: (k.c() < k.o()) & (k.o() >= k.c(1)) & (k.c() <= k.o(1)) & (k.body() > k.body(1))),
+)))
+
+register(CandlePattern('hammer', '錘子線', 'bull', 4, (
+    ("前段下跌 (T-1 收盤 < T-3 收盤)", lambda k: k.c(1) < k.c(3)),
+    ("T: 下影線 >= 2 倍實體", lambda k: (k.body() > 0) & (k.lower() >= k.body() * 2)),
+    ("T: 上影線 <= 0.5 倍實體", lambda k: k.upper() <= k.body() * 0.5),
+)))
+
+register(CandlePattern('shooting_star', '流星線', 'bear', 4, (
+    ("前段上漲 (T-1 收盤 > T-3 收盤)", lambda k: k.c(1) > k.c(3)),
+    ("T: 上影線 >= 2 倍實體", lambda k: (k.body() > 0) & (k.upper() >= k.body() * 2)),
+    ("T: 下影線 <= 0.5 倍實體", lambda k: k.lower() <= k.body() * 0.5),
+)))
+
+register(CandlePattern('three_white_soldiers', '紅三兵', 'bull', 3, (
+    ("連續三根紅 K", lambda k: (k.c() > k.o()) & (k.c(1) > k.o(1)) & (k.c(2) > k.o(2))),
+    ("收盤逐日走高", lambda k: (k.c() > k.c(1)) & (k.c(1) > k.c(2))),
+    ("開盤位於前一根實體內",
+     lambda k: (k.o() > k.o(1)) & (k.o() <= k.c(1)) & (k.o(1) > k.o(2)) & (k.o(1) <= k.c(2))),
+    ("實體 > 0.5 * 總長", lambda k: (k.body() > k.range() * 0.5) & (k.body(1) > k.range(1) * 0.5)
+                                    & (k.body(2) > k.range(2) * 0.5)),
+)))
+
+register(CandlePattern('three_black_crows', '黑三兵', 'bear', 3, (
+    ("連續三根黑 K", lambda k: (k.c() < k.o()) & (k.c(1) < k.o(1)) & (k.c(2) < k.o(2))),
+    ("收盤逐日走低", lambda k: (k.c() < k.c(1)) & (k.c(1) < k.c(2))),
+    ("開盤位於前一根實體內",
+     lambda k: (k.o() < k.o(1)) & (k.o() >= k.c(1)) & (k.o(1) < k.o(2)) & (k.o(1) >= k.c(2))),
+    ("實體 > 0.5 * 總長", lambda k: (k.body() > k.range() * 0.5) & (k.body(1) > k.range(1) * 0.5)
+                                    & (k.body(2) > k.range(2) * 0.5)),
+)))
+
+# 全部型態所需的最多 K 棒數 (載入最近幾根即可)
+MAX_BARS = max(p.bars for p in PATTERNS.values())
+
+
+# ==============================
+# 評估
+# ==============================
+def evaluate(candles: Candles, names: Optional[Iterable[str]] = None, mask: Optional[np.ndarray] = None,
+             confirm: bool = False, last_only: bool = True) -> Dict[str, PatternResult]:
+    """
+    一次評估多個型態
+    :param mask: 前置篩選 (如成交量門檻)，形狀 (S,)；last_only=False 時可為 (S, T)
+    :param confirm: 是否套用確認條件
+    :param last_only: True 只看最後一根並計算漏斗；False 回傳整段時間軸
+    """
+    results = {}
+    for name in (names or PATTERNS):
+        pattern = PATTERNS[name]
+        passed = np.ones(candles.shape, dtype=bool)
+        if last_only:
+            passed = passed[:, -1]
+        if mask is not None:
+            passed = passed & mask
+        funnel = []
+        for label, rule in pattern.steps + (pattern.confirm if confirm else ()):
+            cond = np.asarray(rule(candles), dtype=bool)
+            passed = passed & (cond[:, -1] if last_only else cond)
+            funnel.append((label, int(passed.sum())))
+        results[name] = PatternResult(pattern, passed, funnel)
+    return results
+
+
+def recent_candles(history: Dict[str, dict], codes: List[str], bars: int = MAX_BARS) -> Candles:
+    """
+    {code: {'open': 陣列, ...}} (batch_load_history_arrays 格式) -> 最近 bars 根的 Candles
+    列順序與 codes 一致，不足 bars 根者左側補 NaN
+    """
+    arrays = {name: np.full((len(codes), bars), np.nan) for name in FIELDS}
+    for i, code in enumerate(codes):
+        data = history.get(code)
+        if not data:
+            continue
+        n = min(bars, len(data['close']))
+        if n == 0:
+            continue
+        for name in FIELDS:
+            arrays[name][i, bars - n:] = data[name][-n:]
+    return Candles(**arrays)
+
+
+def pattern_series(df, name: str):
+    """單檔 DataFrame 沿整段時間軸計算型態 (回傳 bool Series，與原 IndicatorCalculator 相同)"""
+    import pandas as pd
+    candles = Candles(*(np.asarray(df[f], dtype=np.float64)[np.newaxis, :] for f in FIELDS))
+    hits = evaluate(candles, [name], last_only=False)[name].hits[0]
+    return pd.Series(hits, index=df.index)
+
+
+def snapshot_flags(history: Dict[str, dict], codes: List[str],
+                   names=('morning_star', 'evening_star')) -> List[tuple]:
+    """stock_snapshot 型態旗標: [(旗標..., code)]，供 executemany UPDATE"""
+    results = evaluate(recent_candles(history, codes), names)
+    columns = [results[name].hits.astype(int).tolist() for name in names]
+    return [tuple(col[i] for col in columns) + (code,) for i, code in enumerate(codes)]
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 雲端同步變更追蹤 (change_tracking)
+
+step8_sync_supabase 原本每次排程都對 stock_history 等表 SELECT * 全表上傳，
+每日實際異動的只有最新交易日的數千筆。此模組以 SQLite 觸發器記錄異動：
+- sync_changes: 每次 INSERT / UPDATE 以主鍵寫入一筆 (INSERT OR REPLACE 取得新的遞增 seq，
+  同一列多次異動只保留最後一次)
+- sync_watermarks: 每張表已成功上傳的最大 seq；每批上傳成功後才推進，
+  失敗時停在該批之前，下次同步從浮水印續傳
+- 首次同步 (尚無浮水印) 依 rowid 全表上傳一次，進度同樣寫入浮水印，中斷可續傳；
+  開始前先記下當時的 seq，全表上傳期間的異動不會遺漏
+不追蹤 DELETE (與原本全表同步相同，雲端不刪除資料)。
+"""
+import time
+
+CHANGES_TABLE = 'sync_changes'
+WATERMARK_TABLE = 'sync_watermarks'
+
+SCHEMA = (
+    f"""CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        k1 NOT NULL,
+        k2 NOT NULL DEFAULT 0
+    )""",
+    f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{CHANGES_TABLE}_key ON {CHANGES_TABLE}(table_name, k1, k2)",
+    f"CREATE INDEX IF NOT EXISTS idx_{CHANGES_TABLE}_seq ON {CHANGES_TABLE}(table_name, seq)",
+    f"""CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        last_seq INTEGER,
+        seed_seq INTEGER,
+        seed_rowid INTEGER DEFAULT 0,
+        updated_at TEXT
+    )""",
+)
+
+
+class SyncBatchError(Exception):
+    """上傳批次失敗 (浮水印停在失敗批次之前)"""
+
+    def __init__(self, table, synced, cause):
+        super().__init__(f"{table}: {cause}")
+        self.table = table
+        self.synced = synced
+        self.cause = cause
+
+
+def primary_key_columns(conn, table):
+    """依宣告順序回傳主鍵欄位 (最多 2 欄)"""
+    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    pk = [r[1] for r in sorted(rows, key=lambda r: r[5]) if r[5]]
+    if not pk:
+        raise ValueError(f"{table} 沒有主鍵，無法追蹤變更")
+    if len(pk) > 2:
+        raise ValueError(f"{table} 主鍵超過 2 欄 ({', '.join(pk)})")
+    return pk
+
+
+def _key_exprs(pk):
+    k2 = f"NEW.{pk[1]}" if len(pk) > 1 else "0"
+    return f"NEW.{pk[0]}", k2
+
+
+def ensure_change_tracking(conn, tables):
+    """建立追蹤表與各表的 INSERT / UPDATE 觸發器 (可重複呼叫)"""
+    for sql in SCHEMA:
+        conn.execute(sql)
+    for table in tables:
+        k1, k2 = _key_exprs(primary_key_columns(conn, table))
+        for event in ('INSERT', 'UPDATE'):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_sync_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT OR REPLACE INTO {CHANGES_TABLE} (table_name, k1, k2)
+                    VALUES ('{table}', {k1}, {k2});
+                END""")
+
+
+def drop_change_tracking(conn, tables):
+    """移除觸發器與浮水印 (下次同步重新全表上傳)"""
+    for table in tables:
+        for event in ('insert', 'update'):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_sync_{table}_{event}")
+        conn.execute(f"DELETE FROM {CHANGES_TABLE} WHERE table_name = ?", (table,))
+        conn.execute(f"DELETE FROM {WATERMARK_TABLE} WHERE table_name = ?", (table,))
+
+
+def _max_seq(conn, table):
+    row = conn.execute(f"SELECT MAX(seq) FROM {CHANGES_TABLE} WHERE table_name = ?", (table,)).fetchone()
+    return row[0] or 0
+
+
+def _watermark(conn, table):
+    return conn.execute(f"SELECT last_seq, seed_seq, seed_rowid FROM {WATERMARK_TABLE} WHERE table_name = ?",
+                        (table,)).fetchone()
+
+
+def _save_watermark(conn, table, last_seq, seed_seq=None, seed_rowid=0):
+    conn.execute(f"""INSERT OR REPLACE INTO {WATERMARK_TABLE} (table_name, last_seq, seed_seq, seed_rowid, updated_at)
+                     VALUES (?, ?, ?, ?, ?)""",
+                 (table, last_seq, seed_seq, seed_rowid, time.strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def _records(cursor, rows, hidden, drop_nulls):
+    columns = [d[0] for d in cursor.description]
+    records = []
+    for row in rows:
+        item = {c: v for c, v in zip(columns, row) if c not in hidden}
+        if drop_nulls:
+            item = {c: v for c, v in item.items() if v is not None}
+        records.append(item)
+    return records
+
+
+def pending_changes(conn, table):
+    """尚未上傳的變更筆數 (None 表示尚未完成首次全表上傳)"""
+    wm = _watermark(conn, table)
+    if wm is None or wm[0] is None:
+        return None
+    row = conn.execute(f"SELECT COUNT(*) FROM {CHANGES_TABLE} WHERE table_name = ? AND seq > ?",
+                       (table, wm[0])).fetchone()
+    return row[0]
+
+
+def sync_table(conn, table, upload, batch_size=2000, drop_nulls=False, progress=None):
+    """
+    上傳 table 自上次成功同步後的變更
+    :param upload: upload(table, records) 上傳一批 (失敗時拋出例外)
+    :param progress: progress(table, synced, mode) 每批完成後呼叫
+    :return: (mode, synced)  mode 為 'seed' (全表) 或 'delta' (變更)
+    :raises SyncBatchError: 某批上傳失敗；已成功的批次浮水印已提交
+    呼叫端需已執行 ensure_change_tracking()；每批成功後 conn.commit() 提交浮水印
+    """
+    pk = primary_key_columns(conn, table)
+    wm = _watermark(conn, table)
+    synced = 0
+
+    if wm is None or wm[0] is None:
+        # 首次: 依 rowid 全表上傳，開始時記下目前 seq，完成後由此開始增量
+        if wm is None:
+            seed_seq, rowid = _max_seq(conn, table), 0
+            _save_watermark(conn, table, None, seed_seq, rowid)
+            conn.commit()
+        else:
+            seed_seq, rowid = wm[1] or 0, wm[2] or 0
+        while True:
+            cur = conn.execute(f"SELECT rowid AS _sync_rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                               (rowid, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            records = _records(cur, rows, {'_sync_rowid'}, drop_nulls)
+            try:
+                upload(table, records)
+            except Exception as e:
+                raise SyncBatchError(table, synced, e) from e
+            rowid = rows[-1][0]
+            synced += len(records)
+            _save_watermark(conn, table, None, seed_seq, rowid)
+            conn.commit()
+            if progress:
+                progress(table, synced, 'seed')
+        _save_watermark(conn, table, seed_seq)
+        conn.execute(f"DELETE FROM {CHANGES_TABLE} WHERE table_name = ? AND seq <= ?", (table, seed_seq))
+        conn.commit()
+        return 'seed', synced
+
+    # 增量: 依 seq 讀取變更並 JOIN 回來源表 (已刪除的列略過)
+    last_seq = wm[0]
+    join = f"t.{pk[0]} = c.k1" + (f" AND t.{pk[1]} = c.k2" if len(pk) > 1 else "")
+    while True:
+        cur = conn.execute(f"""
+            SELECT c.seq AS _sync_seq, t.{pk[0]} IS NOT NULL AS _sync_present, t.*
+            FROM (SELECT seq, k1, k2 FROM {CHANGES_TABLE}
+                  WHERE table_name = ? AND seq > ? ORDER BY seq LIMIT ?) c
+            LEFT JOIN {table} t ON {join}
+            ORDER BY c.seq""", (table, last_seq, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        present = [r for r in rows if r[1]]
+        records = _records(cur, present, {'_sync_seq', '_sync_present'}, drop_nulls)
+        if records:
+            try:
+                upload(table, records)
+            except Exception as e:
+                raise SyncBatchError(table, synced, e) from e
+        last_seq = rows[-1][0]
+        synced += len(records)
+        _save_watermark(conn, table, last_seq)
+        conn.execute(f"DELETE FROM {CHANGES_TABLE} WHERE table_name = ? AND seq <= ?", (table, last_seq))
+        conn.commit()
+        if progress:
+            progress(table, synced, 'delta')
+    return 'delta', synced
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - Supabase → 本地 SQLite 增量拉取 (cloud_pull)
+
+後台「從雲端拉取」原本只更新 last_sync_time，桌機與雲端模式伺服器的資料各自分歧。
+此模組依本地每張表的高水位 (date_int 最大值) 只拉取雲端較新的列：
+- 分頁採 keyset (order=date_int,code 並以上一頁最後一列為起點)，不用 offset，
+  深分頁不會越來越慢，也不會因拉取期間雲端新增資料而漏列或重複
+- 背景執行緒預取下一頁，主執行緒同時寫入 SQLite (連線須在建立它的執行緒使用)
+- 以 UPSERT 寫入，只覆蓋雲端有的欄位，本地獨有的欄位保留；每頁 commit 一次
+  (主程式的 db_manager 連線即為單一寫入者佇列)
+- 拉回的列同時從 sync_changes 移除，避免下次推送又原樣上傳回雲端
+- 受影響的股票以 rebuild_snapshot_rows() 只重建其 stock_snapshot 價量欄位
+高水位當天會重新拉取 (gte)，當日盤後才補齊的資料可被更新；沒有日期欄的表 (stock_meta) 每次全表 keyset 走訪。
+"""
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.change_tracking import CHANGES_TABLE, primary_key_columns
+
+PAGE_SIZE = 1000                # Supabase 預設單次回應上限 (max-rows)
+PREFETCH_PAGES = 2              # 預取頁數 (寫入 SQLite 時網路不閒置)
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+REQUEST_TIMEOUT = 60
+RETRY_STATUS = (429, 500, 502, 503, 504)
+SNAPSHOT_CHUNK = 500            # rebuild_snapshot_rows 每次 IN (...) 的代號數
+
+# (表名, 高水位欄位 (None 表示全表), keyset 排序欄位)；stock_meta 需先於其他表
+PULL_TABLES = (
+    ('stock_meta', None, ('code',)),
+    ('institutional_investors', 'date_int', ('date_int', 'code')),
+    ('stock_history', 'date_int', ('date_int', 'code')),
+)
+
+_END = object()
+
+
+class PullError(Exception):
+    """拉取失敗 (已寫入的頁已提交，下次從新的高水位續拉)"""
+
+    def __init__(self, table, pulled, cause, codes=()):
+        super().__init__(f"{table}: {cause}")
+        self.table = table
+        self.pulled = pulled
+        self.cause = cause
+        self.codes = set(codes)
+
+
+def _quote(value):
+    """PostgREST or=() 條件內的值 (字串加雙引號)"""
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return str(value)
+
+
+def keyset_filter(order, last):
+    """
+    上一頁最後一列之後的條件 (字典序 (a, b) > (x, y))
+    :return: PostgREST 查詢參數 dict
+    """
+    if len(order) == 1:
+        value = last[order[0]]
+        return {order[0]: f"gt.{value}"}
+    a, b = order
+    return {'or': f"({a}.gt.{_quote(last[a])},and({a}.eq.{_quote(last[a])},{b}.gt.{_quote(last[b])}))"}
+
+
+class PostgrestReader:
+    """
+    PostgREST 分頁讀取器
+    :param base_url: Supabase 專案網址 (不含 /rest/v1)
+    """
+
+    def __init__(self, base_url, api_key, page_size=PAGE_SIZE, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, timeout=REQUEST_TIMEOUT, verify=True):
+        self.base_url = base_url.rstrip('/')
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers.update({
+            "apikey": api_key,
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json",
+        })
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch(self, table, params):
+        """GET 一頁；429 / 5xx / 連線錯誤以指數退避重試"""
+        url = f"{self.base_url}/rest/v1/{table}"
+        attempt = 0
+        while True:
+            try:
+                res = self.session.get(url, params=params, timeout=self.timeout, verify=self.verify)
+                if res.status_code < 300:
+                    return res.json()
+                error = f"[{res.status_code}] {res.text[:200]}"
+                if res.status_code not in RETRY_STATUS:
+                    raise RuntimeError(error)
+                retry_after = res.headers.get('Retry-After')
+            except requests.RequestException as e:
+                error, retry_after = str(e), None
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RuntimeError(error)
+            try:
+                delay = float(retry_after) if retry_after else self.backoff_base * (2 ** (attempt - 1))
+            except ValueError:
+                delay = self.backoff_base * (2 ** (attempt - 1))
+            time.sleep(min(delay, 30))
+
+    def pages(self, table, order, since_column=None, since=None):
+        """依 keyset 逐頁產生列 (since_column >= since 起)"""
+        base = {'select': '*', 'order': ','.join(f"{c}.asc" for c in order), 'limit': str(self.page_size)}
+        if since_column and since is not None:
+            base[since_column] = f"gte.{since}"
+        params = dict(base)
+        while True:
+            rows = self.fetch(table, params)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.page_size:
+                return
+            params = dict(base)
+            params.update(keyset_filter(order, rows[-1]))
+
+
+def _prefetch(iterator, depth=PREFETCH_PAGES):
+    """在背景執行緒先取下一頁 (例外於主執行緒重新拋出)"""
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for page in iterator:
+                while not stop.is_set():
+                    try:
+                        pages.put(page, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            pages.put(_END)
+        except Exception as e:
+            pages.put(e)
+
+    thread = threading.Thread(target=worker, name="cloud-pull-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def local_high_water(conn, table, column):
+    """本地高水位 (無資料時回傳 None，表示全表拉取)"""
+    return conn.execute(f"SELECT MAX({column}) FROM {table}").fetchone()[0]
+
+
+def _table_columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def write_rows(conn, table, rows, pk, local_columns, track_changes):
+    """UPSERT 一頁雲端列 (只寫入本地也有的欄位)；回傳寫入筆數"""
+    if not rows:
+        return 0
+    columns = [c for c in local_columns if c in rows[0]]
+    updates = [c for c in columns if c not in pk]
+    placeholders = ', '.join('?' for _ in columns)
+    conflict = f"DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in updates)}" if updates else "DO NOTHING"
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) ON CONFLICT({', '.join(pk)}) {conflict}",
+        [tuple(row.get(c) for c in columns) for row in rows])
+    if track_changes:
+        # 觸發器剛把這些列記為本地變更；內容已與雲端一致，不需再推送
+        k2 = (lambda row: row[pk[1]]) if len(pk) > 1 else (lambda row: 0)
+        conn.executemany(f"DELETE FROM {CHANGES_TABLE} WHERE table_name = ? AND k1 = ? AND k2 = ?",
+                         [(table, row[pk[0]], k2(row)) for row in rows])
+    return len(rows)
+
+
+def pull_table(conn, reader, table, since_column, order, progress=None):
+    """
+    拉取單表高水位之後的雲端列
+    :param progress: progress(table, pulled) 每頁提交後呼叫
+    :return: (pulled, codes)  codes 為受影響的股票代號 (表有 code 欄時)
+    :raises PullError: 某頁讀取或寫入失敗；先前的頁已提交
+    """
+    pk = primary_key_columns(conn, table)
+    local_columns = _table_columns(conn, table)
+    track_changes = _has_table(conn, CHANGES_TABLE)
+    since = local_high_water(conn, table, since_column) if since_column else None
+    pulled, codes = 0, set()
+    try:
+        for rows in _prefetch(reader.pages(table, order, since_column, since)):
+            pulled += write_rows(conn, table, rows, pk, local_columns, track_changes)
+            conn.commit()
+            if 'code' in local_columns:
+                codes.update(row['code'] for row in rows if row.get('code') is not None)
+            if progress:
+                progress(table, pulled)
+    except Exception as e:
+        raise PullError(table, pulled, e, codes) from e
+    return pulled, codes
+
+
+def rebuild_snapshot_rows(conn, codes):
+    """
+    只重建指定股票的 stock_snapshot 價量欄位 (最新/前一交易日，取自 stock_history)
+    指標欄位保留，由指標計算步驟接手更新；回傳處理的代號數
+    """
+    codes = sorted(codes)
+    for i in range(0, len(codes), SNAPSHOT_CHUNK):
+        chunk = codes[i:i + SNAPSHOT_CHUNK]
+        marks = ', '.join('?' for _ in chunk)
+        conn.execute(f"""
+            INSERT INTO stock_snapshot (code, name, date, close, volume, close_prev, vol_prev, amount)
+            WITH ranked AS (
+                SELECT code, date_int, close, volume, amount,
+                       ROW_NUMBER() OVER (PARTITION BY code ORDER BY date_int DESC) AS rn
+                FROM stock_history
+                WHERE code IN ({marks})
+            )
+            SELECT c.code, m.name,
+                   substr(c.date_int, 1, 4) || '-' || substr(c.date_int, 5, 2) || '-' || substr(c.date_int, 7, 2),
+                   c.close, c.volume, COALESCE(p.close, c.close), COALESCE(p.volume, c.volume), c.amount
+            FROM ranked c
+            LEFT JOIN ranked p ON p.code = c.code AND p.rn = 2
+            LEFT JOIN stock_meta m ON m.code = c.code
+            WHERE c.rn = 1
+            ON CONFLICT(code) DO UPDATE SET
+                name = COALESCE(excluded.name, stock_snapshot.name),
+                date = excluded.date,
+                close = excluded.close,
+                volume = excluded.volume,
+                close_prev = excluded.close_prev,
+                vol_prev = excluded.vol_prev,
+                amount = excluded.amount""", chunk)
+        conn.commit()
+    return len(codes)
+
+
+def pull_all(conn, reader, tables=PULL_TABLES, progress=None):
+    """
+    依序拉取各表；單表失敗不影響其他表
+    :return: {'pulled': {表: 筆數}, 'failed': {表: 錯誤訊息}, 'codes': 受影響代號 (stock_history / 法人)}
+    """
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    result = {'pulled': {}, 'failed': {}, 'codes': set()}
+    for table, since_column, order in tables:
+        if table not in existing:
+            continue
+        try:
+            pulled, codes = pull_table(conn, reader, table, since_column, order, progress)
+        except PullError as e:
+            result['failed'][table] = str(e.cause)
+            if table != 'stock_meta':
+                result['codes'] |= e.codes     # 已提交的頁仍需重建快照
+            continue
+        result['pulled'][table] = pulled
+        if table != 'stock_meta':
+            result['codes'] |= codes
+    return result
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - Supabase (PostgREST) 並行上傳管線 (cloud_uploader)
+
+原本的上傳流程讀一批、組 dict、POST、等待回應，全部循序執行，失敗的批次直接略過。
+此模組把上傳拆成三段管線，各段同時運作：
+- 讀取: 呼叫端執行緒逐列走訪來源 (SQLite 游標須在建立它的執行緒讀取)，放入有界佇列
+- 序列化: 每列先轉成 JSON bytes，累積到目標位元組數 (不是固定筆數) 後封裝成一批
+- N 條寫入執行緒: 共用同一個連線池 Session POST 到 /rest/v1/{table}
+失敗處理：
+- 413 (Payload Too Large): 目標大小減半並把該批對半拆開重送
+- 429 / 5xx / 連線錯誤: 指數退避 (優先採用 Retry-After) 後重試
+- 重試用盡: 寫入磁碟重試佇列 (retry_dir/*.json)，replay_retry_queue() 重送；
+  未設定 retry_dir 時拋出 UploadError，由呼叫端決定 (例如保留同步浮水印)
+"""
+import json
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TARGET_BATCH_BYTES = 1024 * 1024        # 每批目標 JSON 大小
+MIN_BATCH_BYTES = 16 * 1024             # 413 時縮小的下限
+MAX_BATCH_ROWS = 5000                   # 每批筆數上限 (避免單批過多列)
+UPLOAD_WORKERS = 4                      # 並行 HTTP 寫入數
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5                      # 退避秒數 = BACKOFF_BASE * 2^嘗試次數 (上限 BACKOFF_MAX)
+BACKOFF_MAX = 30.0
+REQUEST_TIMEOUT = 60
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+READ_CHUNK = 500                        # 讀取端每次交給序列化執行緒的列數
+
+_END = object()
+
+
+class UploadError(Exception):
+    """批次上傳失敗且未設定重試佇列"""
+
+    def __init__(self, table, failed_rows, cause):
+        super().__init__(f"{table}: {failed_rows} 筆上傳失敗 ({cause})")
+        self.table = table
+        self.failed_rows = failed_rows
+        self.cause = cause
+
+
+class _RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _PayloadTooLarge(Exception):
+    pass
+
+
+class _RequestRejected(Exception):
+    """不可重試的錯誤 (4xx 欄位/權限錯誤等)"""
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return int.from_bytes(value, byteorder='little')
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if hasattr(value, 'item'):          # NumPy 純量
+        return value.item()
+    raise TypeError(f"無法序列化 {type(value).__name__}")
+
+
+def _encode_row(row, drop_nulls=False):
+    clean = {}
+    for k, v in row.items():
+        if isinstance(v, float) and not math.isfinite(v):
+            v = None                    # PostgREST 不接受 NaN / Infinity
+        if v is None and drop_nulls:
+            continue
+        clean[k] = v
+    return json.dumps(clean, ensure_ascii=False, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+def _pack(encoded_rows):
+    return b'[' + b','.join(encoded_rows) + b']'
+
+
+class UploadStats:
+    """上傳統計 (執行緒安全)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.end = None                 # upload() 結束時凍結耗時
+        self.read_rows = 0
+        self.sent_rows = 0
+        self.sent_batches = 0
+        self.sent_bytes = 0
+        self.failed_rows = 0
+        self.failed_batches = 0
+        self.queued_batches = 0         # 寫入磁碟重試佇列的批次
+        self.retries = 0
+        self.splits = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    @property
+    def elapsed(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def rows_per_sec(self):
+        elapsed = self.elapsed
+        return self.sent_rows / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "read_rows": self.read_rows,
+                "sent_rows": self.sent_rows,
+                "sent_batches": self.sent_batches,
+                "sent_mb": round(self.sent_bytes / 1024 / 1024, 2),
+                "failed_rows": self.failed_rows,
+                "failed_batches": self.failed_batches,
+                "queued_batches": self.queued_batches,
+                "retries": self.retries,
+                "rows_per_sec": round(self.rows_per_sec, 1),
+                "elapsed_sec": round(self.elapsed, 1),
+            }
+
+    def summary(self):
+        d = self.as_dict()
+        text = f"{d['sent_rows']} 筆 ({d['rows_per_sec']:.0f} 筆/秒, {d['sent_mb']} MB)"
+        if d['failed_rows']:
+            text += f", 失敗 {d['failed_rows']} 筆"
+        return text
+
+
+class PostgrestUploader:
+    """
+    PostgREST 並行上傳器
+    :param base_url: Supabase 專案網址 (不含 /rest/v1)
+    :param retry_dir: 磁碟重試佇列目錄；None 表示失敗時拋出 UploadError
+    """
+
+    def __init__(self, base_url, api_key, workers=UPLOAD_WORKERS, target_bytes=TARGET_BATCH_BYTES,
+                 max_rows=MAX_BATCH_ROWS, retry_dir=None, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, timeout=REQUEST_TIMEOUT, verify=True):
+        self.base_url = base_url.rstrip('/')
+        self.workers = max(1, workers)
+        self.target_bytes = target_bytes
+        self.max_target_bytes = target_bytes
+        self.max_rows = max_rows
+        self.retry_dir = retry_dir
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "apikey": api_key,
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Prefer": "resolution=merge-duplicates,return=minimal",
+        })
+        self._size_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ----------------------------------------
+    # HTTP
+    # ----------------------------------------
+    def _url(self, table, on_conflict):
+        url = f"{self.base_url}/rest/v1/{table}"
+        return f"{url}?on_conflict={on_conflict}" if on_conflict else url
+
+    def _post(self, url, body):
+        try:
+            res = self.session.post(url, data=body, timeout=self.timeout, verify=self.verify)
+        except requests.RequestException as e:
+            raise _RetryableError(str(e)) from e
+        if res.status_code < 300:
+            return
+        if res.status_code == 413:
+            raise _PayloadTooLarge(res.text[:200])
+        if res.status_code in RETRY_STATUS:
+            retry_after = res.headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            raise _RetryableError(f"[{res.status_code}] {res.text[:200]}", retry_after)
+        raise _RequestRejected(f"[{res.status_code}] {res.text[:200]}")
+
+    def _shrink(self):
+        with self._size_lock:
+            self.target_bytes = max(MIN_BATCH_BYTES, self.target_bytes // 2)
+
+    def _grow(self):
+        with self._size_lock:
+            self.target_bytes = min(self.max_target_bytes, int(self.target_bytes * 1.25))
+
+    def _send(self, url, rows, stats):
+        """
+        送出一批 (JSON bytes 列表)；413 時拆半遞迴，429/5xx 依退避重試
+        :return: (失敗的列, 最後的錯誤)；全部成功時為 ([], None)
+        """
+        attempt = 0
+        while True:
+            body = _pack(rows)
+            try:
+                self._post(url, body)
+                stats.add(sent_rows=len(rows), sent_batches=1, sent_bytes=len(body))
+                self._grow()
+                return [], None
+            except _PayloadTooLarge as e:
+                self._shrink()
+                if len(rows) == 1:
+                    return rows, e
+                stats.add(splits=1)
+                mid = len(rows) // 2
+                failed_a, error_a = self._send(url, rows[:mid], stats)
+                failed_b, error_b = self._send(url, rows[mid:], stats)
+                return failed_a + failed_b, error_b or error_a
+            except _RetryableError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    return rows, e
+                stats.add(retries=1)
+                delay = e.retry_after if e.retry_after is not None else self.backoff_base * (2 ** (attempt - 1))
+                time.sleep(min(delay, BACKOFF_MAX))
+            except _RequestRejected as e:
+                return rows, e
+
+    # ----------------------------------------
+    # 重試佇列
+    # ----------------------------------------
+    def _enqueue_retry(self, table, url, rows):
+        os.makedirs(self.retry_dir, exist_ok=True)
+        name = f"{int(time.time() * 1000)}-{table}-{uuid.uuid4().hex[:8]}.json"
+        path = os.path.join(self.retry_dir, name)
+        payload = {'table': table, 'url': url[len(self.base_url):], 'rows': json.loads(_pack(rows))}
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+    def retry_queue_files(self):
+        if not self.retry_dir or not os.path.isdir(self.retry_dir):
+            return []
+        return sorted(os.path.join(self.retry_dir, f) for f in os.listdir(self.retry_dir) if f.endswith('.json'))
+
+    def replay_retry_queue(self):
+        """依寫入順序重送磁碟佇列中的批次；全部成功即刪除檔案，否則只保留失敗的列。回傳 UploadStats"""
+        stats = UploadStats()
+        for path in self.retry_queue_files():
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            rows = [_encode_row(r) for r in payload['rows']]
+            stats.add(read_rows=len(rows))
+            failed, _ = self._send(self.base_url + payload['url'], rows, stats)
+            if not failed:
+                os.remove(path)
+                continue
+            stats.add(failed_rows=len(failed), failed_batches=1)
+            if len(failed) < len(rows):
+                payload['rows'] = json.loads(_pack(failed))
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(payload, f, ensure_ascii=False)
+                os.replace(path + '.tmp', path)
+        return stats
+
+    # ----------------------------------------
+    # 管線
+    # ----------------------------------------
+    def upload(self, table, rows, on_conflict=None, drop_nulls=False, progress=None, progress_interval=1.0):
+        """
+        上傳可迭代的 dict 列 (可為 SQLite 游標產生器)
+        :param drop_nulls: 省略 NULL 欄位以縮小傳輸量；批次附上 columns= 參數，省略的欄位仍寫入 NULL
+        :param progress: progress(stats) 定期回呼 (於寫入執行緒中呼叫)
+        :return: UploadStats
+        :raises UploadError: 有批次失敗且未設定 retry_dir (所有批次結束後才拋出)
+        """
+        base_url = self._url(table, on_conflict)
+        stats = UploadStats()
+        chunk_queue = queue.Queue(maxsize=8)
+        batch_queue = queue.Queue(maxsize=self.workers * 2)
+        errors = []
+        last_report = [time.perf_counter()]
+        report_lock = threading.Lock()
+
+        def report(force=False):
+            if not progress:
+                return
+            with report_lock:
+                now = time.perf_counter()
+                if not force and now - last_report[0] < progress_interval:
+                    return
+                last_report[0] = now
+            progress(stats)
+
+        def batch_url(columns):
+            if not columns:
+                return base_url
+            sep = '&' if '?' in base_url else '?'
+            return f"{base_url}{sep}columns={','.join(sorted(columns))}"
+
+        def serializer():
+            batch, size, columns = [], 2, set()
+            try:
+                while True:
+                    chunk = chunk_queue.get()
+                    if chunk is _END:
+                        break
+                    for row in chunk:
+                        encoded = _encode_row(row, drop_nulls)
+                        if batch and (size + len(encoded) + 1 > self.target_bytes or len(batch) >= self.max_rows):
+                            batch_queue.put((batch_url(columns), batch))
+                            batch, size, columns = [], 2, set()
+                        batch.append(encoded)
+                        size += len(encoded) + 1
+                        if drop_nulls:
+                            columns.update(row)
+                    stats.add(read_rows=len(chunk))
+                if batch:
+                    batch_queue.put((batch_url(columns), batch))
+            except Exception as e:
+                errors.append(e)
+                while chunk_queue.get() is not _END:    # 讓呼叫端的讀取迴圈結束
+                    pass
+            finally:
+                for _ in range(self.workers):
+                    batch_queue.put(_END)
+
+        def writer():
+            while True:
+                item = batch_queue.get()
+                if item is _END:
+                    return
+                url, batch = item
+                try:
+                    failed, error = self._send(url, batch, stats)
+                except Exception as e:
+                    failed, error = batch, e
+                if failed:
+                    stats.add(failed_rows=len(failed), failed_batches=1)
+                    if self.retry_dir:
+                        try:
+                            self._enqueue_retry(table, url, failed)
+                            stats.add(queued_batches=1)
+                        except OSError as e:
+                            errors.append(e)
+                    else:
+                        errors.append(error)
+                report()
+
+        threads = [threading.Thread(target=serializer, name=f"upload-encode-{table}", daemon=True)]
+        threads += [threading.Thread(target=writer, name=f"upload-write-{table}-{i}", daemon=True)
+                    for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        try:
+            # 讀取在呼叫端執行緒 (SQLite 游標不可跨執行緒)，每 READ_CHUNK 列交給序列化執行緒
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= READ_CHUNK:
+                    chunk_queue.put(chunk)
+                    chunk = []
+            if chunk:
+                chunk_queue.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunk_queue.put(_END)
+            for t in threads:
+                t.join()
+        stats.end = time.perf_counter()
+        report(force=True)
+
+        if errors:
+            raise UploadError(table, stats.failed_rows, errors[0])
+        return stats
+
+
+def cursor_rows(cursor, batch_size=2000):
+    """把 SQLite 游標轉成 dict 列產生器 (以 fetchmany 分段讀取)"""
+    columns = [d[0] for d in cursor.description]
+    while True:
+        chunk = cursor.fetchmany(batch_size)
+        if not chunk:
+            return
+        for row in chunk:
+            yield dict(zip(columns, row))
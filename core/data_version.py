@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 資料版本戳記
+
+資料一天只在排程 (14:00 / 15:30 / 21:30) 與手動更新時變動。更新/同步流程
+結束時呼叫 bump_data_version() 改寫資料庫旁的 data_version.json，API 端的
+回應快取以 read_data_version() 比對版本即可判斷快取是否失效：
+- 戳記檔以 os.replace 原子寫入，跨進程 (主程式 CLI、後端背景任務) 皆可見
+- 讀取端只在檔案 mtime/inode 改變時重新解析，平時每次檢查僅一次 os.stat
+"""
+import json
+import os
+import time
+
+VERSION_FILE = 'data_version.json'
+MISSING_VERSION = '0'           # 尚未有任何更新流程寫入戳記
+
+# 讀取快取 {path: ((mtime_ns, inode), version)}；os.replace 每次產生新 inode，同一 mtime 刻度內的更新也能分辨
+_CACHE = {}
+
+
+def default_version_path(db_path):
+    """戳記檔預設位於資料庫同一目錄"""
+    return os.path.join(os.path.dirname(os.path.abspath(str(db_path))), VERSION_FILE)
+
+
+def bump_data_version(path, source=''):
+    """
+    寫入新的資料版本 (更新/同步流程結束時呼叫)
+    :return: 新版本字串
+    """
+    version = str(time.time_ns())
+    payload = {'version': version, 'source': source,
+               'updated_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    _CACHE.pop(path, None)
+    return version
+
+
+def read_data_version(path):
+    """目前的資料版本 (戳記不存在時回傳 MISSING_VERSION)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return MISSING_VERSION
+    stamp = (st.st_mtime_ns, st.st_ino)
+    cached = _CACHE.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            version = str(json.load(f).get('version', MISSING_VERSION))
+    except (OSError, ValueError, AttributeError):
+        return MISSING_VERSION
+    _CACHE[path] = (stamp, version)
+    return version
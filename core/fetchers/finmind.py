@@ -3,11 +3,11 @@
 台灣股市分析系統 - FinMind 資料抓取器
 """
 import time
-import requests
 from typing import List, Optional
 from datetime import datetime, timedelta
 
 from .base import BaseFetcher
+from core.http_client import fetch
 from core.models import StockPrice, InstitutionalData
 
 # FinMind API 設定
@@ -33,7 +33,7 @@ class FinMindFetcher(BaseFetcher):
         
         for attempt in range(retry):
             try:
-                resp = requests.get(self.url, params=params, timeout=30, verify=False)
+                resp = fetch(self.url, params=params, timeout=30)
                 if resp.status_code == 200:
                     data = resp.json()
                     if data.get('status') == 200:
@@ -2,12 +2,11 @@
 """
 台灣股市分析系統 - 法人買賣超資料抓取器
 """
-import time
-import requests
 from typing import List, Optional, Tuple
 from datetime import datetime
 
 from .base import BaseFetcher
+from core.http_client import fetch
 from core.models import InstitutionalData
 
 
@@ -41,7 +40,7 @@ class InstitutionalFetcher(BaseFetcher):
         url = self.API_TWSE.format(date=date_str.replace('-', ''))
         
         try:
-            resp = requests.get(url, timeout=30, verify=False)
+            resp = fetch(url, timeout=30)
             if resp.status_code != 200:
                 return []
             
@@ -117,7 +116,7 @@ class InstitutionalFetcher(BaseFetcher):
                 'Referer': 'https://www.tpex.org.tw/'
             }
             
-            resp = requests.get(url, headers=headers, timeout=30, verify=False)
+            resp = fetch(url, headers=headers, timeout=30)
             
             if resp.status_code != 200:
                 self.log(f"[InstitutionalFetcher] TPEx API 回傳 {resp.status_code}")
@@ -183,7 +182,7 @@ class InstitutionalFetcher(BaseFetcher):
         url = f"https://www.twse.com.tw/rwd/zh/fund/BFI82U?response=json&date={date_str.replace('-', '')}"
         
         try:
-            resp = requests.get(url, timeout=30, verify=False)
+            resp = fetch(url, timeout=30)
             if resp.status_code != 200:
                 return []
             
@@ -244,15 +243,11 @@ class InstitutionalFetcher(BaseFetcher):
         result.extend(twse_data)
         self.log(f"✓ TWSE 法人: {len(twse_data)} 筆")
         
-        time.sleep(1)
-        
         # TPEx
         tpex_data = self.fetch_tpex(date_str)
         result.extend(tpex_data)
         self.log(f"✓ TPEx 法人: {len(tpex_data)} 筆")
         
-        time.sleep(1)
-        
         # Market Summary
         summary_data = self.fetch_market_summary(date_str)
         result.extend(summary_data)
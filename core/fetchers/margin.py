@@ -2,13 +2,11 @@
 """
 台灣股市分析系統 - 融資融券資料抓取器
 """
-import time
-import requests
-import random
 from typing import List, Optional
 from datetime import datetime
 
 from .base import BaseFetcher
+from core.http_client import fetch
 from core.models import MarginData
 
 class MarginFetcher(BaseFetcher):
@@ -49,8 +47,7 @@ class MarginFetcher(BaseFetcher):
         url = self.API_TWSE.format(date=date_str)
         
         try:
-            time.sleep(random.uniform(2.0, 4.0))
-            resp = requests.get(url, timeout=15, verify=False)
+            resp = fetch(url, timeout=15)
             if resp.status_code != 200:
                 return []
                 
@@ -100,8 +97,7 @@ class MarginFetcher(BaseFetcher):
             
             url = self.API_TPEX.format(date=roc_date)
             
-            time.sleep(random.uniform(1.5, 3.0))
-            resp = requests.get(url, timeout=15, verify=False)
+            resp = fetch(url, timeout=15)
             if resp.status_code != 200:
                 return []
                 
@@ -149,11 +145,7 @@ class MarginFetcher(BaseFetcher):
         url = f"https://www.twse.com.tw/rwd/zh/marginTrading/MI_MARGN?response=json&date={date_str}&selectType=ALL"
         
         try:
-            import time
-            import random
-            time.sleep(random.uniform(1.0, 2.0))
-            
-            resp = requests.get(url, timeout=15, verify=False)
+            resp = fetch(url, timeout=15)
             if resp.status_code != 200:
                 return []
             
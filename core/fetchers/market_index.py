@@ -2,12 +2,11 @@
 """
 台灣股市分析系統 - 大盤指數資料抓取器
 """
-import time
-import requests
 from typing import List, Optional, Tuple
 from datetime import datetime
 
 from .base import BaseFetcher
+from core.http_client import fetch
 
 class MarketIndexFetcher(BaseFetcher):
     """大盤指數資料抓取器 (TWSE + TPEx)"""
@@ -48,7 +47,7 @@ class MarketIndexFetcher(BaseFetcher):
         date_int = int(date_str)
         
         try:
-            resp = requests.get(url, timeout=15, verify=False)
+            resp = fetch(url, timeout=15)
             if resp.status_code != 200:
                 return None
                 
@@ -92,7 +91,7 @@ class MarketIndexFetcher(BaseFetcher):
             
             url = self.API_TPEX.format(date=roc_date)
             
-            resp = requests.get(url, timeout=15, verify=False)
+            resp = fetch(url, timeout=15)
             if resp.status_code != 200:
                 return None
                 
@@ -122,8 +121,6 @@ class MarketIndexFetcher(BaseFetcher):
             result.append(twse_data)
             self.log(f"✓ TWSE 指數: {twse_data[2]}")
         
-        time.sleep(0.5)
-        
         # TPEx
         tpex_data = self.fetch_tpex(date_str)
         if tpex_data:
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 資料缺漏位元索引 (gap_index)
+
+step4_check_data_gaps 原本對 stock_history / institutional_investors / margin_data 各做一次
+全表 GROUP BY code，再在 Python dict 裡比對；補資料時又逐檔/逐日查詢。此模組為每個資料集、
+每檔股票維護一個「有資料的日期」位元圖 (bit i = 2000-01-01 起第 i 天)：
+- stock_history 衍生的資料集不另設觸發器，由共用異動紀錄 history_changes (core/history_changes)
+  依各資料集游標取出異動的 (代號, 日期)，再以目前的資料列判定有無；法人與融資表的觸發器把
+  INSERT / DELETE 記入 gap_pending。refresh_gap_index() 只套用這些異動 (首次才全表掃描一次建立)，
+  位元圖存於 gap_index (去除前導 0 後的 BLOB)
+- 交易日曆由 is_market_holiday 產生同樣格式的位元遮罩；「哪些股票缺哪些日期」即為
+  日曆 & ~有資料，每檔一次大整數運算
+- 除了「有資料」之外，amount_missing 記錄「有量但無成交金額」的日期 (位元為 1 表示缺漏)
+每檔只檢查以 stock_history 第一筆至最後一筆為範圍的缺漏 (上市前、下市後不算缺漏)。
+"""
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .history_changes import (TABLE as HISTORY_CHANGES, drop_consumer, ensure_history_changes, get_cursor,
+                              latest_seq, set_cursor)
+
+EPOCH = date(2000, 1, 1).toordinal()
+ANCHOR = 'stock_history'            # 決定每檔股票檢查範圍的資料集
+LOGGED_TABLE = 'stock_history'      # 由 history_changes 取得異動的來源表 (不另設觸發器)
+
+PENDING_TABLE = 'gap_pending'
+INDEX_TABLE = 'gap_index'
+STATE_TABLE = 'gap_index_state'
+
+# 資料集: (來源表, 條件)；條件為 None 表示「有列即有資料」，否則為位元 = 1 的條件 ({p} 為欄位前綴)
+DATASETS = {
+    'stock_history': ('stock_history', None),
+    'amount_missing': ('stock_history', "{p}volume > 0 AND ({p}amount IS NULL OR {p}amount = 0)"),
+    'institutional_investors': ('institutional_investors', None),
+    'margin_data': ('margin_data', None),
+}
+
+SCHEMA = (
+    f"""CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        dataset TEXT NOT NULL,
+        code TEXT NOT NULL,
+        date_int INTEGER NOT NULL,
+        present INTEGER NOT NULL
+    )""",
+    f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{PENDING_TABLE}_key ON {PENDING_TABLE}(dataset, code, date_int)",
+    f"""CREATE TABLE IF NOT EXISTS {INDEX_TABLE} (
+        dataset TEXT NOT NULL,
+        code TEXT NOT NULL,
+        base INTEGER NOT NULL,
+        bits BLOB NOT NULL,
+        PRIMARY KEY (dataset, code)
+    )""",
+    f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} (dataset TEXT PRIMARY KEY, seeded_at TEXT)",
+)
+
+
+# ==========================================
+# 日期 ↔ 位元
+# ==========================================
+
+def day_no(date_int: int) -> int:
+    """YYYYMMDD → 位元位置"""
+    return date(date_int // 10000, date_int // 100 % 100, date_int % 100).toordinal() - EPOCH
+
+
+def date_of(n: int) -> int:
+    """位元位置 → YYYYMMDD"""
+    d = date.fromordinal(n + EPOCH)
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def iter_bits(bits: int):
+    """由低到高列出為 1 的位元位置"""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def popcount(bits: int) -> int:
+    return bin(bits).count('1')
+
+
+def range_mask(lo: int, hi: int) -> int:
+    """位元 lo..hi (含) 為 1"""
+    if hi < lo:
+        return 0
+    return ((1 << (hi - lo + 1)) - 1) << lo
+
+
+def _encode(bits: int):
+    if not bits:
+        return 0, b''
+    base = (bits & -bits).bit_length() - 1
+    trimmed = bits >> base
+    return base, trimmed.to_bytes((trimmed.bit_length() + 7) // 8, 'little')
+
+
+def _decode(base: int, blob: bytes) -> int:
+    return int.from_bytes(blob, 'little') << base
+
+
+class TradingCalendar:
+    """start..end 之間的交易日遮罩 (休市判斷由呼叫端提供，主程式為 is_market_holiday)"""
+
+    def __init__(self, start: int, end: int, is_holiday: Callable[[int], bool]):
+        self.start, self.end = start, end
+        self.lo, self.hi = day_no(start), day_no(end)
+        mask = 0
+        d = date.fromordinal(self.lo + EPOCH)
+        for n in range(self.lo, self.hi + 1):
+            if not is_holiday(d.year * 10000 + d.month * 100 + d.day):
+                mask |= 1 << n
+            d += timedelta(days=1)
+        self.mask = mask
+
+    def days(self) -> List[int]:
+        return [date_of(n) for n in iter_bits(self.mask)]
+
+    def last_days(self, n: int) -> List[int]:
+        """最近 n 個交易日 (升冪)"""
+        return self.days()[-n:] if n > 0 else []
+
+
+# ==========================================
+# 建立 / 增量更新
+# ==========================================
+
+def _table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+
+def _consumer(name):
+    """資料集在 history_changes 的游標名稱"""
+    return f"gap_index:{name}"
+
+
+def _drop_triggers(conn, name):
+    for suffix in ('insert', 'update', 'delete'):
+        conn.execute(f"DROP TRIGGER IF EXISTS trg_gap_{name}_{suffix}")
+
+
+def ensure_gap_index(conn, datasets: Optional[Iterable[str]] = None) -> List[str]:
+    """建立索引表、觸發器與共用異動紀錄 (可重複呼叫)；回傳來源表存在的資料集"""
+    for sql in SCHEMA:
+        conn.execute(sql)
+    ready = []
+    for name in datasets or DATASETS:
+        table, cond = DATASETS[name]
+        if not _table_exists(conn, table):
+            continue
+        ready.append(name)
+        if table == LOGGED_TABLE:
+            # 舊版在 stock_history 上的觸發器與待套用紀錄改由 history_changes 取代
+            _drop_triggers(conn, name)
+            conn.execute(f"DELETE FROM {PENDING_TABLE} WHERE dataset = ?", (name,))
+            ensure_history_changes(conn)
+            continue
+        insert = f"INSERT OR REPLACE INTO {PENDING_TABLE} (dataset, code, date_int, present)"
+        if cond is None:
+            events = (('insert', 'INSERT', 'NEW', '1'), ('delete', 'DELETE', 'OLD', '0'))
+        else:
+            flag = f"({cond.format(p='NEW.')})"
+            events = (('insert', 'INSERT', 'NEW', flag),
+                      ('update', 'UPDATE', 'NEW', flag),
+                      ('delete', 'DELETE', 'OLD', '0'))
+        for suffix, event, row, present in events:
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_gap_{name}_{suffix}
+                AFTER {event} ON {table}
+                WHEN {row}.code IS NOT NULL AND {row}.date_int > 19000000
+                BEGIN
+                    {insert} VALUES ('{name}', {row}.code, {row}.date_int, {present});
+                END""")
+    return ready
+
+
+def drop_gap_index(conn):
+    """移除觸發器、異動游標與索引 (下次 refresh 重新全表建立)"""
+    for name in DATASETS:
+        _drop_triggers(conn, name)
+        drop_consumer(conn, _consumer(name))
+    for table in (PENDING_TABLE, INDEX_TABLE, STATE_TABLE):
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def _save(conn, name, bitmaps: Dict[str, int]):
+    rows = [(name, code, *_encode(bits)) for code, bits in bitmaps.items() if bits]
+    conn.executemany(f"INSERT OR REPLACE INTO {INDEX_TABLE} (dataset, code, base, bits) VALUES (?, ?, ?, ?)", rows)
+    empty = [(name, code) for code, bits in bitmaps.items() if not bits]
+    conn.executemany(f"DELETE FROM {INDEX_TABLE} WHERE dataset = ? AND code = ?", empty)
+
+
+def _seed(conn, name):
+    """全表掃描建立位元圖 (首次)"""
+    table, cond = DATASETS[name]
+    where = "code IS NOT NULL AND date_int > 19000000"
+    if cond:
+        where += f" AND {cond.format(p='')}"
+    bitmaps: Dict[str, int] = {}
+    for code, date_int in conn.execute(f"SELECT code, date_int FROM {table} WHERE {where}"):
+        bitmaps[code] = bitmaps.get(code, 0) | (1 << day_no(int(date_int)))
+    conn.execute(f"DELETE FROM {INDEX_TABLE} WHERE dataset = ?", (name,))
+    conn.execute(f"DELETE FROM {PENDING_TABLE} WHERE dataset = ?", (name,))
+    _save(conn, name, bitmaps)
+    conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE} (dataset, seeded_at) VALUES (?, ?)",
+                 (name, time.strftime('%Y-%m-%d %H:%M:%S')))
+    return len(bitmaps)
+
+
+def _apply_pending(conn, names):
+    """套用觸發器記錄的異動，只讀寫有變動的股票"""
+    if not names:
+        return 0
+    marks = ','.join('?' * len(names))
+    rows = conn.execute(f"""SELECT seq, dataset, code, date_int, present FROM {PENDING_TABLE}
+                            WHERE dataset IN ({marks}) ORDER BY seq""", tuple(names)).fetchall()
+    if not rows:
+        return 0
+    touched: Dict[tuple, List] = {}
+    for _, name, code, date_int, present in rows:
+        touched.setdefault((name, code), []).append((date_int, present))
+    _update_bitmaps(conn, names, touched)
+    conn.execute(f"DELETE FROM {PENDING_TABLE} WHERE dataset IN ({marks}) AND seq <= ?", (*names, rows[-1][0]))
+    return len(rows)
+
+
+def _apply_history_changes(conn, name, upto_seq):
+    """
+    套用 history_changes 中游標之後的異動：每個 (代號, 日期) 只以目前的 stock_history 資料列判定有無，
+    同一列被改寫多次也只讀寫一次
+    """
+    cond = DATASETS[name][1]
+    present = "h.code IS NOT NULL" if cond is None else f"COALESCE({cond.format(p='h.')}, 0)"
+    rows = conn.execute(f"""
+        SELECT c.code, c.date_int, {present}
+        FROM (SELECT DISTINCT code, date_int FROM {HISTORY_CHANGES} WHERE seq > ? AND seq <= ?) c
+        LEFT JOIN {LOGGED_TABLE} h ON h.code = c.code AND h.date_int = c.date_int
+        WHERE c.code IS NOT NULL AND c.date_int > 19000000""",
+                        (get_cursor(conn, _consumer(name)), upto_seq)).fetchall()
+    touched: Dict[tuple, List] = {}
+    for code, date_int, flag in rows:
+        touched.setdefault((name, code), []).append((date_int, flag))
+    _update_bitmaps(conn, [name], touched)
+    set_cursor(conn, _consumer(name), upto_seq)
+    return len(rows)
+
+
+def _update_bitmaps(conn, names, touched: Dict[tuple, List]):
+    """依 {(資料集, 代號): [(日期, 有無), ...]} 依序設定/清除位元並寫回"""
+    for name in names:
+        codes = [code for (n, code) in touched if n == name]
+        if not codes:
+            continue
+        current = {}
+        for i in range(0, len(codes), 500):
+            chunk = codes[i:i + 500]
+            for code, base, blob in conn.execute(
+                    f"SELECT code, base, bits FROM {INDEX_TABLE} WHERE dataset = ? AND code IN ({','.join('?' * len(chunk))})",
+                    (name, *chunk)):
+                current[code] = _decode(base, blob)
+        updated = {}
+        for code in codes:
+            bits = current.get(code, 0)
+            for date_int, present in touched[(name, code)]:
+                bit = 1 << day_no(int(date_int))
+                bits = bits | bit if present else bits & ~bit
+            updated[code] = bits
+        _save(conn, name, updated)
+
+
+def load_gap_index(conn, datasets: Optional[Iterable[str]] = None) -> 'GapIndex':
+    names = list(datasets or DATASETS)
+    bitmaps: Dict[str, Dict[str, int]] = {name: {} for name in names}
+    marks = ','.join('?' * len(names))
+    for name, code, base, blob in conn.execute(
+            f"SELECT dataset, code, base, bits FROM {INDEX_TABLE} WHERE dataset IN ({marks})", tuple(names)):
+        bitmaps[name][code] = _decode(base, blob)
+    return GapIndex(bitmaps)
+
+
+def refresh_gap_index(conn, datasets: Optional[Iterable[str]] = None) -> 'GapIndex':
+    """
+    建立 (首次) 或增量更新位元圖並載入
+    呼叫端決定交易範圍；主程式以 db_manager.run_transaction() 在寫入線程執行
+    """
+    names = ensure_gap_index(conn, datasets)
+    seeded = {r[0] for r in conn.execute(f"SELECT dataset FROM {STATE_TABLE}")}
+    logged = [name for name in names if DATASETS[name][0] == LOGGED_TABLE]
+    upto_seq = latest_seq(conn) if logged else None
+    for name in names:
+        # stock_history 衍生的資料集沒有游標 (首次或由舊版觸發器升級) 時無從得知先前的異動，全表重建
+        if name not in seeded or (name in logged and get_cursor(conn, _consumer(name)) is None):
+            _seed(conn, name)
+            if name in logged:
+                set_cursor(conn, _consumer(name), upto_seq)
+    for name in logged:
+        _apply_history_changes(conn, name, upto_seq)
+    _apply_pending(conn, [name for name in names if name not in logged])
+    return load_gap_index(conn, names)
+
+
+# ==========================================
+# 查詢
+# ==========================================
+
+class GapIndex:
+    """記憶體中的位元圖 {資料集: {代號: 位元圖}}"""
+
+    def __init__(self, bitmaps: Dict[str, Dict[str, int]]):
+        self.bitmaps = bitmaps
+
+    def codes(self, dataset: str = ANCHOR) -> List[str]:
+        return sorted(self.bitmaps.get(dataset, {}))
+
+    def bits(self, dataset: str, code: str) -> int:
+        return self.bitmaps.get(dataset, {}).get(code, 0)
+
+    def count(self, dataset: str, code: str) -> int:
+        return popcount(self.bits(dataset, code))
+
+    def first_date(self, dataset: str, code: str) -> Optional[int]:
+        bits = self.bits(dataset, code)
+        return date_of((bits & -bits).bit_length() - 1) if bits else None
+
+    def last_date(self, dataset: str, code: str) -> Optional[int]:
+        bits = self.bits(dataset, code)
+        return date_of(bits.bit_length() - 1) if bits else None
+
+    def span_mask(self, code: str) -> int:
+        """該股 stock_history 第一筆至最後一筆的範圍"""
+        bits = self.bits(ANCHOR, code)
+        if not bits:
+            return 0
+        return range_mask((bits & -bits).bit_length() - 1, bits.bit_length() - 1)
+
+    def missing(self, dataset: str, calendar: TradingCalendar,
+                codes: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        每檔缺漏的交易日位元圖 (只列出有缺漏者)
+        範圍 = 日曆期間 ∩ 該股 stock_history 首末日；amount_missing 直接回傳為 1 的位元
+        """
+        window = calendar.mask
+        out = {}
+        for code in (self.codes(ANCHOR) if codes is None else codes):
+            scope = window & self.span_mask(code)
+            if DATASETS[dataset][1] is None:
+                gaps = scope & ~self.bits(dataset, code)
+            else:
+                gaps = range_mask(calendar.lo, calendar.hi) & self.bits(dataset, code)
+            if gaps:
+                out[code] = gaps
+        return out
+
+    def missing_by_date(self, dataset: str, calendar: TradingCalendar,
+                        codes: Optional[Iterable[str]] = None) -> Dict[int, List[str]]:
+        """{日期: [缺漏的代號]} (依日期升冪)，補資料時同一天的股票可一次下載"""
+        by_date: Dict[int, List[str]] = {}
+        for code, gaps in self.missing(dataset, calendar, codes).items():
+            for n in iter_bits(gaps):
+                by_date.setdefault(date_of(n), []).append(code)
+        return dict(sorted(by_date.items()))
+
+    def dates_to_fetch(self, dataset: str, calendar: TradingCalendar, min_ratio: float = 0.5) -> List[int]:
+        """
+        值得整日重新下載的日期：缺漏股數 / 當日應有股數 >= min_ratio
+        (整日未下載時比例為 1；少數股票長期沒有該類資料不會每次觸發重抓)
+        """
+        expected: Dict[int, int] = {}
+        for code in self.codes(ANCHOR):
+            for n in iter_bits(calendar.mask & self.span_mask(code)):
+                expected[n] = expected.get(n, 0) + 1
+        out = []
+        for d, codes in self.missing_by_date(dataset, calendar).items():
+            total = expected.get(day_no(d), 0)
+            if total and len(codes) / total >= min_ratio:
+                out.append(d)
+        return out
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 歷史資料快速存取 (整數日期 + NumPy 欄位)
+
+舊查詢在 SQLite 內把 date_int 逐列組成 'YYYY-MM-DD' 字串，取回後再由
+pd.read_sql_query / pd.to_datetime / sort_values 重新解析與排序，佔 Step 7
+相當比例的時間。此模組直接以 cursor.fetchall + np.fromiter 取回：
+- date_int 保持 int64，資料依日期遞增 (SQL 已排序，不再 sort)
+- 數值欄位為 typed NumPy 陣列 (NULL 轉 NaN；整數欄無 NULL 時維持 int64)
+- 日期只在真正需要時 (週/月重取樣、輸出字串) 以向量化運算轉換
+"""
+import numpy as np
+
+# ==============================
+# 欄位定義 (表驅動法: 欄位 -> dtype)
+# ==============================
+PRICE_COLUMNS = (
+    ('date_int', np.int64),
+    ('open', np.float64), ('high', np.float64), ('low', np.float64), ('close', np.float64),
+    ('volume', np.int64), ('amount', np.int64),
+)
+CHIP_COLUMNS = (
+    ('tdcc_count', np.int64), ('large_shareholder_pct', np.float64),
+    ('foreign_buy', np.int64), ('trust_buy', np.int64), ('dealer_buy', np.int64),
+)
+HISTORY_COLUMNS = PRICE_COLUMNS + CHIP_COLUMNS
+
+
+def available_columns(conn, columns=HISTORY_COLUMNS):
+    """過濾掉 stock_history 不存在的欄位 (籌碼欄位為後續遷移新增，舊資料庫可能沒有)"""
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(stock_history)")
+    existing = {row[1] for row in cur.fetchall()}
+    return tuple((name, dtype) for name, dtype in columns if name in existing)
+
+
+def _column(rows, j, dtype):
+    """
+    取出第 j 欄為 NumPy 陣列
+    整數欄遇到 NULL 或非整數值時維持 float64 + NaN (與 pd.read_sql_query 行為一致)
+    """
+    values = np.fromiter((np.nan if r[j] is None else r[j] for r in rows), dtype=np.float64, count=len(rows))
+    if dtype is np.int64 and not np.isnan(values).any() and (values == np.trunc(values)).all():
+        return values.astype(np.int64)
+    return values
+
+
+def rows_to_arrays(rows, columns, offset=0):
+    """資料列 -> {欄位: 陣列}，offset 為前置非數值欄位數 (如 code)"""
+    return {name: _column(rows, offset + j, dtype) for j, (name, dtype) in enumerate(columns)}
+
+
+def fetch_history_arrays(conn, code, limit=None, columns=HISTORY_COLUMNS):
+    """
+    單檔歷史 (依日期遞增)
+    :param limit: 只取最近 limit 筆 (None=全部)
+    :return: {'date_int': int64 陣列, 欄位: 陣列}
+    """
+    columns = available_columns(conn, columns)
+    select = ', '.join(name for name, _ in columns)
+    cur = conn.cursor()
+    if limit:
+        cur.execute(f"SELECT {select} FROM stock_history WHERE code = ? ORDER BY date_int DESC LIMIT ?",
+                    (code, limit))
+        rows = cur.fetchall()
+        rows.reverse()
+    else:
+        cur.execute(f"SELECT {select} FROM stock_history WHERE code = ? ORDER BY date_int ASC", (code,))
+        rows = cur.fetchall()
+    return rows_to_arrays(rows, columns)
+
+
+def fetch_batch_history_arrays(conn, codes, since_date_int, columns=PRICE_COLUMNS):
+    """
+    多檔歷史 (單次查詢，依代號分段切片，各段依日期遞增)
+    :return: {code: {'date_int': 陣列, 欄位: 陣列}}，各陣列為整批陣列的切片視圖
+    """
+    if not codes:
+        return {}
+    columns = available_columns(conn, columns)
+    select = ', '.join(name for name, _ in columns)
+    placeholders = ','.join(['?'] * len(codes))
+    cur = conn.cursor()
+    cur.execute(f"""SELECT code, {select} FROM stock_history
+                    WHERE code IN ({placeholders}) AND date_int >= ?
+                    ORDER BY code, date_int ASC""", list(codes) + [since_date_int])
+    rows = cur.fetchall()
+    if not rows:
+        return {}
+
+    arrays = rows_to_arrays(rows, columns, offset=1)
+    row_codes = [r[0] for r in rows]
+    bounds = [0] + [i for i in range(1, len(rows)) if row_codes[i] != row_codes[i - 1]] + [len(rows)]
+    return {
+        row_codes[start]: {name: arr[start:end] for name, arr in arrays.items()}
+        for start, end in zip(bounds[:-1], bounds[1:])
+    }
+
+
+def fetch_recent_history_arrays(conn, codes, bars, columns=PRICE_COLUMNS):
+    """
+    多檔最近 bars 筆歷史 (各段依日期遞增)
+    每檔以 (code, date_int) 主鍵索引倒序 seek + LIMIT，只讀需要的列；結果逐檔寫入預先配置的
+    (代號數 × bars) 緩衝區，不建立整批的中介串列。短窗掃描 (型態、近期量價) 不再載入兩年資料
+    :return: 同 fetch_batch_history_arrays
+    """
+    if not codes or bars <= 0:
+        return {}
+    columns = available_columns(conn, columns)
+    select = ', '.join(name for name, _ in columns)
+    sql = f"SELECT {select} FROM stock_history WHERE code = ? ORDER BY date_int DESC LIMIT ?"
+    buf = np.empty((len(codes) * bars, len(columns)), dtype=np.float64)
+    spans = []
+    pos = 0
+    cur = conn.cursor()
+    for code in codes:
+        rows = cur.execute(sql, (code, bars)).fetchall()
+        if rows:
+            rows.reverse()
+            buf[pos:pos + len(rows)] = rows          # NULL 轉 NaN
+            spans.append((code, pos, pos + len(rows)))
+            pos += len(rows)
+    if not spans:
+        return {}
+
+    arrays = {}
+    for j, (name, dtype) in enumerate(columns):
+        values = buf[:pos, j]
+        if dtype is np.int64 and not np.isnan(values).any() and (values == np.trunc(values)).all():
+            values = values.astype(np.int64)
+        else:
+            values = values.copy()
+        arrays[name] = values
+    return {code: {name: arr[start:end] for name, arr in arrays.items()} for code, start, end in spans}
+
+
+def date_ints_to_datetime64(date_ints):
+    """YYYYMMDD 整數陣列 -> datetime64[ns] (純整數運算，不經字串解析)"""
+    d = np.asarray(date_ints, dtype=np.int64)
+    months = ((d // 10000 - 1970) * 12 + (d // 100 % 100 - 1)).astype('datetime64[M]')
+    days = (d % 100 - 1).astype('timedelta64[D]')
+    return (months.astype('datetime64[D]') + days).astype('datetime64[ns]')
+
+
+def format_date_int(date_int):
+    """YYYYMMDD -> 'YYYY-MM-DD'"""
+    date_int = int(date_int)
+    return f"{date_int // 10000:04d}-{date_int // 100 % 100:02d}-{date_int % 100:02d}"
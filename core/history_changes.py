@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - stock_history 異動紀錄 (history_changes)
+
+價格立方體、缺漏位元索引與增量指標狀態都由 stock_history 衍生，各自需要知道哪些
+(代號, 日期) 被新增、改寫或刪除 (日期回補、repair_day_quotes、法人資料晚到)。
+此模組只在 stock_history 上安裝一組 INSERT / UPDATE / DELETE 觸發器，把異動寫入
+history_changes (AUTOINCREMENT 序號)，每列只多一次寫入，不論有幾個使用端：
+- 各使用端在 history_change_cursors 記錄自己已處理到的序號 (set_cursor)
+- 所有已登記的使用端都處理過的紀錄即刪除 (prune)；尚無游標的使用端視為「不知道之前改了什麼」，需自行全量重建
+函式本身不 commit，由呼叫端決定交易範圍 (主程式經 db_manager.run_transaction 執行)。
+"""
+import sqlite3
+import time
+from typing import Dict, Optional
+
+TABLE = 'history_changes'
+CURSOR_TABLE = 'history_change_cursors'
+
+SCHEMA = (
+    f"""CREATE TABLE IF NOT EXISTS {TABLE} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT, date_int INTEGER)""",
+    f"""CREATE TABLE IF NOT EXISTS {CURSOR_TABLE} (
+        consumer TEXT PRIMARY KEY, seq INTEGER NOT NULL, updated_at TEXT)""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_history_changes_insert AFTER INSERT ON stock_history
+        BEGIN INSERT INTO {TABLE} (code, date_int) VALUES (NEW.code, NEW.date_int); END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_history_changes_update AFTER UPDATE ON stock_history
+        BEGIN
+            INSERT INTO {TABLE} (code, date_int) VALUES (NEW.code, NEW.date_int);
+            INSERT INTO {TABLE} (code, date_int)
+            SELECT OLD.code, OLD.date_int WHERE OLD.code IS NOT NEW.code OR OLD.date_int IS NOT NEW.date_int;
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_history_changes_delete AFTER DELETE ON stock_history
+        BEGIN INSERT INTO {TABLE} (code, date_int) VALUES (OLD.code, OLD.date_int); END""",
+)
+
+
+def ensure_history_changes(conn):
+    """建立異動紀錄表、游標表與觸發器 (可重複呼叫；需寫入連線)"""
+    for sql in SCHEMA:
+        conn.execute(sql)
+
+
+def latest_seq(conn) -> Optional[int]:
+    """最新異動序號 (刪除紀錄後仍由 sqlite_sequence 保存)；尚未建立紀錄表時回傳 None"""
+    try:
+        seq, exists = conn.execute(
+            "SELECT (SELECT seq FROM sqlite_sequence WHERE name = ?), "
+            "(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)", (TABLE, TABLE)).fetchone()
+    except sqlite3.OperationalError:     # 資料庫尚無任何 AUTOINCREMENT 表
+        return None
+    return int(seq or 0) if exists else None
+
+
+def get_cursor(conn, consumer: str) -> Optional[int]:
+    """使用端已處理到的序號；尚未登記 (或紀錄表不存在) 時回傳 None"""
+    try:
+        row = conn.execute(f"SELECT seq FROM {CURSOR_TABLE} WHERE consumer = ?", (consumer,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return int(row[0]) if row else None
+
+
+def set_cursor(conn, consumer: str, seq: int):
+    """推進使用端游標，並刪除所有使用端都已處理的紀錄"""
+    conn.execute(f"INSERT OR REPLACE INTO {CURSOR_TABLE} (consumer, seq, updated_at) VALUES (?, ?, ?)",
+                 (consumer, int(seq), time.strftime('%Y-%m-%d %H:%M:%S')))
+    prune(conn)
+
+
+def drop_consumer(conn, consumer: str):
+    """停用的使用端移除游標，避免紀錄因它而無法清除"""
+    try:
+        conn.execute(f"DELETE FROM {CURSOR_TABLE} WHERE consumer = ?", (consumer,))
+    except sqlite3.OperationalError:
+        return
+    prune(conn)
+
+
+def prune(conn):
+    """刪除最慢的使用端也已處理的紀錄 (尚無任何游標時不刪，留給之後登記的使用端)"""
+    conn.execute(f"DELETE FROM {TABLE} WHERE seq <= (SELECT MIN(seq) FROM {CURSOR_TABLE})")
+
+
+def changed_codes(conn, after_seq: int, upto_seq: int) -> Dict[str, int]:
+    """序號 (after_seq, upto_seq] 之間有異動的股票 -> 最早異動日期"""
+    return dict(conn.execute(f"SELECT code, MIN(date_int) FROM {TABLE} WHERE seq > ? AND seq <= ? GROUP BY code",
+                             (after_seq, upto_seq)).fetchall())
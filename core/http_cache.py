@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 磁碟 HTTP 回應快取 (http_cache)
+
+原本只有 最終修正.py 的 SimpleCache (記憶體 50 筆、60 秒、程序結束即消失)，回補與更新失敗後重跑
+都會重新下載同樣的 MI_INDEX、T86、MI_MARGN、BWIBBU_ALL、TDCC 檔。此快取：
+- 以 URL + 參數為鍵，內容依 SHA-256 存放 (相同內容只存一份，例如各休市日的「查無資料」)
+- 依端點與查詢日期決定有效期：已定案的歷史日期永久保存，近幾日數小時，當日資料數分鐘
+- 永久保存前先檢查內容 (JSON、stat 為 OK 且 data/tables 非空)；「查無資料」「很抱歉」等只保存 UNSETTLED_TTL，
+  HTML (節流/錯誤頁) 不快取
+- 過期項目帶 ETag / Last-Modified 做條件式請求，304 時沿用本地內容
+- LRU 以 OrderedDict 維護 (O(1))，超過位元組上限時淘汰最久未用的項目
+- 離線重播模式 (offline=True 或環境變數 HTTP_CACHE_OFFLINE=1)：只讀快取，未命中視為連線失敗，供測試使用
+索引存於同目錄的 SQLite，內容檔在 objects/ 下
+"""
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlparse
+
+CACHE_DIR_NAME = 'http_cache'
+MAX_BYTES = 256 * 1024 * 1024
+SETTLED_DAYS = 3                # 早於幾天前的資料視為定案 (交易所偶有隔日補登)
+RECENT_TTL = 6 * 3600           # 近幾日資料的有效期
+UNSETTLED_TTL = 1800            # 歷史日期但內容未通過檢查 (查無資料、很抱歉) 的有效期
+
+# (網域尾碼, 當日 / 無日期資料的有效期秒數)；不在表內的網域不快取
+CACHE_POLICIES = (
+    ('twse.com.tw', 600),
+    ('tpex.org.tw', 600),
+    ('finmindtrade.com', 1800),
+    ('tdcc.com.tw', 6 * 3600),   # 集保股權分散表每週更新
+)
+DATE_PARAMS = ('date', 'd', 'end_date', 'qdate')
+KEPT_HEADERS = ('content-type', 'etag', 'last-modified')
+
+
+def _parse_date(value: str) -> Optional[date]:
+    """支援 YYYYMMDD、YYYY-MM-DD、YYYY/MM/DD 與民國 yyy/mm/dd"""
+    value = value.strip()
+    try:
+        if value.isdigit() and len(value) == 8:
+            return datetime.strptime(value, '%Y%m%d').date()
+        parts = value.replace('-', '/').split('/')
+        if len(parts) == 3 and all(p.isdigit() for p in parts):
+            year = int(parts[0])
+            return date(year + 1911 if year < 1000 else year, int(parts[1]), int(parts[2]))
+    except ValueError:
+        pass
+    return None
+
+
+def ttl_for(url: str, params=None, today: Optional[date] = None, policies=CACHE_POLICIES) -> Optional[float]:
+    """
+    回應有效期 (秒)
+    :return: None 表示不快取；math.inf 表示永久
+    """
+    host = urlparse(url).hostname or ''
+    policy = next((ttl for suffix, ttl in policies if host == suffix or host.endswith('.' + suffix)), None)
+    if policy is None:
+        return None
+    query = dict(parse_qsl(urlparse(url).query))
+    if params:
+        query.update({k: str(v) for k, v in (params.items() if isinstance(params, dict) else params)})
+    day = next((d for d in (_parse_date(query[k]) for k in DATE_PARAMS if k in query) if d), None)
+    if day is None:
+        return policy
+    today = today or date.today()
+    if day < today - timedelta(days=SETTLED_DAYS):
+        return math.inf
+    if day < today:
+        return RECENT_TTL
+    return policy
+
+
+def _header(headers, name: str) -> str:
+    return (headers.get(name) or headers.get(name.title()) or '') if headers else ''
+
+
+def settled_payload(content: bytes, headers) -> bool:
+    """
+    回應內容是否為可永久保存的正式資料：JSON、stat (若有) 為 OK，且 data / tables / aaData 至少一項非空
+    證交所在查無資料、參數錯誤或節流時仍回 200，內容為 stat="很抱歉..." 或空的 data
+    """
+    if 'json' not in _header(headers, 'content-type').lower():
+        return False
+    try:
+        obj = json.loads(content)
+    except ValueError:
+        return False
+    if not isinstance(obj, dict):
+        return bool(obj)
+    if 'stat' in obj and str(obj['stat']).upper() != 'OK':
+        return False
+    if any(isinstance(t, dict) and t.get('data') for t in obj.get('tables') or ()):
+        return True
+    return any(v for k, v in obj.items() if k.startswith('data') or k == 'aaData')
+
+
+def response_ttl(ttl: Optional[float], content: bytes, headers) -> Optional[float]:
+    """
+    依回應內容調整 ttl_for 的有效期
+    :return: None 表示不快取 (HTML 節流/錯誤頁)；永久項目未通過 settled_payload 時縮短為 UNSETTLED_TTL
+    """
+    if ttl is None:
+        return None
+    if 'html' in _header(headers, 'content-type').lower() or content.lstrip()[:1] == b'<':
+        return None
+    if ttl == math.inf and not settled_payload(content, headers):
+        return UNSETTLED_TTL
+    return ttl
+
+
+@dataclass
+class CachedResponse:
+    """快取項目"""
+    status_code: int
+    content: bytes
+    headers: Dict[str, str]
+    url: str
+    encoding: Optional[str]
+    fresh: bool
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """條件式請求標頭"""
+        out = {}
+        if self.headers.get('etag'):
+            out['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified'):
+            out['If-Modified-Since'] = self.headers['last-modified']
+        return out
+
+
+class HttpCache:
+    """磁碟 HTTP 回應快取 (執行緒安全)"""
+
+    def __init__(self, directory, max_bytes: int = MAX_BYTES, offline: Optional[bool] = None,
+                 policies=CACHE_POLICIES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.policies = policies
+        self.offline = os.environ.get('HTTP_CACHE_OFFLINE') == '1' if offline is None else offline
+        (self.directory / 'objects').mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.directory / 'index.sqlite3'), check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, url TEXT, digest TEXT, size INTEGER, status INTEGER, encoding TEXT,
+            headers TEXT, stored_at REAL, expires_at REAL, accessed_at REAL)""")
+        self._conn.commit()
+        # LRU 順序 (最舊在前) 與內容參照計數
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._refs: Counter = Counter()
+        self._sizes: Dict[str, int] = {}
+        for key, digest, size in self._conn.execute(
+                "SELECT key, digest, size FROM entries ORDER BY accessed_at"):
+            self._lru[key] = digest
+            self._refs[digest] += 1
+            self._sizes[digest] = size
+        self.total_bytes = sum(self._sizes.values())
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'stored': 0, 'revalidated': 0, 'evicted': 0}
+
+    def ttl_for(self, url: str, params=None) -> Optional[float]:
+        return ttl_for(url, params, policies=self.policies)
+
+    @staticmethod
+    def make_key(full_url: str) -> str:
+        return hashlib.sha256(full_url.encode('utf-8')).hexdigest()
+
+    def _blob(self, digest: str) -> Path:
+        return self.directory / 'objects' / digest[:2] / digest
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """查詢快取 (過期項目仍回傳，fresh=False；離線模式一律視為有效)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, digest, status, encoding, headers, expires_at FROM entries WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            url, digest, status, encoding, headers, expires_at = row
+            try:
+                content = self._blob(digest).read_bytes()
+            except OSError:
+                self._remove(key)
+                self.stats['misses'] += 1
+                return None
+            now = time.time()
+            fresh = self.offline or expires_at is None or expires_at > now
+            self.stats['hits' if fresh else 'stale'] += 1
+            self._lru.move_to_end(key)
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return CachedResponse(status, content, json.loads(headers), url, encoding, fresh)
+
+    def put(self, key: str, url: str, status_code: int, content: bytes, headers, encoding: Optional[str],
+            ttl: float):
+        """寫入快取 (ttl 為 math.inf 時永久)"""
+        digest = hashlib.sha256(content).hexdigest()
+        kept = {k: headers[k] for k in KEPT_HEADERS if headers.get(k)}
+        now = time.time()
+        expires_at = None if ttl == math.inf else now + ttl
+        with self._lock:
+            blob = self._blob(digest)
+            if digest not in self._sizes:
+                blob.parent.mkdir(exist_ok=True)
+                tmp = blob.with_suffix(f'.tmp{threading.get_ident()}')
+                tmp.write_bytes(content)
+                os.replace(tmp, blob)
+                self._sizes[digest] = len(content)
+                self.total_bytes += len(content)
+            self._refs[digest] += 1
+            previous = self._lru.get(key)
+            if previous is not None:
+                self._release(previous)      # 先加後減，內容相同時不會誤刪
+            self._lru[key] = digest
+            self._lru.move_to_end(key)
+            self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, url, digest, len(content), status_code, encoding, json.dumps(kept),
+                                now, expires_at, now))
+            self.stats['stored'] += 1
+            self._evict()
+            self._conn.commit()
+
+    def refresh(self, key: str, ttl: float):
+        """條件式請求得到 304：延長有效期"""
+        expires_at = None if ttl == math.inf else time.time() + ttl
+        with self._lock:
+            self._conn.execute("UPDATE entries SET expires_at = ?, stored_at = ? WHERE key = ?",
+                               (expires_at, time.time(), key))
+            self._conn.commit()
+            self.stats['revalidated'] += 1
+
+    def _release(self, digest: str):
+        self._refs[digest] -= 1
+        if self._refs[digest] <= 0:
+            del self._refs[digest]
+            self.total_bytes -= self._sizes.pop(digest, 0)
+            try:
+                self._blob(digest).unlink()
+            except OSError:
+                pass
+
+    def _remove(self, key: str):
+        digest = self._lru.pop(key, None)
+        if digest is not None:
+            self._release(digest)
+        self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._lru) > 1:
+            key = next(iter(self._lru))
+            self._remove(key)
+            self.stats['evicted'] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._lru):
+                self._remove(key)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def default_cache_dir(work_dir) -> Path:
+    """快取目錄 (與資料庫同層)"""
+    return Path(work_dir).resolve() / CACHE_DIR_NAME
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 全域非同步 HTTP 抓取層 (http_client)
+
+各抓取器 (法人、融資券、估值、集保、core/fetchers/*) 原本各自呼叫 requests.get，
+有的共用 Session、多數沒有，並行靠 ThreadPoolExecutor 加上固定 sleep。此模組提供單一客戶端：
+- 背景執行緒上的 asyncio 事件迴圈 + httpx.AsyncClient：keep-alive 連線池，安裝 h2 時啟用 HTTP/2
+- 依網域的令牌桶限速 (twse.com.tw、tpex.org.tw、finmindtrade.com、tdcc.com.tw 各自獨立)，
+  取代各處的 time.sleep；429/503 依 Retry-After 退避重試
+- 同一時間相同的 GET (URL + 參數) 只送出一次，其餘等待同一結果
+- 同步介面 fetch() / fetch_many() 供既有程式呼叫；回應物件相容 requests.Response 常用屬性，
+  連線錯誤轉成 requests.exceptions 的對應例外，既有 except 區塊不需修改
+- 可掛上磁碟回應快取 (core/http_cache)：GET 先查快取，過期項目做條件式請求
+- 預設驗證 TLS 憑證，只有 UNVERIFIED_HOSTS 列出的網域 (證交所、櫃買中心) 使用不驗證的連線池
+"""
+import asyncio
+import concurrent.futures
+import importlib.util
+import json as _json
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlencode, urlparse
+
+import httpx
+import requests
+
+from core.http_cache import HttpCache, response_ttl
+
+# (網域尾碼, 每秒請求數, 突發上限)；未列出的網域使用 DEFAULT_POLICY
+HOST_POLICIES = (
+    ('twse.com.tw', 1.0, 3),
+    ('tpex.org.tw', 1.0, 3),
+    ('finmindtrade.com', 5.0, 5),
+    ('tdcc.com.tw', 1.0, 2),
+)
+DEFAULT_POLICY = (10.0, 10)
+# 證交所 / 櫃買中心的憑證缺少 Subject Key Identifier 擴充欄位，新版 OpenSSL 嚴格檢查
+# (Python 3.13 起預設 VERIFY_X509_STRICT) 下驗證失敗，原本各抓取器都以 verify=False 呼叫；
+# 只對這兩個網域 (含子網域) 關閉驗證，FinMind、集保等其他網域一律驗證
+UNVERIFIED_HOSTS = ('twse.com.tw', 'tpex.org.tw')
+MAX_CONNECTIONS = 20
+MAX_RETRIES = 2
+RETRY_STATUS = (429, 503)
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/html, */*',
+    'Accept-Language': 'zh-TW,zh;q=0.9,en;q=0.8',
+}
+
+
+class TokenBucket:
+    """令牌桶 (在事件迴圈執行緒內使用)"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """取得一個令牌，回傳等待秒數"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+class FetchResponse:
+    """相容 requests.Response 常用介面的回應"""
+
+    def __init__(self, status_code: int, content: bytes, headers, url: str, encoding: Optional[str] = None,
+                 from_cache: bool = False):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.url = url
+        self.encoding = encoding
+        self.from_cache = from_cache
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self, **kwargs):
+        return _json.loads(self.text, **kwargs)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+def _policy_for(host: str) -> Tuple[str, float, int]:
+    for suffix, rate, burst in HOST_POLICIES:
+        if host == suffix or host.endswith('.' + suffix):
+            return suffix, rate, burst
+    return host, DEFAULT_POLICY[0], DEFAULT_POLICY[1]
+
+
+def _verifies(host: str, unverified_hosts=UNVERIFIED_HOSTS) -> bool:
+    """該網域是否驗證 TLS 憑證"""
+    return not any(host == suffix or host.endswith('.' + suffix) for suffix in unverified_hosts)
+
+
+def _full_url(url, params):
+    if not params:
+        return url
+    items = sorted(params.items()) if isinstance(params, dict) else list(params)
+    return f"{url}{'&' if '?' in url else '?'}{urlencode(items)}"
+
+
+class AsyncFetchClient:
+    """非同步抓取客戶端 (須在同一個事件迴圈內使用)"""
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, retries: int = MAX_RETRIES,
+                 http2: Optional[bool] = None, policies=None, unverified_hosts=UNVERIFIED_HOSTS):
+        self.max_connections = max_connections
+        self.retries = retries
+        self.http2 = importlib.util.find_spec('h2') is not None if http2 is None else http2
+        self.policies = policies
+        self.unverified_hosts = tuple(unverified_hosts)
+        self._clients: Dict[bool, httpx.AsyncClient] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._waiters: Dict[str, int] = {}
+        self.stats = {'requests': 0, 'deduplicated': 0, 'retries': 0, 'throttled': 0, 'wait_seconds': 0.0}
+
+    def _http(self, url) -> httpx.AsyncClient:
+        """依網域取得驗證 / 不驗證憑證的連線池"""
+        verify = _verifies(urlparse(url).hostname or '', self.unverified_hosts)
+        client = self._clients.get(verify)
+        if client is None:
+            client = self._clients[verify] = httpx.AsyncClient(
+                http2=self.http2, verify=verify, headers=DEFAULT_HEADERS,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections))
+        return client
+
+    def _bucket(self, url) -> TokenBucket:
+        host = urlparse(url).hostname or ''
+        if self.policies is not None:
+            key, rate, burst = next(((s, r, b) for s, r, b in self.policies
+                                     if host == s or host.endswith('.' + s)), (host,) + DEFAULT_POLICY)
+        else:
+            key, rate, burst = _policy_for(host)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def fetch(self, url: str, params=None, headers=None, timeout: float = 30, method: str = 'GET',
+                    data=None, follow_redirects: bool = True) -> FetchResponse:
+        """送出請求 (GET 相同 URL 同時只送一次)"""
+        if method.upper() != 'GET':
+            return await self._send(method, url, params, headers, timeout, data, follow_redirects)
+        key = _full_url(url, params)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats['deduplicated'] += 1
+        else:
+            task = asyncio.ensure_future(self._send('GET', url, params, headers, timeout, None, follow_redirects))
+            self._inflight[key] = task
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield: 單一等待者被取消時不影響其他共用同一請求的等待者
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]
+                # 最後一個等待者也被取消 (同步介面外層逾時) 時停止請求，不再佔用連線與令牌
+                task.cancel()
+
+    async def _send(self, method, url, params, headers, timeout, data, follow_redirects) -> FetchResponse:
+        bucket = self._bucket(url)
+        attempt = 0
+        while True:
+            waited = await bucket.acquire()
+            if waited:
+                self.stats['throttled'] += 1
+                self.stats['wait_seconds'] += waited
+            self.stats['requests'] += 1
+            res = await self._http(url).request(method, url, params=params, headers=headers, data=data,
+                                             timeout=timeout, follow_redirects=follow_redirects)
+            if res.status_code in RETRY_STATUS and attempt < self.retries:
+                attempt += 1
+                self.stats['retries'] += 1
+                try:
+                    delay = float(res.headers.get('Retry-After', ''))
+                except ValueError:
+                    delay = 2.0 ** attempt
+                await asyncio.sleep(min(delay, 30.0))
+                continue
+            return FetchResponse(res.status_code, res.content, res.headers, str(res.url), res.encoding)
+
+    async def aclose(self):
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.aclose()
+
+
+class FetchClient:
+    """同步介面：在背景事件迴圈執行 AsyncFetchClient (任何執行緒皆可呼叫)"""
+
+    def __init__(self, cache: Optional[HttpCache] = None, **kwargs):
+        self.cache = cache
+        self._kwargs = kwargs
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async: Optional[AsyncFetchClient] = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='http-fetch', daemon=True).start()
+                self._async = AsyncFetchClient(**self._kwargs)
+                self._loop = loop
+        return self._loop
+
+    @property
+    def stats(self):
+        return dict(self._async.stats) if self._async else {}
+
+    def _run(self, coro, timeout):
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as e:
+            # 外層逾時 (含排隊等待令牌) 時取消事件迴圈上的協程，並轉成 requests 的例外供既有 except 區塊處理
+            future.cancel()
+            raise requests.exceptions.Timeout(f"請求逾時 ({timeout} 秒)") from e
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def fetch(self, url: str, params=None, headers=None, timeout: float = 30, method: str = 'GET',
+              data=None, allow_redirects: bool = True, **_ignored) -> FetchResponse:
+        """相容 requests.get 呼叫方式 (verify 等參數忽略；是否驗證憑證依網域決定，見 UNVERIFIED_HOSTS)"""
+        ttl = self.cache.ttl_for(url, params) if self.cache is not None and method.upper() == 'GET' else None
+        key = cached = None
+        if ttl is not None:
+            key = HttpCache.make_key(_full_url(url, params))
+            cached = self.cache.get(key)
+            if cached is not None and cached.fresh:
+                return _from_cached(cached)
+            if self.cache.offline:
+                raise requests.exceptions.ConnectionError(f"離線模式且快取未命中: {url}")
+            if cached is not None:
+                headers = {**(headers or {}), **cached.validators}
+
+        self._ensure_loop()
+        coro = self._async.fetch(url, params=params, headers=headers, timeout=timeout, method=method,
+                                 data=data, follow_redirects=allow_redirects)
+        # 外層逾時含排隊等待令牌的時間
+        resp = self._run(coro, None if timeout is None else timeout * (MAX_RETRIES + 2) + 60)
+        if ttl is not None:
+            # 永久有效期只給通過內容檢查的回應 (查無資料/節流頁不會被永久保存)
+            if resp.status_code == 304 and cached is not None:
+                ttl = response_ttl(ttl, cached.content, cached.headers)
+                if ttl is not None:
+                    self.cache.refresh(key, ttl)
+                return _from_cached(cached)
+            ttl = response_ttl(ttl, resp.content, resp.headers)
+            if resp.status_code == 200 and ttl is not None:
+                self.cache.put(key, resp.url, resp.status_code, resp.content, resp.headers, resp.encoding, ttl)
+        return resp
+
+    def fetch_many(self, requests_list: Iterable[dict], timeout: float = 30) -> List[Optional[FetchResponse]]:
+        """並行送出多個請求 (各項為 fetch 的關鍵字參數)；失敗者為 None"""
+        self._ensure_loop()
+        items = [{'timeout': timeout, **kw} for kw in requests_list]
+
+        async def run_all():
+            loop = asyncio.get_running_loop()
+
+            async def one(kw):
+                # 含快取查詢的同步 fetch 在執行緒池執行，網路請求仍回到本事件迴圈並行
+                try:
+                    return await loop.run_in_executor(None, lambda: self.fetch(**kw))
+                except Exception:
+                    return None
+            return await asyncio.gather(*(one(kw) for kw in items))
+
+        return self._run(run_all(), None)
+
+    def close(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._async.aclose(), self._loop).result(10)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+def _from_cached(cached) -> FetchResponse:
+    return FetchResponse(cached.status_code, cached.content, cached.headers, cached.url, cached.encoding,
+                         from_cache=True)
+
+
+_CLIENT: Optional[FetchClient] = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_fetch_client() -> FetchClient:
+    """全域抓取客戶端"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = FetchClient()
+    return _CLIENT
+
+
+def configure_cache(directory, **kwargs) -> HttpCache:
+    """為全域抓取客戶端掛上磁碟回應快取"""
+    client = get_fetch_client()
+    if client.cache is not None:
+        client.cache.close()
+    client.cache = HttpCache(directory, **kwargs)
+    return client.cache
+
+
+def fetch(url: str, params=None, headers=None, timeout: float = 30, **kwargs) -> FetchResponse:
+    """同步 GET (取代 requests.get(url, ...)；證交所 / 櫃買中心以外的網域驗證憑證)"""
+    return get_fetch_client().fetch(url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+
+def fetch_many(requests_list: Iterable[dict], timeout: float = 30) -> List[Optional[FetchResponse]]:
+    return get_fetch_client().fetch_many(requests_list, timeout)
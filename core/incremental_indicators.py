@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - Step 7 增量指標引擎
+
+全量模式每晚重新載入約 450 日歷史，以 pandas 重算全部序列；
+增量模式為每檔股票保存一份滾動狀態，每日只推進新增的 K 棒：
+- 滾動和: MA / VWAP / 量均 (簡單和)，WMA / RSI / MFI / MACD (加權和)
+- 遞迴狀態: 日 KD、週 KD (EWM)、MACD 訊號線尾端
+- 累計狀態: NVI / PVI / ADL
+- 尾端視窗: 其餘固定回溯指標 (SMI、BBW、VP、VSBC...) 只計算最後一根
+
+公式對齊 最終修正.py 的 IndicatorCalculator 與 _calc_*_indicators，
+輸出鍵名沿用 _format_indicators_result，可直接組成 stock_snapshot 的 UPDATE。
+"""
+import json
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from .volume_profile import latest_volume_profile
+
+# ==============================
+# 引擎參數
+# ==============================
+STATE_WINDOW = 260          # 尾端視窗 (涵蓋 MA200/WMA200/VWAP200 與 VSBC 百分位 100 日)
+MIN_BARS = 20               # 與全量計算一致: 少於 20 筆不輸出
+VSBC_MIN_BARS = 100         # 與全量計算一致: 少於 100 筆不計算 VSBC
+RESYNC_INTERVAL = 250       # 每推進 N 根即以視窗重算滾動和，避免浮點累積誤差
+
+MA_PERIODS = (3, 20, 60, 120, 200)
+VWAP_PERIODS = (20, 60, 200)
+
+# bars 陣列的列索引
+F_DATE, F_OPEN, F_HIGH, F_LOW, F_CLOSE, F_VOLUME = range(6)
+N_FIELDS = 6
+
+# 表驅動法: 滾動和規格 (鍵 -> (來源序列, 期數, 是否加權))
+SUM_SPECS = {}
+for _n in MA_PERIODS:
+    SUM_SPECS[f'ma{_n}'] = ('close', _n, False)
+    SUM_SPECS[f'wma{_n}'] = ('close', _n, True)
+for _n in VWAP_PERIODS:
+    SUM_SPECS[f'tpv{_n}'] = ('tpv', _n, False)
+    SUM_SPECS[f'vol{_n}'] = ('volume', _n, False)
+SUM_SPECS.update({
+    'vol3': ('volume', 3, False),
+    'wma12': ('close', 12, True),
+    'wma26': ('close', 26, True),
+    'gain14': ('gain', 14, True),
+    'loss14': ('loss', 14, True),
+    'mfpos14': ('mfpos', 14, True),
+    'mfneg14': ('mfneg', 14, True),
+})
+MACD_SIGNAL_PERIOD = 9
+WEEKLY_KD_PERIOD = 45       # 週 KD 以 45 日 (9 週) 計算 RSV
+
+# 累計型指標: 全量模式以 450 日視窗起點為錨點，增量模式以建檔日為錨點，
+# 驗證時比較「單日變化」(倍率或增量) 而非絕對值
+CUMULATIVE_FIELDS = {'NVI': ('ratio', 'NVI_prev'), 'PVI': ('ratio', 'pvi_prev'), 'ADL': ('delta', 'ADL_prev')}
+
+# 與 _format_indicators_result 一致的「前一日」欄位對照
+PREV_FIELDS = {
+    'MA3_prev': 'MA3', 'MA20_prev': 'MA20', 'MA60_prev': 'MA60',
+    'MA120_prev': 'MA120', 'MA200_prev': 'MA200',
+    'WMA3_prev': 'WMA3', 'WMA20_prev': 'WMA20', 'WMA60_prev': 'WMA60',
+    'WMA120_prev': 'WMA120', 'WMA200_prev': 'WMA200',
+    'MFI_prev': 'MFI', 'VWAP_prev': 'VWAP', 'CHG14_prev': 'CHG14', 'RSI_prev': 'RSI',
+    'Month_K_prev': 'Month_K', 'Month_D_prev': 'Month_D',
+    'Daily_K_prev': 'Daily_K', 'Daily_D_prev': 'Daily_D',
+    'Week_K_prev': 'Week_K', 'Week_D_prev': 'Week_D',
+    'close_prev': 'close', 'vol_prev': 'volume',
+    'SMI_Signal_prev': 'SMI_Signal', 'NVI_Signal_prev': 'NVI_Signal',
+    'SVI_Signal_prev': 'SVI_Signal', 'Smart_Score_prev': 'Smart_Score',
+    'pvi_prev': 'PVI', 'VSBC_prev': 'VSBC',
+    'NVI_prev': 'NVI', 'ADL_prev': 'ADL',
+}
+
+INDICATOR_STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS indicator_state (
+        code TEXT PRIMARY KEY,
+        date_int INTEGER,
+        n_bars INTEGER,
+        window BLOB,
+        carry TEXT,
+        updated_at TEXT
+    )
+"""
+
+INDICATOR_STATE_UPSERT = """
+    INSERT OR REPLACE INTO indicator_state (code, date_int, n_bars, window, carry, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+# ==============================
+# 小工具
+# ==============================
+def _isnan(x):
+    return x is None or (isinstance(x, float) and x != x)
+
+
+def _r(x, digits=2):
+    """四捨五入 (與 pandas .round() 同為 numpy 規則)，NaN/inf 轉 None"""
+    if x is None:
+        return None
+    x = float(x)
+    if not np.isfinite(x):
+        return None
+    return float(np.round(x, digits))
+
+
+def _rolling_mean_minp1(values, win):
+    """rolling(win, min_periods=1).mean() 的 numpy 版本"""
+    csum = np.cumsum(np.concatenate(([0.0], values)))
+    idx = np.arange(1, len(values) + 1)
+    start = np.maximum(idx - win, 0)
+    return (csum[idx] - csum[start]) / (idx - start)
+
+
+def _rolling_sum(values, win):
+    """rolling(win).sum()，不足 win 筆為 NaN"""
+    out = np.full(len(values), np.nan)
+    if len(values) >= win:
+        csum = np.cumsum(np.concatenate(([0.0], values)))
+        out[win - 1:] = csum[win:] - csum[:-win]
+    return out
+
+
+def _wma_series(values, period):
+    """與 IndicatorCalculator.calculate_wma 相同 (最新一筆權重最大)"""
+    if len(values) < period:
+        return np.full(len(values), np.nan)
+    weights = np.arange(1, period + 1)
+    valid = np.convolve(values, weights[::-1], mode='valid') / weights.sum()
+    return np.concatenate((np.full(period - 1, np.nan), valid))
+
+
+def _to_date(date_int):
+    d = int(date_int)
+    return date(d // 10000, (d // 100) % 100, d % 100)
+
+
+def _source_series(bars):
+    """滾動和的來源序列 (視窗第一筆無前值時為 0，與全量計算一致)"""
+    c = bars[F_CLOSE]
+    v = bars[F_VOLUME]
+    tp = (bars[F_HIGH] + bars[F_LOW] + c) / 3
+    delta = np.diff(c, prepend=c[:1])
+    tp_prev = np.concatenate(([np.nan], tp[:-1]))
+    mf = tp * v
+    with np.errstate(invalid='ignore'):
+        up = tp > tp_prev
+        down = tp < tp_prev
+    return {
+        'close': c,
+        'volume': v,
+        'tpv': tp * v,
+        'gain': np.where(delta > 0, delta, 0.0),
+        'loss': np.where(delta < 0, -delta, 0.0),
+        'mfpos': np.where(up, mf, 0.0),
+        'mfneg': np.where(down, mf, 0.0),
+    }
+
+
+def _init_sum(src, n, weighted):
+    """以視窗尾端 n 筆初始化滾動和"""
+    if len(src) < n:
+        return None
+    x = src[-n:]
+    if weighted:
+        return [float(x.sum()), float((x * np.arange(1, n + 1)).sum())]
+    return float(x.sum())
+
+
+def _rsv(close, high, low, period):
+    """單點 RSV (不足期數或 0/0 以 50 代替，與全量 fillna(50) 一致)"""
+    if len(close) < period:
+        return 50.0
+    hh = np.max(high[-period:])
+    ll = np.min(low[-period:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsv = (close[-1] - ll) / (hh - ll) * 100
+    return 50.0 if rsv != rsv else float(rsv)
+
+
+def _rsv_series(close, high, low, period):
+    """RSV 序列 (seed 用)，規則同 _rsv"""
+    out = np.full(len(close), 50.0)
+    if len(close) >= period:
+        from numpy.lib.stride_tricks import sliding_window_view
+        hh = np.max(sliding_window_view(high, period), axis=1)
+        ll = np.min(sliding_window_view(low, period), axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsv = (close[period - 1:] - ll) / (hh - ll) * 100
+        out[period - 1:] = np.where(np.isnan(rsv), 50.0, rsv)
+    return [float(x) for x in out]
+
+
+# ==============================
+# 狀態物件
+# ==============================
+class IndicatorState:
+    """單一股票的增量指標狀態"""
+    __slots__ = ('code', 'bars', 'n_bars', 'sums', 'carry')
+
+    def __init__(self, code, bars=None, n_bars=0, sums=None, carry=None):
+        self.code = code
+        self.bars = bars if bars is not None else np.empty((N_FIELDS, 0))
+        self.n_bars = n_bars
+        self.sums = sums or {}
+        self.carry = carry or {}
+
+    @property
+    def date_int(self):
+        return int(self.bars[F_DATE, -1]) if self.bars.shape[1] else None
+
+    @property
+    def last_bar(self):
+        """最後一根 K 棒 (date_int, open, high, low, close, volume)"""
+        return tuple(self.bars[:, -1]) if self.bars.shape[1] else None
+
+    # ---------- 序列化 ----------
+    def to_row(self):
+        """轉為 indicator_state 資料列"""
+        carry = {'n_bars': self.n_bars, 'sums': self.sums, 'carry': self.carry}
+        return (
+            self.code, self.date_int, self.n_bars,
+            np.ascontiguousarray(self.bars, dtype=np.float64).tobytes(),
+            json.dumps(carry),
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """由 indicator_state 資料列 (code, date_int, n_bars, window, carry) 還原"""
+        code, _date_int, n_bars, blob, carry_json = row[:5]
+        bars = np.frombuffer(blob, dtype=np.float64).reshape(N_FIELDS, -1).copy()
+        payload = json.loads(carry_json)
+        return cls(code, bars, n_bars, payload.get('sums'), payload.get('carry'))
+
+
+# ==============================
+# 建檔與推進
+# ==============================
+def seed_state(code, bars):
+    """
+    以完整回溯視窗 (6 x N 陣列，與全量模式相同的 450 日) 建立狀態
+    回傳的狀態已包含最後一根的輸出 (carry['last'])
+    """
+    bars = np.asarray(bars, dtype=np.float64)
+    n = bars.shape[1]
+    if n == 0:
+        return None
+
+    c, h, l, v = bars[F_CLOSE], bars[F_HIGH], bars[F_LOW], bars[F_VOLUME]
+    state = IndicatorState(code, bars[:, -STATE_WINDOW:].copy(), n)
+
+    # 1. 遞迴狀態 (KD: EWM span=3, adjust=False)
+    k = d = wk = wd = None
+    for rsv, wrsv in zip(_rsv_series(c, h, l, 9), _rsv_series(c, h, l, WEEKLY_KD_PERIOD)):
+        k = rsv if k is None else 0.5 * rsv + 0.5 * k
+        d = k if d is None else 0.5 * k + 0.5 * d
+        wk = wrsv if wk is None else 0.5 * wrsv + 0.5 * wk
+        wd = wk if wd is None else 0.5 * wk + 0.5 * wd
+
+    # 2. 累計狀態 (NVI / PVI / ADL)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.diff(c) / c[:-1]
+        mfm = ((c - l) - (h - c)) / (h - l)
+    mfm = np.where(np.isnan(mfm), 0.0, mfm)
+    nvi = 1000.0 * float(np.prod(np.where(v[1:] < v[:-1], 1 + pct, 1.0)))
+    pvi = 1000.0 * float(np.prod(np.where(v[1:] > v[:-1], 1 + pct, 1.0)))
+    adl = float(np.sum(mfm * v))
+
+    # 3. MACD 尾端 (訊號線 = MACD 的 WMA9)
+    macd_line = _wma_series(c, 12) - _wma_series(c, 26)
+    tail = [None if np.isnan(x) else float(x) for x in macd_line[-MACD_SIGNAL_PERIOD:]]
+
+    state.carry = {'k': k, 'd': d, 'wk': wk, 'wd': wd,
+                   'nvi': nvi, 'pvi': pvi, 'adl': adl, 'macd_tail': tail,
+                   'since_resync': 0}
+    _resync_sums(state)
+    state.carry['last'] = latest_outputs(state)
+    return state
+
+
+def _resync_sums(state):
+    """以尾端視窗重算全部滾動和"""
+    srcs = _source_series(state.bars)
+    state.sums = {key: _init_sum(srcs[src], n, weighted)
+                  for key, (src, n, weighted) in SUM_SPECS.items()}
+    state.carry['since_resync'] = 0
+
+
+def advance(state, bar):
+    """
+    推進一根 K 棒 (date_int, open, high, low, close, volume)
+    :return: 最新一根的完整輸出 (含 *_prev 欄位)
+    """
+    bar = np.asarray(bar, dtype=np.float64).reshape(N_FIELDS, 1)
+    bars = np.concatenate((state.bars, bar), axis=1)
+    c, h, l, v = bars[F_CLOSE], bars[F_HIGH], bars[F_LOW], bars[F_VOLUME]
+    first_bar = state.n_bars == 0
+
+    # 1. 滾動和 (O(1) 加入新值、扣除離開視窗的舊值)
+    srcs = _source_series(bars)
+    for key, (src, n, weighted) in SUM_SPECS.items():
+        s = state.sums.get(key)
+        series = srcs[src]
+        if s is None:
+            state.sums[key] = _init_sum(series, n, weighted)
+            continue
+        x_new = float(series[-1])
+        x_old = float(series[-1 - n])
+        if weighted:
+            total, numer = s
+            state.sums[key] = [total - x_old + x_new, numer - total + n * x_new]
+        else:
+            state.sums[key] = s - x_old + x_new
+
+    # 2. 遞迴狀態
+    carry = state.carry
+    prev_week_kd = (carry.get('wk'), carry.get('wd'))
+    rsv = _rsv(c, h, l, 9)
+    wrsv = _rsv(c, h, l, WEEKLY_KD_PERIOD)
+    if first_bar:
+        carry.update(k=rsv, d=rsv, wk=wrsv, wd=wrsv, nvi=1000.0, pvi=1000.0, adl=0.0)
+    else:
+        carry['k'] = 0.5 * rsv + 0.5 * carry['k']
+        carry['d'] = 0.5 * carry['k'] + 0.5 * carry['d']
+        carry['wk'] = 0.5 * wrsv + 0.5 * carry['wk']
+        carry['wd'] = 0.5 * carry['wk'] + 0.5 * carry['wd']
+        pct = (c[-1] - c[-2]) / c[-2] if c[-2] else 0.0
+        if v[-1] < v[-2]:
+            carry['nvi'] *= (1 + pct)
+        if v[-1] > v[-2]:
+            carry['pvi'] *= (1 + pct)
+    rng = h[-1] - l[-1]
+    mfm = ((c[-1] - l[-1]) - (h[-1] - c[-1])) / rng if rng else 0.0
+    carry['adl'] += float(mfm * v[-1])
+
+    # 3. 視窗裁切 (滾動和已扣除離開的值)
+    state.bars = bars[:, -STATE_WINDOW:]
+    state.n_bars += 1
+
+    # 4. MACD 尾端
+    w12, w26 = state.sums.get('wma12'), state.sums.get('wma26')
+    macd = None
+    if w12 is not None and w26 is not None:
+        macd = w12[1] / (12 * 13 / 2) - w26[1] / (26 * 27 / 2)
+    carry['macd_tail'] = (carry.get('macd_tail', []) + [macd])[-MACD_SIGNAL_PERIOD:]
+
+    carry['since_resync'] = carry.get('since_resync', 0) + 1
+    if carry['since_resync'] >= RESYNC_INTERVAL:
+        _resync_sums(state)
+
+    # 5. 輸出 (前一日欄位取自上一輪輸出)
+    prev = carry.get('last') or {}
+    out = latest_outputs(state)
+    carry['last'] = out
+    result = dict(out)
+    for prev_key, key in PREV_FIELDS.items():
+        result[prev_key] = prev.get(key)
+    # 週 KD 剛滿 45 筆時，全量模式的前一日值為整段序列的 EWM (非 NaN)
+    if out.get('Week_K') is not None and result.get('Week_K_prev') is None:
+        result['Week_K_prev'], result['Week_D_prev'] = (_r(x) for x in prev_week_kd)
+    # VSBC 剛滿 100 筆時同理，前一日分數取自同一段序列
+    if out.get('VSBC') is not None and result.get('VSBC_prev') is None and state.bars.shape[1] >= 2:
+        result['VSBC_prev'] = round(float(vsbc_series(state.bars)[-2]), 2)
+    return result
+
+
+# ==============================
+# 最後一根的指標輸出
+# ==============================
+def _wma_from_sum(s, n):
+    return None if s is None else s[1] / (n * (n + 1) / 2)
+
+
+def _ratio_indicator(pos, neg):
+    """RSI / MFI 共用: neg==0 時 pos>0 為 100，否則 50"""
+    if neg == 0:
+        return 100.0 if pos > 0 else 50.0
+    return 100 - (100 / (1 + pos / neg))
+
+
+def period_open_close(dates, opens, closes, last_date_int, freq):
+    """
+    對齊全量模式 resample('W'/'M') + reindex(ffill) 的結果：
+    取「不晚於今日的最近一個週/月結束標籤」所屬區間的第一個開盤與最後收盤
+    """
+    d = _to_date(last_date_int)
+    if freq == 'W':
+        label = d - timedelta(days=(d.weekday() + 1) % 7)
+        lo, hi = (label - timedelta(days=7)).toordinal(), label.toordinal()
+        mask = np.array([lo < _to_date(x).toordinal() <= hi for x in dates])
+    else:
+        if (d + timedelta(days=1)).month != d.month:
+            y, m = d.year, d.month
+        else:
+            y, m = (d.year, d.month - 1) if d.month > 1 else (d.year - 1, 12)
+        mask = (dates.astype(np.int64) // 100) == (y * 100 + m)
+    if not mask.any():
+        return None, None
+    return float(opens[mask][0]), float(closes[mask][-1])
+
+
+def volume_profile_scheme3(high, low, close, volume, price_levels=10):
+    """與 IndicatorCalculator.calculate_vp_scheme3 相同的 10 價位 VP (POC / 價值區)"""
+    if len(close) < 2:
+        return {'POC': None, 'VP_upper': None, 'VP_lower': None}
+    poc, upper, lower = latest_volume_profile(high, low, close, volume, window=len(close),
+                                              price_levels=price_levels)
+    return {'POC': _r(poc), 'VP_upper': _r(upper), 'VP_lower': _r(lower)}
+
+
+def vsbc_series(bars, win=10, n_recent=3, scale=100):
+    """與 calc_vsbc_series 相同的 VSBC 分數序列 (numpy 版)"""
+    o, h, l, c, v = (bars[F_OPEN], bars[F_HIGH], bars[F_LOW], bars[F_CLOSE], bars[F_VOLUME])
+    signed = np.where(c >= o, v, -v)
+    vs_force = _rolling_mean_minp1(signed, win)
+    vol_mean = _rolling_mean_minp1(v, win)
+    base_range = _rolling_mean_minp1(h - l, win)
+    base_range = np.where(base_range == 0, 1e-9, base_range)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = vs_force / vol_mean
+    shift = np.clip(np.where(np.isnan(shift), 0.0, shift), -0.5, 0.5)
+    mid = (h + l) / 2 + shift * base_range
+
+    diffs = np.diff(mid, prepend=np.nan)
+    with np.errstate(invalid='ignore'):
+        up = _rolling_sum((diffs > 0).astype(float), n_recent)
+        down = _rolling_sum((diffs < 0).astype(float), n_recent)
+        direction = np.where(up > down, 1, np.where(down > up, -1, 0))
+    # 第一筆 diff 為 NaN: 含該筆的視窗 (前 n_recent 筆) 與 pandas rolling 一樣輸出 NaN
+    abs_sum = _rolling_sum(np.abs(np.nan_to_num(diffs)), n_recent)
+    abs_sum[:n_recent] = np.nan
+    magnitude = (abs_sum / n_recent) / (base_range + 1e-9)
+    consistency = np.maximum(up, down) / n_recent
+    out = direction * magnitude * consistency * scale
+    return np.where(np.isnan(out), 0.0, out)
+
+
+def vsbc_percentile(series, window=100, min_periods=20):
+    """rolling(100, min_periods=20).rank(pct=True) 的最後一點，不足期數回傳 50"""
+    x = series[-window:]
+    if len(x) < min_periods:
+        return 50.0
+    last = x[-1]
+    rank = np.sum(x < last) + (np.sum(x == last) + 1) / 2
+    return float(rank / len(x) * 100)
+
+
+def latest_outputs(state):
+    """計算狀態最後一根 K 棒的指標 (不含 *_prev 欄位)"""
+    b = state.bars
+    n = b.shape[1]
+    if n == 0:
+        return {}
+    dates, o, h, l, c, v = b
+    sums = state.sums
+    carry = state.carry
+    out = {'date_int': int(dates[-1]), 'open': float(o[-1]), 'high': float(h[-1]),
+           'low': float(l[-1]), 'close': float(c[-1]), 'volume': float(v[-1])}
+
+    # 均線
+    for p in MA_PERIODS:
+        s = sums.get(f'ma{p}')
+        out[f'MA{p}'] = _r(s / p) if s is not None else None
+        out[f'WMA{p}'] = _r(_wma_from_sum(sums.get(f'wma{p}'), p))
+    out['Vol_MA3'] = _r(sums['vol3'] / 3) if sums.get('vol3') is not None else None
+
+    # VWAP
+    for p, key in ((20, 'VWAP'), (60, 'VWAP60'), (200, 'VWAP200')):
+        tpv, vol = sums.get(f'tpv{p}'), sums.get(f'vol{p}')
+        out[key] = _r(tpv / vol) if tpv is not None and vol else None
+
+    # RSI / MFI (WMA14)
+    gain, loss = _wma_from_sum(sums.get('gain14'), 14), _wma_from_sum(sums.get('loss14'), 14)
+    out['RSI'] = _r(_ratio_indicator(gain, loss)) if gain is not None and loss is not None else None
+    pos, neg = _wma_from_sum(sums.get('mfpos14'), 14), _wma_from_sum(sums.get('mfneg14'), 14)
+    out['MFI'] = _r(_ratio_indicator(pos, neg)) if pos is not None and neg is not None else 50.0
+
+    # MACD
+    tail = carry.get('macd_tail', [])
+    out['MACD'] = _r(tail[-1]) if tail and tail[-1] is not None else None
+    if len(tail) == MACD_SIGNAL_PERIOD and all(x is not None for x in tail):
+        out['SIGNAL'] = _r(np.dot(tail, np.arange(1, MACD_SIGNAL_PERIOD + 1))
+                            / (MACD_SIGNAL_PERIOD * (MACD_SIGNAL_PERIOD + 1) / 2))
+    else:
+        out['SIGNAL'] = None
+
+    # KD (月 KD 與日 KD 在全量模式為相同算法)
+    out['Daily_K'] = out['Month_K'] = _r(carry.get('k'))
+    out['Daily_D'] = out['Month_D'] = _r(carry.get('d'))
+    weekly_ready = state.n_bars >= WEEKLY_KD_PERIOD
+    out['Week_K'] = _r(carry.get('wk')) if weekly_ready else None
+    out['Week_D'] = _r(carry.get('wd')) if weekly_ready else None
+
+    # 14 日變化率 / SMI / RS
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['CHG14'] = _r((c[-1] - c[-15]) / c[-15] * 100) if n >= 15 else 0.0
+        if n >= 14:
+            hh, ll = np.max(h[-14:]), np.min(l[-14:])
+            smi = (c[-1] - (hh + ll) / 2) / (hh - ll) * 100
+            out['SMI'] = 0.0 if smi != smi else _r(smi)
+        else:
+            out['SMI'] = None
+        if n >= 15:
+            rets = c[-14:] / c[-15:-1] - 1
+            avg_gain = np.mean(np.where(rets > 0, rets, 0.0))
+            avg_loss = np.mean(np.where(rets < 0, -rets, 0.0))
+            rs = avg_gain / (avg_loss + 1e-10)
+            out['RS'] = _r(100 - (100 / (1 + rs)))
+        else:
+            out['RS'] = 50.0
+    out['Mansfield_RS'] = out['RS']
+
+    ma200 = out['MA200']
+    out['SVI'] = _r((c[-1] - ma200) / ma200 * 100) if ma200 else None
+
+    # 累計型
+    out['NVI'] = _r(carry.get('nvi'))
+    out['PVI'] = _r(carry.get('pvi'))
+    out['ADL'] = _r(carry.get('adl'))
+    rng = h[-1] - l[-1]
+    out['clv'] = _r(((c[-1] - l[-1]) - (h[-1] - c[-1])) / rng) if rng else 0.0
+
+    # 簡化版智慧分數 (與 calculate_smart_score_series 相同的常數)
+    out['Smart_Score'] = 50
+    for key in ('SMI_Signal', 'NVI_Signal', 'VSA_Signal', 'SVI_Signal',
+                'Vol_Div_Signal', 'Weekly_NVI_Signal'):
+        out[key] = 0
+
+    # 3 日量價背離
+    if n >= 4:
+        pc, vc = c[-1] - c[-4], v[-1] - v[-4]
+        out['Div_3Day_Bull'] = int(pc < 0 and vc > 0)
+        out['Div_3Day_Bear'] = int(pc > 0 and vc < 0)
+    else:
+        out['Div_3Day_Bull'] = out['Div_3Day_Bear'] = 0
+
+    # BBW / Fib 0.618
+    if n >= 20:
+        ma20, std20 = np.mean(c[-20:]), np.std(c[-20:], ddof=1)
+        out['BBW'] = _r(4 * std20 / ma20, 4) if ma20 else None
+    else:
+        out['BBW'] = None
+    if n >= 60:
+        hh60, ll60 = np.max(h[-60:]), np.min(l[-60:])
+        out['Fib_0618'] = _r(hh60 - (hh60 - ll60) * 0.618)
+    else:
+        out['Fib_0618'] = None
+
+    # 週/月 開收盤 (前一完整週期)
+    tail_n = min(n, 70)
+    out['Weekly_Open'], out['Weekly_Close'] = period_open_close(
+        dates[-tail_n:], o[-tail_n:], c[-tail_n:], dates[-1], 'W')
+    out['Monthly_Open'], out['Monthly_Close'] = period_open_close(
+        dates[-tail_n:], o[-tail_n:], c[-tail_n:], dates[-1], 'M')
+
+    # Volume Profile (近 20 日)
+    vp = volume_profile_scheme3(h[-20:], l[-20:], c[-20:], v[-20:])
+    out.update(vp)
+
+    # VSBC
+    if state.n_bars >= VSBC_MIN_BARS:
+        series = vsbc_series(b)
+        out['VSBC'] = round(float(series[-1]), 2)
+        out['VSBC_pct'] = round(vsbc_percentile(series), 2)
+    else:
+        out['VSBC'] = out['VSBC_pct'] = None
+    return out
+
+
+# ==============================
+# 驗證 (與全量重算比對)
+# ==============================
+def compare_with_full(incremental, full_latest, full_prev=None, tolerance=0.011):
+    """
+    比對增量輸出與全量重算輸出
+    - 一般欄位: 絕對誤差 <= tolerance (兩位小數的進位差)
+    - NVI / PVI 比對單日倍率，ADL 比對單日增量 (兩者錨點不同)
+    :return: [(欄位, 增量值, 全量值), ...] 不一致清單
+    """
+    cumulative_prev_keys = {prev_key for _, prev_key in CUMULATIVE_FIELDS.values()}
+    mismatches = []
+    for key, inc_val in incremental.items():
+        if key in cumulative_prev_keys:
+            continue
+        if key in CUMULATIVE_FIELDS:
+            kind, prev_key = CUMULATIVE_FIELDS[key]
+            inc_prev = incremental.get(prev_key)
+            full_val = full_latest.get(key)
+            full_prev_val = (full_prev or {}).get(key)
+            if any(_isnan(x) for x in (inc_val, inc_prev, full_val, full_prev_val)):
+                continue
+            if kind == 'ratio':
+                if not inc_prev or not full_prev_val:
+                    continue
+                inc_step, full_step, tol = inc_val / inc_prev, full_val / full_prev_val, 1e-4
+            else:
+                inc_step, full_step, tol = inc_val - inc_prev, full_val - full_prev_val, tolerance * 2
+            if abs(inc_step - full_step) > tol:
+                mismatches.append((f'{key}(單日變化)', round(inc_step, 6), round(full_step, 6)))
+            continue
+        if key not in full_latest:
+            continue
+        full_val = full_latest.get(key)
+        if _isnan(inc_val) and _isnan(full_val):
+            continue
+        if _isnan(inc_val) or _isnan(full_val):
+            mismatches.append((key, inc_val, full_val))
+            continue
+        try:
+            if abs(float(inc_val) - float(full_val)) > tolerance:
+                mismatches.append((key, inc_val, full_val))
+        except (TypeError, ValueError):
+            if inc_val != full_val:
+                mismatches.append((key, inc_val, full_val))
+    return mismatches
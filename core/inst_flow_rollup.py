@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 法人買賣超前綴和 (inst_flow_rollup)
+
+/api/rankings/institutional?days=N 原本每次請求先對 stock_history 做 SELECT DISTINCT date_int，
+再以兩次 SUM(...) GROUP BY code 全段掃描 (一次算筆數、一次取資料)。此模組由主程式維護前綴和：
+- inst_flow_prefix: 每檔每個交易日的外資/投信/自營累計淨買超 (主鍵 (code, date_int))
+- inst_flow_latest: 每檔最後一筆累計值
+- inst_flow_days: 每個交易日的筆數與三者合計，作為交易日清單與異動比對的檢查碼
+任意 N 日區間合計 = 最新累計 - 區間前一筆累計 (每檔一次主鍵 seek)，見 window_sql()。
+法人資料常晚於行情入庫或事後回補，更新時以最近 CHECK_DAYS 天的檢查碼比對 stock_history，
+從最早不一致的日期起重算；更早的修正可用 rebuild_from 指定。
+函式本身不 commit，由呼叫端決定交易範圍 (主程式經 db_manager.run_transaction 執行)。
+"""
+import sqlite3
+from typing import Optional
+
+PREFIX_TABLE = 'inst_flow_prefix'
+LATEST_TABLE = 'inst_flow_latest'
+DAYS_TABLE = 'inst_flow_days'
+CHECK_DAYS = 60                 # 法人資料回補的天數 (step3_5_download_institutional 預設 60 天)
+FLOWS = ('foreign_buy', 'trust_buy', 'dealer_buy')
+
+DDL = (
+    f"""CREATE TABLE IF NOT EXISTS {PREFIX_TABLE} (
+        code TEXT, date_int INTEGER, foreign_cum INTEGER, trust_cum INTEGER, dealer_cum INTEGER,
+        PRIMARY KEY (code, date_int)) WITHOUT ROWID""",
+    f"""CREATE TABLE IF NOT EXISTS {LATEST_TABLE} (
+        code TEXT PRIMARY KEY, date_int INTEGER, foreign_cum INTEGER, trust_cum INTEGER, dealer_cum INTEGER)""",
+    f"""CREATE TABLE IF NOT EXISTS {DAYS_TABLE} (
+        date_int INTEGER PRIMARY KEY, rows INTEGER, foreign_sum INTEGER, trust_sum INTEGER, dealer_sum INTEGER)""",
+)
+
+_DAY_TOTALS = ("SELECT date_int, COUNT(*), COALESCE(SUM(foreign_buy), 0), COALESCE(SUM(trust_buy), 0), "
+               "COALESCE(SUM(dealer_buy), 0) FROM stock_history WHERE date_int >= ? GROUP BY date_int")
+_ONE_DAY_TOTALS = _DAY_TOTALS.replace("date_int >= ? GROUP BY date_int", "date_int = ?")
+
+
+def ensure_tables(conn):
+    for ddl in DDL:
+        conn.execute(ddl)
+
+
+def _dirty_start(conn, check_days):
+    """
+    需要重算的起始日期
+    :return: 0=尚未建立 (全部重算)；None=已是最新
+    """
+    stored = conn.execute(f"SELECT * FROM {DAYS_TABLE} ORDER BY date_int DESC LIMIT ?", (check_days,)).fetchall()
+    if not stored:
+        return 0
+    since = stored[-1][0]
+    actual = {row[0]: tuple(row) for row in conn.execute(_DAY_TOTALS, (since,)).fetchall()}
+    expected = {row[0]: tuple(row) for row in stored}
+    dirty = [day for day in actual.keys() | expected.keys() if actual.get(day) != expected.get(day)]
+    return min(dirty) if dirty else None
+
+
+def update_inst_flow_rollup(conn, rebuild_from: Optional[int] = None, check_days: int = CHECK_DAYS):
+    """
+    增量更新前綴和 (累計以視窗函式在 SQLite 內計算，全量重建也不需把整張表載入記憶體)
+    :param rebuild_from: 從此日 (含) 起重算；None 時依檢查碼自動判斷
+    :return: 重算的交易日數
+    """
+    ensure_tables(conn)
+    start = _dirty_start(conn, check_days) if rebuild_from is None else int(rebuild_from)
+    if start is None:
+        return 0
+
+    # 1. 刪除重算範圍；inst_flow_latest 退回各檔範圍前的最後一筆 (沒有前一筆的刪除)，作為累計起點
+    conn.execute(f"DELETE FROM {PREFIX_TABLE} WHERE date_int >= ?", (start,))
+    conn.execute(f"DELETE FROM {DAYS_TABLE} WHERE date_int >= ?", (start,))
+    conn.execute(f"""
+        INSERT OR REPLACE INTO {LATEST_TABLE}
+        SELECT p.code, p.date_int, p.foreign_cum, p.trust_cum, p.dealer_cum
+        FROM {LATEST_TABLE} l
+        JOIN {PREFIX_TABLE} p ON p.code = l.code
+         AND p.date_int = (SELECT MAX(date_int) FROM {PREFIX_TABLE} WHERE code = l.code)
+        WHERE l.date_int >= ?""", (start,))
+    conn.execute(f"DELETE FROM {LATEST_TABLE} WHERE date_int >= ?", (start,))
+
+    # 2. 起點 + 範圍內逐日累計 (NULL 視為 0)
+    cums = ', '.join(f"COALESCE(l.{name[:-4]}_cum, 0) + SUM(COALESCE(h.{name}, 0)) OVER w" for name in FLOWS)
+    conn.execute(f"""
+        INSERT INTO {PREFIX_TABLE}
+        SELECT h.code, h.date_int, {cums}
+        FROM stock_history h
+        LEFT JOIN {LATEST_TABLE} l ON l.code = h.code
+        WHERE h.date_int >= ?
+        WINDOW w AS (PARTITION BY h.code ORDER BY h.date_int)""", (start,))
+
+    # 3. 範圍內有資料的股票更新最後一筆累計
+    conn.execute(f"""
+        INSERT OR REPLACE INTO {LATEST_TABLE}
+        SELECT p.code, p.date_int, p.foreign_cum, p.trust_cum, p.dealer_cum
+        FROM (SELECT DISTINCT code FROM stock_history WHERE date_int >= ?) c
+        JOIN {PREFIX_TABLE} p ON p.code = c.code
+         AND p.date_int = (SELECT MAX(date_int) FROM {PREFIX_TABLE} WHERE code = c.code)""", (start,))
+
+    day_rows = conn.execute(_DAY_TOTALS, (start,)).fetchall()
+    conn.executemany(f"INSERT INTO {DAYS_TABLE} VALUES (?, ?, ?, ?, ?)", day_rows)
+    return len(day_rows)
+
+
+def rollup_ready(conn):
+    """
+    前綴和已建立、涵蓋 stock_history 最新交易日，且該日檢查碼 (筆數與三者合計) 與 stock_history 一致
+    最新一日的法人資料常在收盤行情入庫後才補上；不一致時讀取端退回 GROUP BY
+    (只比對最新一日，經 date_int 索引聚合一天的列)
+    """
+    try:
+        stored = conn.execute(f"SELECT * FROM {DAYS_TABLE} ORDER BY date_int DESC LIMIT 1").fetchone()
+    except sqlite3.OperationalError:
+        return False
+    if stored is None:
+        return False
+    latest = conn.execute("SELECT MAX(date_int) FROM stock_history").fetchone()[0]
+    if stored[0] != latest:
+        return False
+    actual = conn.execute(_ONE_DAY_TOTALS, (latest,)).fetchone()
+    return actual is not None and tuple(actual) == tuple(stored)
+
+
+def window_cutoff(conn, days):
+    """最近 days 個交易日的第一天 (交易日不足時為最早一天)"""
+    return conn.execute(f"SELECT MIN(date_int) FROM (SELECT date_int FROM {DAYS_TABLE} "
+                        f"ORDER BY date_int DESC LIMIT ?)", (days,)).fetchone()[0]
+
+
+def window_sql():
+    """
+    N 日區間合計的 CTE 本體 (參數: cutoff, cutoff)
+    欄位: code, foreign_buy, trust_buy, dealer_buy；只包含區間內有資料的股票
+    """
+    return f"""
+        SELECT l.code,
+               l.foreign_cum - COALESCE(p.foreign_cum, 0) AS foreign_buy,
+               l.trust_cum - COALESCE(p.trust_cum, 0) AS trust_buy,
+               l.dealer_cum - COALESCE(p.dealer_cum, 0) AS dealer_buy
+        FROM {LATEST_TABLE} l
+        LEFT JOIN {PREFIX_TABLE} p ON p.code = l.code
+         AND p.date_int = (SELECT MAX(date_int) FROM {PREFIX_TABLE} WHERE code = l.code AND date_int < ?)
+        WHERE l.date_int >= ?"""
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 機構價值回歸策略的批次計算 (institutional_value)
+
+InstitutionalValueStrategy.scan 原本逐檔以 f-string SQL 讀取整段 stock_history 與法人資料
+(每檔重開連線、兩次 pd.read_sql)，再以 pandas 重算 WMA200 / VWAP200 / Mansfield RS / 週 KD，
+全市場需數分鐘。此模組改為：
+- 歷史由呼叫端一次批次載入 ({code: 欄位陣列}，每檔最近 LOOKBACK_BARS 根)
+- 法人淨買超以單次依 (code, date_int) 排序的查詢讀成欄位陣列，以 searchsorted 依 date_int 對齊
+- 各指標只算最後需要的值；KD / 週 KD 的遞迴只對通過前段篩選的股票計算
+公式與原 pandas 版相同 (rolling 視窗、ewm(com=2, adjust=False)、週線以週五為界)；
+EWM 起始值的影響在 LOOKBACK_BARS 根後已可忽略。
+"""
+import numpy as np
+
+LOOKBACK_BARS = 320         # 200 日均線 + 週 KD 暖身
+MIN_BARS = 250              # 原策略要求的最少歷史筆數
+FLOW_DAYS = 5               # 法人近 N 日淨買超
+VALUE_ZONE = 0.05           # 回測 Fib 0.618 / WMA20 的距離 (5%)
+
+
+def _net_flow_sql(since_date_int):
+    # numpy.int64 會被 sqlite3 當成 BLOB 綁定 (與 INTEGER 比較恆不成立)，先轉回 int
+    return ("SELECT code, date_int, COALESCE(foreign_buy - foreign_sell, 0) + COALESCE(trust_buy - trust_sell, 0) "
+            "FROM institutional_investors WHERE date_int >= ? ORDER BY code, date_int", (int(since_date_int),))
+
+
+def load_net_flows(conn, since_date_int):
+    """
+    外資 + 投信淨買超 (單次查詢)
+    :return: {code: (date_int 陣列, 淨買超陣列)}，依日期遞增
+    """
+    sql, params = _net_flow_sql(since_date_int)
+    rows = conn.execute(sql, params).fetchall()
+    if not rows:
+        return {}
+    codes = [r[0] for r in rows]
+    dates = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+    nets = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+    bounds = [0] + [i for i in range(1, len(rows)) if codes[i] != codes[i - 1]] + [len(rows)]
+    return {codes[s]: (dates[s:e], nets[s:e]) for s, e in zip(bounds[:-1], bounds[1:])}
+
+
+def align_exact(dates, ref_dates, ref_values):
+    """
+    依 date_int 取 ref 在同日的值，缺日沿用前一筆 (等同 reindex(...).fillna(method='ffill'))
+    """
+    idx = np.searchsorted(ref_dates, dates)
+    safe = np.minimum(idx, len(ref_dates) - 1)
+    hit = (idx < len(ref_dates)) & (ref_dates[safe] == dates)
+    out = np.where(hit, ref_values[safe], np.nan)
+    # 前向填補
+    valid = np.where(~np.isnan(out), np.arange(len(out)), -1)
+    last = np.maximum.accumulate(valid)
+    return np.where(last >= 0, out[np.maximum(last, 0)], np.nan)
+
+
+def align_exact_sum(dates, flow_dates, flow_values):
+    """dates 各日的法人淨買超合計 (無資料日為 0)"""
+    if len(flow_dates) == 0:
+        return 0.0
+    idx = np.searchsorted(flow_dates, dates)
+    safe = np.minimum(idx, len(flow_dates) - 1)
+    hit = (idx < len(flow_dates)) & (flow_dates[safe] == dates)
+    return np.where(hit, flow_values[safe], 0.0).sum()
+
+
+def wma_last(x, period):
+    """最後一根的 WMA (視窗內有 NaN 或資料不足為 NaN)"""
+    if len(x) < period:
+        return np.nan
+    weights = np.arange(1, period + 1)
+    return float(np.dot(x[-period:], weights) / weights.sum())
+
+
+def _ewm(x):
+    """ewm(com=2, adjust=False)"""
+    out = np.empty(len(x))
+    acc = x[0]
+    for i, v in enumerate(x):
+        acc = v if i == 0 else acc + (v - acc) / 3.0
+        out[i] = acc
+    return out
+
+
+def kd(high, low, close, period=9):
+    """KD (RSV 以 rolling min/max，NaN 補 50，K/D 為 ewm(com=2))"""
+    n = len(close)
+    rsv = np.full(n, np.nan)
+    if n >= period:
+        win = np.lib.stride_tricks.sliding_window_view
+        low_min = win(low, period).min(axis=1)
+        high_max = win(high, period).max(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsv[period - 1:] = (close[period - 1:] - low_min) / (high_max - low_min) * 100
+    rsv = np.where(np.isnan(rsv), 50.0, rsv)
+    k = _ewm(rsv)
+    return k, _ewm(k)
+
+
+def _day_numbers(date_ints):
+    d = np.asarray(date_ints, dtype=np.int64)
+    months = ((d // 10000 - 1970) * 12 + (d // 100 % 100 - 1)).astype('datetime64[M]')
+    return (months.astype('datetime64[D]') + (d % 100 - 1)).astype(np.int64)
+
+
+def weekly_kd_last(dates, open_, high, low, close):
+    """
+    最後一根日 K 對應的週 KD (resample('W-FRI') 後 reindex ffill：週中取上一個完整週)
+    :return: (k, d)；週數不足 9 時 (0, 0)
+    """
+    days = _day_numbers(dates)
+    week = (days + 5) // 7                  # 以週五為一週最後一天
+    starts = np.flatnonzero(np.r_[True, week[1:] != week[:-1]])
+    ends = np.r_[starts[1:], len(week)]
+    w_high = np.maximum.reduceat(high, starts)
+    w_low = np.minimum.reduceat(low, starts)
+    w_close = close[ends - 1]
+    w_open = open_[starts]
+    keep = ~(np.isnan(w_high) | np.isnan(w_low) | np.isnan(w_close) | np.isnan(w_open))
+    labels = week[starts][keep] * 7 + 1     # 週五的日序
+    if keep.sum() < 9:
+        return 0.0, 0.0
+    wk, wd = kd(w_high[keep], w_low[keep], w_close[keep])
+    pos = np.searchsorted(labels, days[-1], side='right') - 1
+    if pos < 0:
+        return np.nan, np.nan
+    return wk[pos], wd[pos]
+
+
+def evaluate_stock(data, market_dates, market_close, flow=None):
+    """
+    單檔策略判斷 (陣列版)
+    :param data: {'date_int', 'open', 'high', 'low', 'close', 'volume'} 陣列，依日期遞增
+    :param flow: (date_int 陣列, 淨買超陣列) 或 None
+    :return: 進入價值區時 {'price', 'inst', 'fib', 'status'}，否則 None
+    """
+    close = np.asarray(data['close'], dtype=np.float64)
+    if len(close) < MIN_BARS:
+        return None
+    high = np.asarray(data['high'], dtype=np.float64)
+    low = np.asarray(data['low'], dtype=np.float64)
+    volume = np.asarray(data['volume'], dtype=np.float64)
+    dates = np.asarray(data['date_int'], dtype=np.int64)
+    price = close[-1]
+
+    # Step 1: 多頭結構 (WMA200 / VWAP200)
+    vol200 = volume[-200:].sum()
+    vwap200 = ((high[-200:] + low[-200:] + close[-200:]) / 3 * volume[-200:]).sum() / vol200 if vol200 else np.nan
+    if not (price > wma_last(close, 200) and price > vwap200):
+        return None
+    # 強於大盤 (Mansfield RS > 其 200 日均)
+    raw_rs = close / align_exact(dates, market_dates, market_close)
+    if not (raw_rs[-1] > raw_rs[-200:].mean()):
+        return None
+    # 週線保護
+    wk, wd = weekly_kd_last(dates, np.asarray(data['open'], dtype=np.float64), high, low, close)
+    if not (wk > wd):
+        return None
+
+    # Step 2: 籌碼 (法人近 5 日 或 ADL 底背離)
+    inst = 0.0
+    if flow is not None:
+        inst = float(align_exact_sum(dates[-FLOW_DAYS:], *flow))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clv = ((close[-4:] - low[-4:]) - (high[-4:] - close[-4:])) / (high[-4:] - low[-4:])
+    adl_up = np.nansum(clv * volume[-4:]) > 0
+    adl_div = (close[-1] < close[-5]) and adl_up
+    if not (inst > 0 or adl_div):
+        return None
+
+    # Step 3: 價值區間 (Fib 0.618 / WMA20)
+    h60, l60 = high[-60:].max(), low[-60:].min()
+    fib = h60 - (h60 - l60) * 0.618 if h60 != l60 else 0
+    dist_fib = abs(price - fib) / price if fib else 1.0
+    dist_wma = abs(price - wma_last(close, 20)) / price
+    if not (dist_fib < VALUE_ZONE or dist_wma < VALUE_ZONE):
+        return None
+
+    # Step 4: 動能觸發 (日 KD 低檔金叉 + 量增)
+    k, d = kd(high, low, close)
+    triggered = (k[-1] > d[-1]) and (k[-2] <= d[-2]) and (k[-1] < 60) and (volume[-1] > volume[-2])
+    return {'price': price, 'inst': inst, 'fib': fib, 'status': "TRIGGERED" if triggered else "WAITING"}
+
+
+def scan_value_candidates(history, market_dates, market_close, flows):
+    """
+    全市場掃描
+    :param history: {code: 欄位陣列}
+    :param flows: load_net_flows() 結果
+    :return: [{'code', 'price', 'inst', 'fib', 'status'}]，依 history 順序
+    """
+    candidates = []
+    for code, data in history.items():
+        try:
+            result = evaluate_stock(data, market_dates, market_close, flows.get(code))
+        except (ValueError, IndexError, ZeroDivisionError):
+            continue
+        if result:
+            result['code'] = code
+            candidates.append(result)
+    return candidates
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 市場寬度日彙總表 (market_breadth)
+
+InstitutionalValueStrategy.calculate_market_adl 原本每次執行都對整張 stock_history 做
+GROUP BY date_int 重算漲跌家數與騰落線。此模組把每日寬度存成 market_breadth (每交易日一列)：
+- 上漲/下跌/平盤家數 (與該股前一筆收盤比較)、創 52 週新高/新低家數、上漲/下跌成交量
+- 累積騰落線 (ADL) 與 McClellan 震盪指標 (淨上漲家數 19 / 39 日 EMA 之差，EMA 值一併保存以便續算)
+- 首次建立時依代號分批一次回補全部歷史；之後只計算 stock_history 中晚於最後一列的新交易日
+- 最近 REVISION_DAYS 天以每日筆數比對，補登的行情會讓該日之後的列重算
+讀取端 (CLI 策略、/api/market/breadth) 只需依 date_int 讀最近 N 列。
+函式本身不 commit，由呼叫端決定交易範圍 (主程式經 db_manager.run_transaction 執行)。
+"""
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from core.history_access import fetch_batch_history_arrays, fetch_recent_history_arrays
+
+TABLE = 'market_breadth'
+INDEX_CODES = ('0000', 'TAIEX')     # 大盤指數不列入家數
+NEW_HIGH_BARS = 250                 # 52 週 (交易日) 新高/新低
+REVISION_DAYS = 10                  # 檢查補登的最近天數
+BACKFILL_CHUNK = 200                # 回補時每批載入的代號數
+EMA_FAST, EMA_SLOW = 19, 39         # McClellan: alpha = 2 / (N + 1)
+
+COUNT_FIELDS = ('issues', 'advancers', 'decliners', 'unchanged', 'new_highs', 'new_lows',
+                'up_volume', 'down_volume')
+COLUMNS = ('date_int',) + COUNT_FIELDS + ('net_advances', 'adl', 'ema19', 'ema39', 'mcclellan')
+
+DDL = f"""CREATE TABLE IF NOT EXISTS {TABLE} (
+    date_int INTEGER PRIMARY KEY,
+    issues INTEGER, advancers INTEGER, decliners INTEGER, unchanged INTEGER,
+    new_highs INTEGER, new_lows INTEGER, up_volume INTEGER, down_volume INTEGER,
+    net_advances INTEGER, adl INTEGER, ema19 REAL, ema39 REAL, mcclellan REAL)"""
+
+
+def ensure_table(conn):
+    conn.execute(DDL)
+
+
+def stock_breadth(data, after_date_int=0, window=NEW_HIGH_BARS):
+    """
+    單檔每日寬度旗標 (只回傳 date_int > after_date_int 的部分)
+    :param data: {'date_int', 'high', 'low', 'close', 'volume'} 陣列，依日期遞增
+    :return: (date_int 陣列, {欄位: 陣列})；無前一筆收盤的 K 棒只計入 issues
+    """
+    dates = np.asarray(data['date_int'], dtype=np.int64)
+    close = np.asarray(data['close'], dtype=np.float64)
+    high = np.asarray(data['high'], dtype=np.float64)
+    low = np.asarray(data['low'], dtype=np.float64)
+    volume = np.nan_to_num(np.asarray(data['volume'], dtype=np.float64))
+    prev = np.r_[np.nan, close[:-1]]
+    # 前 window 根 (不含當日) 的最高/最低；歷史不足 window 根時不判定
+    prior_high = pd.Series(high).rolling(window).max().shift(1).to_numpy()
+    prior_low = pd.Series(low).rolling(window).min().shift(1).to_numpy()
+
+    keep = dates > after_date_int
+    up = (close > prev)[keep]
+    down = (close < prev)[keep]
+    flags = {
+        'issues': np.ones(keep.sum(), dtype=np.int64),
+        'advancers': up,
+        'decliners': down,
+        'unchanged': (close == prev)[keep],
+        'new_highs': (high > prior_high)[keep],
+        'new_lows': (low < prior_low)[keep],
+        'up_volume': np.where(up, volume[keep], 0),
+        'down_volume': np.where(down, volume[keep], 0),
+    }
+    return dates[keep], flags
+
+
+def _sum_by_day(parts):
+    """[(date_int 陣列, {欄位: 陣列})] -> 依日期合計"""
+    parts = [(d, f) for d, f in parts if len(d)]
+    if not parts:
+        return np.empty(0, dtype=np.int64), {name: np.empty(0, dtype=np.int64) for name in COUNT_FIELDS}
+    days, inverse = np.unique(np.concatenate([d for d, _ in parts]), return_inverse=True)
+    return days, {name: np.bincount(inverse, weights=np.concatenate([f[name] for _, f in parts]).astype(np.float64),
+                                    minlength=len(days)).round().astype(np.int64)
+                  for name in COUNT_FIELDS}
+
+
+def aggregate(history, after_date_int=0, window=NEW_HIGH_BARS):
+    """
+    多檔彙總為每日家數
+    :param history: {code: 欄位陣列}
+    :return: (遞增 date_int 陣列, {欄位: 每日合計陣列})
+    """
+    return _sum_by_day([stock_breadth(data, after_date_int, window) for code, data in history.items()
+                        if code not in INDEX_CODES and len(data['date_int'])])
+
+
+def merge_totals(chunks):
+    """合併多批 aggregate() 結果 (回補時依代號分批計算)"""
+    return _sum_by_day(chunks)
+
+
+def build_rows(days, totals, previous=None):
+    """
+    接續前一列計算 ADL 與 McClellan (EMA 以第一天的淨上漲家數起算，等同 ewm(span, adjust=False))
+    :param previous: 上一列 {'adl', 'ema19', 'ema39'} 或 None (從頭計算)
+    :return: 依 COLUMNS 順序的列
+    """
+    a_fast, a_slow = 2 / (EMA_FAST + 1), 2 / (EMA_SLOW + 1)
+    adl = previous['adl'] if previous else 0
+    fast = previous['ema19'] if previous else None
+    slow = previous['ema39'] if previous else None
+    rows = []
+    for i, day in enumerate(days):
+        counts = [int(totals[name][i]) for name in COUNT_FIELDS]
+        net = int(totals['advancers'][i] - totals['decliners'][i])
+        adl += net
+        fast = net if fast is None else fast + a_fast * (net - fast)
+        slow = net if slow is None else slow + a_slow * (net - slow)
+        rows.append((int(day), *counts, net, adl, fast, slow, fast - slow))
+    return rows
+
+
+def _history_codes(conn, after_date_int):
+    if after_date_int:
+        sql, params = "SELECT DISTINCT code FROM stock_history WHERE date_int > ?", (after_date_int,)
+    else:
+        sql, params = "SELECT DISTINCT code FROM stock_history", ()
+    return [r[0] for r in conn.execute(sql, params).fetchall() if r[0] not in INDEX_CODES]
+
+
+def _revision_start(conn):
+    """最近 REVISION_DAYS 天中每日筆數與表內 issues 不同的最早日期 (無則 None)"""
+    stored = conn.execute(f"SELECT date_int, issues FROM {TABLE} ORDER BY date_int DESC LIMIT ?",
+                          (REVISION_DAYS,)).fetchall()
+    if not stored:
+        return None
+    placeholders = ','.join('?' * len(INDEX_CODES))
+    actual = dict(conn.execute(
+        f"SELECT date_int, COUNT(*) FROM stock_history WHERE date_int >= ? AND code NOT IN ({placeholders}) "
+        f"GROUP BY date_int", (stored[-1][0],) + INDEX_CODES).fetchall())
+    changed = [day for day, issues in stored if actual.get(day, 0) != issues]
+    return min(changed) if changed else None
+
+
+def update_market_breadth(conn, rebuild_from: Optional[int] = None, window=NEW_HIGH_BARS):
+    """
+    增量更新 market_breadth
+    :param rebuild_from: 刪除此日 (含) 之後的列後重算；None 時自動偵測最近幾天的補登
+    :return: 新寫入 (或重算) 的列數
+    """
+    ensure_table(conn)
+    if rebuild_from is None:
+        rebuild_from = _revision_start(conn)
+    if rebuild_from is not None:
+        conn.execute(f"DELETE FROM {TABLE} WHERE date_int >= ?", (int(rebuild_from),))
+    last = conn.execute(f"SELECT date_int, adl, ema19, ema39 FROM {TABLE} ORDER BY date_int DESC LIMIT 1").fetchone()
+    after = last[0] if last else 0
+    codes = _history_codes(conn, after)
+    if not codes:
+        return 0
+
+    if last:
+        # 新交易日數 + 前一筆收盤 + 新高/新低視窗
+        new_days = conn.execute("SELECT COUNT(DISTINCT date_int) FROM stock_history WHERE date_int > ?",
+                                (after,)).fetchone()[0]
+        history = fetch_recent_history_arrays(conn, codes, new_days + window + 1)
+        days, totals = aggregate(history, after, window)
+    else:
+        # 首次回補：依代號分批載入全部歷史
+        days, totals = merge_totals([
+            aggregate(fetch_batch_history_arrays(conn, codes[i:i + BACKFILL_CHUNK], 0), 0, window)
+            for i in range(0, len(codes), BACKFILL_CHUNK)])
+
+    previous = {'adl': last[1], 'ema19': last[2], 'ema39': last[3]} if last else None
+    rows = build_rows(days, totals, previous)
+    conn.executemany(f"INSERT OR REPLACE INTO {TABLE} ({', '.join(COLUMNS)}) "
+                     f"VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+    return len(rows)
+
+
+def read_market_breadth(conn, limit: int = 120) -> List[Dict]:
+    """最近 limit 個交易日 (依日期遞增)；表不存在時回傳空串列"""
+    try:
+        rows = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM {TABLE} ORDER BY date_int DESC LIMIT ?",
+                            (limit,)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    return [dict(zip(COLUMNS, row)) for row in reversed(rows)]
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 全市場 OHLCV 矩陣與向量化指標
+
+全量 Step 7 以「一檔一個 DataFrame」在多進程中計算，大部分時間耗在
+pickle/IPC 與 pandas 開銷；此模組一次讀取 stock_history，整理為
+(股票 x 交易日) 對齊的 2-D NumPy 陣列，並沿時間軸一次算出全市場指標。
+
+- MarketMatrix: 全市場矩陣 (日期對齊) 與每檔自身交易日靠右對齊的視圖
+- VectorizedIndicatorCalculator: IndicatorCalculator 的 2-D 版本 (公式一致)
+- snapshot_indicators(): 輸出鍵名與 _format_indicators_result 一致，
+  可直接交給 _build_snapshot_update_tuple 組成 stock_snapshot 的 UPDATE
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .incremental_indicators import (
+    MA_PERIODS, MIN_BARS, PREV_FIELDS, VSBC_MIN_BARS, WEEKLY_KD_PERIOD,
+    F_CLOSE, F_DATE, F_HIGH, F_LOW, F_OPEN, F_VOLUME, N_FIELDS,
+    period_open_close, vsbc_percentile, vsbc_series,
+)
+from .volume_profile import latest_volume_profile
+
+# ==============================
+# 矩陣參數
+# ==============================
+FIELDS = ('open', 'high', 'low', 'close', 'volume', 'amount')
+HISTORY_CALENDAR_DAYS = 730     # 與 batch_load_history 相同的讀取範圍
+MAX_SQL_VARIABLES = 900         # 舊版 SQLite 單句參數上限 999，超過時改為整表讀取後過濾
+PERIOD_TAIL = 70                # 週/月開收盤只需最近 70 根
+VSBC_TAIL = 120                 # VSBC 百分位 100 日 + 10 日均值/3 日差分暖身
+VP_WINDOW = 20                  # stock_snapshot 的 vp_poc / vp_upper / vp_lower 回溯天數
+
+# 表驅動法: VWAP 欄位 (輸出鍵 -> 期數)
+VWAP_KEYS = {'VWAP': 20, 'VWAP60': 60, 'VWAP200': 200}
+
+# 簡化版智慧分數 (與 calculate_smart_score_series 相同的常數)
+CONSTANT_FIELDS = {
+    'Smart_Score': 50, 'SMI_Signal': 0, 'NVI_Signal': 0, 'VSA_Signal': 0,
+    'SVI_Signal': 0, 'Vol_Div_Signal': 0, 'Weekly_NVI_Signal': 0,
+}
+
+
+# ==============================
+# 全市場矩陣
+# ==============================
+class MarketMatrix:
+    """
+    全市場 OHLCV 矩陣 (列=股票, 欄=交易日)
+    - fields[name]: float64 陣列，無資料處為 NaN
+    - present: 該格是否有 K 棒
+    - dates: 每格的 date_int (無 K 棒為 0)
+    - trading_dates: 日期對齊時的欄日期 (靠右對齊視圖為 None)
+    """
+    __slots__ = ('codes', 'code_index', 'fields', 'present', 'dates', 'trading_dates')
+
+    def __init__(self, codes, fields, present, dates, trading_dates=None):
+        self.codes = list(codes)
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.fields = fields
+        self.present = present
+        self.dates = dates
+        self.trading_dates = trading_dates
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    @property
+    def shape(self):
+        return self.present.shape
+
+    @property
+    def n_bars(self):
+        """每檔股票的 K 棒數"""
+        return self.present.sum(axis=1)
+
+    def row(self, code):
+        """取得單一股票的 6 x N 陣列 (date_int, open, high, low, close, volume)，僅含有 K 棒的欄"""
+        i = self.code_index[code]
+        mask = self.present[i]
+        return np.vstack([self.dates[i][mask]] + [self.fields[f][i][mask] for f in FIELDS[:5]])
+
+    def bar_aligned(self, window=None):
+        """
+        每檔股票以自身交易日靠右對齊 (停牌日不佔位)，可再截取最後 window 根
+        現有指標公式以「該股第 N 根 K 棒」計算，而非市場交易日，
+        向量化計算需在此視圖上進行才能與逐檔計算一致。
+        """
+        _, n_cols = self.present.shape
+        key = np.where(self.present, np.arange(n_cols), -1)
+        order = np.sort(key, axis=1)            # 無 K 棒 (-1) 靠左，其餘依日期排序
+        if window:
+            order = order[:, -window:]
+        has_bar = order >= 0
+        src = np.where(has_bar, order, 0)
+        fields = {name: np.where(has_bar, np.take_along_axis(arr, src, axis=1), np.nan)
+                  for name, arr in self.fields.items()}
+        dates = np.where(has_bar, np.take_along_axis(self.dates, src, axis=1), 0)
+        return MarketMatrix(self.codes, fields, has_bar, dates)
+
+
+def load_market_matrix(conn, codes=None, calendar_days=HISTORY_CALENDAR_DAYS):
+    """
+    一次讀取 stock_history，回傳日期對齊的 MarketMatrix
+    :param codes: 限定股票 (None=全部)，列順序與 codes 一致
+    :param calendar_days: 回溯日曆天數
+    """
+    cutoff = int((datetime.now() - timedelta(days=calendar_days)).strftime("%Y%m%d"))
+    query = f"SELECT code, date_int, {', '.join(FIELDS)} FROM stock_history WHERE date_int >= ?"
+    params = [cutoff]
+    if codes and len(codes) <= MAX_SQL_VARIABLES:
+        query += f" AND code IN ({','.join(['?'] * len(codes))})"
+        params += list(codes)
+
+    cur = conn.cursor()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+
+    if codes is None:
+        codes = sorted({r[0] for r in rows})
+    code_index = {code: i for i, code in enumerate(codes)}
+    if len(codes) > MAX_SQL_VARIABLES:
+        rows = [r for r in rows if r[0] in code_index]
+    if not rows:
+        empty = np.empty((len(codes), 0))
+        return MarketMatrix(codes, {f: empty.copy() for f in FIELDS},
+                            empty.astype(bool), empty.astype(np.int64), np.empty(0, dtype=np.int64))
+
+    row_idx = np.fromiter((code_index[r[0]] for r in rows), dtype=np.int64, count=len(rows))
+    values = np.array([r[1:] for r in rows], dtype=np.float64)  # NULL -> NaN
+    date_ints = values[:, 0].astype(np.int64)
+    trading_dates, col_idx = np.unique(date_ints, return_inverse=True)
+
+    shape = (len(codes), len(trading_dates))
+    present = np.zeros(shape, dtype=bool)
+    present[row_idx, col_idx] = True
+    fields = {}
+    for j, name in enumerate(FIELDS, start=1):
+        arr = np.full(shape, np.nan)
+        arr[row_idx, col_idx] = values[:, j]
+        fields[name] = arr
+    dates = np.where(present, trading_dates[np.newaxis, :], 0)
+    return MarketMatrix(codes, fields, present, dates, trading_dates)
+
+
+# ==============================
+# 向量化指標 (沿 axis=1 時間軸)
+# ==============================
+def _shift(x, n=1):
+    """向右平移 n 欄 (左側補 NaN)"""
+    out = np.full(x.shape, np.nan)
+    out[:, n:] = x[:, :-n]
+    return out
+
+
+def _windows(x, n):
+    """(S, T) -> (S, T, n) 的滑動視窗視圖，前 n-1 欄以 NaN 補齊"""
+    padded = np.concatenate((np.full((x.shape[0], n - 1), np.nan), x), axis=1)
+    return sliding_window_view(padded, n, axis=1)
+
+
+def _bfill(x):
+    """沿時間軸向後填補 (fillna(method='bfill'))"""
+    n_rows, n_cols = x.shape
+    idx = np.where(np.isnan(x), n_cols, np.arange(n_cols))
+    idx = np.minimum.accumulate(idx[:, ::-1], axis=1)[:, ::-1]
+    padded = np.concatenate((x, np.full((n_rows, 1), np.nan)), axis=1)
+    return np.take_along_axis(padded, idx, axis=1)
+
+
+class VectorizedIndicatorCalculator:
+    """IndicatorCalculator 的全市場 2-D 版本 (輸入為靠右對齊的 (股票 x K 棒) 陣列)"""
+
+    @staticmethod
+    def rolling_sum(x, n):
+        """rolling(n).sum()，視窗含 NaN 或不足 n 根為 NaN"""
+        out = np.full(x.shape, np.nan)
+        if x.shape[1] < n:
+            return out
+        nan = np.isnan(x)
+        csum = np.zeros((x.shape[0], x.shape[1] + 1))
+        np.cumsum(np.where(nan, 0.0, x), axis=1, out=csum[:, 1:])
+        cnan = np.zeros(csum.shape, dtype=np.int64)
+        np.cumsum(nan, axis=1, out=cnan[:, 1:])
+        total = csum[:, n:] - csum[:, :-n]
+        out[:, n - 1:] = np.where(cnan[:, n:] - cnan[:, :-n] > 0, np.nan, total)
+        return out
+
+    @staticmethod
+    def rolling_mean(x, n):
+        return VectorizedIndicatorCalculator.rolling_sum(x, n) / n
+
+    @staticmethod
+    def rolling_max(x, n):
+        return _windows(x, n).max(axis=2)
+
+    @staticmethod
+    def rolling_min(x, n):
+        return _windows(x, n).min(axis=2)
+
+    @staticmethod
+    def wma(x, n):
+        """與 calculate_wma 相同 (最新一筆權重最大)，以兩組前綴和計算"""
+        out = np.full(x.shape, np.nan)
+        n_cols = x.shape[1]
+        if n_cols < n:
+            return out
+        nan = np.isnan(x)
+        filled = np.where(nan, 0.0, x)
+        idx = np.arange(1, n_cols + 1)
+        c1 = np.zeros((x.shape[0], n_cols + 1))
+        c2 = np.zeros_like(c1)
+        np.cumsum(filled, axis=1, out=c1[:, 1:])
+        np.cumsum(filled * idx, axis=1, out=c2[:, 1:])
+        cnan = np.zeros(c1.shape, dtype=np.int64)
+        np.cumsum(nan, axis=1, out=cnan[:, 1:])
+        ends = np.arange(n, n_cols + 1)
+        numer = (c2[:, n:] - c2[:, :-n]) - (ends - n) * (c1[:, n:] - c1[:, :-n])
+        out[:, n - 1:] = np.where(cnan[:, n:] - cnan[:, :-n] > 0, np.nan, numer / (n * (n + 1) / 2))
+        return out
+
+    @staticmethod
+    def _ratio_index(pos, neg, nan_value):
+        """RSI / MFI 共用: neg==0 時 pos>0 為 100 否則 50，任一為 NaN 時取 nan_value"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = 100 - (100 / (1 + pos / neg))
+        values = np.where(neg == 0, np.where(pos > 0, 100.0, 50.0), values)
+        return np.where(np.isnan(pos) | np.isnan(neg), nan_value, values)
+
+    @staticmethod
+    def rsi(close, present, period=14):
+        """WMA 版 RSI (與 calculate_rsi_series 一致，首根漲跌視為 0)"""
+        delta = close - _shift(close)
+        gains = np.where(present, np.where(delta > 0, delta, 0.0), np.nan)
+        losses = np.where(present, np.where(delta < 0, -delta, 0.0), np.nan)
+        calc = VectorizedIndicatorCalculator
+        return calc._ratio_index(calc.wma(gains, period), calc.wma(losses, period), np.nan)
+
+    @staticmethod
+    def mfi(high, low, close, volume, present, period=14):
+        """WMA 版 MFI (與 calculate_mfi 一致，資料不足為 50)"""
+        tp = (high + low + close) / 3
+        tp_prev = _shift(tp)
+        mf = tp * volume
+        pos = np.where(present, np.where(tp > tp_prev, mf, 0.0), np.nan)
+        neg = np.where(present, np.where(tp < tp_prev, mf, 0.0), np.nan)
+        calc = VectorizedIndicatorCalculator
+        return calc._ratio_index(calc.wma(pos, period), calc.wma(neg, period), 50.0)
+
+    @staticmethod
+    def macd(close, fast=12, slow=26, signal=9):
+        """WMA 版 MACD 與訊號線 (與 calculate_macd_series 一致)"""
+        calc = VectorizedIndicatorCalculator
+        macd_line = calc.wma(close, fast) - calc.wma(close, slow)
+        return macd_line, calc.wma(macd_line, signal)
+
+    @staticmethod
+    def vwap(high, low, close, volume, lookback=20):
+        tp = (high + low + close) / 3
+        calc = VectorizedIndicatorCalculator
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = calc.rolling_sum(tp * volume, lookback) / calc.rolling_sum(volume, lookback)
+        return _bfill(values)
+
+    @staticmethod
+    def kd(high, low, close, present, k_period=9):
+        """KD (RSV 不足期數以 50 代替，EWM span=3 adjust=False)"""
+        calc = VectorizedIndicatorCalculator
+        llv, hhv = calc.rolling_min(low, k_period), calc.rolling_max(high, k_period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsv = (close - llv) / (hhv - llv) * 100
+        rsv = np.where(present, np.where(np.isnan(rsv), 50.0, rsv), np.nan)
+
+        k = np.full(rsv.shape, np.nan)
+        d = np.full(rsv.shape, np.nan)
+        k_t = np.full(rsv.shape[0], np.nan)
+        d_t = np.full(rsv.shape[0], np.nan)
+        for t in range(rsv.shape[1]):
+            r = rsv[:, t]
+            k_t = np.where(np.isnan(k_t), r, 0.5 * r + 0.5 * k_t)
+            d_t = np.where(np.isnan(d_t), k_t, 0.5 * k_t + 0.5 * d_t)
+            k[:, t], d[:, t] = k_t, d_t
+        return k, d
+
+    @staticmethod
+    def volume_index(close, volume, present, positive):
+        """NVI (量縮日累計) / PVI (量增日累計)，起點 1000"""
+        prev_close, prev_volume = _shift(close), _shift(volume)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = (close - prev_close) / prev_close
+        active = volume > prev_volume if positive else volume < prev_volume
+        factor = np.where(present & active, 1 + pct, 1.0)
+        return 1000.0 * np.cumprod(factor, axis=1)
+
+    @staticmethod
+    def clv(high, low, close):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = ((close - low) - (high - close)) / (high - low)
+        return np.where(np.isnan(values), 0.0, values)
+
+    @staticmethod
+    def adl(high, low, close, volume):
+        mfv = VectorizedIndicatorCalculator.clv(high, low, close) * volume
+        return np.cumsum(np.where(np.isnan(mfv), 0.0, mfv), axis=1)
+
+    @staticmethod
+    def smi(high, low, close, period=14):
+        calc = VectorizedIndicatorCalculator
+        hh, ll = calc.rolling_max(high, period), calc.rolling_min(low, period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = (close - (hh + ll) / 2) / (hh - ll) * 100
+        return np.where(np.isnan(values), 0.0, values)
+
+    @staticmethod
+    def rs(close, present, period=14):
+        returns = close / _shift(close) - 1
+        pos = np.where(present, np.where(returns > 0, returns, 0.0), np.nan)
+        neg = np.where(present, np.where(returns < 0, -returns, 0.0), np.nan)
+        calc = VectorizedIndicatorCalculator
+        rs = calc.rolling_mean(pos, period) / (calc.rolling_mean(neg, period) + 1e-10)
+        values = 100 - (100 / (1 + rs))
+        return np.where(np.isnan(values), 50.0, values)
+
+    @staticmethod
+    def chg(close, period=14):
+        base = _shift(close, period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = (close - base) / base * 100
+        return np.where(np.isnan(values), 0.0, values)
+
+
+# ==============================
+# Step 7 快照輸出
+# ==============================
+def _value(x):
+    """numpy 值轉為 Python float，NaN 轉 None"""
+    x = float(x)
+    return None if x != x else x
+
+
+def _series_indicators(m):
+    """沿時間軸計算需要完整序列的指標 (均線、WMA、RSI、MACD、KD、MFI、VWAP、累計型)"""
+    calc = VectorizedIndicatorCalculator
+    o, h, l, c, v = (m['open'], m['high'], m['low'], m['close'], m['volume'])
+    present = m.present
+    n_bars = m.n_bars[:, np.newaxis]
+    series = {'open': o, 'high': h, 'low': l, 'close': c, 'volume': v}
+
+    for p in MA_PERIODS:
+        series[f'MA{p}'] = np.round(calc.rolling_mean(c, p), 2)
+        series[f'WMA{p}'] = np.round(calc.wma(c, p), 2)
+    series['Vol_MA3'] = np.round(calc.rolling_mean(v, 3), 2)
+
+    series['MFI'] = np.round(calc.mfi(h, l, c, v, present), 2)
+    for key, p in VWAP_KEYS.items():
+        series[key] = np.round(calc.vwap(h, l, c, v, p), 2)
+    series['CHG14'] = np.round(calc.chg(c, 14), 2)
+    series['RSI'] = np.round(calc.rsi(c, present), 2)
+    macd, signal = calc.macd(c)
+    series['MACD'], series['SIGNAL'] = np.round(macd, 2), np.round(signal, 2)
+
+    # KD (月 KD 與日 KD 為相同算法；週 KD 需滿 45 根才計算)
+    k, d = calc.kd(h, l, c, present, 9)
+    series['Month_K'] = series['Daily_K'] = np.round(k, 2)
+    series['Month_D'] = series['Daily_D'] = np.round(d, 2)
+    wk, wd = calc.kd(h, l, c, present, WEEKLY_KD_PERIOD)
+    weekly_ready = n_bars >= WEEKLY_KD_PERIOD
+    series['Week_K'] = np.where(weekly_ready, np.round(wk, 2), np.nan)
+    series['Week_D'] = np.where(weekly_ready, np.round(wd, 2), np.nan)
+
+    series['SMI'] = np.round(calc.smi(h, l, c), 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        series['SVI'] = np.round((c - series['MA200']) / series['MA200'] * 100, 2)
+    series['NVI'] = np.round(calc.volume_index(c, v, present, positive=False), 2)
+    series['PVI'] = np.round(calc.volume_index(c, v, present, positive=True), 2)
+    series['ADL'] = np.round(calc.adl(h, l, c, v), 2)
+    series['RS'] = np.round(calc.rs(c, present), 2)
+    series['clv'] = np.round(calc.clv(h, l, c), 2)
+    return series
+
+
+def _tail_indicators(m, i, n):
+    """只需最後一根的指標 (3 日背離、BBW、Fib、週/月開收盤、VSBC)"""
+    dates = m.dates[i, -n:]
+    o, h, l, c, v = (m[f][i, -n:] for f in ('open', 'high', 'low', 'close', 'volume'))
+    out = {}
+
+    if n >= 4:
+        pc, vc = c[-1] - c[-4], v[-1] - v[-4]
+        out['Div_3Day_Bull'] = int(pc < 0 and vc > 0)
+        out['Div_3Day_Bear'] = int(pc > 0 and vc < 0)
+    else:
+        out['Div_3Day_Bull'] = out['Div_3Day_Bear'] = 0
+
+    ma20, std20 = np.mean(c[-20:]), np.std(c[-20:], ddof=1)
+    out['BBW'] = _value(np.round(4 * std20 / ma20, 4)) if ma20 else None
+    if n >= 60:
+        hh60, ll60 = np.max(h[-60:]), np.min(l[-60:])
+        out['Fib_0618'] = _value(np.round(hh60 - (hh60 - ll60) * 0.618, 2))
+    else:
+        out['Fib_0618'] = None
+
+    tail_n = min(n, PERIOD_TAIL)
+    out['Weekly_Open'], out['Weekly_Close'] = period_open_close(
+        dates[-tail_n:], o[-tail_n:], c[-tail_n:], dates[-1], 'W')
+    out['Monthly_Open'], out['Monthly_Close'] = period_open_close(
+        dates[-tail_n:], o[-tail_n:], c[-tail_n:], dates[-1], 'M')
+
+    if n >= VSBC_MIN_BARS:
+        tail_n = min(n, VSBC_TAIL)
+        bars = np.empty((N_FIELDS, tail_n))
+        for row, arr in ((F_DATE, dates), (F_OPEN, o), (F_HIGH, h), (F_LOW, l), (F_CLOSE, c), (F_VOLUME, v)):
+            bars[row] = arr[-tail_n:]
+        scores = vsbc_series(bars)
+        out['VSBC'] = round(float(scores[-1]), 2)
+        out['VSBC_pct'] = round(vsbc_percentile(scores), 2)
+        out['VSBC_prev'] = round(float(scores[-2]), 2)
+    else:
+        out['VSBC'] = out['VSBC_pct'] = out['VSBC_prev'] = None
+    return out
+
+
+def snapshot_indicators(matrix, lookback=450):
+    """
+    計算全市場最新一日指標 (含 *_prev)
+    :param matrix: load_market_matrix 的結果 (日期對齊)
+    :param lookback: 每檔回溯 K 棒數 (與 Config.CALC_LOOKBACK_DAYS 一致)
+    :return: {code: 指標 dict}，K 棒不足 20 根的股票不輸出
+    """
+    m = matrix.bar_aligned(lookback)
+    if m.shape[1] < MIN_BARS:
+        return {}
+    series = _series_indicators(m)
+    # [優化] 20 日 VP 全市場一次計算 (core.volume_profile)
+    vp = dict(zip(('POC', 'VP_upper', 'VP_lower'), latest_volume_profile(
+        m['high'], m['low'], m['close'], m['volume'], window=VP_WINDOW)))
+    latest = {key: arr[:, -1] for key, arr in series.items()}
+    prev = {key: arr[:, -2] for key, arr in series.items()}
+    n_bars = m.n_bars
+
+    results = {}
+    for i, code in enumerate(m.codes):
+        n = int(n_bars[i])
+        if n < MIN_BARS:
+            continue
+        out = {key: _value(arr[i]) for key, arr in latest.items()}
+        out['date_int'] = int(m.dates[i, -1])
+        out['Mansfield_RS'] = out['RS']
+        out['close_prev'] = _value(prev['close'][i])
+        out['vol_prev'] = _value(prev['volume'][i])
+        out.update(CONSTANT_FIELDS)
+        out.update(_tail_indicators(m, i, n))
+        out.update({key: _value(np.round(arr[i], 2)) for key, arr in vp.items()})
+        for prev_key, key in PREV_FIELDS.items():
+            if key in prev:
+                out[prev_key] = _value(prev[key][i])
+            elif key in CONSTANT_FIELDS:
+                out[prev_key] = CONSTANT_FIELDS[key]
+        results[code] = out
+    return results
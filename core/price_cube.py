@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 記憶體映射價格立方體 (Price Cube)
+
+掃描、後端 /api/stocks/{code}/history 與 Step 7 每次都重新查詢 SQLite，
+並在 SQL 內組日期字串再 pd.to_datetime；價格立方體把 stock_history 以
+(股票 x 交易日) 二進位陣列存放於磁碟，以 np.memmap 零複製讀取：
+- 每欄一個 .npy (float64，NULL 為 NaN)，present.npy 標記該格是否有 K 棒
+- meta.json 保存 code→列、date→欄索引與同步水位，以原子替換確保讀者一致
+- 每日更新只追加新交易日：複製現行世代為新世代後寫入，再以 meta.json 原子切換，
+  不寫入讀者正在映射的檔案；容量不足或偵測到舊資料回補時從資料庫重建新世代
+- stock_history 的 INSERT / UPDATE / DELETE 由共用異動紀錄 history_changes (core/history_changes) 記錄，
+  序號納入同步水位，既有列被改寫 (法人資料晚到、除權息還原) 時讀者即判定不一致，追加時於新世代修補
+多個進程映射同一組檔案時共用作業系統頁面快取，不額外佔用各自的 RSS。
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from .history_changes import TABLE as CHANGES_TABLE, ensure_history_changes, latest_seq, set_cursor
+
+# ==============================
+# 立方體參數
+# ==============================
+CUBE_DIR_NAME = 'price_cube'
+META_FILE = 'meta.json'
+BASE_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'amount')
+OPTIONAL_FIELDS = ('foreign_buy', 'trust_buy', 'dealer_buy', 'tdcc_count', 'large_shareholder_pct')
+INTEGER_FIELDS = {'volume', 'amount', 'foreign_buy', 'trust_buy', 'dealer_buy', 'tdcc_count'}
+HISTORY_CALENDAR_DAYS = 1095     # 與 Config.HISTORY_DAYS_LOOKBACK 相同 (3 年)
+DATE_HEADROOM = 60               # 欄容量預留 (約 3 個月交易日)，用完即重建並滑動視窗
+CODE_HEADROOM = 100              # 列容量預留 (新上市股票)
+FETCH_CHUNK = 100000             # 建置時分批讀取，避免一次載入全部資料列
+FRESH_CHECK_SECONDS = 60         # 讀者檢查與資料庫一致性的最短間隔
+CHANGE_CONSUMER = 'price_cube'   # history_changes 游標名稱
+
+# 舊版立方體自有的異動紀錄 (已改用共用的 history_changes)
+LEGACY_CHANGE_LOG = (
+    "DROP TRIGGER IF EXISTS trg_cube_history_insert",
+    "DROP TRIGGER IF EXISTS trg_cube_history_update",
+    "DROP TRIGGER IF EXISTS trg_cube_history_delete",
+    "DROP TABLE IF EXISTS price_cube_changes",
+)
+
+
+def default_cube_dir(db_path):
+    """立方體目錄 (與資料庫同層)"""
+    return Path(db_path).resolve().parent / CUBE_DIR_NAME
+
+
+def _table_fields(conn):
+    """stock_history 實際存在的欄位 (籌碼欄位為後續遷移新增，舊資料庫可能沒有)"""
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(stock_history)")
+    columns = {row[1] for row in cur.fetchall()}
+    return [f for f in BASE_FIELDS + OPTIONAL_FIELDS if f in columns]
+
+
+def ensure_change_log(conn):
+    """移除舊版自有觸發器並安裝共用異動紀錄 (可重複呼叫；需寫入連線)"""
+    for sql in LEGACY_CHANGE_LOG:
+        conn.execute(sql)
+    ensure_history_changes(conn)
+
+
+def prune_change_log(conn, upto_seq):
+    """推進立方體的異動游標，所有使用端都處理過的紀錄由 history_changes 刪除"""
+    if upto_seq is not None:
+        set_cursor(conn, CHANGE_CONSUMER, upto_seq)
+
+
+def _change_seq(conn):
+    """最新異動序號；尚未建立異動紀錄表時回傳 None"""
+    return latest_seq(conn)
+
+
+def _source_signature(conn, start_date):
+    """
+    stock_history 自 start_date 起的 (筆數, 最新日期, 異動序號)，判斷立方體是否與資料庫一致
+    筆數與日期只能察覺新增/刪除；既有列被 UPDATE 時由異動序號察覺
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*), MAX(date_int) FROM stock_history WHERE date_int >= ?", (start_date,))
+    count, last = cur.fetchone()
+    return int(count or 0), int(last or 0), _change_seq(conn)
+
+
+def _meta_signature(meta):
+    return meta['source_rows'], meta['last_date'], meta.get('change_seq')
+
+
+def _write_meta(cube_dir, meta):
+    """原子替換 meta.json (讀者不會看到寫到一半的檔案)"""
+    tmp = cube_dir / (META_FILE + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, cube_dir / META_FILE)
+
+
+def _read_meta(cube_dir):
+    try:
+        with open(Path(cube_dir) / META_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _gen_dir(cube_dir, generation):
+    return Path(cube_dir) / f"gen_{generation}"
+
+
+def _remove_other_generations(cube_dir, keep):
+    """清除舊世代 (Windows 上仍被映射的檔案刪除失敗時略過，下次更新再清)"""
+    for path in Path(cube_dir).glob('gen_*'):
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _fill_rows(rows, code_index, dates, fields, arrays, present):
+    """將 (code, date_int, *fields) 資料列寫入陣列"""
+    if not rows:
+        return
+    row_idx = np.fromiter((code_index[r[0]] for r in rows), dtype=np.int64, count=len(rows))
+    values = np.array([r[1:] for r in rows], dtype=np.float64)  # NULL -> NaN
+    col_idx = np.searchsorted(dates, values[:, 0].astype(np.int64))
+    present[row_idx, col_idx] = True
+    for j, name in enumerate(fields, start=1):
+        arrays[name][row_idx, col_idx] = values[:, j]
+
+
+# ==============================
+# 讀取端
+# ==============================
+class PriceCube:
+    """
+    唯讀價格立方體 (memmap 視圖)
+    - codes / code_index: 列索引
+    - dates: 欄對應的 date_int
+    - present: (股票 x 交易日) 是否有 K 棒
+    - fields[name]: (股票 x 交易日) float64，無 K 棒處的值未定義 (以 present 遮罩)
+    """
+    __slots__ = ('cube_dir', 'meta', 'codes', 'code_index', 'dates', 'present', 'fields',
+                 '_checked_at', '_fresh')
+
+    def __init__(self, cube_dir, meta):
+        self.cube_dir = Path(cube_dir)
+        self.meta = meta
+        self.codes = meta['codes']
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        gen_dir = _gen_dir(cube_dir, meta['generation'])
+        n_codes, n_dates = len(self.codes), meta['n_dates']
+        self.dates = np.load(gen_dir / 'dates.npy', mmap_mode='r')[:n_dates]
+        self.present = np.load(gen_dir / 'present.npy', mmap_mode='r')[:n_codes, :n_dates]
+        self.fields = {name: np.load(gen_dir / f'{name}.npy', mmap_mode='r')[:n_codes, :n_dates]
+                       for name in meta['fields']}
+        self._checked_at = None
+        self._fresh = False
+
+    def has_fields(self, names):
+        return all(name in self.fields for name in names)
+
+    def is_fresh(self, conn):
+        """與 stock_history 的筆數、最新日期與異動序號一致 (結果快取 FRESH_CHECK_SECONDS 秒)"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < FRESH_CHECK_SECONDS:
+            return self._fresh
+        self._fresh = _source_signature(conn, self.meta['start_date']) == _meta_signature(self.meta)
+        self._checked_at = now
+        return self._fresh
+
+    def history(self, code, limit=None, fields=None):
+        """
+        單檔歷史 (依日期遞增)
+        :return: {'date_int': 陣列, 欄位: 陣列}，無此股票回傳 None
+        """
+        i = self.code_index.get(code)
+        if i is None:
+            return None
+        cols = np.flatnonzero(self.present[i])
+        if limit:
+            cols = cols[-limit:]
+        out = {'date_int': np.asarray(self.dates[cols])}
+        for name in fields or self.fields:
+            out[name] = np.asarray(self.fields[name][i, cols])
+        return out
+
+    def history_records(self, code, limit=None, fields=None):
+        """單檔歷史轉為 dict 清單 (NaN 轉 None，整數欄位轉 int)，格式同 SQL 查詢結果"""
+        data = self.history(code, limit, fields)
+        if data is None:
+            return []
+        columns = [(name, name in INTEGER_FIELDS or name == 'date_int', values.tolist())
+                   for name, values in data.items()]
+        records = []
+        for k in range(len(data['date_int'])):
+            record = {}
+            for name, is_int, values in columns:
+                value = values[k]
+                record[name] = None if value != value else (int(value) if is_int else value)
+            records.append(record)
+        return records
+
+    def market_matrix(self, codes=None, calendar_days=730):
+        """
+        轉為 core.market_matrix.MarketMatrix (日期對齊，最近 calendar_days 日曆天)
+        與 load_market_matrix 結果相同，但不經 SQLite
+        """
+        from .market_matrix import FIELDS, MarketMatrix
+        cutoff = int((datetime.now() - timedelta(days=calendar_days)).strftime("%Y%m%d"))
+        start = int(np.searchsorted(self.dates, cutoff))
+        if codes is None:
+            codes = self.codes
+        rows = np.array([self.code_index.get(code, -1) for code in codes], dtype=np.int64)
+        known = rows >= 0
+        safe_rows = np.where(known, rows, 0)
+        present = np.asarray(self.present[safe_rows, start:]) & known[:, np.newaxis]
+        fields = {name: np.where(present, self.fields[name][safe_rows, start:], np.nan)
+                  for name in FIELDS if name in self.fields}
+        trading_dates = np.asarray(self.dates[start:], dtype=np.int64)
+        dates = np.where(present, trading_dates[np.newaxis, :], 0)
+        return MarketMatrix(codes, fields, present, dates, trading_dates)
+
+
+_OPEN_CUBES = {}
+
+
+def open_price_cube(cube_dir):
+    """開啟價格立方體 (依 meta.json 修改時間快取，更新後自動重新映射)；不存在回傳 None"""
+    cube_dir = Path(cube_dir)
+    try:
+        mtime = (cube_dir / META_FILE).stat().st_mtime_ns
+    except OSError:
+        return None
+    cached = _OPEN_CUBES.get(cube_dir)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    meta = _read_meta(cube_dir)
+    if not meta:
+        return None
+    try:
+        cube = PriceCube(cube_dir, meta)
+    except (OSError, ValueError, KeyError):
+        return None
+    _OPEN_CUBES[cube_dir] = (mtime, cube)
+    return cube
+
+
+# ==============================
+# 寫入端
+# ==============================
+def build_price_cube(conn, cube_dir, calendar_days=HISTORY_CALENDAR_DAYS):
+    """以 stock_history 重建立方體 (寫入新世代目錄後才切換 meta.json)"""
+    cube_dir = Path(cube_dir)
+    cube_dir.mkdir(parents=True, exist_ok=True)
+    old_meta = _read_meta(cube_dir)
+    generation = (old_meta or {}).get('generation', 0) + 1
+    start_date = int((datetime.now() - timedelta(days=calendar_days)).strftime("%Y%m%d"))
+    fields = _table_fields(conn)
+    # 讀取前先記下異動序號：建置期間的寫入序號較大，下次同步時再修補
+    change_seq = _change_seq(conn)
+
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT code FROM stock_history WHERE date_int >= ? ORDER BY code", (start_date,))
+    codes = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT DISTINCT date_int FROM stock_history WHERE date_int >= ? ORDER BY date_int", (start_date,))
+    trading_dates = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+
+    gen_dir = _gen_dir(cube_dir, generation)
+    shutil.rmtree(gen_dir, ignore_errors=True)
+    gen_dir.mkdir(parents=True)
+    shape = (len(codes) + CODE_HEADROOM, len(trading_dates) + DATE_HEADROOM)
+    open_memmap = np.lib.format.open_memmap
+    dates = open_memmap(gen_dir / 'dates.npy', mode='w+', dtype=np.int64, shape=(shape[1],))
+    dates[:len(trading_dates)] = trading_dates
+    present = open_memmap(gen_dir / 'present.npy', mode='w+', dtype=np.bool_, shape=shape)
+    arrays = {name: open_memmap(gen_dir / f'{name}.npy', mode='w+', dtype=np.float64, shape=shape)
+              for name in fields}
+
+    code_index = {code: i for i, code in enumerate(codes)}
+    cur.execute(f"SELECT code, date_int, {', '.join(fields)} FROM stock_history WHERE date_int >= ?",
+                (start_date,))
+    while True:
+        rows = cur.fetchmany(FETCH_CHUNK)
+        if not rows:
+            break
+        _fill_rows(rows, code_index, trading_dates, fields, arrays, present)
+
+    for arr in [dates, present] + list(arrays.values()):
+        arr.flush()
+    source_rows, last_date, _ = _source_signature(conn, start_date)
+    del dates, present, arrays
+
+    meta = {
+        'generation': generation, 'start_date': start_date,
+        'codes': codes, 'n_dates': int(len(trading_dates)), 'capacity': list(shape),
+        'fields': fields, 'source_rows': source_rows, 'last_date': last_date,
+        'change_seq': change_seq, 'change_log': CHANGES_TABLE,
+        'built_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _write_meta(cube_dir, meta)
+    _remove_other_generations(cube_dir, gen_dir)
+    return open_price_cube(cube_dir)
+
+
+def _patch_changed_cells(conn, meta, before, code_index, dates, fields, arrays, present):
+    """
+    依異動紀錄重寫 before 之前已改寫或刪除的格子
+    :return: False 表示異動落在立方體之外 (新代號或新交易日出現在舊日期)，需重建
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT c.code, c.date_int, h.date_int IS NOT NULL, {', '.join('h.' + f for f in fields)}
+        FROM (SELECT DISTINCT code, date_int FROM {CHANGES_TABLE}
+              WHERE seq > ? AND date_int >= ? AND date_int < ?) c
+        LEFT JOIN stock_history h ON h.code = c.code AND h.date_int = c.date_int""",
+                (meta['change_seq'], meta['start_date'], before))
+    rows = cur.fetchall()
+    if not rows:
+        return True
+    if any(r[0] not in code_index for r in rows if r[2]):
+        return False
+    rows = [r for r in rows if r[0] in code_index]
+    col_idx = np.searchsorted(dates, [r[1] for r in rows])
+    if any(c >= len(dates) or dates[c] != r[1] for c, r in zip(col_idx, rows) if r[2]):
+        return False
+    gone = [(code_index[r[0]], c) for c, r in zip(col_idx, rows)
+            if not r[2] and c < len(dates) and dates[c] == r[1]]
+    if gone:
+        present[tuple(np.array(gone).T)] = False
+    _fill_rows([(r[0], r[1]) + tuple(r[3:]) for r in rows if r[2]], code_index, dates, fields, arrays, present)
+    return True
+
+
+def _append_price_cube(conn, cube_dir, meta):
+    """
+    追加新交易日 (並重寫最後一日以納入盤後修正)，舊日期被改寫的格子依異動紀錄修補
+    現行世代仍被後端與掃描映射 (讀者快取一致性檢查 FRESH_CHECK_SECONDS 秒)，因此先複製為
+    新世代再寫入，完成檢查後才切換 meta.json；任何一步失敗只丟棄未發布的新世代
+    :return: 更新後的 meta，容量不足、異動無法修補或與資料庫筆數不一致時回傳 None (需重建)
+    """
+    fields = meta['fields']
+    codes = list(meta['codes'])
+    n_dates = meta['n_dates']
+    cap_codes, cap_dates = meta['capacity']
+
+    # 異動紀錄於建置後才建立 (或被移除、或仍是舊版紀錄表) 時無從得知中間改了哪些列
+    change_seq = _change_seq(conn)
+    if (change_seq is None) != (meta.get('change_seq') is None):
+        return None
+    if change_seq is not None and meta.get('change_log') != CHANGES_TABLE:
+        return None
+
+    # 從已存在的最後一日開始讀 (含當日重複下載的修正)
+    old_dates = np.load(_gen_dir(cube_dir, meta['generation']) / 'dates.npy', mmap_mode='r')
+    since = int(old_dates[n_dates - 1]) if n_dates else meta['start_date']
+    del old_dates
+    cur = conn.cursor()
+    cur.execute(f"SELECT code, date_int, {', '.join(fields)} FROM stock_history WHERE date_int >= ?", (since,))
+    rows = cur.fetchall()
+
+    new_codes = sorted({r[0] for r in rows} - set(codes))
+    new_dates = sorted({int(r[1]) for r in rows if r[1] > since})
+    if len(codes) + len(new_codes) > cap_codes or n_dates + len(new_dates) > cap_dates:
+        return None
+
+    generation = meta['generation'] + 1
+    gen_dir = _gen_dir(cube_dir, generation)
+    shutil.rmtree(gen_dir, ignore_errors=True)
+    shutil.copytree(_gen_dir(cube_dir, meta['generation']), gen_dir)
+    try:
+        source_rows, last_date = _write_appended(conn, meta, gen_dir, since, rows, codes, new_codes,
+                                                 new_dates, change_seq)
+    except Exception:
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        raise
+    if source_rows is None:
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        return None
+
+    meta = dict(meta, generation=generation, codes=codes + new_codes, n_dates=n_dates + len(new_dates),
+                source_rows=source_rows, last_date=last_date, change_seq=change_seq,
+                updated_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    _write_meta(cube_dir, meta)
+    _remove_other_generations(cube_dir, gen_dir)
+    return meta
+
+
+def _write_appended(conn, meta, gen_dir, since, rows, codes, new_codes, new_dates, change_seq):
+    """
+    在尚未發布的新世代寫入追加內容
+    :return: (來源筆數, 最新日期)；異動無法修補或筆數不一致時回傳 (None, None)
+    """
+    fields = meta['fields']
+    codes = codes + new_codes
+    n_dates = meta['n_dates'] + len(new_dates)
+    dates_mm = np.load(gen_dir / 'dates.npy', mmap_mode='r+')
+    dates_mm[meta['n_dates']:n_dates] = new_dates
+    present = np.load(gen_dir / 'present.npy', mmap_mode='r+')
+    arrays = {name: np.load(gen_dir / f'{name}.npy', mmap_mode='r+') for name in fields}
+    code_index = {code: i for i, code in enumerate(codes)}
+    dates = np.asarray(dates_mm[:n_dates])
+    if change_seq is not None and change_seq != meta['change_seq']:
+        if not _patch_changed_cells(conn, meta, since, code_index, dates, fields, arrays, present):
+            return None, None
+    # 最後一日整日重寫：先清除 present，當日被刪除的列才不會殘留
+    present[:len(codes), int(np.searchsorted(dates, since)):n_dates] = False
+    _fill_rows(rows, code_index, dates, fields, arrays, present)
+    for arr in [dates_mm, present] + list(arrays.values()):
+        arr.flush()
+
+    # 一致性檢查: 筆數不符代表舊日期被回補或刪除，交由重建處理
+    source_rows, last_date, _ = _source_signature(conn, meta['start_date'])
+    if int(present[:len(codes), :n_dates].sum()) != source_rows:
+        return None, None
+    return source_rows, last_date
+
+
+def refresh_price_cube(conn, cube_dir, rebuild=False):
+    """
+    讓立方體與 stock_history 同步 (每日更新後呼叫)
+    異動紀錄由 ensure_change_log 建立；同步後以 prune_change_log(conn, cube.meta['change_seq']) 推進游標
+    :return: (PriceCube, 動作) 動作為 'current' / 'appended' / 'rebuilt'
+    """
+    cube_dir = Path(cube_dir)
+    meta = _read_meta(cube_dir)
+    if not rebuild and meta and meta.get('fields') == _table_fields(conn):
+        if _source_signature(conn, meta['start_date']) == _meta_signature(meta):
+            return open_price_cube(cube_dir), 'current'
+        try:
+            if _append_price_cube(conn, cube_dir, meta):
+                return open_price_cube(cube_dir), 'appended'
+        except (OSError, ValueError):
+            pass
+    return build_price_cube(conn, cube_dir), 'rebuilt'
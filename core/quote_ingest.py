@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 每日行情批次寫入 (quote_ingest)
+
+update_market_data 與缺值修復原本對每檔股票各做 2~4 次 SQL (檢查舊資料、查前日收盤、
+INSERT OR REPLACE、快照 UPSERT)，全市場約 1,900 檔就是近萬次往返。此模組改為：
+- 解析後的整日行情以一次 executemany 載入暫存表 (TEMP TABLE，只存在於該連線)
+- 以集合運算一次判斷新增/更新/略過，並以一句 INSERT ... SELECT ... ON CONFLICT DO UPDATE
+  套用整日資料 (只覆寫行情欄位，其餘欄位保留)
+- 前日收盤/成交量以視窗函式 (ROW_NUMBER) 在回看期間內一次取得；回看期間內沒有交易的少數
+  股票才逐檔查最近一筆
+函式本身不 commit，由呼叫端決定交易範圍 (主程式經單一寫入者在同一個交易內執行整個函式)。
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Sequence, Set, Tuple
+
+PREV_LOOKBACK_DAYS = 45         # 前日收盤的視窗回看天數 (日曆天，涵蓋長假)
+
+STAGING_TABLE = 'temp.quote_staging'
+PREV_TABLE = 'temp.quote_prev'
+
+
+@dataclass
+class IngestResult:
+    """批次寫入結果"""
+    new: int = 0
+    updated: int = 0
+    skipped: int = 0
+    codes: Set[str] = field(default_factory=set)    # 新增或更新的股票
+
+
+def _lookback_start(date_int: int) -> int:
+    day = datetime.strptime(str(date_int), '%Y%m%d') - timedelta(days=PREV_LOOKBACK_DAYS)
+    return int(day.strftime('%Y%m%d'))
+
+
+def _ensure_staging(conn):
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS quote_staging (
+            code TEXT PRIMARY KEY, name TEXT,
+            open REAL, high REAL, low REAL, close REAL, volume INTEGER, amount REAL
+        )""")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS quote_prev (code TEXT PRIMARY KEY, close REAL, volume INTEGER)")
+    conn.execute(f"DELETE FROM {STAGING_TABLE}")
+    conn.execute(f"DELETE FROM {PREV_TABLE}")
+
+
+def _stage_prev_close(conn, date_int: int, positive_only: bool = False):
+    """
+    暫存表內每檔在 date_int 之前最近一筆的 (close, volume) 寫入 quote_prev
+    :param positive_only: 只採用 close > 0 的列 (估算缺值用)
+    """
+    cond = "AND h.close > 0" if positive_only else ""
+    conn.execute(f"""
+        INSERT INTO {PREV_TABLE} (code, close, volume)
+        SELECT code, close, volume FROM (
+            SELECT h.code, h.close, h.volume,
+                   ROW_NUMBER() OVER (PARTITION BY h.code ORDER BY h.date_int DESC) AS rn
+            FROM stock_history h
+            JOIN {STAGING_TABLE} s ON s.code = h.code
+            WHERE h.date_int >= ? AND h.date_int < ? {cond}
+        ) WHERE rn = 1""", (_lookback_start(date_int), date_int))
+    # 回看期間內沒有交易 (久未交易/停牌) 的股票才逐檔找最近一筆
+    conn.execute(f"""
+        INSERT INTO {PREV_TABLE} (code, close, volume)
+        SELECT h.code, h.close, h.volume
+        FROM (
+            SELECT s.code,
+                   (SELECT MAX(x.date_int) FROM stock_history x
+                    WHERE x.code = s.code AND x.date_int < ? {cond.replace('h.', 'x.')}) AS d
+            FROM {STAGING_TABLE} s
+            WHERE s.code NOT IN (SELECT code FROM {PREV_TABLE})
+        ) m
+        JOIN stock_history h ON h.code = m.code AND h.date_int = m.d""", (date_int,))
+
+
+def ingest_daily_quotes(conn, date_int: int, trade_date: str,
+                        quotes: Iterable[Sequence], update_snapshot: bool = True) -> IngestResult:
+    """
+    套用一整日的行情到 stock_history 與 stock_snapshot
+    :param quotes: (code, name, open, high, low, close, volume, amount)；同代號以最後一筆為準
+    :param trade_date: 快照的 date 欄 (YYYY-MM-DD)
+    :param update_snapshot: 回補過去日期時為 False (只寫歷史，不動快照)
+    規則與原本逐檔寫入相同：已有資料且收盤相同、成交金額已有值者略過；
+    快照的 close_prev/vol_prev 取前一交易日 (無前日時沿用當日)
+    """
+    _ensure_staging(conn)
+    conn.executemany(f"INSERT OR REPLACE INTO {STAGING_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     [tuple(q) for q in quotes])
+    result = IngestResult()
+
+    # 1. 資料未變的列從暫存表移除
+    result.skipped = conn.execute(f"""
+        DELETE FROM {STAGING_TABLE}
+        WHERE EXISTS (
+            SELECT 1 FROM stock_history h
+            WHERE h.code = quote_staging.code AND h.date_int = ?
+              AND h.close IS quote_staging.close
+              AND NOT ((h.amount IS NULL OR h.amount = 0) AND quote_staging.amount > 0)
+        )""", (date_int,)).rowcount
+
+    rows = conn.execute(f"""
+        SELECT s.code, h.code IS NULL
+        FROM {STAGING_TABLE} s
+        LEFT JOIN stock_history h ON h.code = s.code AND h.date_int = ?""", (date_int,)).fetchall()
+    if not rows:
+        return result
+    result.codes = {code for code, _ in rows}
+    result.new = sum(1 for _, is_new in rows if is_new)
+    result.updated = len(rows) - result.new
+
+    # 2. 前日收盤 (須在寫入當日資料前取得)
+    if update_snapshot:
+        _stage_prev_close(conn, date_int)
+
+    # 3. 整日寫入歷史 (WHERE true: 避免 SELECT ... ON CONFLICT 的語法歧義)
+    conn.execute(f"""
+        INSERT INTO stock_history (code, date_int, open, high, low, close, volume, amount)
+        SELECT code, ?, open, high, low, close, volume, amount FROM {STAGING_TABLE} WHERE true
+        ON CONFLICT(code, date_int) DO UPDATE SET
+            open=excluded.open, high=excluded.high, low=excluded.low,
+            close=excluded.close, volume=excluded.volume, amount=excluded.amount""", (date_int,))
+
+    if not update_snapshot:
+        return result
+
+    # 4. 快照 UPSERT (保留 PE/Yield 與指標欄位)
+    conn.execute(f"""
+        INSERT INTO stock_snapshot (code, name, date, close, volume, close_prev, vol_prev, amount)
+        SELECT s.code, s.name, ?, s.close, s.volume,
+               CASE WHEN p.code IS NULL THEN s.close ELSE p.close END,
+               CASE WHEN p.code IS NULL THEN s.volume ELSE p.volume END,
+               s.amount
+        FROM {STAGING_TABLE} s
+        LEFT JOIN {PREV_TABLE} p ON p.code = s.code
+        WHERE true
+        ON CONFLICT(code) DO UPDATE SET
+            name=excluded.name, date=excluded.date, close=excluded.close, volume=excluded.volume,
+            close_prev=excluded.close_prev, vol_prev=excluded.vol_prev, amount=excluded.amount""",
+                 (trade_date,))
+    return result
+
+
+def _complete(close, volume, amount):
+    """量/價/額三者缺一時以另外兩者推算"""
+    if volume and close and not amount:
+        amount = int(volume * close)
+    if amount and close and not volume:
+        volume = int(amount / close) if close > 0 else 0
+    if amount and volume and not close:
+        close = round(amount / volume, 2) if volume > 0 else 0
+    return close, volume, amount
+
+
+def repair_day_quotes(conn, date_int: int, stocks: Sequence[Tuple],
+                      crawled: Dict[str, Dict]) -> Tuple[int, int]:
+    """
+    以重新下載的整日行情修復單日缺值
+    :param stocks: 需修復的 (code, close, volume, amount)
+    :param crawled: {code: {'close', 'volume', 'amount'}} 當日重新下載的行情
+    :return: (以下載資料修復筆數, 以前日收盤估算筆數)
+    有下載到者：缺值以舊值補上並互相推算，三者齊全才寫入；
+    沒下載到但有成交量者：收盤沿用前一筆 close > 0 的收盤，金額 = 前日收盤 × 量
+    """
+    _ensure_staging(conn)
+    fixed, estimate = [], []
+    for code, old_close, old_volume, old_amount in stocks:
+        cdata = crawled.get(code)
+        if cdata is None:
+            if old_volume and old_volume > 0:
+                estimate.append((code, None, None, None, None, None, old_volume, None))
+            continue
+        close, volume, amount = _complete(cdata.get('close') or old_close,
+                                          cdata.get('volume') or old_volume,
+                                          cdata.get('amount') or old_amount)
+        if close and volume and amount:
+            fixed.append((code, close, volume, amount))
+
+    if fixed:
+        conn.executemany("""
+            INSERT INTO stock_history (code, date_int, close, volume, amount) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(code, date_int) DO UPDATE SET
+                close=excluded.close, volume=excluded.volume, amount=excluded.amount""",
+                         [(code, date_int, close, volume, amount) for code, close, volume, amount in fixed])
+
+    estimated = 0
+    if estimate:
+        conn.executemany(f"INSERT OR REPLACE INTO {STAGING_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?)", estimate)
+        _stage_prev_close(conn, date_int, positive_only=True)
+        estimated = conn.execute(f"""
+            INSERT INTO stock_history (code, date_int, close, amount)
+            SELECT s.code, ?, p.close, CAST(p.close * s.volume AS INTEGER)
+            FROM {STAGING_TABLE} s
+            JOIN {PREV_TABLE} p ON p.code = s.code
+            WHERE p.close > 0
+            ON CONFLICT(code, date_int) DO UPDATE SET close=excluded.close, amount=excluded.amount""",
+                                 (date_int,)).rowcount
+    return len(fixed), estimated
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 掃描結果物化 (scan_results)
+
+/api/scan/* 每次請求都對 stock_meta JOIN stock_snapshot 全表重建動態 SQL
+(六維共振還有 CASE WHEN 計分)，收盤時多人同時刷新儀表板就重複計算同一份結果。
+此模組在 Step 7 寫完指標後把所有已登記的掃描各算一次：
+- SCAN_DEFINITIONS: 掃描登記表 {scan_type: (條件, 排序, 分數)}，為 API 與物化共用的唯一來源
+- refresh_scan_results(): 依登記表寫入 (scan_type, rank, code, score, payload) 新世代，
+  切換 scan_results_meta 後再刪除舊世代，讀取端不會看到半套結果
+- lookup_scan_results(): API 以 (scan_type, generation, rank) 主鍵單次查詢，
+  成交量/股價/分數門檻在索引順序上過濾，延遲與掃描條件複雜度無關
+物化時不套用成交量/股價門檻與筆數上限，由查詢端依請求參數過濾，結果與即時 SQL 相同。
+"""
+import json
+import re
+import time
+from collections import namedtuple
+
+# ==============================
+# 掃描登記表
+# ==============================
+ScanDefinition = namedtuple('ScanDefinition', ['conditions', 'order_by', 'score'])
+
+VP_MAX_TOLERANCE = 0.1          # /scan/vp 容忍度上限 (物化時以上限計算，查詢時以分數過濾)
+
+_VP_SUPPORT_DISTANCE = "ABS(s.close - s.vp_low) / s.close"
+_VP_RESISTANCE_DISTANCE = "ABS(s.close - s.vp_high) / s.close"
+
+# 六維共振: MACD > Signal、K > D、RSI > 50、LWR > -50、Price > BBI、MTM > 0 的符合項數
+_SIX_DIM_SCORE = """(
+                (CASE WHEN s.macd > s.signal THEN 1 ELSE 0 END) +
+                (CASE WHEN s.daily_k > s.daily_d THEN 1 ELSE 0 END) +
+                (CASE WHEN s.rsi > 50 THEN 1 ELSE 0 END) +
+                (CASE WHEN s.lwr > -50 THEN 1 ELSE 0 END) +
+                (CASE WHEN s.close > s.bbi THEN 1 ELSE 0 END) +
+                (CASE WHEN s.mtm > 0 THEN 1 ELSE 0 END)
+            )"""
+
+_MA_BULL = """
+    AND s.ma5 IS NOT NULL AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL AND s.ma120 IS NOT NULL
+    AND s.close > s.ma5
+    AND s.ma5 > s.ma20
+    AND s.ma20 > s.ma60
+    AND s.ma60 > s.ma120
+    AND (s.close - s.ma20) / s.ma20 * 100 > 0
+    AND (s.close - s.ma20) / s.ma20 * 100 < 10
+"""
+
+# VSBC 多方行為: PR>=99、VSBC 上升、站上 POC、MA20>MA60、站上 MA20
+_VSBC_STEADY = """
+    AND s.vsbc_pct IS NOT NULL AND s.vsbc IS NOT NULL AND s.vsbc_prev IS NOT NULL
+    AND s.vsbc_pct >= 99
+    AND s.vsbc > s.vsbc_prev
+    AND s.vp_poc IS NOT NULL AND s.close >= s.vp_poc
+    AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL AND s.ma20 > s.ma60
+    AND s.close > s.ma20
+"""
+
+SCAN_DEFINITIONS = {
+    'vp_support': ScanDefinition(
+        f"AND s.vp_low IS NOT NULL AND {_VP_SUPPORT_DISTANCE} < {VP_MAX_TOLERANCE}",
+        f"{_VP_SUPPORT_DISTANCE} ASC", _VP_SUPPORT_DISTANCE),
+    'vp_resistance': ScanDefinition(
+        f"AND s.vp_high IS NOT NULL AND {_VP_RESISTANCE_DISTANCE} < {VP_MAX_TOLERANCE}",
+        f"{_VP_RESISTANCE_DISTANCE} ASC", _VP_RESISTANCE_DISTANCE),
+    # MFI 由小→大 (資金開始流入) / 由大→小 (資金開始流出)
+    'mfi_oversold': ScanDefinition("""
+        AND s.mfi14 IS NOT NULL AND s.mfi14_prev IS NOT NULL
+        AND s.mfi14 > s.mfi14_prev
+        AND s.mfi14 < 30
+    """, "s.mfi14 ASC", "s.mfi14"),
+    'mfi_overbought': ScanDefinition("""
+        AND s.mfi14 IS NOT NULL AND s.mfi14_prev IS NOT NULL
+        AND s.mfi14 < s.mfi14_prev
+        AND s.mfi14 > 70
+    """, "s.mfi14 DESC", "s.mfi14"),
+    'ma_bull': ScanDefinition(_MA_BULL, "(s.close - s.ma20) / s.ma20 ASC", "(s.close - s.ma20) / s.ma20"),
+    'ma_below_ma20': ScanDefinition("""
+        AND s.ma20 IS NOT NULL
+        AND s.close < s.ma20
+        AND s.close >= s.ma20 * 0.9
+    """, "(s.close - s.ma20) / s.ma20 DESC", "(s.close - s.ma20) / s.ma20"),
+    'ma_below_ma200': ScanDefinition("""
+        AND s.ma200 IS NOT NULL
+        AND s.close < s.ma200
+        AND s.close >= s.ma200 * 0.9
+    """, "(s.close - s.ma200) / s.ma200 DESC", "(s.close - s.ma200) / s.ma200"),
+    # 月 KD 金叉 (K < 80 且 NVI > PVI) / 死叉
+    'kd_golden': ScanDefinition("""
+        AND s.month_k IS NOT NULL AND s.month_d IS NOT NULL
+        AND s.month_k_prev IS NOT NULL AND s.month_d_prev IS NOT NULL
+        AND s.nvi IS NOT NULL AND s.pvi IS NOT NULL
+        AND s.month_k_prev <= s.month_d_prev
+        AND s.month_k > s.month_d
+        AND s.month_k < 80
+        AND s.nvi > s.pvi
+    """, "s.month_k ASC", "s.month_k"),
+    'kd_death': ScanDefinition("""
+        AND s.month_k IS NOT NULL AND s.month_d IS NOT NULL
+        AND s.month_k_prev IS NOT NULL AND s.month_d_prev IS NOT NULL
+        AND s.month_k_prev >= s.month_d_prev
+        AND s.month_k < s.month_d
+    """, "s.month_k DESC", "s.month_k"),
+    'vsbc_steady': ScanDefinition(_VSBC_STEADY, "s.vsbc_pct DESC, s.volume DESC", "s.vsbc_pct"),
+    'vsbc_burst': ScanDefinition(
+        _VSBC_STEADY + " AND (s.close - s.close_prev) / s.close_prev > 0.03",
+        "s.vsbc_pct DESC, s.volume DESC", "s.vsbc_pct"),
+    # 聰明錢: 量增 > 1.1x、價 > MA200、MFI < 80、籌碼評分 >= 4
+    'smart_money': ScanDefinition("""
+        AND s.vol_prev IS NOT NULL AND s.volume > s.vol_prev * 1.1
+        AND s.ma200 IS NOT NULL AND s.close > s.ma200
+        AND s.mfi14 IS NOT NULL AND s.mfi14 < 80
+        AND s.smart_score IS NOT NULL AND s.smart_score >= 4
+    """, "s.smart_score DESC", "s.smart_score"),
+    # 2560 戰法: 股價 > MA25 向上、均量線多頭、陽線收漲、乖離 < 10%
+    '2560': ScanDefinition("""
+        AND s.ma25 IS NOT NULL AND s.ma25_slope IS NOT NULL
+        AND s.vol_ma5 IS NOT NULL AND s.vol_ma60 IS NOT NULL
+        AND s.close > s.ma25
+        AND s.ma25_slope > 0
+        AND s.vol_ma5 > s.vol_ma60
+        AND s.close > s.open
+        AND s.close > s.close_prev
+        AND s.close < s.ma25 * 1.10
+    """, "s.volume DESC", "s.volume"),
+    # 五階篩選: RS 強勢、多頭排列、NVI 籌碼、RSI 強勢、收紅
+    'five_stage': ScanDefinition("""
+        AND s.mansfield_rs IS NOT NULL AND s.mansfield_rs > 0
+        AND s.ma5 > s.ma20 AND s.ma20 > s.ma60
+        AND s.nvi > s.pvi
+        AND s.rsi > 50
+        AND s.close > s.open
+    """, "s.mansfield_rs DESC", "s.mansfield_rs"),
+    # 機構價值: 趨勢向上、未過熱、高流動性
+    'institutional': ScanDefinition("""
+        AND s.ma20 IS NOT NULL AND s.ma60 IS NOT NULL
+        AND s.ma20 > s.ma60
+        AND s.close > s.ma20
+        AND s.rsi IS NOT NULL AND s.rsi < 60
+        AND s.vol_ma60 > 1000
+    """, "s.vol_ma60 DESC", "s.vol_ma60"),
+    'six_dim': ScanDefinition(f"AND {_SIX_DIM_SCORE} >= 5", f"{_SIX_DIM_SCORE} DESC, s.volume DESC", _SIX_DIM_SCORE),
+    'patterns_morning_star': ScanDefinition("AND s.pattern_morning_star = 1", "s.volume DESC", "s.volume"),
+    'patterns_evening_star': ScanDefinition("AND s.pattern_evening_star = 1", "s.volume DESC", "s.volume"),
+    'pv_div': ScanDefinition("AND (s.div_3day_bull = 1 OR s.div_3day_bear = 1)", "s.rsi DESC", "s.rsi"),
+}
+
+# 與 backend execute_scan_query 相同的輸出欄位 (payload 內容)
+SCAN_SELECT = """
+            m.code, m.name, m.market_type as market,
+            s.close, ROUND((s.close - s.close_prev) / s.close_prev * 100, 2) as change_pct, s.volume, s.amount,
+            s.ma5, s.ma20, s.ma25, s.ma60, s.ma120, s.ma200,
+            s.rsi, s.rsi as mfi, NULL as k, NULL as d,
+            s.vp_poc, s.vp_high, s.vp_low,
+            s.vol_ma5, s.vol_ma60,
+            s.foreign_buy as "foreign", s.trust_buy as "trust", s.dealer_buy as "dealer",
+            s.major_holders_pct as big_trader, s.total_shareholders as concentration,
+            ROUND(s.amount / NULLIF(s.volume, 0), 2) as vwap"""
+
+SCAN_FROM = """
+        FROM stock_meta m
+        JOIN stock_snapshot s ON m.code = s.code
+        WHERE m.code GLOB '[0-9][0-9][0-9][0-9]'"""
+
+
+def build_scan_query(conditions, order_by, extra_conditions="", select=SCAN_SELECT):
+    """組出即時掃描 SQL (LIMIT 以參數傳入)"""
+    return f"""
+        SELECT {select}
+        {SCAN_FROM}
+        {extra_conditions}
+        {conditions}
+        ORDER BY {order_by}
+        LIMIT ?
+    """
+
+
+# ==============================
+# 物化表結構
+# ==============================
+SCAN_RESULTS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS scan_results (
+        scan_type TEXT,
+        generation INTEGER,
+        rank INTEGER,
+        code TEXT,
+        score REAL,
+        volume REAL,
+        close REAL,
+        payload TEXT,
+        PRIMARY KEY (scan_type, generation, rank)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scan_results_meta (
+        scan_type TEXT PRIMARY KEY,
+        generation INTEGER,
+        row_count INTEGER,
+        built_at TEXT
+    )
+    """,
+)
+
+SCAN_RESULTS_INSERT = """
+    INSERT OR REPLACE INTO scan_results (scan_type, generation, rank, code, score, volume, close, payload)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def ensure_scan_results_schema(conn):
+    for statement in SCAN_RESULTS_SCHEMA:
+        conn.execute(statement)
+
+
+def _payload_select(conn):
+    """輸出欄位中快照缺少的欄位以 NULL 代替 (篩選條件仍需完整欄位)"""
+    try:
+        available = {row[1] for row in conn.execute("PRAGMA table_info(stock_snapshot)").fetchall()}
+    except Exception:
+        available = set()
+    if not available:
+        return SCAN_SELECT
+    return re.sub(r'\bs\.(\w+)', lambda m: m.group(0) if m.group(1) in available else 'NULL', SCAN_SELECT)
+
+
+def _current_generation(conn):
+    row = conn.execute("SELECT MAX(generation) FROM scan_results_meta").fetchone()
+    return row[0] if row and row[0] is not None else 0
+
+
+def refresh_scan_results(conn, definitions=None):
+    """
+    依登記表重算所有掃描並寫入新世代 (呼叫端負責 commit)
+    篩選欄位缺漏等查詢失敗的掃描不物化，API 端自動改走即時 SQL
+    :return: ({scan_type: 筆數}, {scan_type: 錯誤訊息})
+    """
+    definitions = SCAN_DEFINITIONS if definitions is None else definitions
+    ensure_scan_results_schema(conn)
+    generation = _current_generation(conn) + 1
+    built_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    select = _payload_select(conn)
+
+    counts, errors = {}, {}
+    for scan_type, definition in definitions.items():
+        query = build_scan_query(definition.conditions, definition.order_by,
+                                 select=f"{select}, {definition.score} as _scan_score")
+        try:
+            cursor = conn.execute(query, (-1,))
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        except Exception as e:
+            errors[scan_type] = str(e)
+            continue
+
+        records = []
+        for rank, row in enumerate(rows, start=1):
+            item = dict(zip(columns, row))
+            score = item.pop('_scan_score')
+            records.append((scan_type, generation, rank, item['code'], score,
+                            item['volume'], item['close'], json.dumps(item, ensure_ascii=False)))
+        if records:
+            conn.executemany(SCAN_RESULTS_INSERT, records)
+        counts[scan_type] = len(records)
+
+    # 先寫入新世代再切換 meta，最後刪除舊世代
+    conn.executemany(
+        "INSERT OR REPLACE INTO scan_results_meta (scan_type, generation, row_count, built_at) VALUES (?, ?, ?, ?)",
+        [(scan_type, generation, n, built_at) for scan_type, n in counts.items()])
+    if errors:
+        placeholders = ','.join('?' * len(errors))
+        conn.execute(f"DELETE FROM scan_results_meta WHERE scan_type IN ({placeholders})", list(errors))
+    conn.execute("DELETE FROM scan_results WHERE generation < ?", (generation,))
+    return counts, errors
+
+
+def lookup_scan_results(conn, scan_type, limit=30, min_vol=0, min_price=None, max_score=None):
+    """
+    讀取物化結果 (依 rank 排序)
+    :return: payload 字典列表；該掃描尚未物化時回傳 None (呼叫端改走即時 SQL)
+    """
+    try:
+        meta = conn.execute("SELECT 1 FROM scan_results_meta WHERE scan_type = ?", (scan_type,)).fetchone()
+    except Exception:
+        return None  # 尚未建立物化表
+    if not meta:
+        return None
+
+    # 世代以子查詢在同一語句內取得，刷新途中也只會讀到完整的一個世代
+    filters = ["scan_type = ?",
+               "generation = (SELECT generation FROM scan_results_meta WHERE scan_type = ?)",
+               "volume >= ?"]
+    params = [scan_type, scan_type, min_vol]
+    if min_price:
+        filters.append("close >= ?")
+        params.append(min_price)
+    if max_score is not None:
+        filters.append("score < ?")
+        params.append(max_score)
+    rows = conn.execute(
+        f"SELECT payload FROM scan_results WHERE {' AND '.join(filters)} ORDER BY rank LIMIT ?",
+        params + [limit]).fetchall()
+    return [json.loads(row[0]) for row in rows]
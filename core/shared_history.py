@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - Step 7 多進程共享歷史區塊
+
+多進程 Step 7 原本把每檔預載的 DataFrame 放進任務 tuple 交給 Pool.imap，
+每檔約 450 列 x 12 欄都要 pickle 後複製到子進程。此模組把整批歷史以欄式
+float64 陣列寫入一塊共享記憶體，任務只傳 (code, 區塊, offset, length)：
+- 父進程: SharedHistoryBlock 建立區塊並寫入，批次結束後釋放
+- 子進程: read_shared_history() 附加區塊 (每批只附加一次) 並取回切片視圖
+平台不支援 multiprocessing.shared_memory 時 (如 Android/Termux 無 /dev/shm)，
+改以暫存檔 np.memmap 作為共享區塊，介面相同。
+"""
+import os
+import tempfile
+
+import numpy as np
+
+# 共享欄位 (date_int 以 float64 存放，8 位整數可精確表示)
+SHARED_FIELDS = ('date_int', 'open', 'high', 'low', 'close', 'volume', 'amount')
+FILE_PREFIX = 'step7_history_'
+
+
+def _create_shared_memory(size):
+    """建立共享記憶體，平台不支援時回傳 None"""
+    try:
+        from multiprocessing import shared_memory
+        return shared_memory.SharedMemory(create=True, size=size)
+    except (ImportError, OSError):
+        return None
+
+
+def prepare_pool():
+    """
+    建立進程池前呼叫: 先啟動 resource_tracker，讓子進程共用父進程的追蹤器
+    (否則先建立的常駐進程池各自啟動追蹤器，結束時誤報洩漏並重複刪除區塊)
+    """
+    if os.name != 'posix':
+        return
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    except (ImportError, OSError):
+        pass
+
+
+class SharedHistoryBlock:
+    """
+    父進程端: 整批歷史的共享欄式區塊
+    - history: {code: {欄位: 陣列}}，各陣列依日期遞增
+    - index: {code: (offset, length)}
+    - ref: 傳給子進程的區塊參照 ('shm' 或 'file', 共享記憶體名稱或暫存檔路徑, 總列數)
+    """
+
+    def __init__(self, history, fields=SHARED_FIELDS):
+        self.fields = tuple(fields)
+        self.index = {}
+        total = sum(len(arrays['date_int']) for arrays in history.values())
+        shape = (len(self.fields), max(total, 1))
+        size = shape[0] * shape[1] * 8
+
+        self._shm = _create_shared_memory(size)
+        if self._shm is not None:
+            block = np.ndarray(shape, dtype=np.float64, buffer=self._shm.buf)
+            self.ref = ('shm', self._shm.name, shape[1])
+        else:
+            fd, path = tempfile.mkstemp(prefix=FILE_PREFIX, suffix='.bin')
+            os.close(fd)
+            block = np.memmap(path, dtype=np.float64, mode='w+', shape=shape)
+            self.ref = ('file', path, shape[1])
+
+        offset = 0
+        for code, arrays in history.items():
+            length = len(arrays['date_int'])
+            for j, name in enumerate(self.fields):
+                block[j, offset:offset + length] = arrays[name] if name in arrays else np.nan
+            self.index[code] = (offset, length)
+            offset += length
+        if isinstance(block, np.memmap):
+            block.flush()
+        del block
+
+    def task(self, code, *extra):
+        """子進程任務 tuple: (code, *extra, ref, offset, length)，不在批次內回傳 None"""
+        if code not in self.index:
+            return None
+        offset, length = self.index[code]
+        return (code, *extra, self.ref, offset, length)
+
+    def close(self):
+        """釋放區塊 (子進程的附加會在下一批或進程結束時解除)"""
+        if self._shm is not None:
+            self._shm.close()
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+        else:
+            try:
+                os.remove(self.ref[1])
+            except OSError:
+                pass  # Windows 上子進程仍映射時刪除失敗，留給系統暫存清理
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+# 子進程端目前附加的區塊 {'key': ref, 'handle': SharedMemory 或 None, 'block': 陣列}
+_ATTACHED = {'key': None, 'handle': None, 'block': None}
+
+
+def _detach():
+    handle = _ATTACHED['handle']
+    _ATTACHED.update(key=None, handle=None, block=None)
+    if handle is not None:
+        try:
+            handle.close()
+        except BufferError:
+            pass  # 仍有切片視圖存活，交由垃圾回收
+
+
+def _attach(ref, n_fields):
+    """附加父進程的區塊 (同一區塊只附加一次)"""
+    if _ATTACHED['key'] == ref:
+        return _ATTACHED['block']
+    _detach()
+    kind, location, total = ref
+    shape = (n_fields, total)
+    if kind == 'file':
+        handle = None
+        block = np.memmap(location, dtype=np.float64, mode='r', shape=shape)
+    else:
+        from multiprocessing import shared_memory
+        handle = shared_memory.SharedMemory(name=location)
+        block = np.ndarray(shape, dtype=np.float64, buffer=handle.buf)
+    _ATTACHED.update(key=ref, handle=handle, block=block)
+    return block
+
+
+def read_shared_history(ref, offset, length, fields=SHARED_FIELDS):
+    """
+    子進程: 取回單檔歷史
+    :return: {'date_int': int64 陣列, 欄位: float64 切片視圖}
+    """
+    block = _attach(ref, len(fields))
+    arrays = {name: block[j, offset:offset + length] for j, name in enumerate(fields)}
+    arrays['date_int'] = arrays['date_int'].astype(np.int64)
+    return arrays
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 欄式快照匯出 (snapshot_export)
+
+雲端模式的後端原本每個個股請求都要查 Supabase 兩次 (stock_meta + stock_snapshot)，
+掃描一次抓 limit*5 列、25+ 欄的 JSON。同步流程改為另外發佈一份版本化的欄式快照：
+- 全市場 stock_snapshot (約 1,900 檔 × 全部指標欄位) 加上 stock_meta 的市場別，
+  每欄一個 NumPy 陣列，以 np.savez_compressed 壓縮 (不使用 pickle，載入安全)
+- 版本含陣列內容雜湊 (zip 檔含寫入時間，不能以檔案雜湊判斷內容是否改變)；先上傳 snapshot-{version}.npz，最後才改寫 manifest，讀取端不會讀到半份檔案
+- 儲存位置抽象為 store (put/get/delete)：LocalFileStore (本機目錄，離線測試) 與
+  SupabaseStorageStore (Supabase Storage bucket)
+讀取端 (backend/services/snapshot_store.py) 依 manifest 版本載入一次到記憶體，
+以 SnapshotFrame.row()/rows() 回答快照類端點。
+"""
+import hashlib
+import io
+import json
+import os
+import time
+
+import numpy as np
+import requests
+
+MANIFEST_NAME = 'snapshot-manifest.json'
+FORMAT_VERSION = 1
+KEEP_VERSIONS = 3               # store 內保留的歷史版本數 (讀取端切換期間仍可取得舊檔)
+
+_TEXT_TYPES = ('TEXT', 'CHAR', 'CLOB', '')
+
+
+def snapshot_file_name(version):
+    return f"snapshot-{version}.npz"
+
+
+# ==========================================
+# 儲存位置
+# ==========================================
+
+class LocalFileStore:
+    """本機目錄 (原子寫入)"""
+
+    def __init__(self, root):
+        self.root = str(root)
+
+    def put(self, name, data, content_type='application/octet-stream'):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.root, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+    def list(self):
+        try:
+            return sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            return []
+
+
+class SupabaseStorageStore:
+    """Supabase Storage bucket (REST: /storage/v1/object/{bucket}/{name})"""
+
+    def __init__(self, base_url, api_key, bucket='snapshots', timeout=60, verify=True):
+        self.base_url = base_url.rstrip('/')
+        self.bucket = bucket
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        self.session.headers.update({"apikey": api_key, "Authorization": f"Bearer {api_key}"})
+
+    def _url(self, name=''):
+        return f"{self.base_url}/storage/v1/object/{self.bucket}/{name}"
+
+    def put(self, name, data, content_type='application/octet-stream'):
+        res = self.session.post(self._url(name), data=data, timeout=self.timeout, verify=self.verify,
+                                headers={"Content-Type": content_type, "x-upsert": "true",
+                                         "Cache-Control": "no-cache"})
+        if res.status_code >= 300:
+            raise RuntimeError(f"[{res.status_code}] {res.text[:200]}")
+
+    def get(self, name):
+        res = self.session.get(self._url(name), timeout=self.timeout, verify=self.verify)
+        if res.status_code in (400, 404):
+            return None
+        if res.status_code >= 300:
+            raise RuntimeError(f"[{res.status_code}] {res.text[:200]}")
+        return res.content
+
+    def delete(self, name):
+        self.session.delete(f"{self.base_url}/storage/v1/object/{self.bucket}", json={"prefixes": [name]},
+                            timeout=self.timeout, verify=self.verify)
+
+    def list(self):
+        res = self.session.post(f"{self.base_url}/storage/v1/object/list/{self.bucket}",
+                                json={"prefix": "", "limit": 1000}, timeout=self.timeout, verify=self.verify)
+        if res.status_code >= 300:
+            return []
+        return sorted(item['name'] for item in res.json())
+
+
+# ==========================================
+# 匯出
+# ==========================================
+
+def _snapshot_columns(conn):
+    """(欄名, 是否為文字欄)；依 stock_snapshot 宣告型別判斷"""
+    cols = []
+    for row in conn.execute("PRAGMA table_info(stock_snapshot)").fetchall():
+        decl = (row[2] or '').upper()
+        cols.append((row[1], any(t in decl for t in _TEXT_TYPES if t) or decl == ''))
+    return cols
+
+
+def build_snapshot(conn):
+    """
+    讀取全市場快照並轉成欄式陣列
+    :return: {欄名: np.ndarray}；數值欄為 float64 (NULL 為 NaN)，文字欄為 unicode (NULL 為空字串)
+    """
+    cols = _snapshot_columns(conn)
+    select = ', '.join(f"s.{name}" for name, _ in cols)
+    cur = conn.execute(f"""
+        SELECT {select}, m.market_type
+        FROM stock_snapshot s
+        LEFT JOIN stock_meta m ON m.code = s.code
+        ORDER BY s.code""")
+    rows = cur.fetchall()
+    arrays = {}
+    for i, (name, is_text) in enumerate(cols + [('market_type', True)]):
+        values = [r[i] for r in rows]
+        if is_text:
+            arrays[name] = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        else:
+            arrays[name] = np.array([np.nan if v is None or isinstance(v, (str, bytes)) else v for v in values],
+                                    dtype=np.float64)
+    return arrays
+
+
+def content_digest(arrays):
+    """陣列內容雜湊 (欄名、型別、資料)"""
+    h = hashlib.sha256()
+    for name in sorted(arrays):
+        arr = np.ascontiguousarray(arrays[name])
+        h.update(f"{name}:{arr.dtype.str}:{arr.shape}".encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def encode_snapshot(arrays):
+    """壓縮成 npz bytes；回傳 (bytes, 檔案雜湊)"""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    data = buffer.getvalue()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def read_manifest(store):
+    raw = store.get(MANIFEST_NAME)
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def publish_snapshot(conn, store, keep=KEEP_VERSIONS):
+    """
+    匯出並發佈快照 (內容未變時不重新上傳)
+    :return: manifest dict
+    """
+    arrays = build_snapshot(conn)
+    content = content_digest(arrays)
+    current = read_manifest(store)
+    if current and current.get('content_sha256') == content:
+        return current
+    data, digest = encode_snapshot(arrays)
+
+    dates = [d for d in arrays.get('date', []) if d]
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{content[:12]}"
+    manifest = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'file': snapshot_file_name(version),
+        'sha256': digest,
+        'content_sha256': content,
+        'bytes': len(data),
+        'rows': int(len(arrays['code'])) if 'code' in arrays else 0,
+        'columns': sorted(arrays),
+        'data_date': max(dates) if dates else None,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        # 前幾版的檔名 (新到舊)，清除時保留
+        'history': ([current['file']] + current.get('history', []))[:max(keep - 1, 0)] if current else [],
+    }
+    store.put(manifest['file'], data)
+    store.put(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    # 清除不在保留清單內的舊版本
+    retained = {manifest['file'], *manifest['history']}
+    for name in store.list():
+        if name.startswith('snapshot-') and name.endswith('.npz') and name not in retained:
+            store.delete(name)
+    return manifest
+
+
+# ==========================================
+# 載入
+# ==========================================
+
+class SnapshotFrame:
+    """記憶體中的欄式快照 (唯讀)"""
+
+    def __init__(self, arrays, version=None):
+        self.arrays = arrays
+        self.version = version
+        self.columns = list(arrays)
+        self.codes = arrays['code']
+        self._index = {code: i for i, code in enumerate(self.codes.tolist())}
+        self._text = {name for name, arr in arrays.items() if arr.dtype.kind == 'U'}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self._index
+
+    def _value(self, name, i):
+        v = self.arrays[name][i]
+        if name in self._text:
+            return str(v) or None
+        v = float(v)
+        if np.isnan(v):
+            return None
+        return int(v) if v.is_integer() and name in ('volume', 'vol_prev') else v
+
+    def row(self, code):
+        """單檔快照 dict (NaN 轉 None)；不存在時回傳 None"""
+        i = self._index.get(code)
+        if i is None:
+            return None
+        return {name: self._value(name, i) for name in self.columns}
+
+    def select(self, mask=None, order_by=None, descending=True):
+        """依布林遮罩篩選、依欄位排序，回傳列索引 (np.ndarray)"""
+        idx = np.arange(len(self.codes)) if mask is None else np.flatnonzero(mask)
+        if order_by is not None:
+            values = self.arrays[order_by][idx]
+            keys = np.where(np.isnan(values), -np.inf if descending else np.inf, values)
+            order = np.argsort(-keys if descending else keys, kind='stable')
+            idx = idx[order]
+        return idx
+
+    def rows(self, indices, columns=None):
+        columns = columns or self.columns
+        return [{name: self._value(name, i) for name in columns if name in self.arrays} for i in indices]
+
+    def column(self, name):
+        """數值欄陣列 (缺欄時回傳全 NaN)"""
+        arr = self.arrays.get(name)
+        if arr is None:
+            return np.full(len(self.codes), np.nan)
+        return arr
+
+
+def load_snapshot(data, version=None):
+    """由 npz bytes 建立 SnapshotFrame"""
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    return SnapshotFrame(arrays, version)
+
+
+def fetch_snapshot(store, known_version=None):
+    """
+    依 manifest 取得最新快照
+    :return: (manifest, SnapshotFrame)；版本與 known_version 相同時 frame 為 None；store 無快照時回傳 (None, None)
+    :raises ValueError: 內容雜湊與 manifest 不符
+    """
+    manifest = read_manifest(store)
+    if not manifest or manifest.get('format') != FORMAT_VERSION:
+        return None, None
+    if manifest['version'] == known_version:
+        return manifest, None
+    data = store.get(manifest['file'])
+    if data is None:
+        return None, None
+    if hashlib.sha256(data).hexdigest() != manifest['sha256']:
+        raise ValueError(f"快照雜湊不符 ({manifest['file']})")
+    return manifest, load_snapshot(data, manifest['version'])
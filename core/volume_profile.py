@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+台灣股市分析系統 - 向量化 Volume Profile (POC / 價值區)
+
+原本 VP 有三套算法: calculate_vp_scheme3 (20 日、10 價位、逐價位布林遮罩)、
+calc_vp_poc (60 日、30 組 np.histogram) 與 update_vp_data.py (50 組、向外擴張
+價值區)，同一檔股票在不同掃描得到不一致的支撐壓力。此模組為唯一的 VP 引擎：
+- 價位區間以視窗內最高價/最低價等分，收盤價落在 [下緣, 上緣) 的成交量計入該價位
+- POC 為成交量最大的價位中點；價值區依成交量由大到小累加至 70% (sorted cumulative volume)
+- 輸入可為 1-D (單檔) 或 2-D (股票 x K 棒，靠右對齊、NaN 為無資料)，一次計算全市場
+- rolling_volume_profile() 產生每根 K 棒的序列；latest_volume_profile() 只算最後一根
+"""
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ==============================
+# VP 參數
+# ==============================
+VP_WINDOWS = (20, 60, 120)      # 支援的回溯視窗 (20=stock_snapshot 的 vp_poc/vp_upper/vp_lower)
+PRICE_LEVELS = 10               # 價位數 (與 calculate_vp_scheme3 相同)
+VALUE_AREA = 0.7                # 價值區涵蓋的成交量比例
+MIN_PERIODS = 2                 # 視窗內至少 2 根 K 棒才計算
+CHUNK_ELEMENTS = 4_000_000      # 分塊計算時 (視窗數 x 視窗長 x 價位數) 的上限，控制暫存記憶體
+
+
+def _profile(high, low, close, volume, price_levels, value_area, min_periods):
+    """
+    VP 核心 (最後一軸為視窗)
+    :return: (poc, va_high, va_low) 形狀為輸入去掉最後一軸，未四捨五入，無法計算為 NaN
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)   # 全 NaN 視窗
+        hi = np.nanmax(high, axis=-1)
+        lo = np.nanmin(low, axis=-1)
+    valid_close = ~np.isnan(close)
+    enough = valid_close.sum(axis=-1) >= min_periods
+
+    step = (hi - lo) / price_levels
+    levels = np.arange(price_levels + 1)
+    # 價位邊界與 scheme3 相同寫法: lo + i * step
+    edges = lo[..., np.newaxis] + levels * step[..., np.newaxis]
+    mids = (edges[..., :-1] + edges[..., 1:]) / 2
+
+    # 收盤價落在第幾個價位: 邊界 <= close 的個數 - 1 (超過最後上緣者不計入)
+    count = (close[..., np.newaxis] >= edges[..., np.newaxis, :]).sum(axis=-1)
+    in_range = valid_close & (count >= 1) & (count <= price_levels)
+    one_hot = (count[..., np.newaxis] - 1 == levels[:-1]) & in_range[..., np.newaxis]
+    vols = np.where(one_hot, np.nan_to_num(volume)[..., np.newaxis], 0.0).sum(axis=-2)
+
+    poc = np.take_along_axis(mids, vols.argmax(axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+
+    # 價值區: 依成交量由大到小 (同量維持價位順序) 累加，含跨過 70% 的那一個價位
+    total = vols.sum(axis=-1)
+    order = np.argsort(-vols, axis=-1, kind='stable')
+    cumulative = np.cumsum(np.take_along_axis(vols, order, axis=-1), axis=-1)
+    n_area = (cumulative < (total * value_area)[..., np.newaxis]).sum(axis=-1) + 1
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.broadcast_to(np.arange(price_levels), order.shape), axis=-1)
+    in_area = rank < n_area[..., np.newaxis]
+    va_high = np.where(in_area, mids, -np.inf).max(axis=-1) + step / 2
+    va_low = np.where(in_area, mids, np.inf).min(axis=-1) - step / 2
+
+    # 特例: 無成交量時價值區為整段區間；最高 = 最低時三者皆為該價
+    no_volume = total <= 0
+    va_high = np.where(no_volume, hi, va_high)
+    va_low = np.where(no_volume, lo, va_low)
+    flat = hi == lo
+    poc = np.where(flat, hi, poc)
+    va_high = np.where(flat, hi, va_high)
+    va_low = np.where(flat, lo, va_low)
+
+    return tuple(np.where(enough, arr, np.nan) for arr in (poc, va_high, va_low))
+
+
+def _as_float(*arrays):
+    return [np.asarray(a, dtype=np.float64) for a in arrays]
+
+
+def latest_volume_profile(high, low, close, volume, window=20, price_levels=PRICE_LEVELS,
+                          value_area=VALUE_AREA, min_periods=MIN_PERIODS):
+    """
+    最後一根 K 棒的 VP (批次: 2-D 輸入時每列一檔)
+    :return: (poc, va_high, va_low)，1-D 輸入回傳純量陣列，2-D 輸入回傳每檔一值
+    """
+    high, low, close, volume = (a[..., -window:] for a in _as_float(high, low, close, volume))
+    return _profile(high, low, close, volume, price_levels, value_area, min_periods)
+
+
+def rolling_volume_profile(high, low, close, volume, window=20, price_levels=PRICE_LEVELS,
+                           value_area=VALUE_AREA, min_periods=MIN_PERIODS):
+    """
+    每根 K 棒的 VP 序列 (開頭不足 window 根時使用已有的 K 棒，與逐列 df.iloc[i-19:i+1] 相同)
+    :return: (poc, va_high, va_low) 形狀與輸入相同
+    """
+    arrays = _as_float(high, low, close, volume)
+    shape = arrays[0].shape
+    flat = [a.reshape(-1, shape[-1]) for a in arrays]
+    n_rows, n_bars = flat[0].shape
+    pad = np.full((n_rows, window - 1), np.nan)
+    windows = [sliding_window_view(np.concatenate([pad, a], axis=1), window, axis=1) for a in flat]
+
+    out = [np.full((n_rows, n_bars), np.nan) for _ in range(3)]
+    rows_per_chunk = max(1, CHUNK_ELEMENTS // max(1, n_bars * window * (price_levels + 1)))
+    for start in range(0, n_rows, rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        results = _profile(*(w[chunk] for w in windows), price_levels, value_area, min_periods)
+        for target, result in zip(out, results):
+            target[chunk] = result
+    return tuple(arr.reshape(shape) for arr in out)
+
+
+def batch_volume_profile(high, low, close, volume, windows=VP_WINDOWS, price_levels=PRICE_LEVELS):
+    """
+    全市場最後一根 K 棒的多視窗 VP
+    :return: {window: (poc, va_high, va_low)}，每個陣列每檔一值
+    """
+    return {w: latest_volume_profile(high, low, close, volume, window=w, price_levels=price_levels)
+            for w in windows}
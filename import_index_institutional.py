@@ -48,7 +48,7 @@ def fetch_index_institutional(days=730):
             pivot['Dealer'] = 0
             
         # 寫入資料庫
-        with db_manager.get_connection() as conn:
+        with db_manager.get_write_connection() as conn:
             updated = 0
             for date_int, row in pivot.iterrows():
                 foreign = float(row.get('Foreign_Investor', 0))
@@ -63,7 +63,6 @@ def fetch_index_institutional(days=730):
                 
                 if conn.total_changes > 0:
                     updated += 1
-            conn.commit()
             print(f"  ✓ 成功更新 {updated} 筆加權指數法人資料")
             
     except Exception as e:
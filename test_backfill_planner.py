@@ -0,0 +1,71 @@
+"""
+測試 core.backfill_planner (依日期回補規劃與並行下載)
+以記憶體 SQLite 建立缺漏位元索引，下載以假函式模擬，不需網路
+"""
+import sqlite3
+import threading
+from datetime import date
+
+from core import gap_index as gi
+from core.backfill_planner import BackfillPlan, plan_backfill, run_date_jobs
+from core.quote_ingest import ingest_daily_quotes
+
+DAYS = [20250106, 20250107, 20250108, 20250109, 20250110,
+        20250113, 20250114, 20250115, 20250116, 20250117]
+OUTAGE = (20250113, 20250114, 20250115)
+CODES = [str(1101 + i) for i in range(20)]
+
+
+def weekend(date_int):
+    return date(date_int // 10000, date_int // 100 % 100, date_int % 100).weekday() >= 5
+
+
+def make_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL, low REAL,
+                    close REAL, volume INTEGER, amount INTEGER, PRIMARY KEY (code, date_int))""")
+    rows = [(c, d, 1, 1, 1, 10.0, 100, 1000) for c in CODES for d in DAYS if d not in OUTAGE]
+    rows.remove(('1105', 20250108, 1, 1, 1, 10.0, 100, 1000))      # 單檔零星缺漏
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+
+def test_outage_planned_by_date_and_stray_gap_per_stock():
+    conn = make_db()
+    gaps = gi.refresh_gap_index(conn)
+    plan = plan_backfill(gaps, gi.TradingCalendar(20250101, 20250117, weekend))
+    assert sorted(plan.by_date) == list(OUTAGE)
+    assert all(len(codes) == 20 for codes in plan.by_date.values())
+    assert plan.per_stock == {'1105': [20250108]}
+    assert plan.requests == 3 * 2 + 1
+    assert plan.naive_requests == 20
+    assert BackfillPlan().requests == 0
+
+
+def test_run_date_jobs_fetches_concurrently_and_applies_on_caller_thread():
+    conn = make_db()
+    gaps = gi.refresh_gap_index(conn)
+    plan = plan_backfill(gaps, gi.TradingCalendar(20250101, 20250117, weekend))
+    caller = threading.get_ident()
+    applied_threads = set()
+
+    def fetch_day(d):
+        if d == 20250115:
+            return None                                   # 下載失敗
+        return [(c, 'x', 1, 1, 1, 11.0, 200, 2200) for c in CODES + ['9999']]
+
+    def apply_day(d, rows, codes):
+        applied_threads.add(threading.get_ident())
+        wanted = set(codes)
+        result = ingest_daily_quotes(conn, d, '', [q for q in rows if q[0] in wanted], update_snapshot=False)
+        return result.new
+
+    outcome = run_date_jobs(plan.by_date, fetch_day, apply_day)
+    assert outcome == {'written': 40, 'done': [20250113, 20250114], 'failed': [20250115]}
+    assert applied_threads == {caller}
+    assert conn.execute("SELECT COUNT(*) FROM stock_history WHERE code = '9999'").fetchone()[0] == 0
+
+    remaining = plan_backfill(gi.refresh_gap_index(conn), gi.TradingCalendar(20250101, 20250117, weekend))
+    assert list(remaining.by_date) == [20250115]
+
@@ -0,0 +1,85 @@
+"""
+測試 core.candle_patterns (全市場向量化 K 線型態引擎)
+以隨機 K 棒與原逐檔純量判斷比對，不需資料庫或網路
+"""
+import numpy as np
+import pandas as pd
+
+from core import candle_patterns as cp
+
+
+def legacy_morning_star(c, o, h, l, v):
+    """原 scan_candlestick_patterns 的逐檔判斷 (回傳通過的步驟數)"""
+    c2, c1, c0 = c[-3:]
+    o2, o1, o0 = o[-3:]
+    range0, range2 = h[-1] - l[-1], h[-3] - l[-3]
+    body0, body1, body2 = abs(c0 - o0), abs(c1 - o1), abs(c2 - o2)
+    if not ((c2 < o2) and (body2 > range2 * 0.6)):
+        return 0
+    if not ((body1 < body2 * 0.3) and (c1 < c2)):
+        return 1
+    if not ((c0 > o0) and (c0 > (o2 + c2) / 2) and (body0 > range0 * 0.6)):
+        return 2
+    if not (v[-1] > v[-2] * 1.3):
+        return 3
+    return 4
+
+
+def random_history(n_codes=3000, bars=6, seed=7):
+    rng = np.random.default_rng(seed)
+    history = {}
+    for i in range(n_codes):
+        n = int(rng.integers(1, bars + 1))
+        o = rng.uniform(90, 110, n)
+        c = o + rng.normal(0, 4, n)
+        h = np.maximum(o, c) + rng.uniform(0, 1.5, n)
+        l = np.minimum(o, c) - rng.uniform(0, 1.5, n)
+        v = rng.integers(100, 5000, n).astype(float)
+        history[str(1000 + i)] = {'open': o, 'high': h, 'low': l, 'close': c, 'volume': v}
+    return history
+
+
+def test_morning_star_funnel_matches_legacy_loop():
+    history = random_history()
+    codes = list(history)
+    results = cp.evaluate(cp.recent_candles(history, codes), ['morning_star'], confirm=True)
+    steps = np.array([legacy_morning_star(d['close'], d['open'], d['high'], d['low'], d['volume'])
+                      if len(d['close']) >= 3 else 0 for d in history.values()])
+    funnel = [count for _, count in results['morning_star'].funnel]
+    assert funnel == [int((steps >= k).sum()) for k in (1, 2, 3, 4)]
+    assert funnel[0] > funnel[-1] > 0
+    assert results['morning_star'].hits.tolist() == (steps == 4).tolist()
+
+
+def test_pattern_series_matches_pandas_formula():
+    h = random_history(1, 400, seed=3)['1000']
+    df = pd.DataFrame(h)
+    body = (df['close'] - df['open']).abs()
+    rng = df['high'] - df['low']
+    expected = ((df['close'].shift(2) > df['open'].shift(2)) & (body.shift(2) > rng.shift(2) * 0.6)
+                & (body.shift(1) < body.shift(2) * 0.3) & (df['close'].shift(1) > df['close'].shift(2))
+                & (df['close'] < df['open']) & (df['close'] < (df['open'].shift(2) + df['close'].shift(2)) / 2)
+                & (body > rng * 0.6))
+    got = cp.pattern_series(df, 'evening_star')
+    assert got.index.equals(df.index)
+    assert got.tolist() == expected.tolist()
+
+
+def test_registry_snapshot_flags_and_mask():
+    assert {'morning_star', 'evening_star', 'bullish_engulfing', 'hammer', 'three_white_soldiers'} <= set(cp.PATTERNS)
+    # 紅三兵 + 多頭吞噬 (最後兩根)
+    history = {
+        '2330': {'open': np.array([10., 10.5, 11.0]), 'close': np.array([10.6, 11.2, 11.9]),
+                 'high': np.array([10.7, 11.3, 12.0]), 'low': np.array([9.9, 10.4, 10.9]),
+                 'volume': np.array([1e6, 1e6, 1e6])},
+        '1101': {'open': np.array([20., 19.0]), 'close': np.array([19.2, 20.5]),
+                 'high': np.array([20.1, 20.6]), 'low': np.array([19.1, 18.9]), 'volume': np.array([1e3, 1e3])},
+    }
+    codes = ['2330', '1101', '9999']
+    results = cp.evaluate(cp.recent_candles(history, codes))
+    assert results['three_white_soldiers'].hits.tolist() == [True, False, False]
+    assert results['bullish_engulfing'].hits.tolist() == [False, True, False]
+    masked = cp.evaluate(cp.recent_candles(history, codes), ['bullish_engulfing'],
+                         mask=np.array([True, False, True]))
+    assert masked['bullish_engulfing'].funnel[-1][1] == 0
+    assert cp.snapshot_flags(history, codes) == [(0, 0, '2330'), (0, 0, '1101'), (0, 0, '9999')]
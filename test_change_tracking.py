@@ -0,0 +1,106 @@
+"""
+測試 core.change_tracking (雲端同步變更追蹤與浮水印續傳)
+使用記憶體 SQLite，上傳以 dict 模擬雲端表，不需網路
+"""
+import sqlite3
+
+import pytest
+
+from core import change_tracking as ct
+
+
+def make_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stock_history (code TEXT, date_int INTEGER, close REAL, volume INTEGER, "
+                 "PRIMARY KEY (code, date_int))")
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT)")
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?)",
+                     [(c, d, 10.0 + d % 7, None if d % 5 == 0 else 1000) for c in ('1101', '2330')
+                      for d in range(20250101, 20250131)])
+    conn.executemany("INSERT INTO stock_meta VALUES (?, ?)", [('1101', '台泥'), ('2330', '台積電')])
+    conn.commit()
+    ct.ensure_change_tracking(conn, ['stock_history', 'stock_meta'])
+    conn.commit()
+    return conn
+
+
+class Cloud:
+    """以主鍵 upsert 的模擬雲端表；fail_after 指定第幾次上傳失敗"""
+
+    def __init__(self, fail_after=None):
+        self.tables = {}
+        self.calls = 0
+        self.fail_after = fail_after
+
+    def upload(self, table, records):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise RuntimeError("network down")
+        store = self.tables.setdefault(table, {})
+        for r in records:
+            store[(r['code'], r.get('date_int'))] = r
+
+
+def local_rows(conn):
+    return {(c, d): (cl, v) for c, d, cl, v in conn.execute("SELECT code, date_int, close, volume FROM stock_history")}
+
+
+def cloud_rows(cloud):
+    return {k: (r['close'], r.get('volume')) for k, r in cloud.tables['stock_history'].items()}
+
+
+def test_seed_then_delta_only_pushes_changes():
+    conn = make_db()
+    cloud = Cloud()
+    assert ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=7) == ('seed', 60)
+    assert cloud_rows(cloud) == local_rows(conn)
+    assert ct.pending_changes(conn, 'stock_history') == 0
+
+    conn.execute("INSERT INTO stock_history VALUES ('2330', 20250131, 99.0, 5)")
+    conn.execute("UPDATE stock_history SET close = 1.0 WHERE code = '1101' AND date_int = 20250102")
+    conn.execute("INSERT OR REPLACE INTO stock_history VALUES ('1101', 20250103, 2.0, 3)")
+    conn.execute("UPDATE stock_history SET volume = 7 WHERE code = '1101' AND date_int = 20250102")  # 同列再改
+    conn.commit()
+    assert ct.pending_changes(conn, 'stock_history') == 3
+    assert ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=2) == ('delta', 3)
+    assert cloud_rows(cloud) == local_rows(conn)
+    assert ct.sync_table(conn, 'stock_history', cloud.upload) == ('delta', 0)
+
+
+def test_failed_batch_resumes_from_watermark():
+    conn = make_db()
+    cloud = Cloud(fail_after=3)
+    with pytest.raises(ct.SyncBatchError) as exc:
+        ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=10)
+    assert exc.value.synced == 30
+    # 全表上傳期間的異動也要在之後的增量中送出
+    conn.execute("UPDATE stock_history SET close = 5.0 WHERE code = '1101' AND date_int = 20250101")
+    conn.commit()
+    cloud.fail_after = None
+    assert ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=10) == ('seed', 30)
+    assert ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=10) == ('delta', 1)
+    assert cloud_rows(cloud) == local_rows(conn)
+
+    conn.executemany("UPDATE stock_history SET volume = 1 WHERE code = '2330' AND date_int = ?",
+                     [(d,) for d in range(20250101, 20250106)])
+    conn.commit()
+    cloud.calls, cloud.fail_after = 0, 1
+    with pytest.raises(ct.SyncBatchError):
+        ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=2)
+    assert ct.pending_changes(conn, 'stock_history') == 3
+    cloud.fail_after = None
+    assert ct.sync_table(conn, 'stock_history', cloud.upload, batch_size=2) == ('delta', 3)
+    assert cloud_rows(cloud) == local_rows(conn)
+
+
+def test_single_key_table_and_drop_nulls():
+    conn = make_db()
+    cloud = Cloud()
+    ct.sync_table(conn, 'stock_meta', cloud.upload)
+    conn.execute("UPDATE stock_meta SET name = '台積' WHERE code = '2330'")
+    conn.commit()
+    assert ct.sync_table(conn, 'stock_meta', cloud.upload) == ('delta', 1)
+    assert cloud.tables['stock_meta'][('2330', None)]['name'] == '台積'
+
+    ct.sync_table(conn, 'stock_history', cloud.upload, drop_nulls=True)
+    assert 'volume' not in cloud.tables['stock_history'][('1101', 20250105)]
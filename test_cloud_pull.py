@@ -0,0 +1,172 @@
+"""
+測試 core.cloud_pull (Supabase → SQLite keyset 增量拉取)
+以本機 HTTP 伺服器模擬 PostgREST 的 GET 查詢，不需網路
+"""
+import json
+import re
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from core import cloud_pull as cp
+from core.change_tracking import ensure_change_tracking, pending_changes, sync_table
+
+_OR = re.compile(r'^\((\w+)\.gt\.("?)(.+?)\2,and\(\1\.eq\.\2\3\2,(\w+)\.gt\.("?)(.+?)\5\)\)$')
+
+
+def _cast(value, sample):
+    return int(value) if isinstance(sample, int) else value
+
+
+class FakePostgrestReader:
+    """模擬 PostgREST 查詢: select/order/limit、col=gte./gt. 與 keyset 的 or=() 條件"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                table = url.path.rsplit('/', 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                fake.queries.append((table, params))
+                rows = list(fake.tables.get(table, []))
+                for key, value in params.items():
+                    if key in ('select', 'order', 'limit'):
+                        continue
+                    if key == 'or':
+                        a, _, va, b, _, vb = _OR.match(value).groups()
+                        rows = [r for r in rows if (r[a], r[b]) > (_cast(va, r[a]), _cast(vb, r[b]))]
+                        continue
+                    op, operand = value.split('.', 1)
+                    if op == 'gte':
+                        rows = [r for r in rows if r[key] >= _cast(operand, r[key])]
+                    elif op == 'gt':
+                        rows = [r for r in rows if r[key] > _cast(operand, r[key])]
+                order = [o.split('.')[0] for o in params['order'].split(',')]
+                rows.sort(key=lambda r: tuple(r[c] for c in order))
+                rows = rows[:int(params['limit'])]
+                body = json.dumps(rows).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_local():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT, market_type TEXT)")
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL, low REAL,
+                    close REAL, volume INTEGER, amount INTEGER, local_note TEXT, PRIMARY KEY (code, date_int))""")
+    conn.execute("""CREATE TABLE stock_snapshot (code TEXT PRIMARY KEY, name TEXT, date TEXT, close REAL,
+                    volume INTEGER, close_prev REAL, vol_prev INTEGER, amount REAL, rsi REAL)""")
+    return conn
+
+
+def cloud_history(codes=('1101', '2330', '2454'), days=(20250102, 20250103, 20250106)):
+    return [{'code': c, 'date_int': d, 'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': float(d % 100),
+             'volume': d % 1000, 'amount': 100, 'foreign_buy': 5.0}
+            for d in days for c in codes]
+
+
+@pytest.fixture
+def cloud():
+    server = FakePostgrestReader({
+        'stock_meta': [{'code': c, 'name': f"股票{c}", 'market_type': 'twse', 'total_shares': 1}
+                       for c in ('1101', '2330', '2454')],
+        'stock_history': cloud_history(),
+    })
+    yield server
+    server.close()
+
+
+def test_keyset_pagination_pulls_everything_without_offset(cloud):
+    conn = make_local()
+    with cp.PostgrestReader(cloud.url, 'key', page_size=2) as reader:
+        result = cp.pull_all(conn, reader)
+
+    assert result['failed'] == {}
+    assert result['pulled'] == {'stock_meta': 3, 'stock_history': 9}
+    assert result['codes'] == {'1101', '2330', '2454'}
+    assert conn.execute("SELECT COUNT(*) FROM stock_history").fetchone()[0] == 9
+    assert all('offset' not in params for _, params in cloud.queries)
+    assert any('or' in params for table, params in cloud.queries if table == 'stock_history')
+
+
+def test_pull_starts_at_local_high_water_and_keeps_local_columns(cloud):
+    conn = make_local()
+    conn.execute("INSERT INTO stock_history (code, date_int, close, local_note) VALUES ('2330', 20250103, 1.0, 'keep')")
+    conn.commit()
+    with cp.PostgrestReader(cloud.url, 'key', page_size=100) as reader:
+        pulled, codes = cp.pull_table(conn, reader, 'stock_history', 'date_int', ('date_int', 'code'))
+
+    # 高水位當天重新拉取 (gte)，之前的日期不再請求
+    assert pulled == 6
+    history_query = [p for t, p in cloud.queries if t == 'stock_history'][0]
+    assert history_query['date_int'] == 'gte.20250103'
+    row = conn.execute("SELECT close, local_note FROM stock_history WHERE code='2330' AND date_int=20250103").fetchone()
+    assert row == (3.0, 'keep')
+    assert conn.execute("SELECT COUNT(*) FROM stock_history WHERE date_int = 20250102").fetchone()[0] == 0
+
+
+def test_pulled_rows_are_not_pushed_back(cloud):
+    conn = make_local()
+    ensure_change_tracking(conn, ['stock_history'])
+    sync_table(conn, 'stock_history', lambda table, records: None)    # 建立浮水印 (空表)
+    with cp.PostgrestReader(cloud.url, 'key') as reader:
+        cp.pull_table(conn, reader, 'stock_history', 'date_int', ('date_int', 'code'))
+    assert pending_changes(conn, 'stock_history') == 0
+
+    conn.execute("UPDATE stock_history SET close = 99 WHERE code = '1101' AND date_int = 20250106")
+    conn.commit()
+    assert pending_changes(conn, 'stock_history') == 1
+
+
+def test_rebuild_snapshot_rows_only_touches_given_codes(cloud):
+    conn = make_local()
+    conn.execute("INSERT INTO stock_snapshot (code, name, close, rsi) VALUES ('2330', '台積電', 1.0, 55.0)")
+    conn.execute("INSERT INTO stock_snapshot (code, name, close) VALUES ('2454', '聯發科', 7.0)")
+    conn.commit()
+    with cp.PostgrestReader(cloud.url, 'key') as reader:
+        cp.pull_all(conn, reader)
+
+    assert cp.rebuild_snapshot_rows(conn, {'2330', '1101'}) == 2
+    snap = {r[0]: r[1:] for r in conn.execute(
+        "SELECT code, name, date, close, close_prev, volume, vol_prev, rsi FROM stock_snapshot")}
+    assert snap['2330'] == ('股票2330', '2025-01-06', 6.0, 3.0, 106, 103, 55.0)
+    assert snap['1101'][:4] == ('股票1101', '2025-01-06', 6.0, 3.0)
+    assert snap['2454'][2] == 7.0
+
+
+def test_failed_table_reports_committed_codes(cloud):
+    conn = make_local()
+
+    class FlakyReader(cp.PostgrestReader):
+        def fetch(self, table, params):
+            if 'or' in params:
+                raise RuntimeError("連線中斷")
+            return super().fetch(table, params)
+
+    with FlakyReader(cloud.url, 'key', page_size=3) as reader:
+        result = cp.pull_all(conn, reader)
+
+    assert 'stock_history' in result['failed']
+    assert conn.execute("SELECT COUNT(*) FROM stock_history").fetchone()[0] == 3
+    assert result['codes'] == {'1101', '2330', '2454'}
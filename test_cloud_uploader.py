@@ -0,0 +1,146 @@
+"""
+測試 core.cloud_uploader (PostgREST 並行上傳管線)
+以本機 HTTP 伺服器模擬 PostgREST，不需網路
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from core import cloud_uploader as cu
+
+
+class FakePostgrest:
+    """
+    模擬 PostgREST upsert: 依 (code, date_int) 合併
+    max_bytes: 超過時回 413；fail_first: 前 N 次回 503；reject: 一律回 400
+    """
+
+    def __init__(self, max_bytes=None, fail_first=0, reject=False):
+        self.rows = {}
+        self.requests = []
+        self.max_bytes = max_bytes
+        self.fail_first = fail_first
+        self.reject = reject
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                url = urlparse(self.path)
+                with fake.lock:
+                    fake.requests.append((url.path, len(body), self.headers.get('apikey')))
+                    if fake.reject:
+                        status = 400
+                    elif fake.fail_first > 0:
+                        fake.fail_first -= 1
+                        status = 503
+                    elif fake.max_bytes and len(body) > fake.max_bytes:
+                        status = 413
+                    else:
+                        status = 201
+                        columns = parse_qs(url.query).get('columns', [None])[0]
+                        for row in json.loads(body):
+                            if columns:
+                                row = {c: row.get(c) for c in columns.split(',')}
+                            fake.rows[(url.path, row['code'], row['date_int'])] = row
+                self.send_response(status)
+                if status == 503:
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake():
+    server = FakePostgrest()
+    yield server
+    server.close()
+
+
+def make_rows(n=3000):
+    return [{'code': f"{1000 + i % 100}", 'date_int': 20250101 + i // 100, 'close': float(i),
+             'volume': None if i % 3 == 0 else i * 10} for i in range(n)]
+
+
+def test_parallel_upload_sizes_batches_by_bytes(fake):
+    rows = make_rows()
+    with cu.PostgrestUploader(fake.url, 'k', workers=4, target_bytes=8 * 1024) as up:
+        stats = up.upload('stock_history', iter(rows))
+    assert stats.sent_rows == len(rows) and stats.failed_rows == 0
+    assert len(fake.rows) == len(rows)
+    assert all(size <= 8 * 1024 for _, size, _ in fake.requests)
+    assert len(fake.requests) > 10
+    assert {key for _, _, key in fake.requests} == {'k'}
+
+
+def test_drop_nulls_sends_columns_and_keeps_nulls(fake):
+    rows = make_rows(30)
+    with cu.PostgrestUploader(fake.url, 'k') as up:
+        up.upload('stock_history', rows, drop_nulls=True)
+    stored = fake.rows[('/rest/v1/stock_history', '1000', 20250101)]
+    assert stored == {'code': '1000', 'date_int': 20250101, 'close': 0.0, 'volume': None}
+
+
+def test_payload_too_large_splits_and_shrinks(fake):
+    fake.max_bytes = 4 * 1024
+    rows = make_rows(500)
+    with cu.PostgrestUploader(fake.url, 'k', workers=2, target_bytes=64 * 1024) as up:
+        stats = up.upload('stock_history', rows)
+        assert up.target_bytes < 64 * 1024
+    assert stats.failed_rows == 0 and stats.splits > 0
+    assert len(fake.rows) == len(rows)
+
+
+def test_retry_after_503(fake):
+    fake.fail_first = 3
+    with cu.PostgrestUploader(fake.url, 'k', workers=1, backoff_base=0.01) as up:
+        stats = up.upload('stock_history', make_rows(100))
+    assert stats.retries == 3 and stats.sent_rows == 100
+
+
+def test_failed_batches_go_to_disk_queue_and_replay(fake):
+    fake.reject = True
+    with tempfile.TemporaryDirectory() as tmp:
+        with cu.PostgrestUploader(fake.url, 'k', workers=2, target_bytes=4 * 1024, retry_dir=tmp) as up:
+            stats = up.upload('stock_history', make_rows(300))
+            assert stats.failed_rows == 300 and stats.queued_batches == len(up.retry_queue_files())
+            assert not fake.rows
+            fake.reject = False
+            replay = up.replay_retry_queue()
+            assert replay.sent_rows == 300 and up.retry_queue_files() == []
+        assert len(fake.rows) == 300
+
+
+def test_failure_without_retry_dir_raises(fake):
+    fake.reject = True
+    with cu.PostgrestUploader(fake.url, 'k', max_retries=0) as up:
+        with pytest.raises(cu.UploadError) as exc:
+            up.upload('stock_history', make_rows(10))
+    assert exc.value.failed_rows == 10
+
+
+def test_reads_sqlite_cursor_in_caller_thread(fake):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stock_history (code TEXT, date_int INTEGER, close REAL, volume INTEGER)")
+    conn.executemany("INSERT INTO stock_history VALUES (:code, :date_int, :close, :volume)", make_rows(1000))
+    with cu.PostgrestUploader(fake.url, 'k') as up:
+        stats = up.upload('stock_history', cu.cursor_rows(conn.execute("SELECT * FROM stock_history"), 128))
+    assert stats.sent_rows == 1000 and len(fake.rows) == 1000
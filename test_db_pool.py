@@ -0,0 +1,87 @@
+"""
+測試 backend.services.db 讀取連線池與單一寫入路徑
+使用暫存目錄的 SQLite，不需網路
+"""
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from backend.services.db import DBManager, ReadConnectionPool
+
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT)")
+    conn.executemany("INSERT INTO stock_meta VALUES (?, ?)", [('1101', '台泥'), ('2330', '台積電')])
+    conn.commit()
+    conn.close()
+
+
+def test_pool_reuses_connection_and_pragmas():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'pool.db'
+        make_db(path)
+        pool = ReadConnectionPool(path, max_size=2)
+        with pool.connection() as conn:
+            first = conn
+            assert conn.execute("PRAGMA query_only").fetchone()[0] == 1
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            # 同一執行緒巢狀取用共用同一條連線
+            with pool.connection() as inner:
+                assert inner is conn
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM stock_meta")
+        with pool.connection() as conn:
+            assert conn is first
+        assert pool.info()["created"] == 1 and pool.info()["reused"] == 1
+        pool.reset()
+
+
+def test_pool_is_bounded_across_threads():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'pool.db'
+        make_db(path)
+        pool = ReadConnectionPool(path, max_size=2)
+        held = threading.Barrier(3)
+        release = threading.Event()
+        errors = []
+
+        def hold():
+            with pool.connection():
+                held.wait()
+                release.wait(5)
+
+        threads = [threading.Thread(target=hold) for _ in range(2)]
+        for t in threads:
+            t.start()
+        held.wait()     # 兩條連線皆已借出
+        try:
+            with pool.connection(timeout=0.05):
+                pass
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+        release.set()
+        for t in threads:
+            t.join()
+        assert len(errors) == 1
+        assert pool.info()["created"] == 2
+        pool.reset()
+
+
+def test_writer_path_commits_and_readers_see_it():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'pool.db'
+        make_db(path)
+        db = DBManager(path)
+        assert len(db.execute_query("SELECT * FROM stock_meta")) == 2
+        db.execute_update("INSERT INTO stock_meta VALUES (?, ?)", ('2317', '鴻海'))
+        with pytest.raises(ValueError):
+            with db.get_write_connection() as conn:
+                conn.execute("INSERT INTO stock_meta VALUES (?, ?)", ('9999', 'x'))
+                raise ValueError("rollback")
+        codes = [r['code'] for r in db.execute_query("SELECT code FROM stock_meta ORDER BY code")]
+        assert codes == ['1101', '2317', '2330']
+        db.shutdown()
@@ -0,0 +1,63 @@
+"""
+測試 backend.services.executor (阻塞呼叫分派到各 lane 執行緒池)
+純 asyncio，不需資料庫或網路
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from backend.services.executor import BlockingLane
+
+
+def test_runs_off_event_loop_thread():
+    lane = BlockingLane("t", workers=2, concurrency=4, queue_timeout=1, timeout=1)
+
+    async def main():
+        return await lane.run(threading.get_ident), threading.get_ident()
+
+    worker, loop_thread = asyncio.run(main())
+    assert worker != loop_thread
+    assert lane.info()["calls"] == 1 and lane.info()["active"] == 0
+    lane.shutdown()
+
+
+def test_heavy_lane_does_not_block_light_lane():
+    """重量級 lane 佔滿時，另一個 lane 與事件迴圈仍可即時回應"""
+    heavy = BlockingLane("heavy", workers=1, concurrency=1, queue_timeout=5, timeout=5)
+    light = BlockingLane("light", workers=1, concurrency=4, queue_timeout=1, timeout=1)
+
+    async def main():
+        slow = asyncio.ensure_future(heavy.run(time.sleep, 0.3))
+        await asyncio.sleep(0.02)
+        start = time.perf_counter()
+        assert await light.run(lambda: "ok") == "ok"
+        elapsed = time.perf_counter() - start
+        await slow
+        return elapsed
+
+    assert asyncio.run(main()) < 0.2
+    heavy.shutdown()
+    light.shutdown()
+
+
+def test_queue_and_execution_timeouts():
+    lane = BlockingLane("t", workers=1, concurrency=1, queue_timeout=0.05, timeout=0.1)
+
+    async def main():
+        with pytest.raises(HTTPException) as exc:
+            await lane.run(time.sleep, 0.3)
+        assert exc.value.status_code == 504
+        # 逾時的呼叫仍佔用名額直到執行緒結束
+        with pytest.raises(HTTPException) as exc:
+            await lane.run(lambda: None)
+        assert exc.value.status_code == 503
+        await asyncio.sleep(0.3)
+        assert await lane.run(lambda: 1) == 1
+
+    asyncio.run(main())
+    info = lane.info()
+    assert info["timeouts"] == 1 and info["rejected"] == 1
+    lane.shutdown()
@@ -0,0 +1,107 @@
+"""
+測試 core.gap_index (資料缺漏位元索引)
+使用記憶體 SQLite，休市日以週末判斷，不需網路
+"""
+import sqlite3
+from datetime import date
+
+from core import gap_index as gi
+
+
+def weekend(date_int):
+    return date(date_int // 10000, date_int // 100 % 100, date_int % 100).weekday() >= 5
+
+
+# 2025-01-06 (一) ~ 2025-01-17 (五)：10 個交易日
+DAYS = [20250106, 20250107, 20250108, 20250109, 20250110,
+        20250113, 20250114, 20250115, 20250116, 20250117]
+
+
+def make_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, close REAL, volume INTEGER,
+                    amount INTEGER, PRIMARY KEY (code, date_int))""")
+    conn.execute("CREATE TABLE institutional_investors (code TEXT, date_int INTEGER, foreign_buy INTEGER, "
+                 "PRIMARY KEY (code, date_int))")
+    rows = []
+    for code in ('1101', '2330', '2454'):
+        for d in DAYS:
+            if code == '2454' and d < 20250109:      # 20250109 才上市
+                continue
+            if code == '2330' and d == 20250114:     # 中間缺一天
+                continue
+            amount = None if (code == '1101' and d == 20250110) else 1000
+            rows.append((code, d, 10.0, 100, amount))
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?)", rows)
+    # 法人資料: 20250115 整日只抓到 1101
+    conn.executemany("INSERT INTO institutional_investors VALUES (?, ?, 0)",
+                     [(c, d) for c, d, *_ in rows if d != 20250115 or c == '1101'])
+    conn.commit()
+    return conn
+
+
+def test_bitmaps_count_and_find_gaps():
+    conn = make_db()
+    gaps = gi.refresh_gap_index(conn)
+    assert gaps.count('stock_history', '1101') == 10
+    assert gaps.count('stock_history', '2330') == 9
+    assert gaps.first_date('stock_history', '2454') == 20250109
+    assert gaps.count('amount_missing', '1101') == 1
+
+    cal = gi.TradingCalendar(20250101, 20250117, weekend)
+    assert gaps.missing('stock_history', cal) == {'2330': 1 << gi.day_no(20250114)}   # 上市前不算缺漏
+    by_date = gaps.missing_by_date('institutional_investors', cal)
+    assert by_date == {20250114: ['2330'], 20250115: ['2330', '2454']}
+    assert gaps.dates_to_fetch('institutional_investors', cal) == [20250115]
+
+
+def test_incremental_updates_from_change_logs():
+    conn = make_db()
+    gi.refresh_gap_index(conn)
+    conn.execute("INSERT INTO stock_history VALUES ('2330', 20250114, 10.0, 100, 1000)")
+    conn.execute("UPDATE stock_history SET amount = 5 WHERE code = '1101' AND date_int = 20250110")
+    conn.execute("DELETE FROM stock_history WHERE code = '2454' AND date_int = 20250117")
+    conn.execute("INSERT INTO institutional_investors VALUES ('2454', 20250115, 0)")
+    # stock_history 只經共用異動紀錄 (每列一筆)，不再有 gap 專用觸發器
+    assert conn.execute("SELECT COUNT(*) FROM history_changes").fetchone()[0] == 3
+    assert conn.execute("SELECT COUNT(*) FROM gap_pending").fetchone()[0] == 1
+    assert not conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' "
+                            "AND tbl_name = 'stock_history' AND name LIKE 'trg_gap_%'").fetchall()
+
+    gaps = gi.refresh_gap_index(conn)
+    assert conn.execute("SELECT COUNT(*) FROM gap_pending").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM history_changes").fetchone()[0] == 0
+    assert gaps.count('institutional_investors', '2454') == 7
+    assert gaps.count('stock_history', '2330') == 10
+    assert gaps.count('amount_missing', '1101') == 0
+    assert gaps.last_date('stock_history', '2454') == 20250116
+
+    # 增量結果與重新全表建立相同
+    gi.drop_gap_index(conn)
+    rebuilt = gi.refresh_gap_index(conn)
+    assert rebuilt.bitmaps == gaps.bitmaps
+
+
+def test_legacy_triggers_replaced_and_reseeded():
+    """舊版 stock_history 觸發器移除並全表重建一次，之後由異動紀錄增量更新"""
+    conn = make_db()
+    conn.execute("CREATE TABLE gap_pending (seq INTEGER PRIMARY KEY AUTOINCREMENT, dataset TEXT NOT NULL, "
+                 "code TEXT NOT NULL, date_int INTEGER NOT NULL, present INTEGER NOT NULL)")
+    conn.execute("""CREATE TRIGGER trg_gap_stock_history_insert AFTER INSERT ON stock_history
+                    BEGIN INSERT INTO gap_pending (dataset, code, date_int, present)
+                          VALUES ('stock_history', NEW.code, NEW.date_int, 1); END""")
+    conn.execute("INSERT INTO stock_history VALUES ('2330', 20250114, 10.0, 100, 1000)")
+
+    gaps = gi.refresh_gap_index(conn, ['stock_history'])
+    assert gaps.count('stock_history', '2330') == 10
+    assert not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'trg_gap_stock_history_insert'").fetchall()
+
+    conn.execute("DELETE FROM stock_history WHERE code = '2330' AND date_int = 20250106")
+    assert gi.refresh_gap_index(conn, ['stock_history']).count('stock_history', '2330') == 9
+
+
+def test_missing_source_table_is_skipped():
+    conn = make_db()
+    gaps = gi.refresh_gap_index(conn)
+    assert 'margin_data' not in gaps.bitmaps
+    assert gi.date_of(gi.day_no(20240229)) == 20240229
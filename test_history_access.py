@@ -0,0 +1,80 @@
+"""
+測試 core.history_access (整數日期歷史存取)
+使用記憶體 SQLite，不需網路
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from core import history_access as ha
+
+
+def make_db(with_chips=True):
+    conn = sqlite3.connect(':memory:')
+    chips = ", tdcc_count INTEGER, large_shareholder_pct REAL, foreign_buy INTEGER, " \
+            "trust_buy INTEGER, dealer_buy INTEGER" if with_chips else ""
+    conn.execute(f"""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL,
+                     low REAL, close REAL, volume INTEGER, amount INTEGER{chips})""")
+    for code in ('1101', '2330'):
+        for d in (20240131, 20240201, 20240229, 20240301):
+            values = [code, d, 10.5, 11, 10, 10.8, 1000, 10800]
+            if with_chips:
+                values += [None if d == 20240201 else 500, 40.5, 3, 0, -1]
+            conn.execute(f"INSERT INTO stock_history VALUES ({','.join('?' * len(values))})", values)
+    return conn
+
+
+def test_fetch_history_arrays():
+    """依日期遞增、limit 取最近 N 筆；NULL 的整數欄轉為 float + NaN"""
+    conn = make_db()
+    data = ha.fetch_history_arrays(conn, '2330', limit=3)
+    assert data['date_int'].tolist() == [20240201, 20240229, 20240301]
+    assert data['date_int'].dtype == np.int64 and data['volume'].dtype == np.int64
+    assert data['tdcc_count'].dtype == np.float64 and np.isnan(data['tdcc_count'][0])
+    assert data['foreign_buy'].tolist() == [3, 3, 3]
+
+    # 舊資料庫沒有籌碼欄位時只回傳存在的欄位
+    data = ha.fetch_history_arrays(make_db(with_chips=False), '1101')
+    assert set(data) == {name for name, _ in ha.PRICE_COLUMNS}
+
+
+def test_fetch_batch_history_arrays():
+    """單次查詢依代號切段，與逐檔查詢一致"""
+    conn = make_db()
+    batch = ha.fetch_batch_history_arrays(conn, ['1101', '2330', '9999'], 20240201)
+    assert set(batch) == {'1101', '2330'}
+    single = ha.fetch_history_arrays(conn, '2330', columns=ha.PRICE_COLUMNS)
+    for name, values in batch['2330'].items():
+        assert np.array_equal(values, single[name][1:]), name
+
+
+def test_fetch_recent_history_arrays():
+    """每檔只取最近 N 筆，與單檔 limit 查詢一致；NULL 整數欄轉 NaN"""
+    conn = make_db()
+    conn.execute("INSERT INTO stock_history (code, date_int, close, volume, amount) VALUES ('2454', 20240301, 900, NULL, 1)")
+    recent = ha.fetch_recent_history_arrays(conn, ['1101', '2330', '2454', '9999'], 2)
+    assert set(recent) == {'1101', '2330', '2454'}
+    single = ha.fetch_history_arrays(conn, '1101', limit=2, columns=ha.PRICE_COLUMNS)
+    for name, values in recent['1101'].items():
+        assert np.array_equal(values, single[name]), name
+    assert recent['2330']['date_int'].dtype == np.int64
+    assert recent['2454']['date_int'].tolist() == [20240301]
+    assert recent['2454']['volume'].dtype == np.float64 and np.isnan(recent['2454']['volume'][0])
+    assert ha.fetch_recent_history_arrays(conn, ['9999'], 5) == {}
+
+
+def test_date_conversion():
+    """整數日期向量化轉換與 pd.to_datetime 字串解析一致"""
+    dates = np.array([20240131, 20240229, 20241231, 19991001])
+    expected = pd.to_datetime(dates.astype(str), format='%Y%m%d').values
+    assert np.array_equal(ha.date_ints_to_datetime64(dates), expected)
+    assert ha.format_date_int(np.int64(20240229)) == '2024-02-29'
+
+
+if __name__ == "__main__":
+    test_fetch_history_arrays()
+    test_fetch_batch_history_arrays()
+    test_fetch_recent_history_arrays()
+    test_date_conversion()
+    print("✓ 歷史資料快速存取測試通過")
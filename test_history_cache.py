@@ -0,0 +1,127 @@
+"""
+測試 backend.services.history_cache (雲端歷史 K 線範圍快取)
+以記憶體中的假雲端資料取代 Supabase，記錄每次查詢
+"""
+import time
+
+from backend.services.history_cache import HistoryCache, HistoryRange
+
+
+class FakeCloud:
+    def __init__(self, days=300, codes=('2330', '2317')):
+        self.rows = {code: [{'code': code, 'date_int': 20240000 + d, 'open': 1.0, 'high': 2.0, 'low': 0.5,
+                             'close': float(d), 'volume': d * 10, 'amount': None}
+                            for d in range(1, days + 1)] for code in codes}
+        self.calls = []
+        self.version = 'v1'
+
+    def fetch(self, code, limit, before=None, since=None):
+        self.calls.append((code, limit, before, since))
+        rows = self.rows.get(code, [])
+        if before is not None:
+            rows = [r for r in rows if r['date_int'] < before]
+        if since is not None:
+            rows = [r for r in rows if r['date_int'] >= since]
+        rows = sorted(rows, key=lambda r: r['date_int'], reverse=True)
+        return rows[:limit] if limit else rows
+
+    def add_day(self, code, d):
+        self.rows[code].append({'code': code, 'date_int': 20240000 + d, 'open': 1.0, 'high': 2.0, 'low': 0.5,
+                                'close': float(d), 'volume': d * 10, 'amount': 5})
+
+
+def make_cache(cloud, **kwargs):
+    return HistoryCache(cloud.fetch, lambda: cloud.version, **kwargs)
+
+
+def test_repeat_and_shorter_requests_hit_cache():
+    cloud = FakeCloud()
+    cache = make_cache(cloud)
+    first = cache.get('2330', 60)
+    assert len(first) == 60 and first[-1]['date_int'] == 20240300
+    assert first[0]['date_int'] < first[-1]['date_int']
+    assert cache.get('2330', 30) == first[-30:]
+    assert cache.get('2330', 60) == first
+    assert len(cloud.calls) == 1
+    assert first[0]['volume'] == 2410 and isinstance(first[0]['volume'], int)
+    assert first[0]['amount'] is None and first[0]['foreign_buy'] == 0   # 缺欄沿用 0 預設值
+
+
+def test_longer_window_fetches_only_older_delta():
+    cloud = FakeCloud()
+    cache = make_cache(cloud)
+    cache.get('2330', 60)
+    longer = cache.get('2330', 120)
+    assert len(longer) == 120 and longer[-1]['date_int'] == 20240300
+    assert cloud.calls[-1] == ('2330', 60, 20240241, None)
+
+    # 超過雲端全部歷史: 記錄為完整，之後更長的視窗不再查詢
+    assert len(cache.get('2330', 1000)) == 300
+    calls = len(cloud.calls)
+    assert len(cache.get('2330', 2000)) == 300
+    assert len(cloud.calls) == calls
+
+
+def test_new_version_fetches_only_recent_overlap():
+    cloud = FakeCloud()
+    cache = make_cache(cloud)
+    cache.get('2330', 60)
+    cloud.add_day('2330', 301)
+    cloud.version = 'v2'
+    rows = cache.get('2330', 60)
+    assert rows[-1]['date_int'] == 20240301 and rows[-1]['amount'] == 5
+    assert cloud.calls[-1] == ('2330', None, None, 20240296)     # 最近 5 根起重抓
+    assert len(cloud.calls) == 2
+    cache.get('2330', 60)
+    assert len(cloud.calls) == 2
+
+
+def test_new_version_replaces_rewritten_and_deleted_recent_rows():
+    cloud = FakeCloud()
+    cache = make_cache(cloud)
+    cache.get('2330', 60)
+    rows = cloud.rows['2330']
+    rows[-2] = dict(rows[-2], close=-1.0, foreign_buy=123)      # 法人資料晚到、收盤修正
+    del rows[-3]
+    cloud.version = 'v2'
+    got = cache.get('2330', 60)
+    by_date = {r['date_int']: r for r in got}
+    assert by_date[20240299]['close'] == -1.0 and by_date[20240299]['foreign_buy'] == 123
+    assert 20240298 not in by_date
+    assert [r['date_int'] for r in got] == sorted(r['date_int'] for r in rows)[-60:]
+
+
+def test_lru_evicts_by_bytes():
+    cloud = FakeCloud(codes=('2330', '2317', '2454'))
+    one = HistoryRange.from_rows(cloud.fetch('2330', 100), False, 'v1').nbytes
+    cache = make_cache(cloud, max_bytes=int(one * 2.5))
+    for code in ('2330', '2317', '2454'):
+        cache.get(code, 100)
+    info = cache.info()
+    assert info['entries'] == 2 and info['bytes'] <= cache.max_bytes and info['evicted'] == 1
+    calls = len(cloud.calls)
+    cache.get('2454', 100)
+    assert len(cloud.calls) == calls
+    cache.get('2330', 100)              # 最久未用者已被淘汰
+    assert len(cloud.calls) == calls + 1
+
+
+def test_new_version_prefetches_popular_codes_in_background():
+    cloud = FakeCloud()
+    cache = make_cache(cloud, prefetch_top_n=1)
+    for _ in range(3):
+        cache.get('2330', 60)
+    cache.note_scan_hits(['2317'])
+    assert cache.popular_codes() == ['2330']
+
+    cloud.add_day('2330', 301)
+    cloud.version = 'v2'
+    cache.notify_version('v2')
+    deadline = time.time() + 5
+    while cache.stats['prefetched'] < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.stats['prefetched'] == 1
+
+    calls = len(cloud.calls)
+    assert cache.get('2330', 60)[-1]['date_int'] == 20240301
+    assert len(cloud.calls) == calls    # 使用者開圖時已是新版本，不再查雲端
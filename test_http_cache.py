@@ -0,0 +1,131 @@
+"""
+測試 core.http_cache (磁碟 HTTP 回應快取) 與 core.http_client 的快取整合
+使用暫存目錄與本機 HTTP 伺服器，不需網路
+"""
+import json
+import math
+import tempfile
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from core.http_cache import HttpCache, RECENT_TTL, UNSETTLED_TTL, response_ttl, ttl_for
+from core.http_client import FetchClient
+
+
+class Handler(BaseHTTPRequestHandler):
+    hits = {}
+
+    def do_GET(self):
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps({'path': self.path, 'n': self.hits[self.path]}).encode()
+        content_type = 'application/json'
+        if self.path.startswith('/settled'):
+            body = json.dumps({'stat': 'OK', 'data': [[self.hits[self.path]]]}).encode()
+        elif self.path.startswith('/busy'):
+            body, content_type = '<html>請稍後再試</html>'.encode(), 'text/html'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def test_ttl_policy_by_endpoint_and_date():
+    today = date(2025, 3, 10)
+    mi_index = "https://www.twse.com.tw/exchangeReport/MI_INDEX?response=json&type=ALLBUT0999&date="
+    assert ttl_for(mi_index + "20250103", today=today) == math.inf
+    assert ttl_for(mi_index + "20250309", today=today) == RECENT_TTL
+    assert ttl_for(mi_index + "20250310", today=today) == 600
+    tpex = "https://www.tpex.org.tw/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php"
+    assert ttl_for(tpex, {'l': 'zh-tw', 'd': '114/01/02', 'o': 'json'}, today=today) == math.inf
+    assert ttl_for("https://opendata.tdcc.com.tw/getOD.ashx?id=1-5", today=today) == 6 * 3600
+    assert ttl_for("https://example.com/data?date=20200101", today=today) is None
+
+
+def test_permanent_ttl_requires_settled_content():
+    as_json = {'content-type': 'application/json; charset=utf-8'}
+    ok = json.dumps({'stat': 'OK', 'date': '20250103', 'tables': [{'data': []}, {'data': [['0050']]}]}).encode()
+    assert response_ttl(math.inf, ok, as_json) == math.inf
+    assert response_ttl(math.inf, json.dumps({'stat': 'OK', 'data9': [[1]]}).encode(), as_json) == math.inf
+    for body in ({'stat': '很抱歉，沒有符合條件的資料!'}, {'stat': '查無資料'},
+                 {'stat': 'OK', 'data': []}, {'stat': 'OK', 'tables': [{'data': []}]}):
+        assert response_ttl(math.inf, json.dumps(body).encode(), as_json) == UNSETTLED_TTL, body
+    assert response_ttl(math.inf, b'code,name\n', {'content-type': 'text/csv'}) == UNSETTLED_TTL
+    assert response_ttl(RECENT_TTL, json.dumps({'stat': '查無資料'}).encode(), as_json) == RECENT_TTL
+    assert response_ttl(math.inf, b'<html>THE PAGE CANNOT BE ACCESSED</html>', {'content-type': 'text/html'}) is None
+    assert response_ttl(600, b'  <!DOCTYPE html>', {}) is None
+
+
+def test_lru_eviction_by_bytes_and_content_dedupe():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = HttpCache(tmp, max_bytes=250)
+        cache.put('a', 'u/a', 200, b'x' * 100, {}, None, math.inf)
+        cache.put('a2', 'u/a2', 200, b'x' * 100, {}, None, math.inf)      # 同內容只存一份
+        assert cache.total_bytes == 100
+        cache.put('b', 'u/b', 200, b'y' * 100, {}, None, math.inf)
+        assert cache.get('a').content == b'x' * 100                       # a 變成最近使用
+        cache.put('c', 'u/c', 200, b'z' * 100, {}, None, math.inf)        # 超過上限，依序淘汰 a2、b
+        assert cache.get('b') is None and cache.get('a2') is None
+        assert cache.total_bytes == 200
+        cache.put('a', 'u/a', 200, b'x' * 100, {}, None, math.inf)        # 覆寫相同內容不誤刪
+        assert cache.get('a').content == b'x' * 100
+        cache.close()
+
+        reopened = HttpCache(tmp, max_bytes=250)
+        assert reopened.get('c').content == b'z' * 100 and reopened.total_bytes == 200
+        reopened.close()
+
+
+def test_client_uses_cache_revalidates_and_replays_offline(server):
+    policies = (('127.0.0.1', 600),)
+    with tempfile.TemporaryDirectory() as tmp:
+        client = FetchClient(cache=HttpCache(tmp, policies=policies))
+        url = f"{server}/quotes"
+        first = client.fetch(url, params={'date': '20200103'})
+        second = client.fetch(url, params={'date': '20200103'})
+        assert not first.from_cache and second.from_cache
+        assert second.json() == first.json()
+        assert Handler.hits['/quotes?date=20200103'] == 1
+
+        def expires(path):
+            key = HttpCache.make_key(f"{server}{path}")
+            return client.cache._conn.execute("SELECT expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+
+        client.fetch(f"{server}/settled", params={'date': '20200103'})
+        assert expires('/settled?date=20200103') == (None,)                  # 正式資料永久保存
+        assert expires('/quotes?date=20200103')[0] is not None                # 無 stat/data: 短效期
+        busy = client.fetch(f"{server}/busy", params={'date': '20200103'})
+        assert busy.status_code == 200 and expires('/busy?date=20200103') is None
+
+        today = client.fetch(f"{server}/today")
+        client.cache._conn.execute("UPDATE entries SET expires_at = 0")     # 模擬過期
+        again = client.fetch(f"{server}/today")
+        assert again.from_cache and again.json() == today.json()
+        assert Handler.hits['/today'] == 2 and client.cache.stats['revalidated'] == 1
+        client.close()
+
+        offline = FetchClient(cache=HttpCache(tmp, policies=policies, offline=True))
+        assert offline.fetch(url, params={'date': '20200103'}).json()['n'] == 1
+        with pytest.raises(requests.exceptions.ConnectionError):
+            offline.fetch(f"{server}/never")
+        assert '/never' not in Handler.hits
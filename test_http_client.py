@@ -0,0 +1,109 @@
+"""
+測試 core.http_client (全域非同步抓取層)
+以本機 HTTP 伺服器模擬，不需網路
+"""
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from core.http_client import AsyncFetchClient, FetchClient, _verifies
+
+
+class Handler(BaseHTTPRequestHandler):
+    hits = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            n = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path.startswith('/slow'):
+            time.sleep(0.3)
+        if self.path.startswith('/busy') and n == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'path': self.path, 'n': n}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def test_concurrent_identical_gets_are_sent_once(server):
+    client = FetchClient()
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: client.fetch(f"{server}/slow", params={'b': 2, 'a': 1}), range(8)))
+    assert {r.json()['n'] for r in results} == {1}
+    assert sum(n for p, n in Handler.hits.items() if p.startswith('/slow')) == 1
+    assert client.stats['deduplicated'] == 7
+    client.close()
+
+
+def test_token_bucket_limits_rate_per_host(server):
+    client = FetchClient(policies=(('127.0.0.1', 10.0, 2),))
+    start = time.monotonic()
+    results = client.fetch_many([{'url': f"{server}/rate/{i}"} for i in range(5)])
+    elapsed = time.monotonic() - start
+    assert all(r.status_code == 200 for r in results)
+    assert elapsed >= 0.25                               # 突發 2 次後每 0.1 秒 1 次
+    assert client.stats['throttled'] >= 1
+    client.close()
+
+
+def test_retry_after_and_requests_compatible_errors(server):
+    client = FetchClient()
+    resp = client.fetch(f"{server}/busy")
+    assert resp.status_code == 200 and resp.json()['n'] == 2
+    assert client.stats['retries'] == 1
+    resp.encoding = 'latin-1'
+    assert '"path"' in resp.text
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.fetch("http://127.0.0.1:1/none", timeout=2)
+    client.close()
+
+
+def test_outer_timeout_cancels_request(server):
+    """同步介面外層逾時轉成 requests 的 Timeout，並取消仍在執行的請求"""
+    client = FetchClient()
+    client._ensure_loop()
+    with pytest.raises(requests.exceptions.Timeout):
+        client._run(client._async.fetch(f"{server}/slow/cancel"), 0.05)
+    time.sleep(0.1)                                      # 伺服器仍在回應 (0.3 秒)，請求已被取消
+    assert not client._async._inflight
+    client.close()
+
+
+def test_tls_verification_only_disabled_for_exchange_hosts():
+    """證交所 / 櫃買中心 (含子網域) 不驗證憑證，其餘網域驗證並使用各自的連線池"""
+    assert not _verifies('www.twse.com.tw')
+    assert not _verifies('openapi.twse.com.tw')
+    assert not _verifies('www.tpex.org.tw')
+    assert _verifies('api.finmindtrade.com')
+    assert _verifies('www.tdcc.com.tw')
+    assert _verifies('nottwse.com.tw')
+
+    client = AsyncFetchClient()
+    assert client._http('https://www.twse.com.tw/a') is client._http('https://www.tpex.org.tw/b')
+    assert client._http('https://api.finmindtrade.com/a') is not client._http('https://www.twse.com.tw/a')
+    assert set(client._clients) == {True, False}
+    asyncio.run(client.aclose())
@@ -0,0 +1,152 @@
+"""
+測試 core.incremental_indicators (增量指標引擎)
+使用合成 K 棒與記憶體資料庫，不需網路
+"""
+import importlib.util
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+
+from core import history_changes as hc
+from core import incremental_indicators as inc
+
+
+def make_bars(n=320, seed=1):
+    rng = np.random.default_rng(seed)
+    close = np.round(100 * np.exp(np.cumsum(rng.normal(0, 0.02, n))), 2)
+    open_ = np.round(close * (1 + rng.normal(0, 0.01, n)), 2)
+    high = np.round(np.maximum(open_, close) * (1 + abs(rng.normal(0, 0.01, n))), 2)
+    low = np.round(np.minimum(open_, close) * (1 - abs(rng.normal(0, 0.01, n))), 2)
+    volume = rng.integers(1000, 100000, n).astype(float)
+    # 每月 25 個交易日的遞增日期
+    dates = [int(f"{2024 + i // 300}{(i // 25) % 12 + 1:02d}{i % 25 + 1:02d}") for i in range(n)]
+    return np.vstack([dates, open_, high, low, close, volume]).astype(float)
+
+
+def _load_main():
+    """載入主程式 (缺少相依套件時略過需要全量計算的測試)"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '最終修正.py')
+    try:
+        spec = importlib.util.spec_from_file_location('final_fix_incremental', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    except Exception as e:
+        pytest.skip(f"無法載入主程式: {e}")
+    return module
+
+
+def _insert_bars(conn, bars, indexes):
+    conn.executemany(
+        "INSERT INTO stock_history (code, date_int, open, high, low, close, volume, amount) "
+        "VALUES ('9999', ?, ?, ?, ?, ?, ?, ?)",
+        [tuple(bars[:, i].tolist()) + (round(bars[inc.F_CLOSE, i] * bars[inc.F_VOLUME, i]),) for i in indexes])
+
+
+def test_backfill_mid_window_reseeds_to_full():
+    """視窗中段被日期回補後，狀態須重新建檔，結果與 calculate_stock_history_indicators 一致"""
+    import pandas as pd
+    from core.history_access import fetch_history_arrays
+    main = _load_main()
+
+    bars = make_bars()
+    gap, last = 290, 310
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL, low REAL,
+                    close REAL, volume REAL, amount REAL, PRIMARY KEY (code, date_int))""")
+    hc.ensure_history_changes(conn)
+    _insert_bars(conn, bars, [i for i in range(last) if i != gap])
+    state, _ = main._seed_indicator_state('9999', pd.DataFrame(fetch_history_arrays(conn, '9999')))
+    hc.set_cursor(conn, 'indicator_state', hc.latest_seq(conn))
+    after_seq = hc.get_cursor(conn, 'indicator_state')
+
+    # 回補缺漏的中段 K 棒，並新增下一個交易日
+    _insert_bars(conn, bars, [gap, last])
+    rewritten = hc.changed_codes(conn, after_seq, hc.latest_seq(conn))
+    assert rewritten['9999'] == int(bars[0, gap]) <= state.date_int
+
+    df = pd.DataFrame(fetch_history_arrays(conn, '9999'))
+    full = main.calculate_stock_history_indicators(
+        '9999', display_days=2, limit_days=main.Config.CALC_LOOKBACK_DAYS, preloaded_df=df)
+    if not full:
+        pytest.skip("全量計算在此環境無法執行 (相依套件版本)")
+    # 全量模式依賴的 pandas API 在部分版本算不出的欄位 (NaN) 不比對
+    full_latest = {k: v for k, v in full[0].items() if not (isinstance(v, float) and np.isnan(v))}
+    full_latest['VSBC'], full_latest['VSBC_pct'], full_latest['VSBC_prev'] = main._calc_vsbc_latest(df)
+
+    # 只看最後一根的推進會沿用缺漏的視窗
+    naive = main._advance_indicator_state(state, main._load_new_bars(conn, {'9999': state})['9999'])
+    assert inc.compare_with_full(naive, full_latest, full[1])
+
+    _, reseeded = main._seed_indicator_state('9999', df)
+    assert int(reseeded['date_int']) == int(bars[0, last])
+    assert inc.compare_with_full(reseeded, full_latest, full[1]) == []
+
+
+def test_step7_post_processing_only_after_writes(monkeypatch):
+    """Step 7 沒有寫入任何指標時不重算衍生表、不改寫資料版本；force 傳到增量模式"""
+    main = _load_main()
+    calls = []
+    for name in ('update_candlestick_patterns', 'refresh_market_breadth', 'refresh_inst_flow_rollup',
+                 'update_scan_results', 'bump_api_data_version'):
+        monkeypatch.setattr(main, name, lambda *args, _name=name, **kwargs: calls.append((_name, args)))
+
+    written = []
+    def fake_incremental(data, batch_size, verify, force):
+        calls.append(('incremental', force))
+        return written
+    monkeypatch.setattr(main, 'step7_calc_indicators_incremental', fake_incremental)
+
+    assert main.step7_calc_indicators({}, incremental=True) == []
+    assert calls == [('incremental', False)]
+
+    calls.clear()
+    written.append('2330')
+    main.step7_calc_indicators({}, force=True, incremental=True, source='test')
+    assert calls[0] == ('incremental', True)
+    assert ('update_candlestick_patterns', (['2330'],)) in calls
+    assert ('bump_api_data_version', ('test',)) in calls
+
+
+def test_state_roundtrip():
+    """indicator_state 資料列序列化後可完整還原並繼續推進"""
+    bars = make_bars()
+    state = inc.seed_state('9999', bars[:, :300])
+    restored = inc.IndicatorState.from_row(state.to_row())
+    assert restored.date_int == state.date_int
+    assert restored.n_bars == state.n_bars
+    assert inc.advance(restored, bars[:, 300]) == inc.advance(state, bars[:, 300])
+
+
+def test_moving_averages():
+    """滾動和的均線與直接計算一致"""
+    bars = make_bars()
+    state = inc.seed_state('9999', bars[:, :200])
+    for t in range(200, 260):
+        out = inc.advance(state, bars[:, t])
+    close = bars[inc.F_CLOSE, :260]
+    for p in inc.MA_PERIODS:
+        assert abs(out[f'MA{p}'] - round(close[-p:].mean(), 2)) <= 0.01
+    assert abs(out['MA20_prev'] - round(close[-21:-1].mean(), 2)) <= 0.01
+
+
+def test_compare_cumulative_by_daily_change():
+    """NVI/PVI/ADL 以單日變化比對，錨點不同不視為錯誤"""
+    incremental = {'MA20': 10.0, 'NVI': 1010.0, 'NVI_prev': 1000.0, 'ADL': 50.0, 'ADL_prev': 40.0}
+    full_latest = {'MA20': 10.0, 'NVI': 2020.0, 'ADL': 150.0}
+    full_prev = {'NVI': 2000.0, 'ADL': 140.0}
+    assert inc.compare_with_full(incremental, full_latest, full_prev) == []
+
+    full_latest['MA20'] = 10.5
+    assert inc.compare_with_full(incremental, full_latest, full_prev) == [('MA20', 10.0, 10.5)]
+
+
+if __name__ == "__main__":
+    test_backfill_mid_window_reseeds_to_full()
+    test_state_roundtrip()
+    test_moving_averages()
+    test_compare_cumulative_by_daily_change()
+    print("✓ 增量指標引擎測試通過")
@@ -0,0 +1,116 @@
+"""
+測試 core.inst_flow_rollup (法人買賣超前綴和) 與 /api/rankings/institutional 多日排行
+使用暫存目錄的 SQLite，不需網路
+"""
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from backend.routers import rankings
+from backend.services.db import DBManager
+from core import inst_flow_rollup as rollup
+
+DATES = pd.bdate_range('2025-01-02', periods=40).strftime('%Y%m%d').astype(int).tolist()
+
+
+def make_db(path, seed=9):
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE stock_history (code TEXT, date_int INTEGER, close REAL, foreign_buy INTEGER, "
+                 "trust_buy INTEGER, dealer_buy INTEGER, PRIMARY KEY (code, date_int))")
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT, market_type TEXT, total_shares INTEGER)")
+    conn.execute("CREATE TABLE stock_snapshot (code TEXT PRIMARY KEY, name TEXT, close REAL, close_prev REAL, "
+                 "volume INTEGER, foreign_buy INTEGER, trust_buy INTEGER, dealer_buy INTEGER, foreign_streak INTEGER, "
+                 "trust_streak INTEGER, dealer_streak INTEGER, foreign_cumulative INTEGER, trust_cumulative INTEGER, "
+                 "dealer_cumulative INTEGER)")
+    rows = []
+    for i in range(50):
+        code = str(2000 + i)
+        start = int(rng.integers(0, 30)) if i % 4 == 0 else 0
+        for d in DATES[start:]:
+            if rng.random() < 0.05:
+                continue
+            flows = [None if rng.random() < 0.05 else int(v) for v in rng.integers(-5000, 5000, 3)]
+            rows.append((code, d, 10.0, *flows))
+        conn.execute("INSERT INTO stock_meta VALUES (?, ?, ?, ?)", (code, code, 'TWSE' if i % 7 else 'ETF', 10 ** 7))
+        conn.execute("INSERT INTO stock_snapshot VALUES (?, ?, 10, 9.5, 1000, 0, 0, 0, ?, 0, 0, 0, 0, 0)",
+                     (code, code, int(rng.integers(-3, 4))))
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+
+def window_sums(conn, cutoff):
+    got = conn.execute(f"WITH agg AS ({rollup.window_sql()}) SELECT * FROM agg ORDER BY code",
+                       (cutoff, cutoff)).fetchall()
+    expected = conn.execute("SELECT code, COALESCE(SUM(foreign_buy), 0), COALESCE(SUM(trust_buy), 0), "
+                            "COALESCE(SUM(dealer_buy), 0) FROM stock_history WHERE date_int >= ? "
+                            "GROUP BY code ORDER BY code", (cutoff,)).fetchall()
+    return got, expected
+
+
+def test_window_sums_match_group_by_and_follow_late_updates():
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'r.db')
+        held = conn.execute("SELECT * FROM stock_history WHERE date_int > ?", (DATES[-4],)).fetchall()
+        conn.execute("DELETE FROM stock_history WHERE date_int > ?", (DATES[-4],))
+        assert rollup.update_inst_flow_rollup(conn) == len(DATES) - 3
+        assert rollup.update_inst_flow_rollup(conn) == 0
+
+        # 新交易日入庫 + 法人資料晚到 (更新既有列) + 刪除一檔最近的列
+        conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?)", held)
+        conn.execute("UPDATE stock_history SET trust_buy = 777 WHERE code = '2003' AND date_int = ?", (DATES[-10],))
+        conn.execute("DELETE FROM stock_history WHERE code = '2005' AND date_int >= ?", (DATES[-6],))
+        assert rollup.update_inst_flow_rollup(conn) == 10
+        assert rollup.rollup_ready(conn)
+
+        for days in (1, 2, 5, 20, 40, 100):
+            cutoff = rollup.window_cutoff(conn, days)
+            assert cutoff == DATES[max(len(DATES) - days, 0)]
+            got, expected = window_sums(conn, cutoff)
+            assert got == expected, days
+
+        # 最新一日的法人資料晚到：檢查碼不一致，讀取端退回 GROUP BY，重算後恢復
+        conn.execute("UPDATE stock_history SET foreign_buy = COALESCE(foreign_buy, 0) + 1 WHERE code = '2001' "
+                     "AND date_int = ?", (DATES[-1],))
+        assert not rollup.rollup_ready(conn)
+        assert rollup.update_inst_flow_rollup(conn) == 1
+        assert rollup.rollup_ready(conn)
+
+        incremental = conn.execute("SELECT * FROM inst_flow_prefix ORDER BY code, date_int").fetchall()
+        rollup.update_inst_flow_rollup(conn, rebuild_from=0)
+        assert conn.execute("SELECT * FROM inst_flow_prefix ORDER BY code, date_int").fetchall() == incremental
+
+
+def test_rankings_use_rollup_with_same_results(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'r.db'
+        conn = make_db(path)
+        conn.execute("UPDATE stock_history SET foreign_buy = COALESCE(foreign_buy, 0), "
+                     "trust_buy = COALESCE(trust_buy, 0), dealer_buy = COALESCE(dealer_buy, 0)")
+        conn.commit()
+        manager = DBManager(path)
+        manager.is_cloud_mode = False
+        monkeypatch.setattr(rankings, 'db_manager', manager)
+
+        def run(**kwargs):
+            return rankings.query_institutional_rankings(type='total', limit=7, days=5, **kwargs)
+
+        legacy = [run(page=p, min_foreign_streak=1) for p in (1, 2, 9)]
+        rollup.update_inst_flow_rollup(conn)
+        conn.commit()
+        with manager.get_connection() as read_conn:
+            assert rollup.rollup_ready(read_conn)
+        fast = [run(page=p, min_foreign_streak=1) for p in (1, 2, 9)]
+        for old, new in zip(legacy, fast):
+            assert new['success'] and new['total_count'] == old['total_count'] > 7
+            assert new['total_pages'] == old['total_pages']
+            assert [r['total_buy'] for r in new['data']] == [r['total_buy'] for r in old['data']]
+            assert all('total_count' not in r for r in new['data'])
+        assert fast[2]['data'] == []
+        by_code = {r['code']: r for r in run(sort_by='foreign', direction='asc', page=1)['data']}
+        assert list(by_code.values())[0]['foreign_buy'] <= list(by_code.values())[-1]['foreign_buy']
+        manager.shutdown()
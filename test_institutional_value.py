@@ -0,0 +1,137 @@
+"""
+測試 core.institutional_value (機構價值回歸策略的批次陣列計算)
+以隨機走勢與原逐檔 pandas 判斷比對，法人資料使用記憶體 SQLite，不需網路
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from core import institutional_value as iv
+
+
+def legacy_scan_one(df, market_close, inst):
+    """原 InstitutionalValueStrategy.scan 的逐檔判斷 (df 為完整歷史，index 為日期)"""
+    def kd(frame):
+        low_min = frame['Low'].rolling(9).min()
+        high_max = frame['High'].rolling(9).max()
+        rsv = ((frame['Close'] - low_min) / (high_max - low_min) * 100).fillna(50)
+        k = rsv.ewm(com=2, adjust=False).mean()
+        return k, k.ewm(com=2, adjust=False).mean()
+
+    def wma(series, period):
+        weights = np.arange(1, period + 1)
+        return series.rolling(period).apply(lambda x: np.dot(x, weights) / weights.sum(), raw=True)
+
+    if len(df) < 250:
+        return None
+    cur = df.iloc[-1]
+    tp = (df['High'] + df['Low'] + df['Close']) / 3
+    vwap200 = ((tp * df['Volume']).rolling(200).sum() / df['Volume'].rolling(200).sum()).iloc[-1]
+    if not (cur['Close'] > wma(df['Close'], 200).iloc[-1] and cur['Close'] > vwap200):
+        return None
+    raw_rs = df['Close'] / market_close.reindex(df.index).ffill()
+    if not (raw_rs.iloc[-1] > raw_rs.rolling(200).mean().iloc[-1]):
+        return None
+    w_df = df.resample('W-FRI').agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last'}).dropna()
+    wk, wd = kd(w_df)
+    if not (wk.reindex(df.index, method='ffill').iloc[-1] > wd.reindex(df.index, method='ffill').iloc[-1]):
+        return None
+    clv = (((df['Close'] - df['Low']) - (df['High'] - df['Close'])) / (df['High'] - df['Low'])).fillna(0)
+    adl = (clv * df['Volume']).cumsum()
+    inst_5d = 0
+    if not inst.empty:
+        joined = df.join(inst, how='left').fillna(0)
+        inst_5d = (joined['f_net'] + joined['t_net']).rolling(5).sum().iloc[-1]
+    adl_div = (df['Close'].iloc[-1] < df['Close'].iloc[-5]) and (adl.iloc[-1] > adl.iloc[-5])
+    if not (inst_5d > 0 or adl_div):
+        return None
+    recent = df.iloc[-60:]
+    diff = recent['High'].max() - recent['Low'].min()
+    fib = recent['High'].max() - diff * 0.618 if diff else 0
+    dist_fib = abs(cur['Close'] - fib) / cur['Close'] if fib else 1.0
+    dist_wma = abs(cur['Close'] - wma(df['Close'], 20).iloc[-1]) / cur['Close']
+    if not (dist_fib < 0.05 or dist_wma < 0.05):
+        return None
+    dk, dd = kd(df)
+    triggered = (dk.iloc[-1] > dd.iloc[-1]) and (dk.iloc[-2] <= dd.iloc[-2]) and dk.iloc[-1] < 60 \
+        and cur['Volume'] > df['Volume'].iloc[-2]
+    return {'price': cur['Close'], 'inst': inst_5d, 'fib': fib, 'status': "TRIGGERED" if triggered else "WAITING"}
+
+
+def synthetic_market(n_codes=400, bars=500, seed=11):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2022-01-03', periods=bars)
+    date_ints = dates.strftime('%Y%m%d').astype(int).to_numpy()
+    market = pd.Series(10000 * np.exp(np.cumsum(rng.normal(0.0003, 0.01, bars))), index=dates)
+    stocks, flows = {}, []
+    for i in range(n_codes):
+        # 部分股票有停牌缺日
+        keep = rng.random(bars) > (0.05 if i % 3 == 0 else 0)
+        drift = rng.normal(0.001, 0.001)
+        close = 50 * np.exp(np.cumsum(rng.normal(drift, 0.02, bars)))[keep]
+        open_ = close * (1 + rng.normal(0, 0.01, len(close)))
+        high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.02, len(close)))
+        low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.02, len(close)))
+        volume = rng.integers(1000, 50000, len(close)).astype(float)
+        code = str(1000 + i)
+        stocks[code] = {'date_int': date_ints[keep], 'open': open_, 'high': high, 'low': low,
+                        'close': close, 'volume': volume}
+        for d in date_ints[keep][-20:]:
+            if rng.random() < 0.6:
+                fb, fs = rng.integers(0, 5000, 2)
+                trust = rng.integers(0, 2000, 2) if rng.random() < 0.7 else (None, None)
+                flows.append((code, int(d), int(fb), int(fs), trust[0] and int(trust[0]), trust[1] and int(trust[1])))
+    return dates, date_ints, market, stocks, flows
+
+
+def test_scan_matches_legacy_pandas_loop():
+    dates, date_ints, market, stocks, flows = synthetic_market()
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE institutional_investors (code TEXT, date_int INTEGER, foreign_buy INTEGER, "
+                 "foreign_sell INTEGER, trust_buy INTEGER, trust_sell INTEGER)")
+    conn.executemany("INSERT INTO institutional_investors VALUES (?, ?, ?, ?, ?, ?)", flows)
+    inst_all = pd.read_sql("SELECT code, date_int, foreign_buy-foreign_sell as f_net, "
+                           "trust_buy-trust_sell as t_net FROM institutional_investors", conn)
+
+    expected = {}
+    for code, data in stocks.items():
+        df = pd.DataFrame({'Open': data['open'], 'High': data['high'], 'Low': data['low'],
+                           'Close': data['close'], 'Volume': data['volume']},
+                          index=pd.to_datetime(data['date_int'].astype(str), format='%Y%m%d'))
+        inst = inst_all[inst_all['code'] == code][['date_int', 'f_net', 't_net']].copy()
+        inst.index = pd.to_datetime(inst.pop('date_int').astype(str), format='%Y%m%d')
+        result = legacy_scan_one(df, market, inst)
+        if result:
+            expected[code] = result
+
+    history = {code: {k: v[-iv.LOOKBACK_BARS:] for k, v in data.items()} for code, data in stocks.items()}
+    since = min(a['date_int'][-iv.FLOW_DAYS] for a in history.values())
+    got = {c.pop('code'): c for c in iv.scan_value_candidates(history, date_ints, market.to_numpy(),
+                                                             iv.load_net_flows(conn, since))}
+    assert len(expected) >= 5 and any(r['inst'] > 0 for r in expected.values())
+    assert sorted(got) == sorted(expected)
+    for code, exp in expected.items():
+        assert got[code]['status'] == exp['status']
+        assert np.isclose(got[code]['price'], exp['price'])
+        assert np.isclose(got[code]['inst'], exp['inst'])
+        assert np.isclose(got[code]['fib'], exp['fib'])
+
+
+def test_weekly_kd_uses_last_completed_friday():
+    # 20240101 為週一；資料停在週三時沿用上一個週五的週 KD
+    dates = pd.bdate_range('2024-01-01', '2024-04-03')
+    rng = np.random.default_rng(5)
+    close = 100 + np.cumsum(rng.normal(0, 1, len(dates)))
+    df = pd.DataFrame({'Open': close + 0.3, 'High': close + 1, 'Low': close - 1, 'Close': close}, index=dates)
+    w_df = df.resample('W-FRI').agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last'})
+    rsv = ((w_df['Close'] - w_df['Low'].rolling(9).min())
+           / (w_df['High'].rolling(9).max() - w_df['Low'].rolling(9).min()) * 100).fillna(50)
+    k = rsv.ewm(com=2, adjust=False).mean()
+    d = k.ewm(com=2, adjust=False).mean()
+    date_ints = dates.strftime('%Y%m%d').astype(int).to_numpy()
+    wk, wd = iv.weekly_kd_last(date_ints, df['Open'].to_numpy(), df['High'].to_numpy(),
+                               df['Low'].to_numpy(), df['Close'].to_numpy())
+    assert np.isclose(wk, k.reindex(dates, method='ffill').iloc[-1])
+    assert np.isclose(wd, d.reindex(dates, method='ffill').iloc[-1])
+    assert iv.weekly_kd_last(date_ints[:20], *(df[c].to_numpy()[:20] for c in ('Open', 'High', 'Low', 'Close'))) == (0.0, 0.0)
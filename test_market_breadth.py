@@ -0,0 +1,114 @@
+"""
+測試 core.market_breadth (市場寬度日彙總表)
+以記憶體 SQLite 與 pandas 全表重算比對回補、增量與補登重算，不需網路
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from core import market_breadth as mb
+
+WINDOW = 20
+
+
+def make_db(days=80, n_codes=60, seed=3):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-01-02', periods=days).strftime('%Y%m%d').astype(int)
+    rows = []
+    for i in range(n_codes):
+        code = str(1100 + i)
+        start = int(rng.integers(0, days // 2)) if i % 5 == 0 else 0     # 部分為新上市
+        close = np.round(50 * np.exp(np.cumsum(rng.normal(0, 0.02, days))), 1)
+        for j in range(start, days):
+            if rng.random() < 0.03:
+                continue                                                    # 停牌
+            rows.append((code, int(dates[j]), close[j], close[j] * 1.01, close[j] * 0.99, close[j],
+                         int(rng.integers(1000, 9000))))
+    rows += [('0000', int(d), 1.0, 1.0, 1.0, 17000.0 + k, 0) for k, d in enumerate(dates)]
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL, low REAL, "
+                 "close REAL, volume INTEGER, amount INTEGER, PRIMARY KEY (code, date_int))")
+    conn.executemany("INSERT INTO stock_history (code, date_int, open, high, low, close, volume) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return conn, dates
+
+
+def reference(conn):
+    df = pd.read_sql("SELECT * FROM stock_history WHERE code != '0000' ORDER BY code, date_int", conn)
+    g = df.groupby('code')
+    df['prev'] = g['close'].shift(1)
+    df['prior_high'] = g['high'].transform(lambda s: s.rolling(WINDOW).max().shift(1))
+    df['prior_low'] = g['low'].transform(lambda s: s.rolling(WINDOW).min().shift(1))
+    df['adv'] = df['close'] > df['prev']
+    df['dec'] = df['close'] < df['prev']
+    out = df.groupby('date_int').agg(
+        issues=('code', 'size'), advancers=('adv', 'sum'), decliners=('dec', 'sum'),
+        new_highs=('high', lambda s: (s > df.loc[s.index, 'prior_high']).sum()),
+        up_volume=('volume', lambda s: s[df.loc[s.index, 'adv']].sum()))
+    net = out['advancers'] - out['decliners']
+    out['adl'] = net.cumsum()
+    out['mcclellan'] = net.ewm(span=19, adjust=False).mean() - net.ewm(span=39, adjust=False).mean()
+    return out
+
+
+def table(conn):
+    return pd.read_sql("SELECT * FROM market_breadth ORDER BY date_int", conn).set_index('date_int')
+
+
+def test_backfill_matches_full_recompute():
+    conn, dates = make_db()
+    assert mb.update_market_breadth(conn, window=WINDOW) == len(dates)
+    got, expected = table(conn), reference(conn)
+    for col in ('issues', 'advancers', 'decliners', 'new_highs', 'up_volume', 'adl'):
+        assert got[col].tolist() == expected[col].tolist(), col
+    assert np.allclose(got['mcclellan'], expected['mcclellan'])
+    assert got['new_highs'].sum() > 0
+    assert mb.update_market_breadth(conn, window=WINDOW) == 0                 # 已是最新
+    rows = mb.read_market_breadth(conn, limit=5)
+    assert [r['date_int'] for r in rows] == list(dates[-5:])
+
+
+def test_incremental_append_and_late_revision_match_rebuild():
+    conn, dates = make_db()
+    cut = int(dates[-6])
+    held = conn.execute("SELECT * FROM stock_history WHERE date_int > ?", (cut,)).fetchall()
+    conn.execute("DELETE FROM stock_history WHERE date_int > ?", (cut,))
+    mb.update_market_breadth(conn, window=WINDOW)
+
+    # 新交易日入庫後只補算新的 5 天
+    late = [r for r in held if r[0] == '1101' and r[1] == int(dates[-3])]
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     [r for r in held if r not in late])
+    assert mb.update_market_breadth(conn, window=WINDOW) == 5
+    # 補登一筆：自動偵測並從該日起重算
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", late)
+    assert mb.update_market_breadth(conn, window=WINDOW) == 3
+
+    incremental = table(conn)
+    conn.execute("DELETE FROM market_breadth")
+    mb.update_market_breadth(conn, window=WINDOW)
+    pd.testing.assert_frame_equal(incremental, table(conn))
+
+
+def test_old_backfill_needs_rebuild_from():
+    """回補早於 REVISION_DAYS 的日期：自動偵測看不到，依回補路徑傳入的最早日期重算後與全量一致"""
+    conn, dates = make_db()
+    old = int(dates[20])
+    held = conn.execute("SELECT * FROM stock_history WHERE date_int = ? AND code IN ('1102', '1103')",
+                        (old,)).fetchall()
+    conn.execute("DELETE FROM stock_history WHERE date_int = ? AND code IN ('1102', '1103')", (old,))
+    mb.update_market_breadth(conn, window=WINDOW)
+
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", held)
+    assert mb.update_market_breadth(conn, window=WINDOW) == 0
+    assert mb.update_market_breadth(conn, rebuild_from=old, window=WINDOW) == len(dates) - 20
+
+    rebuilt = table(conn)
+    conn.execute("DELETE FROM market_breadth")
+    mb.update_market_breadth(conn, window=WINDOW)
+    pd.testing.assert_frame_equal(rebuilt, table(conn))
+
+
+def test_read_without_table_returns_empty():
+    assert mb.read_market_breadth(sqlite3.connect(':memory:')) == []
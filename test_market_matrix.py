@@ -0,0 +1,89 @@
+"""
+測試 core.market_matrix (全市場 OHLCV 矩陣與向量化指標)
+使用記憶體 SQLite 與合成 K 棒，不需網路
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from core import market_matrix as mm
+from core import incremental_indicators as inc
+
+
+def make_db(specs, seed=5):
+    """specs: {code: (K 棒數, 停牌天數)}"""
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL,
+                    low REAL, close REAL, volume INTEGER, amount INTEGER)""")
+    today = datetime.now()
+    dates = [int((today - timedelta(days=i)).strftime("%Y%m%d")) for i in range(400)][::-1]
+    for code, (n, gaps) in specs.items():
+        idx = np.arange(len(dates) - n, len(dates))
+        if gaps:
+            idx = np.delete(idx, rng.choice(np.arange(1, n - 1), gaps, replace=False))
+        close = np.round(50 * np.exp(np.cumsum(rng.normal(0, 0.02, len(idx)))), 2)
+        volume = rng.integers(1000, 50000, len(idx))
+        conn.executemany("INSERT INTO stock_history VALUES (?,?,?,?,?,?,?,?)", [
+            (code, dates[j], c, round(c * 1.01, 2), round(c * 0.99, 2), c, int(v), 0)
+            for j, c, v in zip(idx, close, volume)])
+    return conn
+
+
+def test_load_and_bar_aligned():
+    """日期對齊矩陣含停牌空格；靠右對齊視圖與單檔序列一致"""
+    conn = make_db({'1101': (300, 0), '2330': (300, 12), '6666': (50, 0)})
+    matrix = mm.load_market_matrix(conn, ['1101', '2330', '6666'])
+    assert matrix.shape == (3, 300)
+    assert list(matrix.n_bars) == [300, 288, 50]
+
+    aligned = matrix.bar_aligned(100)
+    assert aligned.shape == (3, 100)
+    assert aligned.present[2].sum() == 50 and aligned.present[2, -50:].all()
+    expected = matrix.row('2330')[inc.F_CLOSE][-100:]
+    assert np.array_equal(aligned['close'][1], expected)
+
+
+def test_kernels_match_reference():
+    """WMA / 滾動和 / KD 與逐檔參考實作一致"""
+    rng = np.random.default_rng(0)
+    x = rng.normal(100, 5, (4, 80))
+    x[1, :30] = np.nan                      # 模擬上市較晚的股票
+    calc = mm.VectorizedIndicatorCalculator
+
+    wma = calc.wma(x, 20)
+    ref = inc._wma_series(x[0], 20)
+    assert np.allclose(wma[0], ref, equal_nan=True)
+    assert np.isnan(wma[1, :49]).all() and not np.isnan(wma[1, 49:]).any()
+
+    sums = calc.rolling_sum(x, 5)
+    assert np.allclose(sums[0, 4:], np.convolve(x[0], np.ones(5), mode='valid'))
+
+    present = ~np.isnan(x)
+    k, d = calc.kd(x + 1, x - 1, x, present)
+    ref_k = ref_d = None
+    for rsv in inc._rsv_series(x[0], x[0] + 1, x[0] - 1, 9):
+        ref_k = rsv if ref_k is None else 0.5 * rsv + 0.5 * ref_k
+        ref_d = ref_k if ref_d is None else 0.5 * ref_k + 0.5 * ref_d
+    assert abs(k[0, -1] - ref_k) < 1e-9
+    assert abs(d[0, -1] - ref_d) < 1e-9
+
+
+def test_snapshot_indicators():
+    """不足 20 根不輸出；輸出含 UPDATE 所需欄位"""
+    conn = make_db({'1101': (300, 5), '6666': (15, 0)})
+    results = mm.snapshot_indicators(mm.load_market_matrix(conn), lookback=250)
+    assert set(results) == {'1101'}
+    out = results['1101']
+    for key in ('MA200', 'WMA20_prev', 'RSI', 'MACD', 'SIGNAL', 'Week_K', 'VWAP200',
+                'POC', 'Weekly_Close', 'VSBC', 'VSBC_prev', 'pvi_prev', 'Smart_Score_prev'):
+        assert key in out, key
+    assert out['MA3'] is not None and out['Smart_Score'] == 50
+
+
+if __name__ == "__main__":
+    test_load_and_bar_aligned()
+    test_kernels_match_reference()
+    test_snapshot_indicators()
+    print("✓ 全市場矩陣測試通過")
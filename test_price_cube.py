@@ -0,0 +1,177 @@
+"""
+測試 core.price_cube (記憶體映射價格立方體)
+使用暫存目錄的 SQLite 與合成 K 棒，不需網路
+"""
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from core import price_cube as pc
+from core import market_matrix as mm
+
+
+def make_db(path, codes=('1101', '2330'), days=60):
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL,
+                    low REAL, close REAL, volume INTEGER, amount INTEGER, foreign_buy INTEGER,
+                    PRIMARY KEY (code, date_int))""")
+    pc.ensure_change_log(conn)
+    insert_days(conn, codes, range(days, 0, -1))
+    return conn
+
+
+def insert_days(conn, codes, offsets):
+    today = datetime.now()
+    rows = []
+    for code in codes:
+        for i in offsets:
+            d = int((today - timedelta(days=i)).strftime("%Y%m%d"))
+            c = 10.0 + i / 10
+            rows.append((code, d, c, c + 1, c - 1, c, 1000 + i, 0, None if i % 7 else i))
+    conn.executemany("INSERT OR REPLACE INTO stock_history VALUES (?,?,?,?,?,?,?,?,?)", rows)
+    conn.commit()
+
+
+def sql_history(conn, code, limit):
+    cur = conn.execute("""SELECT date_int, close, volume, foreign_buy FROM stock_history
+                          WHERE code=? ORDER BY date_int DESC LIMIT ?""", (code, limit))
+    return [dict(zip(('date_int', 'close', 'volume', 'foreign_buy'), r)) for r in cur.fetchall()][::-1]
+
+
+def test_build_and_read():
+    """重建後的單檔歷史與 SQL 查詢一致 (NULL 還原為 None)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'db.sqlite')
+        cube, action = pc.refresh_price_cube(conn, Path(tmp) / 'cube')
+        assert action == 'rebuilt'
+        assert cube.is_fresh(conn)
+        fields = ['close', 'volume', 'foreign_buy']
+        assert cube.history_records('2330', 30, fields) == sql_history(conn, '2330', 30)
+        assert cube.history('9999') is None
+        conn.close()
+
+
+def test_append_and_rebuild():
+    """新交易日以追加方式同步；回補舊日期則觸發重建"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'db.sqlite', days=60)
+        cube_dir = Path(tmp) / 'cube'
+        pc.refresh_price_cube(conn, cube_dir)
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'current'
+
+        conn.execute("DELETE FROM stock_history WHERE date_int >= ?",
+                     (int(datetime.now().strftime("%Y%m%d")),))
+        insert_days(conn, ('1101', '2330', '3008'), [0])
+        cube, action = pc.refresh_price_cube(conn, cube_dir)
+        assert action == 'appended'
+        assert cube.is_fresh(conn)
+        fields = ['close', 'volume', 'foreign_buy']
+        assert cube.history_records('3008', None, fields) == sql_history(conn, '3008', 10)
+        assert cube.history_records('1101', 5, fields) == sql_history(conn, '1101', 5)
+
+        insert_days(conn, ('1101',), [90])
+        cube, action = pc.refresh_price_cube(conn, cube_dir)
+        assert action == 'rebuilt'
+        assert len(cube.history('1101')['close']) == 62
+        assert len(list(cube_dir.glob('gen_*'))) == 1
+        conn.close()
+
+
+def test_in_place_updates_are_patched():
+    """既有列被 UPDATE / DELETE (筆數與最新日期不變) 時判定不一致，追加時依異動紀錄修補"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'db.sqlite', days=60)
+        cube_dir = Path(tmp) / 'cube'
+        cube, _ = pc.refresh_price_cube(conn, cube_dir)
+        pc.prune_change_log(conn, cube.meta['change_seq'])
+        assert conn.execute("SELECT COUNT(*) FROM history_changes").fetchone()[0] == 0
+
+        old_day = sql_history(conn, '2330', 30)[0]['date_int']
+        conn.execute("UPDATE stock_history SET close = 99.5, foreign_buy = 1234 WHERE code = '2330' AND date_int = ?",
+                     (old_day,))
+        conn.execute("DELETE FROM stock_history WHERE code = '1101' AND date_int = ?", (old_day,))
+        insert_days(conn, ('1101',), [40])                                      # 重新寫入相同內容
+        conn.commit()
+        cube._checked_at = None
+        assert not cube.is_fresh(conn)
+
+        cube, action = pc.refresh_price_cube(conn, cube_dir)
+        assert action == 'appended'
+        assert cube.is_fresh(conn)
+        fields = ['close', 'volume', 'foreign_buy']
+        for code in ('1101', '2330'):
+            assert cube.history_records(code, None, fields) == sql_history(conn, code, 100)
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'current'
+        conn.close()
+
+
+def test_append_leaves_live_generation_untouched():
+    """追加寫入新世代後才切換；讀者映射中的現行世代 (含追加失敗改為重建時) 內容不變"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'db.sqlite', days=60)
+        cube_dir = Path(tmp) / 'cube'
+        live, _ = pc.refresh_price_cube(conn, cube_dir)
+        snapshot = (np.array(live.present), np.array(live.fields['close']))
+
+        conn.execute("UPDATE stock_history SET close = 99.5 WHERE code = '2330'")
+        insert_days(conn, ('1101', '2330'), [0])
+        cube, action = pc.refresh_price_cube(conn, cube_dir)
+        assert action == 'appended'
+        assert cube.meta['generation'] == live.meta['generation'] + 1
+        assert np.array_equal(live.present, snapshot[0])
+        assert np.array_equal(live.fields['close'], snapshot[1], equal_nan=True)
+        assert [p.name for p in cube_dir.glob('gen_*')] == [f"gen_{cube.meta['generation']}"]
+
+        # 舊日期回補使追加失敗 (需重建)：未發布的新世代丟棄，現行世代仍不變
+        snapshot = (np.array(cube.present), np.array(cube.fields['close']))
+        insert_days(conn, ('1101',), [90])
+        rebuilt, action = pc.refresh_price_cube(conn, cube_dir)
+        assert action == 'rebuilt'
+        assert np.array_equal(cube.present, snapshot[0])
+        assert np.array_equal(cube.fields['close'], snapshot[1], equal_nan=True)
+        conn.close()
+
+
+def test_change_log_installed_after_build_forces_rebuild():
+    """立方體建立時尚無異動紀錄，之後才安裝觸發器：中間的改寫無從得知，重建一次"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(Path(tmp) / 'db.sqlite')
+        conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL,
+                        low REAL, close REAL, volume INTEGER, amount INTEGER, foreign_buy INTEGER,
+                        PRIMARY KEY (code, date_int))""")
+        insert_days(conn, ('1101',), range(30, 0, -1))
+        cube_dir = Path(tmp) / 'cube'
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'rebuilt'
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'current'
+        pc.ensure_change_log(conn)
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'rebuilt'
+        assert pc.refresh_price_cube(conn, cube_dir)[1] == 'current'
+        conn.close()
+
+
+def test_market_matrix_matches_sql_loader():
+    """立方體產生的矩陣與 load_market_matrix 相同"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_db(Path(tmp) / 'db.sqlite', days=60)
+        conn.execute("DELETE FROM stock_history WHERE code='2330' AND date_int % 5 = 0")
+        conn.commit()
+        cube, _ = pc.refresh_price_cube(conn, Path(tmp) / 'cube')
+        codes = ['1101', '2330', '9999']
+        expected = mm.load_market_matrix(conn, codes)
+        matrix = cube.market_matrix(codes)
+        assert np.array_equal(matrix.present, expected.present)
+        assert np.array_equal(matrix.dates, expected.dates)
+        for name in mm.FIELDS:
+            assert np.array_equal(matrix[name], expected[name], equal_nan=True), name
+        conn.close()
+
+
+if __name__ == "__main__":
+    test_build_and_read()
+    test_append_and_rebuild()
+    test_append_leaves_live_generation_untouched()
+    test_market_matrix_matches_sql_loader()
+    print("✓ 價格立方體測試通過")
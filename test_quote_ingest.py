@@ -0,0 +1,101 @@
+"""
+測試 core.quote_ingest (每日行情暫存表批次寫入與缺值修復)
+使用記憶體 SQLite，不需網路
+"""
+import sqlite3
+import time
+
+from core import quote_ingest as qi
+
+
+def make_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE stock_history (code TEXT, date_int INTEGER, open REAL, high REAL, low REAL,
+                    close REAL, volume INTEGER, amount INTEGER, PRIMARY KEY (code, date_int))""")
+    conn.execute("""CREATE TABLE stock_snapshot (code TEXT PRIMARY KEY, name TEXT, date TEXT, close REAL,
+                    volume INTEGER, close_prev REAL, vol_prev INTEGER, amount REAL, pe REAL)""")
+    conn.executemany("INSERT INTO stock_history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+        ('1101', 20250102, 1, 1, 1, 30.0, 500, 15000),
+        ('1101', 20250103, 1, 1, 1, 31.0, 600, 18600),
+        ('2330', 20250103, 1, 1, 1, 600.0, 9000, 5400000),
+        ('2330', 20250106, 1, 1, 1, 610.0, 9100, None),      # 當日已有資料但缺成交金額
+        ('1234', 20240101, 1, 1, 1, 12.0, 100, 1200),        # 超出回看期間的前日資料
+    ])
+    conn.execute("INSERT INTO stock_snapshot (code, name, pe) VALUES ('1101', '台泥', 9.5)")
+    conn.commit()
+    return conn
+
+
+def quote(code, close, volume=1000, amount=None, name='x'):
+    return (code, name, close, close, close, close, volume, amount)
+
+
+def test_ingest_classifies_and_upserts_in_one_pass():
+    conn = make_db()
+    result = qi.ingest_daily_quotes(conn, 20250106, '2025-01-06', [
+        quote('1101', 32.0, 700, 22400, '台泥'),   # 新增
+        quote('2330', 610.0, 9100, 5551000),      # 補成交金額 → 更新
+        quote('1234', 13.0),                      # 新增 (前日超出回看期間)
+        quote('9999', 5.0),                       # 新增 (無前日)
+    ])
+    conn.commit()
+    assert (result.new, result.updated, result.skipped) == (3, 1, 0)
+    assert result.codes == {'1101', '2330', '1234', '9999'}
+    assert conn.execute("SELECT amount FROM stock_history WHERE code='2330' AND date_int=20250106").fetchone() == (5551000,)
+
+    snap = {r[0]: r[1:] for r in conn.execute("SELECT code, close_prev, vol_prev, date, pe FROM stock_snapshot")}
+    assert snap['1101'] == (31.0, 600, '2025-01-06', 9.5)     # 前日取自 20250103，PE 保留
+    assert snap['2330'][:2] == (600.0, 9000)
+    assert snap['1234'][:2] == (12.0, 100)
+    assert snap['9999'][:2] == (5.0, 1000)
+
+    # 同一批資料再寫一次全部略過
+    again = qi.ingest_daily_quotes(conn, 20250106, '2025-01-06', [
+        quote('1101', 32.0, 700, 22400), quote('2330', 610.0, 9100, 5551000)])
+    assert (again.new, again.updated, again.skipped) == (0, 0, 2) and again.codes == set()
+
+
+def test_ingest_keeps_columns_not_in_quote():
+    conn = make_db()
+    conn.execute("ALTER TABLE stock_history ADD COLUMN adj REAL")
+    conn.execute("UPDATE stock_history SET adj = 1.5 WHERE code='2330' AND date_int=20250106")
+    qi.ingest_daily_quotes(conn, 20250106, '2025-01-06', [quote('2330', 611.0, 9100, 5560000)])
+    assert conn.execute("SELECT close, adj FROM stock_history WHERE code='2330' AND date_int=20250106"
+                        ).fetchone() == (611.0, 1.5)
+
+
+def test_repair_day_uses_crawled_values_and_prev_close():
+    conn = make_db()
+    conn.executemany("INSERT INTO stock_history (code, date_int, close, volume, amount) VALUES (?, ?, ?, ?, ?)", [
+        ('1101', 20250106, None, 800, None),
+        ('1234', 20250106, None, 50, None),
+        ('5555', 20250106, None, 0, None),
+    ])
+    stocks = [('1101', None, 800, None), ('1234', None, 50, None), ('5555', None, 0, None),
+              ('2330', 610.0, 9100, None)]
+    crawled = {'2330': {'close': 610.0, 'volume': 0, 'amount': 0}}
+    fixed, estimated = qi.repair_day_quotes(conn, 20250106, stocks, crawled)
+    assert (fixed, estimated) == (1, 2)
+
+    rows = {r[0]: r[1:] for r in conn.execute("SELECT code, close, volume, amount FROM stock_history "
+                                              "WHERE date_int = 20250106")}
+    assert rows['2330'] == (610.0, 9100, 5551000)             # 額 = 量 × 價
+    assert rows['1101'] == (31.0, 800, 24800)                 # 前日收盤估算
+    assert rows['1234'] == (12.0, 50, 600)                    # 回看期間外，逐檔找最近一筆
+    assert rows['5555'] == (None, 0, None)                    # 無量無法估算
+
+
+def test_full_market_ingest_is_fast():
+    conn = make_db()
+    codes = [str(3000 + i) for i in range(2000)]
+    days = [20241201 + d for d in range(25)]
+    conn.executemany("INSERT INTO stock_history (code, date_int, close, volume, amount) VALUES (?, ?, ?, ?, ?)",
+                     [(c, d, 10.0, 1000, 10000) for c in codes for d in days])
+    conn.execute("CREATE INDEX idx_date ON stock_history(date_int)")
+    conn.commit()
+    start = time.perf_counter()
+    result = qi.ingest_daily_quotes(conn, 20250106, '2025-01-06', [quote(c, 11.0, 1200, 13200) for c in codes])
+    conn.commit()
+    assert result.new == 2000
+    assert time.perf_counter() - start < 1.0
+    assert conn.execute("SELECT COUNT(*) FROM stock_snapshot WHERE close_prev = 10.0").fetchone() == (2000,)
@@ -0,0 +1,88 @@
+"""
+測試 core.data_version 與 backend.services.response_cache (API 回應快取)
+使用暫存目錄的版本戳記與最小 FastAPI 應用，不需資料庫或網路
+"""
+import os
+import tempfile
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core import data_version as dv
+from backend.services.response_cache import ResponseCache
+
+
+def test_data_version_bump_and_read():
+    """戳記不存在時為 MISSING_VERSION；每次 bump 產生新版本並立即可讀"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = dv.default_version_path(os.path.join(tmp, 'taiwan_stock.db'))
+        assert os.path.dirname(path) == tmp
+        assert dv.read_data_version(path) == dv.MISSING_VERSION
+        v1 = dv.bump_data_version(path, 'test')
+        assert dv.read_data_version(path) == v1
+        v2 = dv.bump_data_version(path, 'test')
+        assert v2 != v1
+        assert dv.read_data_version(path) == v2
+
+
+def make_app(version):
+    calls = {'n': 0}
+    app = FastAPI()
+    cache = ResponseCache(lambda: version['v'], rules=(("/api/scan/", 60),))
+    app.middleware("http")(cache.middleware)
+
+    @app.get("/api/scan/demo")
+    def scan(limit: int = 10):
+        calls['n'] += 1
+        return {"limit": limit, "n": calls['n']}
+
+    @app.get("/api/other")
+    def other():
+        calls['n'] += 1
+        return {"n": calls['n']}
+
+    return TestClient(app), cache, calls
+
+
+def test_hit_miss_and_parameter_keys():
+    version = {'v': '1'}
+    client, cache, calls = make_app(version)
+    first = client.get("/api/scan/demo?limit=5")
+    assert first.headers["X-Cache"] == "MISS"
+    second = client.get("/api/scan/demo?limit=5")
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json() == first.json()
+    assert calls['n'] == 1
+    # 不同參數為不同快取鍵
+    client.get("/api/scan/demo?limit=6")
+    assert calls['n'] == 2
+    # 不在規則內的路徑不快取
+    client.get("/api/other")
+    client.get("/api/other")
+    assert calls['n'] == 4
+    stats = cache.stats()
+    assert stats["counts"]["hit"] == 1 and stats["counts"]["miss"] == 2
+    assert stats["hit_rate"] == round(1 / 3, 4)
+    assert sum(stats["latency_ms"]["miss"]["histogram"].values()) == 2
+
+
+def test_etag_not_modified():
+    client, cache, calls = make_app({'v': '1'})
+    etag = client.get("/api/scan/demo").headers["ETag"]
+    response = client.get("/api/scan/demo", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert cache.stats()["counts"]["not_modified"] == 1
+    assert client.get("/api/scan/demo", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_version_change_invalidates():
+    version = {'v': '1'}
+    client, cache, calls = make_app(version)
+    etag = client.get("/api/scan/demo").headers["ETag"]
+    version['v'] = '2'
+    response = client.get("/api/scan/demo", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json()["n"] == 2
+    assert cache.stats()["invalidations"]["version"] == 1
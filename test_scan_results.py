@@ -0,0 +1,101 @@
+"""
+測試 core.scan_results (掃描結果物化)
+使用記憶體 SQLite，不需網路
+"""
+import re
+import sqlite3
+
+import numpy as np
+
+from core import scan_results as sr
+
+
+def snapshot_columns():
+    """登記表與輸出欄位引用到的所有 stock_snapshot 欄位"""
+    sql = sr.SCAN_SELECT + ''.join(''.join(d) for d in sr.SCAN_DEFINITIONS.values())
+    return sorted(set(re.findall(r'\bs\.(\w+)', sql)) - {'code'})
+
+
+def make_db(n=400, drop=()):
+    conn = sqlite3.connect(':memory:')
+    columns = [c for c in snapshot_columns() if c not in drop]
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT, market_type TEXT)")
+    conn.execute(f"CREATE TABLE stock_snapshot (code TEXT PRIMARY KEY, {', '.join(c + ' REAL' for c in columns)})")
+    rng = np.random.default_rng(11)
+    for i in range(n):
+        code = f"{1000 + i}" if i % 50 else f"00{i:03d}X"   # 含非 4 碼代號
+        conn.execute("INSERT INTO stock_meta VALUES (?, ?, ?)", (code, f"股{i}", 'TWSE'))
+        close = float(np.round(rng.uniform(5, 500), 2))
+        values = {c: float(np.round(close * rng.uniform(0.85, 1.15), 2)) for c in columns}
+        values.update(close=close, volume=float(rng.integers(0, 5000)), vol_prev=float(rng.integers(1, 5000)),
+                      amount=close * 1000, rsi=float(rng.uniform(0, 100)), mfi14=float(rng.uniform(0, 100)),
+                      mfi14_prev=float(rng.uniform(0, 100)), vsbc_pct=float(rng.choice([50, 99, 100])),
+                      smart_score=float(rng.integers(0, 7)), lwr=float(rng.uniform(-100, 0)),
+                      mtm=float(rng.normal()), month_k=float(rng.uniform(0, 100)),
+                      pattern_morning_star=float(rng.integers(0, 2)), pattern_evening_star=float(rng.integers(0, 2)),
+                      div_3day_bull=float(rng.integers(0, 2)), div_3day_bear=float(rng.integers(0, 2)),
+                      ma25_slope=float(rng.normal()), mansfield_rs=float(rng.normal()),
+                      vol_ma60=float(rng.integers(0, 3000)))
+        if i % 7 == 0:
+            values['vp_low'] = None
+        values = {c: values[c] for c in columns}
+        conn.execute(f"INSERT INTO stock_snapshot (code, {', '.join(values)}) VALUES ({','.join('?' * (len(values) + 1))})",
+                     [code] + list(values.values()))
+    return conn
+
+
+def live_scan(conn, key, limit, min_vol, min_price=None, tolerance=None):
+    """與 backend execute_scan_query 即時 SQL 相同的查詢"""
+    scan = sr.SCAN_DEFINITIONS[key]
+    conditions = scan.conditions
+    if tolerance is not None:
+        conditions += f" AND {scan.score} < {tolerance}"
+    extra = f"AND s.volume >= {min_vol}" + (f" AND s.close >= {min_price}" if min_price else "")
+    cursor = conn.execute(sr.build_scan_query(conditions, scan.order_by, extra), (limit,))
+    columns = [d[0] for d in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def test_lookup_matches_live_query():
+    """物化後依成交量/股價/筆數過濾的結果與即時 SQL 完全相同"""
+    conn = make_db()
+    counts, errors = sr.refresh_scan_results(conn)
+    assert not errors and set(counts) == set(sr.SCAN_DEFINITIONS)
+    assert sum(counts.values()) > 0
+    for key in sr.SCAN_DEFINITIONS:
+        for limit, min_vol, min_price in ((30, 500, None), (5, 0, 100.0), (100, 2000, None)):
+            expected = live_scan(conn, key, limit, min_vol, min_price)
+            assert sr.lookup_scan_results(conn, key, limit, min_vol, min_price) == expected, (key, limit)
+
+    for tolerance in (0.02, 0.05, 0.1):
+        expected = live_scan(conn, 'vp_support', 100, 0, tolerance=tolerance)
+        got = sr.lookup_scan_results(conn, 'vp_support', 100, 0, max_score=tolerance)
+        assert got == expected and len(got) > 0, tolerance
+
+
+def test_missing_columns_fall_back():
+    """篩選欄位缺漏的掃描不物化 (查詢回傳 None 讓 API 改走即時 SQL)；僅輸出欄位缺漏時以 NULL 代替"""
+    conn = make_db(n=50, drop=('mansfield_rs', 'total_shareholders'))
+    counts, errors = sr.refresh_scan_results(conn)
+    assert set(errors) == {'five_stage'} and counts['pv_div'] > 0
+    assert sr.lookup_scan_results(conn, 'five_stage') is None
+    assert all(row['concentration'] is None for row in sr.lookup_scan_results(conn, 'pv_div', 100, 0))
+    assert sr.lookup_scan_results(sqlite3.connect(':memory:'), 'six_dim') is None
+
+
+def test_refresh_replaces_generation():
+    """重算後只保留最新世代，指標變動反映在結果中"""
+    conn = make_db(n=100)
+    sr.refresh_scan_results(conn)
+    conn.execute("UPDATE stock_snapshot SET pattern_morning_star = 0")
+    sr.refresh_scan_results(conn)
+    assert sr.lookup_scan_results(conn, 'patterns_morning_star', 100, 0) == []
+    generations = conn.execute("SELECT DISTINCT generation FROM scan_results").fetchall()
+    assert generations == [(2,)]
+
+
+if __name__ == "__main__":
+    test_lookup_matches_live_query()
+    test_missing_columns_fall_back()
+    test_refresh_replaces_generation()
+    print("✓ 掃描結果物化測試通過")
@@ -0,0 +1,78 @@
+"""
+測試 core.shared_history (Step 7 共享歷史區塊)
+不需資料庫或網路
+"""
+from multiprocessing import Pool
+
+import numpy as np
+
+from core import shared_history as sh
+
+
+def make_history():
+    rng = np.random.default_rng(3)
+    history = {}
+    for code, n in (('1101', 30), ('2330', 45), ('6666', 5)):
+        history[code] = {'date_int': np.arange(20240101, 20240101 + n, dtype=np.int64)}
+        for name in sh.SHARED_FIELDS[1:]:
+            history[code][name] = rng.normal(100, 5, n)
+    return history
+
+
+def _read_sum(task):
+    code, ref, offset, length = task
+    arrays = sh.read_shared_history(ref, offset, length)
+    return code, int(arrays['date_int'][-1]), float(arrays['close'].sum())
+
+
+def check_roundtrip(history, block):
+    for code, arrays in history.items():
+        code_, ref, offset, length = block.task(code)
+        out = sh.read_shared_history(ref, offset, length)
+        assert code_ == code and out['date_int'].dtype == np.int64
+        for name in sh.SHARED_FIELDS:
+            assert np.array_equal(out[name], arrays[name]), (code, name)
+    assert block.task('9999') is None
+
+
+def test_roundtrip_shared_memory():
+    """寫入共享記憶體後以 (offset, length) 取回相同陣列"""
+    history = make_history()
+    with sh.SharedHistoryBlock(history) as block:
+        assert block.ref[0] == 'shm'
+        check_roundtrip(history, block)
+        sh._detach()
+
+
+def test_roundtrip_file_fallback():
+    """不支援共享記憶體時改用暫存檔 memmap"""
+    history = make_history()
+    original = sh._create_shared_memory
+    sh._create_shared_memory = lambda size: None
+    try:
+        with sh.SharedHistoryBlock(history) as block:
+            assert block.ref[0] == 'file'
+            check_roundtrip(history, block)
+            sh._detach()
+    finally:
+        sh._create_shared_memory = original
+
+
+def test_worker_processes():
+    """常駐進程池跨多批讀取不同區塊"""
+    sh.prepare_pool()
+    with Pool(processes=2) as pool:
+        for _ in range(2):
+            history = make_history()
+            with sh.SharedHistoryBlock(history) as block:
+                results = pool.map(_read_sum, [block.task(code) for code in history])
+            for code, last_date, close_sum in results:
+                assert last_date == history[code]['date_int'][-1]
+                assert abs(close_sum - history[code]['close'].sum()) < 1e-9
+
+
+if __name__ == "__main__":
+    test_roundtrip_shared_memory()
+    test_roundtrip_file_fallback()
+    test_worker_processes()
+    print("✓ 共享歷史區塊測試通過")
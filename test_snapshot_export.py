@@ -0,0 +1,121 @@
+"""
+測試 core.snapshot_export (欄式快照發佈/載入) 與 backend.services.snapshot_store (雲端記憶體快照)
+使用記憶體 SQLite 與暫存目錄的 LocalFileStore，不需網路
+"""
+import math
+import sqlite3
+import tempfile
+
+import numpy as np
+import pytest
+
+from core import snapshot_export as se
+from backend.services.snapshot_store import SnapshotCache
+
+
+def make_db(n=50):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stock_meta (code TEXT PRIMARY KEY, name TEXT, market_type TEXT)")
+    conn.execute("""CREATE TABLE stock_snapshot (code TEXT PRIMARY KEY, name TEXT, date TEXT, close REAL,
+                    volume INTEGER, close_prev REAL, ma20 REAL, rsi REAL, mfi14 REAL)""")
+    for i in range(n):
+        code = str(1101 + i)
+        conn.execute("INSERT INTO stock_meta VALUES (?, ?, ?)", (code, f"股票{i}", 'twse' if i % 2 else 'tpex'))
+        conn.execute("INSERT INTO stock_snapshot VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (code, f"股票{i}", '2025-01-06', 10.0 + i, 1000 * (i + 1), 10.0,
+                      None if i % 5 == 0 else 9.5 + i, 20.0 + i, 15.0 + i))
+    conn.commit()
+    return conn
+
+
+@pytest.fixture
+def store():
+    with tempfile.TemporaryDirectory() as tmp:
+        yield se.LocalFileStore(tmp)
+
+
+def test_publish_and_load_roundtrip(store):
+    conn = make_db()
+    manifest = se.publish_snapshot(conn, store)
+    assert manifest['rows'] == 50
+    assert manifest['data_date'] == '2025-01-06'
+    assert store.get(manifest['file']) is not None
+
+    fetched, frame = se.fetch_snapshot(store)
+    assert fetched['version'] == manifest['version']
+    row = frame.row('1105')
+    assert row['name'] == '股票4'
+    assert row['market_type'] == 'tpex'
+    assert row['volume'] == 5000 and isinstance(row['volume'], int)
+    assert row['close'] == 14.0
+    assert frame.row('1101')['ma20'] is None          # NULL 保持為 None
+    assert frame.row('9999') is None
+
+
+def test_unchanged_content_is_not_republished(store, monkeypatch):
+    conn = make_db()
+    first = se.publish_snapshot(conn, store)
+    clock = iter(range(10 ** 9, 2 * 10 ** 9, 3600))     # zip 內含寫入時間: 隔一小時再匯出仍視為未改變
+    monkeypatch.setattr(se.time, 'time', lambda: next(clock))
+    assert se.publish_snapshot(conn, store)['version'] == first['version']
+    assert se.fetch_snapshot(store, first['version']) == (first, None)
+
+    conn.execute("UPDATE stock_snapshot SET close = 99 WHERE code = '1101'")
+    conn.commit()
+    second = se.publish_snapshot(conn, store)
+    assert second['version'] != first['version']
+
+
+def test_old_versions_pruned_and_hash_checked(store):
+    conn = make_db()
+    for i in range(5):
+        conn.execute("UPDATE stock_snapshot SET close = ? WHERE code = '1101'", (i,))
+        conn.commit()
+        manifest = se.publish_snapshot(conn, store, keep=2)
+    files = [n for n in store.list() if n.endswith('.npz')]
+    assert len(files) <= 2 and manifest['file'] in files
+
+    store.put(manifest['file'], b'corrupted')
+    with pytest.raises(ValueError):
+        se.fetch_snapshot(store)
+
+
+def test_frame_select_filters_and_orders_by_volume(store):
+    conn = make_db()
+    se.publish_snapshot(conn, store)
+    _, frame = se.fetch_snapshot(store)
+    mask = (frame.column('rsi') < 40) & ~np.isnan(frame.column('ma20'))
+    rows = frame.rows(frame.select(mask, order_by='volume'), ('code', 'volume', 'rsi'))
+    assert [r['volume'] for r in rows] == sorted((r['volume'] for r in rows), reverse=True)
+    assert all(r['rsi'] < 40 for r in rows)
+    assert '1101' not in {r['code'] for r in rows}    # ma20 為 NULL
+    assert math.isnan(frame.column('missing_col')[0])
+
+
+def test_snapshot_cache_reloads_only_on_new_version(store):
+    conn = make_db()
+    cache = SnapshotCache(lambda: store, check_interval=0)
+    assert cache.get() is None                        # 尚未發佈
+
+    se.publish_snapshot(conn, store)
+    frame = cache.get()
+    assert frame is not None and cache.stats['loads'] == 1
+    assert cache.get() is frame and cache.stats['loads'] == 1
+
+    conn.execute("UPDATE stock_snapshot SET close = 1 WHERE code = '1102'")
+    conn.commit()
+    se.publish_snapshot(conn, store)
+    assert cache.get().row('1102')['close'] == 1.0
+    assert cache.stats['loads'] == 2
+
+
+def test_cloud_scan_prefilter_on_snapshot(store):
+    from backend.routers.scan import _fetch_cloud_rows_from_snapshot
+    conn = make_db()
+    se.publish_snapshot(conn, store)
+    _, frame = se.fetch_snapshot(store)
+
+    rows = _fetch_cloud_rows_from_snapshot(frame, 'mfi_oversold', min_vol=2000, min_price=None)
+    assert rows and all(r['mfi14'] < 30 and r['volume'] >= 2000 for r in rows)
+    assert rows[0]['volume'] == max(r['volume'] for r in rows)
+    assert set(rows[0]) <= set(('code', 'name', 'close', 'close_prev', 'volume', 'ma20', 'rsi', 'mfi14'))
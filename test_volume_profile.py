@@ -0,0 +1,88 @@
+"""
+測試 core.volume_profile (向量化 Volume Profile)
+以原 calculate_vp_scheme3 的逐價位算法為參考，不需資料庫或網路
+"""
+import numpy as np
+
+from core import volume_profile as vp
+
+
+def reference_vp(high, low, close, volume, price_levels=10):
+    """原 IndicatorCalculator.calculate_vp_scheme3 的逐價位算法 (未四捨五入)"""
+    hi, lo = max(high), min(low)
+    if hi == lo:
+        return hi, hi, lo
+    step = (hi - lo) / price_levels
+    volume_at_price = {}
+    for i in range(price_levels):
+        p_lo, p_hi = lo + i * step, lo + (i + 1) * step
+        mask = (close >= p_lo) & (close < p_hi)
+        volume_at_price[(p_lo + p_hi) / 2] = volume[mask].sum()
+    poc = max(volume_at_price, key=volume_at_price.get)
+    total = sum(volume_at_price.values())
+    if total <= 0:
+        return poc, hi, lo
+    cumulative, area = 0, []
+    for price, vol in sorted(volume_at_price.items(), key=lambda x: x[1], reverse=True):
+        cumulative += vol
+        area.append(price)
+        if cumulative >= total * 0.7:
+            break
+    return poc, max(area) + step / 2, min(area) - step / 2
+
+
+def make_bars(n, seed):
+    rng = np.random.default_rng(seed)
+    if seed % 3 == 0:   # 少數價位反覆出現，製造同量價位
+        close = rng.choice([10.0, 10.5, 11.0, 11.5], n)
+    else:
+        close = np.round(50 + np.cumsum(rng.normal(0, 1, n)), 2)
+    high = np.round(close + rng.random(n), 2)
+    low = np.round(close - rng.random(n), 2)
+    volume = rng.integers(0, 5, n) * 1000.0
+    return high, low, close, volume
+
+
+def test_latest_matches_reference():
+    """最後一根 VP 與原算法一致 (含同量價位、無量、平盤)"""
+    for seed in range(300):
+        high, low, close, volume = make_bars(25, seed)
+        if seed % 10 == 0:
+            volume[:] = 0
+        if seed % 10 == 1:
+            high = low = close = np.full(25, 12.0)
+        expected = reference_vp(high[-20:], low[-20:], close[-20:], volume[-20:])
+        got = vp.latest_volume_profile(high, low, close, volume, window=20)
+        assert np.allclose(got, expected), (seed, got, expected)
+
+
+def test_rolling_matches_per_window():
+    """序列版每根 K 棒與逐列視窗 (開頭使用不足 20 根的部分視窗) 一致"""
+    high, low, close, volume = make_bars(80, 7)
+    poc, va_high, va_low = vp.rolling_volume_profile(high, low, close, volume, window=20)
+    assert np.isnan(poc[0])
+    for i in range(1, 80):
+        s = max(0, i - 19)
+        expected = reference_vp(high[s:i + 1], low[s:i + 1], close[s:i + 1], volume[s:i + 1])
+        assert np.allclose((poc[i], va_high[i], va_low[i]), expected), i
+
+
+def test_batch_matches_single():
+    """2-D 批次 (含 NaN 前綴的新股) 與逐檔計算一致"""
+    bars = [make_bars(150, seed) for seed in (1, 2, 4)]
+    stacked = [np.vstack([b[k] for b in bars]) for k in range(4)]
+    for arr in stacked:
+        arr[2, :100] = np.nan   # 第三檔只有 50 根
+    results = vp.batch_volume_profile(*stacked)
+    assert set(results) == set(vp.VP_WINDOWS)
+    for window, (poc, va_high, va_low) in results.items():
+        for i in range(3):
+            single = vp.latest_volume_profile(*(arr[i][~np.isnan(arr[i])] for arr in stacked), window=window)
+            assert np.allclose((poc[i], va_high[i], va_low[i]), single), (window, i)
+
+
+if __name__ == "__main__":
+    test_latest_matches_reference()
+    test_rolling_matches_per_window()
+    test_batch_matches_single()
+    print("✓ Volume Profile 測試通過")
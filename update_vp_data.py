@@ -22,99 +22,60 @@ def add_vp_columns():
     conn.commit()
     conn.close()
 
-def calculate_vp(df, price_col='close', vol_col='volume', bins=50):
+# VP 參數 (演算法與 Step 7 快照 VP 相同，見 core/volume_profile.py)
+VP_WINDOW = 60
+VP_PRICE_LEVELS = 50
+
+def calculate_vp(df, price_col='close', vol_col='volume', bins=VP_PRICE_LEVELS):
     """Calculate Volume Profile POC, High, Low"""
+    from core.volume_profile import latest_volume_profile
     if df.empty:
         return None, None, None
         
     df = df.dropna(subset=[price_col, vol_col])
     if df.empty:
         return None, None, None
-        
-    price_min = df[price_col].min()
-    price_max = df[price_col].max()
-    
-    if price_min == price_max:
-        return price_min, price_max, price_min
-        
-    hist, bin_edges = np.histogram(df[price_col], bins=bins, weights=df[vol_col])
-    
-    # Find POC (Point of Control) - price level with max volume
-    max_idx = np.argmax(hist)
-    poc_price = (bin_edges[max_idx] + bin_edges[max_idx+1]) / 2
     
-    # Find Value Area (70% of volume)
-    total_vol = np.sum(hist)
-    target_vol = total_vol * 0.7
-    
-    current_vol = hist[max_idx]
-    left = max_idx
-    right = max_idx
-    
-    while current_vol < target_vol:
-        left_vol = hist[left-1] if left > 0 else 0
-        right_vol = hist[right+1] if right < len(hist)-1 else 0
-        
-        if left == 0 and right == len(hist)-1:
-            break
-            
-        if left_vol > right_vol:
-            left -= 1
-            current_vol += left_vol
-        elif right < len(hist)-1:
-            right += 1
-            current_vol += right_vol
-        elif left > 0:
-            left -= 1
-            current_vol += left_vol
-            
-    va_low = bin_edges[left]
-    va_high = bin_edges[right+1]
-    
-    return poc_price, va_high, va_low
+    high = df['high'] if 'high' in df.columns else df[price_col]
+    low = df['low'] if 'low' in df.columns else df[price_col]
+    poc, va_high, va_low = latest_volume_profile(high.values, low.values, df[price_col].values,
+                                                 df[vol_col].values, window=len(df), price_levels=bins,
+                                                 min_periods=1)
+    return float(poc), float(va_high), float(va_low)
 
 def update_vp_data():
-    """Calculate and update VP data for all stocks"""
+    """Calculate and update VP data for all stocks (single batched call)"""
+    from core.market_matrix import load_market_matrix
+    from core.volume_profile import latest_volume_profile
+    
     print("Fetching stocks...")
     stocks = db_manager.execute_query("SELECT code FROM stock_snapshot WHERE code GLOB '[0-9][0-9][0-9][0-9]'")
+    codes = [stock['code'] for stock in stocks]
     
     conn = sqlite3.connect(db_manager.db_path)
     cursor = conn.cursor()
     
-    count = 0
-    total = len(stocks)
+    print(f"Updating VP data for {len(codes)} stocks...")
     
-    print(f"Updating VP data for {total} stocks...")
+    # 一次讀取全市場矩陣，取每檔最近 VP_WINDOW 根 K 棒
+    matrix = load_market_matrix(conn, codes).bar_aligned(VP_WINDOW)
+    poc, va_high, va_low = latest_volume_profile(
+        matrix['high'], matrix['low'], matrix['close'], matrix['volume'],
+        window=VP_WINDOW, price_levels=VP_PRICE_LEVELS)
     
-    for stock in stocks:
-        code = stock['code']
-        
-        # Get history (last 60 days)
-        history = db_manager.execute_query(
-            "SELECT close, volume FROM stock_history WHERE code = ? ORDER BY date_int DESC LIMIT 60",
-            (code,)
-        )
-        
-        if not history or len(history) < 20:
-            continue
-            
-        df = pd.DataFrame(history)
-        poc, va_high, va_low = calculate_vp(df)
-        
-        if poc is not None:
-            cursor.execute(
-                "UPDATE stock_snapshot SET vp_poc = ?, vp_high = ?, vp_low = ? WHERE code = ?",
-                (poc, va_high, va_low, code)
-            )
-            count += 1
-            
-        if count % 100 == 0:
-            print(f"Processed {count}/{total}...")
-            conn.commit()
+    updates = [
+        (float(poc[i]), float(va_high[i]), float(va_low[i]), code)
+        for i, code in enumerate(matrix.codes)
+        if matrix.n_bars[i] >= 20 and np.isfinite(poc[i])
+    ]
+    cursor.executemany(
+        "UPDATE stock_snapshot SET vp_poc = ?, vp_high = ?, vp_low = ? WHERE code = ?",
+        updates
+    )
             
     conn.commit()
     conn.close()
-    print(f"Completed! Updated {count} stocks.")
+    print(f"Completed! Updated {len(updates)} stocks.")
 
 if __name__ == "__main__":
     add_vp_columns()
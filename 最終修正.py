@@ -70,8 +70,9 @@ import math
 import ssl
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple, Any
+from typing import Optional, Dict, List, Tuple, Any, Callable
 from contextlib import contextmanager
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 from dataclasses import dataclass, field
 
@@ -183,43 +184,44 @@ def get_http_session() -> requests.Session:
 # [優化] 簡易記憶體快取
 # ==============================
 class SimpleCache:
-    """輕量快取 (手機友善)"""
+    """輕量快取 (手機友善；OrderedDict 維護 LRU 順序，淘汰為 O(1))"""
     def __init__(self, max_size: int = 100, ttl: int = 300) -> None:
-        self._cache: dict = {}
-        self._timestamps: dict = {}
+        self._cache: OrderedDict = OrderedDict()   # key -> (value, 寫入時間)
         self._max_size = max_size
         self._ttl = ttl  # 存活時間 (秒)
     
     def get(self, key: str) -> any:
-        if key in self._cache:
-            if time.time() - self._timestamps.get(key, 0) < self._ttl:
-                return self._cache[key]
-            else:
-                # 過期清理
-                del self._cache[key]
-                del self._timestamps[key]
-        return None
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        if time.time() - item[1] >= self._ttl:
+            # 過期清理
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return item[0]
     
     def set(self, key: str, value: any) -> None:
-        # LRU: 超過上限時刪除最舊的
-        if len(self._cache) >= self._max_size:
-            oldest = min(self._timestamps, key=self._timestamps.get)
-            del self._cache[oldest]
-            del self._timestamps[oldest]
-        self._cache[key] = value
-        self._timestamps[key] = time.time()
+        self._cache[key] = (value, time.time())
+        self._cache.move_to_end(key)
+        # LRU: 超過上限時刪除最久未用的
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
     
     def clear(self) -> None:
         self._cache.clear()
-        self._timestamps.clear()
 
 # 全域快取實例
 _QUERY_CACHE = SimpleCache(max_size=50, ttl=60)  # 1分鐘快取
 
+# 全域非同步抓取層：依網域令牌桶限速、keep-alive 連線池、同時相同 URL 只送一次
+# fetch_url 與 requests.get 呼叫方式相容 (回傳 FetchResponse，錯誤轉為 requests.exceptions)
+from core.http_client import fetch as fetch_url, get_fetch_client
+
 def http_get(url: str, timeout: int = 30, json_response: bool = True, use_cache: bool = False, cache_ttl: int = 60) -> dict | list | requests.Response:
     """
     [優化] 統一 HTTP GET 介面
-    - 使用連線池複用 TCP 連線
+    - 經由全域抓取層 (core/http_client)：連線複用、依網域限速、相同請求合併
     - 支援快取機制
     - 統一錯誤處理
     
@@ -239,8 +241,7 @@ def http_get(url: str, timeout: int = 30, json_response: bool = True, use_cache:
         if cached is not None:
             return cached
     
-    session = get_http_session()
-    res = session.get(url, timeout=timeout, verify=False)
+    res = fetch_url(url, timeout=timeout)
     res.raise_for_status()
     
     if json_response:
@@ -287,6 +288,17 @@ class Config:
     MAX_WORKERS = 6                 # 多線程最大工作數
     BATCH_SIZE = 200                # 批次處理大小
     LIGHTWEIGHT_MODE = False        # 輕量模式 (手機專用)
+    
+    # 指標計算模式
+    INCREMENTAL_INDICATORS = True   # Step 12 使用增量指標引擎 (僅推進新增 K 棒)
+    VECTORIZED_INDICATORS = True    # Step 7 全量計算使用全市場矩陣 (不經多進程)
+    INCREMENTAL_VERIFY_SAMPLE = 30  # 增量驗證模式抽樣比對的股票數
+    PRICE_CUBE_ENABLED = True       # 歷史讀取優先使用記憶體映射價格立方體 (core/price_cube)
+    SHARED_MEMORY_HANDOFF = True    # 多進程 Step 7 以共享記憶體交付歷史 (不 pickle DataFrame)
+    SCAN_RESULTS_ENABLED = True     # Step 7 後物化所有掃描結果 (core/scan_results)，API 單次索引查詢
+    SNAPSHOT_EXPORT_ENABLED = True  # 雲端同步時另發佈欄式快照檔 (core/snapshot_export)，雲端後端載入記憶體回答
+    SNAPSHOT_BUCKET = "snapshots"   # 欄式快照所在的 Supabase Storage bucket
+    DATE_BACKFILL_ENABLED = True    # Step 6 先依日期以全市場行情檔回補缺漏 (core/backfill_planner)，其餘才逐檔
 
 # ==============================
 # TPEX Patch (Fix for 404 Error)
@@ -311,7 +323,7 @@ def tpex_fetch(self, year: int, month: int, sid: str, retry: int = 5):
             # 加入隨機延遲，避免觸發 Rate Limit
             time.sleep(np.random.uniform(1.5, 3.0))
             
-            r = requests.get(url, params=params, headers={
+            r = fetch_url(url, params=params, headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
             })
             data = r.json()
@@ -401,6 +413,11 @@ BACKUP_DIR = WORK_DIR / 'backups'
 BACKUP_DIR.mkdir(exist_ok=True)
 REQUEST_TIMEOUT = 30
 
+# 磁碟 HTTP 回應快取：歷史日期永久保存、當日資料短暫保存，更新失敗重跑時多半直接命中
+from core.http_cache import default_cache_dir
+from core.http_client import configure_cache
+HTTP_CACHE = configure_cache(default_cache_dir(WORK_DIR))
+
 # API 設定
 def load_finmind_token():
     try:
@@ -585,7 +602,7 @@ def _fetch_holidays_from_twse():
     try:
         url = "https://openapi.twse.com.tw/v1/holidaySchedule/holidaySchedule"
         # [Optimization] 縮短 timeout，避免卡住
-        resp = requests.get(url, timeout=3, verify=False)
+        resp = fetch_url(url, timeout=3)
         if resp.status_code != 200:
             return None
         
@@ -744,6 +761,99 @@ COFFEE_COLOR = '\033[38;5;130m'
 RESET_COLOR = '\033[0m'
 
 
+# Step 7 快照更新 SQL (全量/增量模式共用，欄位順序與 _build_snapshot_update_tuple 一致)
+_STEP7_SNAPSHOT_UPDATE_SQL = """
+    UPDATE stock_snapshot SET
+        ma3=?, ma20=?, ma60=?, ma120=?, ma200=?,
+        wma3=?, wma20=?, wma60=?, wma120=?, wma200=?,
+        mfi14=?, vwap20=?, chg14_pct=?, rsi=?, macd=?, signal=?,
+        vp_poc=?, vp_upper=?, vp_lower=?,
+        month_k=?, month_d=?,
+        daily_k=?, daily_d=?,
+        week_k=?, week_d=?,
+        ma3_prev=?, ma20_prev=?, ma60_prev=?, ma120_prev=?, ma200_prev=?,
+        wma3_prev=?, wma20_prev=?, wma60_prev=?, wma120_prev=?, wma200_prev=?,
+        mfi14_prev=?, vwap20_prev=?, chg14_pct_prev=?,
+        month_k_prev=?, month_d_prev=?,
+        daily_k_prev=?, daily_d_prev=?,
+        week_k_prev=?, week_d_prev=?,
+        close_prev=?, vol_prev=?,
+        smi=?, svi=?, nvi=?, pvi=?, clv=?,
+        smart_score=?, smi_signal=?, svi_signal=?, nvi_signal=?, vsa_signal=?,
+        smi_prev=?, svi_prev=?, nvi_prev=?, smart_score_prev=?,
+        vol_div_signal=?, weekly_nvi_signal=?,
+        div_3day_bull=?, div_3day_bear=?,
+        vol_ma3=?, pvi_prev=?,
+        vwap60=?, bbw=?, fib_0618=?,
+        weekly_close=?, weekly_open=?,
+        monthly_close=?, monthly_open=?,
+        vwap200=?, mansfield_rs=?,
+        adl=?, rs=?,
+        vsbc=?, vsbc_pct=?, vsbc_prev=?
+    WHERE code=?
+"""
+
+
+def _build_snapshot_update_tuple(latest, code, vsbc_values=(None, None, None)):
+    """建構 Step 7 更新 Tuple (latest 為 _format_indicators_result 格式的單日指標)"""
+    return (
+        latest.get('MA3'), latest.get('MA20'), latest.get('MA60'), latest.get('MA120'), latest.get('MA200'),
+        latest.get('WMA3'), latest.get('WMA20'), latest.get('WMA60'), latest.get('WMA120'), latest.get('WMA200'),
+        latest.get('MFI'), latest.get('VWAP'), latest.get('CHG14'), latest.get('RSI'), latest.get('MACD'), latest.get('SIGNAL'),
+        latest.get('POC'), latest.get('VP_upper'), latest.get('VP_lower'),
+        latest.get('Month_K'), latest.get('Month_D'),
+        latest.get('Daily_K'), latest.get('Daily_D'),
+        latest.get('Week_K'), latest.get('Week_D'),
+        latest.get('MA3_prev'), latest.get('MA20_prev'), latest.get('MA60_prev'), latest.get('MA120_prev'), latest.get('MA200_prev'),
+        latest.get('WMA3_prev'), latest.get('WMA20_prev'), latest.get('WMA60_prev'), latest.get('WMA120_prev'), latest.get('WMA200_prev'),
+        latest.get('MFI_prev'), latest.get('VWAP_prev'), latest.get('CHG14_prev'),
+        latest.get('Month_K_prev'), latest.get('Month_D_prev'),
+        latest.get('Daily_K_prev'), latest.get('Daily_D_prev'),
+        latest.get('Week_K_prev'), latest.get('Week_D_prev'),
+        latest.get('close_prev'), latest.get('vol_prev'),
+        latest.get('SMI'), latest.get('SVI'), latest.get('NVI'), latest.get('PVI'), latest.get('clv'),
+        latest.get('Smart_Score'), latest.get('SMI_Signal'), latest.get('SVI_Signal'), latest.get('NVI_Signal'), latest.get('VSA_Signal'),
+        latest.get('SMI_Signal_prev'), latest.get('SVI_Signal_prev'), latest.get('NVI_Signal_prev'), latest.get('Smart_Score_prev'),
+        latest.get('Vol_Div_Signal'), latest.get('Weekly_NVI_Signal'),
+        latest.get('Div_3Day_Bull'), latest.get('Div_3Day_Bear'),
+        latest.get('Vol_MA3'), latest.get('pvi_prev'),
+        latest.get('VWAP60'), latest.get('BBW'), latest.get('Fib_0618'),
+        latest.get('Weekly_Close'), latest.get('Weekly_Open'),
+        latest.get('Monthly_Close'), latest.get('Monthly_Open'),
+        latest.get('VWAP200'), latest.get('Mansfield_RS'),
+        latest.get('ADL'), latest.get('RS'),
+        *vsbc_values,  # [新增] VSBC 欄位
+        code  # WHERE code=?
+    )
+
+
+def _calc_vsbc_latest(preloaded_df):
+    """計算最新一日 VSBC 分數、百分位與前一日分數，資料不足回傳 (None, None, None)"""
+    import pandas as pd
+    
+    # [Guard Clause] VSBC 需要至少 100 筆歷史
+    if preloaded_df is None or len(preloaded_df) < 100:
+        return None, None, None
+    
+    try:
+        df = preloaded_df.copy()
+        df['vsbc'] = calc_vsbc_series(df)
+        df['vsbc_pct'] = df['vsbc'].rolling(100, min_periods=20).rank(pct=True) * 100
+        df['vsbc_pct'] = df['vsbc_pct'].fillna(50)
+        
+        # 確保值為數值
+        vsbc_val = df['vsbc'].iloc[-1]
+        vsbc_pct_val = df['vsbc_pct'].iloc[-1]
+        vsbc_prev_val = df['vsbc'].iloc[-2]
+        return (
+            round(float(vsbc_val), 2) if pd.notna(vsbc_val) else None,
+            round(float(vsbc_pct_val), 2) if pd.notna(vsbc_pct_val) else None,
+            round(float(vsbc_prev_val), 2) if pd.notna(vsbc_prev_val) else None,
+        )
+    except Exception:
+        return None, None, None
+
+
 def _worker_calc_indicators(args):
     """Step 7 Worker: 計算單支股票指標 (含 VSBC)"""
     import pandas as pd
@@ -771,88 +881,115 @@ def _worker_calc_indicators(args):
         latest = indicators_list[0]
         
         # [新增] 計算 VSBC (使用預載入的 DataFrame)
-        vsbc_val = None
-        vsbc_pct_val = None
-        vsbc_prev_val = None
+        vsbc_values = _calc_vsbc_latest(preloaded_df)
         
-        if preloaded_df is not None and len(preloaded_df) >= 100:
-            try:
-                df = preloaded_df.copy()
-                df['vsbc'] = calc_vsbc_series(df)
-                df['vsbc_pct'] = df['vsbc'].rolling(100, min_periods=20).rank(pct=True) * 100
-                df['vsbc_pct'] = df['vsbc_pct'].fillna(50)
-                
-                if len(df) >= 2:
-                    vsbc_val = df['vsbc'].iloc[-1]
-                    vsbc_pct_val = df['vsbc_pct'].iloc[-1]
-                    vsbc_prev_val = df['vsbc'].iloc[-2]
-                    
-                    # 確保值為數值
-                    vsbc_val = round(float(vsbc_val), 2) if pd.notna(vsbc_val) else None
-                    vsbc_pct_val = round(float(vsbc_pct_val), 2) if pd.notna(vsbc_pct_val) else None
-                    vsbc_prev_val = round(float(vsbc_prev_val), 2) if pd.notna(vsbc_prev_val) else None
-            except:
-                pass
-        
-        # 建構更新 Tuple (必須與 SQL UPDATE 順序完全一致)
-        return (
-            latest.get('MA3'), latest.get('MA20'), latest.get('MA60'), latest.get('MA120'), latest.get('MA200'),
-            latest.get('WMA3'), latest.get('WMA20'), latest.get('WMA60'), latest.get('WMA120'), latest.get('WMA200'),
-            latest.get('MFI'), latest.get('VWAP'), latest.get('CHG14'), latest.get('RSI'), latest.get('MACD'), latest.get('SIGNAL'),
-            latest.get('POC'), latest.get('VP_upper'), latest.get('VP_lower'),
-            latest.get('Month_K'), latest.get('Month_D'),
-            latest.get('Daily_K'), latest.get('Daily_D'),
-            latest.get('Week_K'), latest.get('Week_D'),
-            latest.get('MA3_prev'), latest.get('MA20_prev'), latest.get('MA60_prev'), latest.get('MA120_prev'), latest.get('MA200_prev'),
-            latest.get('WMA3_prev'), latest.get('WMA20_prev'), latest.get('WMA60_prev'), latest.get('WMA120_prev'), latest.get('WMA200_prev'),
-            latest.get('MFI_prev'), latest.get('VWAP_prev'), latest.get('CHG14_prev'),
-            latest.get('Month_K_prev'), latest.get('Month_D_prev'),
-            latest.get('Daily_K_prev'), latest.get('Daily_D_prev'),
-            latest.get('Week_K_prev'), latest.get('Week_D_prev'),
-            latest.get('close_prev'), latest.get('vol_prev'),
-            latest.get('SMI'), latest.get('SVI'), latest.get('NVI'), latest.get('PVI'), latest.get('clv'),
-            latest.get('Smart_Score'), latest.get('SMI_Signal'), latest.get('SVI_Signal'), latest.get('NVI_Signal'), latest.get('VSA_Signal'),
-            latest.get('SMI_Signal_prev'), latest.get('SVI_Signal_prev'), latest.get('NVI_Signal_prev'), latest.get('Smart_Score_prev'),
-            latest.get('Vol_Div_Signal'), latest.get('Weekly_NVI_Signal'),
-            latest.get('Div_3Day_Bull'), latest.get('Div_3Day_Bear'),
-            latest.get('Vol_MA3'), latest.get('pvi_prev'),
-            latest.get('VWAP60'), latest.get('BBW'), latest.get('Fib_0618'),
-            latest.get('Weekly_Close'), latest.get('Weekly_Open'),
-            latest.get('Monthly_Close'), latest.get('Monthly_Open'),
-            latest.get('VWAP200'), latest.get('Mansfield_RS'),
-            latest.get('ADL'), latest.get('RS'),
-            vsbc_val, vsbc_pct_val, vsbc_prev_val,  # [新增] VSBC 欄位
-            code # WHERE code=?
-        )
+        # 建構更新 Tuple (必須與 _STEP7_SNAPSHOT_UPDATE_SQL 順序完全一致)
+        return _build_snapshot_update_tuple(latest, code, vsbc_values)
     except Exception:
         return None
 
 
-def batch_load_history(codes, limit_days=400, conn=None):
-    """批次載入多支股票的歷史資料 (優化版 - 直接連線)"""
-    import pandas as pd
+def _worker_calc_indicators_shared(args):
+    """Step 7 Worker (共享記憶體版): 任務只帶 (code, name, 區塊參照, offset, length)"""
+    code, name, ref, offset, length = args
+    preloaded_df = None
+    if ref is not None:
+        from core.shared_history import read_shared_history
+        try:
+            preloaded_df = _history_arrays_to_frame(read_shared_history(ref, offset, length), code)
+        except Exception:
+            return None
+    return _worker_calc_indicators((code, name, preloaded_df))
+
+
+def get_price_cube(conn=None):
+    """
+    取得與資料庫一致的價格立方體 (core/price_cube)
+    未啟用、尚未建立或與 stock_history 不一致時回傳 None，呼叫端改走 SQL
+    """
+    if not Config.PRICE_CUBE_ENABLED:
+        return None
+    try:
+        from core.price_cube import open_price_cube, default_cube_dir
+        cube = open_price_cube(default_cube_dir(db_manager.db_path))
+        if cube is None:
+            return None
+        if conn is None:
+            with db_manager.get_connection() as own_conn:
+                return cube if cube.is_fresh(own_conn) else None
+        return cube if cube.is_fresh(conn) else None
+    except Exception:
+        return None
+
+def update_price_cube(rebuild=False):
+    """更新價格立方體 (每日更新後追加新交易日並修補被改寫的舊列；容量不足或舊資料回補時重建)"""
+    from core.price_cube import (refresh_price_cube, default_cube_dir, ensure_change_log, prune_change_log,
+                                 CHANGE_CONSUMER)
+    if not Config.PRICE_CUBE_ENABLED:
+        # 停用後移除游標，共用異動紀錄才不會為立方體保留
+        from core.history_changes import drop_consumer
+        db_manager.run_transaction(lambda conn: drop_consumer(conn, CHANGE_CONSUMER))
+        return None
+    start_time = time.time()
+    try:
+        # 共用異動紀錄 (history_changes) 記錄 stock_history 異動，既有列被改寫時立方體才會修補
+        db_manager.run_transaction(ensure_change_log)
+        with db_manager.get_connection() as conn:
+            cube, action = refresh_price_cube(conn, default_cube_dir(db_manager.db_path), rebuild=rebuild)
+        db_manager.run_transaction(lambda conn: prune_change_log(conn, cube.meta.get('change_seq')))
+    except Exception as e:
+        print_flush(f"⚠ 價格立方體更新失敗 (改走 SQL 讀取): {e}")
+        return None
+    label = {'current': '已是最新', 'appended': '追加新交易日', 'rebuilt': '重建'}[action]
+    print_flush(f"  -> 價格立方體{label}: {len(cube.codes)} 檔 x {len(cube.dates)} 日 ({time.time() - start_time:.1f} 秒)")
+    return cube
+
+def _cube_history_arrays(cube, codes, calendar_days=730, bars=None):
+    """
+    [優化] 由價格立方體取出與 batch_load_history_arrays SQL 版相同欄位的陣列
+    :param bars: 每檔取最近幾筆有 K 棒的欄 (不受日曆天限制，與 fetch_recent_history_arrays 相同)；None=最近 calendar_days 日曆天
+    """
+    import numpy as np
+    fields = ('open', 'high', 'low', 'close', 'volume', 'amount')
+    result = {}
+    if bars:
+        for code in codes:
+            arrays = cube.history(code, bars, fields)
+            if arrays is not None and len(arrays['date_int']):
+                result[code] = arrays
+        return result
+    matrix = cube.market_matrix(codes, calendar_days=calendar_days)
+    for i, code in enumerate(matrix.codes):
+        cols = np.flatnonzero(matrix.present[i])
+        if len(cols) == 0:
+            continue
+        arrays = {'date_int': matrix.trading_dates[cols]}
+        for name in fields:
+            arrays[name] = matrix[name][i, cols]
+        result[code] = arrays
+    return result
+
+def batch_load_history_arrays(codes, conn=None, limit_days=None):
+    """
+    批次載入多支股票的歷史資料 (NumPy 欄位版)
+    :param limit_days: 每檔只取最近幾筆 (交易日)；None=最近 730 日曆天
+    :return: {code: {'date_int': 陣列, 'open': 陣列, ...}}，各陣列依日期遞增
+    """
     if not codes:
         return {}
     
-    # 計算截止日期
-    cutoff_date = (datetime.now() - timedelta(days=730)).strftime("%Y%m%d")
-    cutoff_int = int(cutoff_date)
+    # [優化] 價格立方體與資料庫一致時直接讀取 memmap
+    cube = get_price_cube(conn)
+    if cube is not None:
+        if limit_days:
+            # 每檔取最後 limit_days 個有 K 棒的欄 (長期停牌或剛復牌的股票也拿到完整筆數)
+            return _cube_history_arrays(cube, codes, bars=limit_days)
+        return _cube_history_arrays(cube, codes)
     
-    placeholders = ','.join(['?'] * len(codes))
-    query = f"""
-        SELECT 
-            code,
-            CAST(date_int/10000 AS TEXT) || '-' || 
-            SUBSTR('0'||CAST((date_int/100)%100 AS TEXT),-2) || '-' ||
-            SUBSTR('0'||CAST(date_int%100 AS TEXT),-2) as date,
-            date_int,
-            open, high, low, close, volume, amount
-        FROM stock_history 
-        WHERE code IN ({placeholders}) AND date_int >= ?
-        ORDER BY code, date_int ASC
-    """
+    from core.history_access import fetch_batch_history_arrays, fetch_recent_history_arrays
     
-    params = list(codes) + [cutoff_int]
+    # 計算截止日期
+    cutoff_int = int((datetime.now() - timedelta(days=730)).strftime("%Y%m%d"))
     should_close = False
     
     try:
@@ -860,8 +997,12 @@ def batch_load_history(codes, limit_days=400, conn=None):
             # 直接建立連線，避開 db_manager 可能的問題
             conn = sqlite3.connect(DB_FILE)
             should_close = True
-            
-        df_all = pd.read_sql_query(query, conn, params=params)
+        
+        # [優化] 直接取回 date_int 與 NumPy 欄位 (不在 SQL 內組日期字串、不經 read_sql_query)
+        if limit_days:
+            # [優化] 每檔依主鍵索引只讀最近 limit_days 筆
+            return fetch_recent_history_arrays(conn, codes, limit_days)
+        return fetch_batch_history_arrays(conn, codes, cutoff_int)
             
     except Exception as e:
         print_flush(f"批次載入失敗: {e}")
@@ -869,15 +1010,22 @@ def batch_load_history(codes, limit_days=400, conn=None):
     finally:
         if should_close and conn:
             conn.close()
-    
-    result = {}
-    if not df_all.empty:
-        df_all['date'] = pd.to_datetime(df_all['date'])
-        groups = list(df_all.groupby('code'))
-        for i, (code, group) in enumerate(groups):
-            result[code] = group.reset_index(drop=True)
-            
-    return result
+
+def batch_load_history(codes, limit_days=400, conn=None):
+    """批次載入多支股票的歷史資料 (每檔最近 limit_days 筆；None=最近 730 日曆天)"""
+    history = batch_load_history_arrays(codes, conn=conn, limit_days=limit_days)
+    return {code: _history_arrays_to_frame(arrays, code) for code, arrays in history.items()}
+
+def _history_arrays_to_frame(arrays, code=None):
+    """{欄位: 陣列} -> DataFrame (date 欄位以整數運算向量化轉換，不解析字串)"""
+    import pandas as pd
+    from core.history_access import date_ints_to_datetime64
+    frame = {}
+    if code is not None:
+        frame['code'] = code
+    frame['date'] = date_ints_to_datetime64(arrays['date_int'])
+    frame.update(arrays)
+    return pd.DataFrame(frame)
 
 
 # ==============================
@@ -1000,9 +1148,9 @@ def safe_api_request(url, headers=None, timeout=30, method='GET', params=None):
     
     try:
         if method.upper() == 'GET':
-            resp = requests.get(url, headers=headers, params=params, timeout=timeout, verify=False)
+            resp = fetch_url(url, headers=headers, params=params, timeout=timeout)
         else:
-            resp = requests.post(url, headers=headers, data=params, timeout=timeout, verify=False)
+            resp = fetch_url(url, headers=headers, data=params, timeout=timeout, method='POST')
         
         if resp.status_code != 200:
             logger.warning(f"API 回應非 200: {url} -> {resp.status_code}")
@@ -1735,6 +1883,7 @@ class WriteOperation:
     params: tuple = ()                      # 參數
     is_many: bool = False                   # 是否為 executemany
     result_future: Optional[Future] = None  # 結果 Future
+    func: Optional[Callable] = None         # 交易函式 func(conn) (設定時忽略 query)
 
 class SingleWriterDBManager:
     """
@@ -1822,12 +1971,16 @@ class SingleWriterDBManager:
                     conn.execute("BEGIN IMMEDIATE")
                     for op in batch:
                         try:
-                            if op.is_many:
+                            if op.func is not None:
+                                result = self._run_func(conn, op.func)
+                            elif op.is_many:
                                 cursor.executemany(op.query, op.params)
+                                result = cursor.rowcount
                             else:
                                 cursor.execute(op.query, op.params)
+                                result = cursor.rowcount
                             if op.result_future and not op.result_future.done():
-                                op.result_future.set_result(cursor.rowcount)
+                                op.result_future.set_result(result)
                         except Exception as e:
                             if op.result_future and not op.result_future.done():
                                 op.result_future.set_exception(e)
@@ -1858,6 +2011,32 @@ class SingleWriterDBManager:
         conn.close()
         logger.debug("資料庫寫入線程已關閉")
     
+    @staticmethod
+    def _run_func(conn, func):
+        """以 SAVEPOINT 包住交易函式：失敗時只回滾此函式的寫入，不影響同批次其他操作"""
+        conn.execute("SAVEPOINT write_func")
+        try:
+            result = func(conn)
+        except Exception:
+            conn.execute("ROLLBACK TO write_func")
+            conn.execute("RELEASE write_func")
+            raise
+        conn.execute("RELEASE write_func")
+        return result
+    
+    def execute_transaction(self, func, timeout=60):
+        """
+        在寫入線程的連線上執行 func(conn)，整個函式為同一個交易 (全部成功或全部回滾)
+        用於需要暫存表或多句 SQL 一起生效的批次寫入；回傳 func 的回傳值
+        """
+        future = Future()
+        self._write_queue.put(WriteOperation(query='', func=func, result_future=future))
+        try:
+            return future.result(timeout=timeout)
+        except Exception as e:
+            logger.error(f"交易寫入失敗: {e}")
+            raise
+    
     def execute_write(self, query, params=(), is_many=False, wait=True):
         """提交寫入操作"""
         future = Future() if wait else None
@@ -2029,6 +2208,13 @@ class ProxyConnection:
         )
         self._conn_version += 1
     
+    def run_transaction(self, func):
+        """先提交待處理寫入，再於寫入線程以單一交易執行 func(conn)"""
+        self.commit()
+        result = self._manager.execute_transaction(func)
+        self._conn_version += 1
+        return result
+    
     def rollback(self):
         """清除待處理寫入"""
         self._pending_writes.clear()
@@ -2071,6 +2257,10 @@ class DBManager:
         """直接寫入 API (bypass proxy)"""
         return self._writer.execute_write(query, params, is_many)
     
+    def run_transaction(self, func):
+        """於寫入線程以單一交易執行 func(conn) (批次寫入 API)"""
+        return self._writer.execute_transaction(func)
+    
     def get_read_connection(self, timeout=30):
         """取得讀取專用連線 (高效能讀取)"""
         return self._writer.get_read_connection(timeout)
@@ -2256,6 +2446,7 @@ def ensure_db(force=False):
         ("smi_signal", "INTEGER"), ("svi_signal", "INTEGER"), ("nvi_signal", "INTEGER"), ("vsa_signal", "INTEGER"),
         ("vol_div_signal", "INTEGER"), ("weekly_nvi_signal", "INTEGER"),
         ("div_3day_bull", "INTEGER"), ("div_3day_bear", "INTEGER"),
+        ("pattern_morning_star", "INTEGER"), ("pattern_evening_star", "INTEGER"),
         ("smart_score", "INTEGER"), ("smart_score_prev", "INTEGER"),
         # Extra
         ("vol_ma3", "REAL"), ("vwap60", "REAL"), ("vwap200", "REAL"), ("bbw", "REAL"), ("fib_0618", "REAL"),
@@ -2405,7 +2596,7 @@ def check_api_status():
                 "Authorization": f"Bearer {SUPABASE_KEY}"
             }
             url = f"{SUPABASE_URL}/rest/v1/stock_list?select=count"
-            response = requests.get(url, headers=headers, timeout=3, verify=False)
+            response = fetch_url(url, headers=headers, timeout=3)
             if response.status_code == 200:
                 status['supabase'] = True
         except Exception:
@@ -2414,7 +2605,7 @@ def check_api_status():
     # 檢查 FinMind API
     try:
         url = f"{FINMIND_URL}?dataset=TaiwanStockPrice&stock_id=2330&start_date=2024-01-01&token={FINMIND_TOKEN}"
-        response = requests.get(url, timeout=3, verify=False)
+        response = fetch_url(url, timeout=3)
         if response.status_code == 200:
             data = response.json()
             if data.get('status') == 200 or 'data' in data:
@@ -2424,7 +2615,7 @@ def check_api_status():
     
     # 檢查 TWSE API
     try:
-        response = requests.get(TWSE_BWIBBU_URL, timeout=3, verify=False)
+        response = fetch_url(TWSE_BWIBBU_URL, timeout=3)
         if response.status_code == 200 and response.json():
             status['twse'] = True
     except Exception:
@@ -2432,7 +2623,7 @@ def check_api_status():
     
     # 檢查 TPEx API
     try:
-        response = requests.get(TPEX_MAINBOARD_URL, timeout=3, verify=False)
+        response = fetch_url(TPEX_MAINBOARD_URL, timeout=3)
         if response.status_code == 200:
             status['tpex'] = True
     except Exception:
@@ -2566,11 +2757,10 @@ class FinMindDataSource(DataSource):
                         self.progress.info(f"{self.name}: 嘗試獲取 {stock_code} ({attempt+1}/{retry})", 1)
                     
                     # 使用 SSL 驗證但忽略警告
-                    response = requests.get(
+                    response = fetch_url(
                         self.url, 
                         params=params, 
-                        timeout=REQUEST_TIMEOUT,
-                        verify=False
+                        timeout=REQUEST_TIMEOUT
                     )
                     
                     if response.status_code == 429:  # 速率限制
@@ -3060,7 +3250,7 @@ class InstitutionalInvestorAPI:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             
-            resp = requests.get(url, headers=headers, timeout=20, verify=False)
+            resp = fetch_url(url, headers=headers, timeout=20)
             resp.raise_for_status()
             
             data = resp.json()
@@ -3109,7 +3299,7 @@ class InstitutionalInvestorAPI:
                 if progress:
                     progress.info("嘗試 TWSE OpenAPI 備援...", level=1)
                 
-                resp = requests.get(cls.TWSE_OPENAPI_URL, timeout=30, verify=False)
+                resp = fetch_url(cls.TWSE_OPENAPI_URL, timeout=30)
                 content = resp.text.strip()
                 
                 if content and content != '[]':
@@ -3167,7 +3357,7 @@ class InstitutionalInvestorAPI:
                 "token": FINMIND_TOKEN
             }
             
-            resp = requests.get(FINMIND_URL, params=params, timeout=30, verify=False)
+            resp = fetch_url(FINMIND_URL, params=params, timeout=30)
             data = resp.json()
             
             if data.get('status') != 200 or 'data' not in data:
@@ -3234,8 +3424,6 @@ class InstitutionalInvestorAPI:
         """使用 TWSE 網頁版取得法人資料 (最終備援)"""
         from io import StringIO
         import pandas as pd
-        import time
-        import random
         
         results = []
         today = datetime.now().strftime("%Y%m%d")
@@ -3244,14 +3432,11 @@ class InstitutionalInvestorAPI:
             # TWSE T86 CSV 格式 API
             url = f"https://www.twse.com.tw/rwd/zh/fund/T86?response=csv&date={today}&selectType=ALLBUT0999"
             
-            # 添加延遲避免被封鎖
-            time.sleep(random.uniform(1.0, 2.0))
-            
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             
-            resp = requests.get(url, headers=headers, timeout=20, verify=False)
+            resp = fetch_url(url, headers=headers, timeout=20)
             
             if resp.status_code != 200 or len(resp.text) < 100:
                 if progress:
@@ -3313,7 +3498,7 @@ class InstitutionalInvestorAPI:
                 'Accept': 'application/json'
             }
             
-            resp = requests.get(cls.TPEX_OPENAPI_URL, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(cls.TPEX_OPENAPI_URL, headers=headers, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -3556,7 +3741,7 @@ class InstitutionalInvestorAPI:
         
         try:
             url = f"{cls.TWSE_T86_URL}?date={date_str}&selectType=ALL&response=json"
-            resp = requests.get(url, timeout=10, verify=False)
+            resp = fetch_url(url, timeout=10)
             resp.raise_for_status()
             data = resp.json()
             
@@ -3605,7 +3790,7 @@ class InstitutionalInvestorAPI:
         
         try:
             url = f"{cls.TPEX_INST_URL}?l=zh-tw&d={date_str}&se=EW&t=D"
-            resp = requests.get(url, timeout=10, verify=False)
+            resp = fetch_url(url, timeout=10)
             resp.raise_for_status()
             data = resp.json()
             
@@ -3689,7 +3874,7 @@ class InstitutionalInvestorAPI:
                 "token": FINMIND_TOKEN
             }
             
-            resp = requests.get(FINMIND_URL, params=params, timeout=15, verify=False)
+            resp = fetch_url(FINMIND_URL, params=params, timeout=15)
             data = resp.json()
             
             if data.get('status') != 200 or 'data' not in data:
@@ -3868,7 +4053,7 @@ class MarginDataAPI:
         # === 主要來源: MI_MARGN 網頁版 API (更即時) ===
         try:
             url = f"https://www.twse.com.tw/exchangeReport/MI_MARGN?response=json&date={today}&selectType=ALL"
-            resp = requests.get(url, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(url, headers=headers, timeout=30)
             data = resp.json()
             
             if data.get('stat') == 'OK' and data.get('data'):
@@ -3922,7 +4107,7 @@ class MarginDataAPI:
         
         # === 備援: OpenAPI ===
         try:
-            resp = requests.get(cls.TWSE_MARGIN_URL, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(cls.TWSE_MARGIN_URL, headers=headers, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -3984,7 +4169,7 @@ class MarginDataAPI:
                 'Accept': 'application/json'
             }
             
-            resp = requests.get(cls.TPEX_MARGIN_URL, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(cls.TPEX_MARGIN_URL, headers=headers, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -4199,7 +4384,7 @@ class PePbDataAPI:
         # === 主要來源: BWIBBU_ALL 網頁版 API (更即時) ===
         try:
             url = "https://www.twse.com.tw/exchangeReport/BWIBBU_ALL?response=json"
-            resp = requests.get(url, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(url, headers=headers, timeout=30)
             data = resp.json()
             
             if data.get('stat') == 'OK' and data.get('data'):
@@ -4235,7 +4420,7 @@ class PePbDataAPI:
         
         # === 備援: OpenAPI ===
         try:
-            resp = requests.get(cls.TWSE_PEPB_URL, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(cls.TWSE_PEPB_URL, headers=headers, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -4277,7 +4462,7 @@ class PePbDataAPI:
                 'Accept': 'application/json'
             }
             
-            resp = requests.get(cls.TPEX_PEPB_URL, headers=headers, timeout=30, verify=False)
+            resp = fetch_url(cls.TPEX_PEPB_URL, headers=headers, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -4361,8 +4546,8 @@ class PePbDataAPI:
                 'token': FINMIND_TOKEN
             }
             
-            resp = requests.get("https://api.finmindtrade.com/api/v4/data", 
-                              params=params, timeout=30)
+            resp = fetch_url("https://api.finmindtrade.com/api/v4/data",
+                             params=params, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -4452,7 +4637,7 @@ class ShareholderDataAPI:
                 'token': FINMIND_TOKEN
             }
             
-            resp = requests.get(cls.FINMIND_URL, params=params, timeout=30)
+            resp = fetch_url(cls.FINMIND_URL, params=params, timeout=30)
             resp.raise_for_status()
             
             data = resp.json()
@@ -4506,7 +4691,7 @@ class ShareholderDataAPI:
             }
             
             # 注意：TDCC 網站有重定向問題，需禁止自動重定向
-            resp = requests.get(cls.TDCC_CSV_URL, headers=headers, timeout=30, verify=False, allow_redirects=False)
+            resp = fetch_url(cls.TDCC_CSV_URL, headers=headers, timeout=30, allow_redirects=False)
             resp.raise_for_status()
             
             # 解析 CSV
@@ -5064,73 +5249,17 @@ class IndicatorCalculator:
 
     @staticmethod
     def calculate_vp_scheme3(df, lookback=20):
-        """計算 Volume Profile (POC, VP_upper, VP_lower)"""
+        """計算 Volume Profile (POC, VP_upper, VP_lower)，由 core.volume_profile 向量化引擎計算"""
+        from core.incremental_indicators import volume_profile_scheme3
         result = {'POC': None, 'VP_upper': None, 'VP_lower': None}
         
         if df.empty or len(df) < 2:
             return result
         
         try:
-            # Use recent data
-            recent = df.tail(lookback) if len(df) >= lookback else df
-            
-            if len(recent) < 2:
-                return result
-                
-            # Calculate typical price and volume profile
-            high = recent['high'].max()
-            low = recent['low'].min()
-            
-            if high == low:
-                result['POC'] = high
-                result['VP_upper'] = high
-                result['VP_lower'] = low
-                return result
-            
-            # Simple POC calculation - price with highest volume
-            price_levels = 10
-            step = (high - low) / price_levels
-            
-            volume_at_price = {}
-            for i in range(price_levels):
-                price_low = low + i * step
-                price_high = low + (i + 1) * step
-                mid_price = (price_low + price_high) / 2
-                
-                mask = (recent['close'] >= price_low) & (recent['close'] < price_high)
-                vol = recent.loc[mask, 'volume'].sum()
-                volume_at_price[mid_price] = vol
-            
-            if volume_at_price:
-                poc_price = max(volume_at_price, key=volume_at_price.get)
-                result['POC'] = round(poc_price, 2)
-            else:
-                result['POC'] = round(recent['close'].iloc[-1], 2)
-            
-            # Calculate value area (70% of volume)
-            total_vol = sum(volume_at_price.values())
-            if total_vol > 0:
-                sorted_prices = sorted(volume_at_price.items(), key=lambda x: x[1], reverse=True)
-                cumulative = 0
-                value_area_prices = []
-                
-                for price, vol in sorted_prices:
-                    cumulative += vol
-                    value_area_prices.append(price)
-                    if cumulative >= total_vol * 0.7:
-                        break
-                
-                if value_area_prices:
-                    result['VP_upper'] = round(max(value_area_prices) + step/2, 2)
-                    result['VP_lower'] = round(min(value_area_prices) - step/2, 2)
-                else:
-                    result['VP_upper'] = round(high, 2)
-                    result['VP_lower'] = round(low, 2)
-            else:
-                result['VP_upper'] = round(high, 2)
-                result['VP_lower'] = round(low, 2)
-            
-            return result
+            recent = df.tail(lookback)
+            return volume_profile_scheme3(recent['high'].values, recent['low'].values,
+                                          recent['close'].values, recent['volume'].values)
         except Exception as e:
             return result
 
@@ -5173,84 +5302,24 @@ class IndicatorCalculator:
     @staticmethod
     def calculate_pattern_morning_star(df):
         """
-        早晨之星 (Morning Star) - 底部反轉
+        早晨之星 (Morning Star) - 底部反轉 (定義見 core/candle_patterns)
         T-2: 長黑 K
         T-1: 星線 (實體小, 收盤 < T-2 收盤)
         T: 長紅 K (收盤 > T-2 實體中點)
         """
-        import pandas as pd
-        if len(df) < 3:
-            return pd.Series([False] * len(df), index=df.index)
-            
-        close = df['close']
-        open_ = df['open']
-        high = df['high']
-        low = df['low']
-        
-        body = (close - open_).abs()
-        candle_range = high - low
-        
-        c2 = close.shift(2)
-        o2 = open_.shift(2)
-        body2 = body.shift(2)
-        range2 = candle_range.shift(2)
-        
-        c1 = close.shift(1)
-        o1 = open_.shift(1)
-        body1 = body.shift(1)
-        
-        c0 = close
-        o0 = open_
-        body0 = body
-        range0 = candle_range
-        
-        is_long_black_2 = (c2 < o2) & (body2 > range2 * 0.6)
-        is_star_1 = (body1 < body2 * 0.3) & (c1 < c2)
-        mid_point_2 = (o2 + c2) / 2
-        is_long_red_0 = (c0 > o0) & (c0 > mid_point_2) & (body0 > range0 * 0.6)
-        
-        return is_long_black_2 & is_star_1 & is_long_red_0
+        from core.candle_patterns import pattern_series
+        return pattern_series(df, 'morning_star')
 
     @staticmethod
     def calculate_pattern_evening_star(df):
         """
-        黃昏之星 (Evening Star) - 頂部反轉
+        黃昏之星 (Evening Star) - 頂部反轉 (定義見 core/candle_patterns)
         T-2: 長紅 K
         T-1: 星線 (實體小, 收盤 > T-2 收盤)
         T: 長黑 K (收盤 < T-2 實體中點)
         """
-        import pandas as pd
-        if len(df) < 3:
-            return pd.Series([False] * len(df), index=df.index)
-            
-        close = df['close']
-        open_ = df['open']
-        high = df['high']
-        low = df['low']
-        
-        body = (close - open_).abs()
-        candle_range = high - low
-        
-        c2 = close.shift(2)
-        o2 = open_.shift(2)
-        body2 = body.shift(2)
-        range2 = candle_range.shift(2)
-        
-        c1 = close.shift(1)
-        o1 = open_.shift(1)
-        body1 = body.shift(1)
-        
-        c0 = close
-        o0 = open_
-        body0 = body
-        range0 = candle_range
-        
-        is_long_red_2 = (c2 > o2) & (body2 > range2 * 0.6)
-        is_star_1 = (body1 < body2 * 0.3) & (c1 > c2)
-        mid_point_2 = (o2 + c2) / 2
-        is_long_black_0 = (c0 < o0) & (c0 < mid_point_2) & (body0 > range0 * 0.6)
-        
-        return is_long_red_2 & is_star_1 & is_long_black_0
+        from core.candle_patterns import pattern_series
+        return pattern_series(df, 'evening_star')
 
 
 class TaiwanStockScreenerAdvanced:
@@ -5440,137 +5509,52 @@ class InstitutionalValueStrategy:
     """
     
     def __init__(self):
-        self.market_df = None
+        self.market_dates = None
+        self.market_close = None
         self.market_adl_status = False
         
     def get_connection(self):
         return db_manager.get_connection()
 
-    def _wma(self, series, period):
-        """加權移動平均 (Weighted Moving Average)"""
-        if len(series) < period: return pd.Series(np.nan, index=series.index)
-        weights = np.arange(1, period + 1)
-        return series.rolling(period).apply(lambda x: np.dot(x, weights) / weights.sum(), raw=True)
-
-    def _vwap(self, df, period=200):
-        """成交量加權平均價 (VWAP)"""
-        try:
-            typical_price = (df['High'] + df['Low'] + df['Close']) / 3
-            pv = typical_price * df['Volume']
-            cum_pv = pv.rolling(period).sum()
-            cum_vol = df['Volume'].rolling(period).sum()
-            return cum_pv / cum_vol
-        except:
-            return pd.Series(np.nan, index=df.index)
-
-    def _mansfield_rs(self, stock_close, market_close, period=200):
-        """曼斯菲爾德相對強度 (Standardized RS)"""
-        try:
-            # 確保索引對齊
-            m_aligned = market_close.reindex(stock_close.index).fillna(method='ffill')
-            # 原始比率
-            raw_rs = stock_close / m_aligned
-            # 基準線 (MA200 of Ratio)
-            base = raw_rs.rolling(period).mean()
-            return raw_rs, base
-        except:
-            return pd.Series(0, index=stock_close.index), pd.Series(0, index=stock_close.index)
-
-    def _stock_adl(self, df):
-        """Chaikin A/D Line (累積派發線)"""
-        try:
-            clv = ((df['Close'] - df['Low']) - (df['High'] - df['Close'])) / (df['High'] - df['Low'])
-            clv = clv.fillna(0)
-            return (clv * df['Volume']).cumsum()
-        except:
-            return pd.Series(0, index=df.index)
-
-    def _fibonacci_pivots(self, df, lookback=60):
-        """計算波段高低點與費波那契回撤"""
-        if len(df) < lookback: return None
-        recent = df.iloc[-lookback:]
-        high = recent['High'].max()
-        low = recent['Low'].min()
-        diff = high - low
-        if diff == 0: return None
-        return {
-            '0.618': high - (diff * 0.618) # 黃金買點
-        }
-
-    def _kd(self, df, period=9):
-        """KD指標"""
-        try:
-            low_min = df['Low'].rolling(period).min()
-            high_max = df['High'].rolling(period).max()
-            rsv = (df['Close'] - low_min) / (high_max - low_min) * 100
-            rsv = rsv.fillna(50)
-            k = rsv.ewm(com=2, adjust=False).mean()
-            d = k.ewm(com=2, adjust=False).mean()
-            return k, d
-        except:
-            return pd.Series(50, index=df.index), pd.Series(50, index=df.index)
-
-    def _weekly_kd(self, df):
-        """週線 KD"""
-        try:
-            w_df = df.resample('W-FRI').agg({
-                'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last'
-            }).dropna()
-            if len(w_df) < 9: return pd.Series(0, index=df.index), pd.Series(0, index=df.index)
-            wk, wd = self._kd(w_df)
-            return wk.reindex(df.index, method='ffill'), wd.reindex(df.index, method='ffill')
-        except:
-            return pd.Series(0, index=df.index), pd.Series(0, index=df.index)
-
     def calculate_market_adl(self):
-        """計算全市場 ADL (Market Breadth)"""
+        """市場騰落線狀態 (讀取 market_breadth 最近 20 日，不再全表 GROUP BY)"""
+        from core.market_breadth import read_market_breadth
         print_flush("\n[Step 1] 計算全市場騰落線 (Market ADL)...")
+        refresh_market_breadth()
         try:
             with self.get_connection() as conn:
-                # 簡單計算每日漲跌家數
-                df = pd.read_sql("""
-                    SELECT date_int, 
-                           SUM(CASE WHEN close > open THEN 1 ELSE 0 END) as rise,
-                           SUM(CASE WHEN close < open THEN 1 ELSE 0 END) as fall
-                    FROM stock_history 
-                    WHERE code != '0000' AND code != 'TAIEX'
-                    GROUP BY date_int
-                    ORDER BY date_int
-                """, conn)
-                
-                if df.empty: return False
-                
-                df['net'] = df['rise'] - df['fall']
-                df['adl'] = df['net'].cumsum()
-                
-                # 判斷狀態 (ADL > MA20)
-                curr_adl = df['adl'].iloc[-1]
-                ma20_adl = df['adl'].rolling(20).mean().iloc[-1]
-                self.market_adl_status = curr_adl > ma20_adl
-                
-                status = "健康 (ADL > MA20)" if self.market_adl_status else "警戒 (ADL < MA20)"
-                print_flush(f"Market ADL 狀態: {status}")
-                return self.market_adl_status
+                rows = read_market_breadth(conn, limit=20)
+            if len(rows) < 20: return False
+            
+            # 判斷狀態 (ADL > MA20)
+            curr_adl = rows[-1]['adl']
+            ma20_adl = sum(r['adl'] for r in rows) / len(rows)
+            self.market_adl_status = curr_adl > ma20_adl
+            
+            status = "健康 (ADL > MA20)" if self.market_adl_status else "警戒 (ADL < MA20)"
+            print_flush(f"Market ADL 狀態: {status} | McClellan: {rows[-1]['mcclellan']:.1f}")
+            return self.market_adl_status
         except Exception as e:
             print_flush(f"⚠ Market ADL 計算失敗: {e}")
             return False
 
-    def load_market_index(self):
-        """載入大盤指數 (0000 或 TAIEX)"""
+    def load_market_index(self, since_date_int=0):
+        """載入大盤指數 (0000 或 TAIEX) since_date_int 之後的 (date_int 陣列, 收盤陣列)"""
         try:
             with self.get_connection() as conn:
-                df = pd.read_sql("SELECT date_int, close FROM stock_history WHERE code='0000' OR code='TAIEX' ORDER BY date_int", conn)
-                if df.empty: return False
-                
-                df['date'] = pd.to_datetime(df['date_int'].astype(str), format='%Y%m%d')
-                df.set_index('date', inplace=True)
-                self.market_df = df['close']
-                return True
+                rows = conn.execute("SELECT date_int, close FROM stock_history "
+                                    "WHERE code IN ('0000', 'TAIEX') AND date_int >= ? ORDER BY date_int",
+                                    (int(since_date_int),)).fetchall()
+            if not rows: return False
+            self.market_dates = np.array([r[0] for r in rows], dtype=np.int64)
+            self.market_close = np.array([r[1] for r in rows], dtype=np.float64)
+            return True
         except:
             return False
 
     def scan(self):
-        """執行策略掃描"""
+        """執行策略掃描 ([優化] 批次載入 + 陣列計算，見 core/institutional_value)"""
+        from core.institutional_value import LOOKBACK_BARS, FLOW_DAYS, load_net_flows, scan_value_candidates
         print_flush("\n[機構價值回歸策略] V2.0")
         
         # 獲取使用者輸入的掃描參數
@@ -5578,14 +5562,11 @@ class InstitutionalValueStrategy:
         
         print_flush("\n[Step 1] 準備市場數據...")
         
-        # 1. 準備數據
-        if not self.load_market_index():
-            print_flush("❌ 無法載入大盤數據")
-            return
-            
+        # 1. 市場寬度 (market_breadth 最近 20 日)
         self.calculate_market_adl()
         
-        # 2. 獲取股票清單
+        # 2. 獲取股票清單，一次載入歷史 (每檔最近 LOOKBACK_BARS 根)、大盤同期收盤與法人淨買超
+        start_time = time.time()
         with self.get_connection() as conn:
             codes = [r[0] for r in conn.execute("SELECT DISTINCT code FROM stock_history WHERE code NOT LIKE '0%' AND LENGTH(code)=4").fetchall()]
             # Fetch names
@@ -5593,99 +5574,23 @@ class InstitutionalValueStrategy:
                 names = {r[0]: r[1] for r in conn.execute("SELECT code, name FROM stock_meta").fetchall()}
             except:
                 names = {}
+            
+            print_flush(f"目標: {len(codes)} 檔股票")
+            history = batch_load_history_arrays(codes, conn=conn, limit_days=LOOKBACK_BARS)
+            recent = [a['date_int'][-FLOW_DAYS] for a in history.values() if len(a['date_int']) >= FLOW_DAYS]
+            try:
+                flows = load_net_flows(conn, min(recent)) if recent else {}
+            except sqlite3.Error:
+                flows = {}
         
-        print_flush(f"目標: {len(codes)} 檔股票 (分析需時較長，請稍候...)")
-        
-        candidates = []
-        processed = 0
+        if not self.load_market_index(min((a['date_int'][0] for a in history.values() if len(a['date_int'])), default=0)):
+            print_flush("❌ 無法載入大盤數據")
+            return
         
-        for code in codes:
-            processed += 1
-            if processed % 50 == 0:
-                print_flush(f"  進度: {processed}/{len(codes)}")
-                
-            try:
-                # 載入個股數據
-                with self.get_connection() as conn:
-                    df = pd.read_sql(f"SELECT * FROM stock_history WHERE code='{code}' ORDER BY date_int", conn)
-                    inst = pd.read_sql(f"SELECT date_int, foreign_buy-foreign_sell as f_net, trust_buy-trust_sell as t_net FROM institutional_investors WHERE code='{code}'", conn)
-                
-                if len(df) < 250: continue
-                
-                df['date'] = pd.to_datetime(df['date_int'].astype(str), format='%Y%m%d')
-                df.set_index('date', inplace=True)
-                
-                df.rename(columns={'open':'Open', 'high':'High', 'low':'Low', 'close':'Close', 'volume':'Volume'}, inplace=True)
-                
-                # --- Step 1: 趨勢與強弱 ---
-                df['wma20'] = self._wma(df['Close'], 20)
-                df['wma200'] = self._wma(df['Close'], 200)
-                df['vwap200'] = self._vwap(df, 200)
-                
-                # RS
-                rs_val, rs_ma = self._mansfield_rs(df['Close'], self.market_df)
-                
-                # 週 KD
-                wk, wd = self._weekly_kd(df)
-                
-                cur = df.iloc[-1]
-                
-                # 1. 多頭結構
-                if not (cur['Close'] > cur['wma200'] and cur['Close'] > cur['vwap200']): continue
-                # 2. 強於大盤
-                if not (rs_val.iloc[-1] > rs_ma.iloc[-1]): continue
-                # 3. 週線保護
-                if not (wk.iloc[-1] > wd.iloc[-1]): continue
-                
-                # --- Step 2: 籌碼 ---
-                # Stock ADL
-                df['stock_adl'] = self._stock_adl(df)
-                
-                # 法人近5日
-                inst_5d_net = 0
-                if not inst.empty:
-                    inst['date'] = pd.to_datetime(inst['date_int'].astype(str), format='%Y%m%d')
-                    inst.set_index('date', inplace=True)
-                    # Join
-                    df_inst = df.join(inst, how='left').fillna(0)
-                    inst_5d_net = (df_inst['f_net'] + df_inst['t_net']).rolling(5).sum().iloc[-1]
-                
-                # ADL 底背離 (股價跌 ADL 漲) - 簡單判斷近5日
-                price_trend = df['Close'].iloc[-1] < df['Close'].iloc[-5]
-                adl_trend = df['stock_adl'].iloc[-1] > df['stock_adl'].iloc[-5]
-                adl_div = price_trend and adl_trend
-                
-                if not (inst_5d_net > 0 or adl_div): continue
-                
-                # --- Step 3: 價值區間 ---
-                fibs = self._fibonacci_pivots(df)
-                fib_0618 = fibs['0.618'] if fibs else 0
-                
-                dist_fib = abs(cur['Close'] - fib_0618) / cur['Close'] if fib_0618 else 1.0
-                dist_wma = abs(cur['Close'] - cur['wma20']) / cur['Close']
-                
-                in_value_zone = (dist_fib < 0.05) or (dist_wma < 0.05) # 放寬至 5%
-                
-                # --- Step 4: 動能觸發 ---
-                dk, dd = self._kd(df)
-                kd_cross = (dk.iloc[-1] > dd.iloc[-1]) and (dk.iloc[-2] <= dd.iloc[-2])
-                kd_low = dk.iloc[-1] < 60
-                vol_up = cur['Volume'] > df['Volume'].iloc[-2]
-                
-                is_triggered = kd_cross and kd_low and vol_up
-                
-                if in_value_zone:
-                    candidates.append({
-                        'code': code,
-                        'name': names.get(code, code),
-                        'price': cur['Close'],
-                        'inst': inst_5d_net,
-                        'fib': fib_0618,
-                        'status': "TRIGGERED" if is_triggered else "WAITING"
-                    })
-                    
-            except Exception as e:
-                continue
+        candidates = scan_value_candidates(history, self.market_dates, self.market_close, flows)
+        for c in candidates:
+            c['name'] = names.get(c['code'], c['code'])
+        print_flush(f"  完成 {len(history)} 檔分析 ({time.time() - start_time:.1f} 秒)")
                 
         # 輸出結果
         print_flush(f"\n{'='*80}")
@@ -6154,7 +6059,7 @@ def get_latest_market_date():
     # 2. Check TPEx
     try:
         url = f"{TPEX_DAILY_TRADING_URL}?d=&stk_code=&o=json&_={int(time.time())}"
-        res = requests.get(url, timeout=10, verify=False)
+        res = fetch_url(url, timeout=10)
         if res.status_code == 200:
             data = res.json()
             if 'reportDate' in data:
@@ -6206,7 +6111,7 @@ def step1_check_holiday():
     try:
         url = get_api_url('twse', 'holiday_schedule')
         # 參數: response=json
-        res = requests.get(f"{url}?response=json", timeout=10, verify=False)
+        res = fetch_url(f"{url}?response=json", timeout=10)
         if res.status_code == 200:
             data = res.json()
             if data.get('stat') == 'OK':
@@ -6483,8 +6388,76 @@ def step11_verify_backfill(auto_mode=False):
 def step12_calc_indicators():
     """步驟12: 計算技術指標 (含 VSBC 分數) [優化版]"""
     print_flush("\n[Step 12] 計算技術指標與 VSBC 分數...")
-    step7_calc_indicators()
-    # VSBC 已整合到 step7_calc_indicators 的多進程計算中
+    update_price_cube()
+    # VSBC 已整合到 step7_calc_indicators 的多進程計算中；掃描結果與資料版本戳記亦由其更新
+    step7_calc_indicators(incremental=Config.INCREMENTAL_INDICATORS, source="step12")
+
+def bump_api_data_version(source=''):
+    """[優化] 資料已更新: 改寫資料版本戳記，後端 API 回應快取隨之失效 (core/data_version)"""
+    from core.data_version import bump_data_version, default_version_path
+    try:
+        return bump_data_version(default_version_path(Config.DB_PATH), source)
+    except OSError as e:
+        print_flush(f"⚠ 資料版本戳記寫入失敗 (API 快取將於 TTL 後失效): {e}")
+        return None
+
+def update_candlestick_patterns(codes=None):
+    """[優化] 全市場一次評估 K 線型態 (core/candle_patterns)，寫入 stock_snapshot 型態旗標"""
+    from core.candle_patterns import MAX_BARS, snapshot_flags
+    try:
+        with db_manager.get_connection() as conn:
+            if codes is None:
+                codes = [row[0] for row in conn.execute("SELECT code FROM stock_snapshot").fetchall()]
+            history = batch_load_history_arrays(codes, conn=conn, limit_days=MAX_BARS)
+            rows = snapshot_flags(history, codes)
+            conn.executemany("UPDATE stock_snapshot SET pattern_morning_star = ?, pattern_evening_star = ? "
+                             "WHERE code = ?", rows)
+            conn.commit()
+    except Exception as e:
+        print_flush(f"⚠ K 線型態旗標更新失敗: {e}")
+        return None
+    return sum(r[0] for r in rows), sum(r[1] for r in rows)
+
+def refresh_market_breadth(rebuild_from=None):
+    """
+    [優化] 增量更新市場寬度日彙總表 market_breadth (core/market_breadth；首次執行時回補全部歷史)
+    :param rebuild_from: 回補了舊日期的行情時傳入最早日期，從該日起重算 (自動偵測只比對最近幾天)
+    """
+    from core.market_breadth import update_market_breadth
+    try:
+        return db_manager.run_transaction(lambda conn: update_market_breadth(conn, rebuild_from=rebuild_from))
+    except Exception as e:
+        print_flush(f"⚠ 市場寬度更新失敗: {e}")
+        return None
+
+def refresh_inst_flow_rollup():
+    """[優化] 增量更新法人買賣超前綴和 (core/inst_flow_rollup)，供多日法人排行以相減取得區間合計"""
+    from core.inst_flow_rollup import update_inst_flow_rollup
+    try:
+        return db_manager.run_transaction(update_inst_flow_rollup)
+    except Exception as e:
+        print_flush(f"⚠ 法人前綴和更新失敗: {e}")
+        return None
+
+def update_scan_results():
+    """[優化] 指標寫入後重算所有已登記掃描並寫入 scan_results (API 以單次索引查詢讀取)"""
+    if not Config.SCAN_RESULTS_ENABLED:
+        return None
+    from core.scan_results import refresh_scan_results, ensure_scan_results_schema
+    start_time = time.time()
+    try:
+        with db_manager.get_connection() as conn:
+            ensure_scan_results_schema(conn)
+            conn.commit()   # 寫入佇列需先建表，後續才能讀取目前世代
+            counts, errors = refresh_scan_results(conn)
+            conn.commit()
+    except Exception as e:
+        print_flush(f"⚠ 掃描結果物化失敗 (API 改走即時查詢): {e}")
+        return None
+    print_flush(f"  -> 掃描結果物化: {len(counts)} 種掃描、{sum(counts.values())} 筆 ({time.time() - start_time:.1f} 秒)")
+    if errors:
+        print_flush(f"  -> 略過 {len(errors)} 種掃描 (快照欄位不足): {', '.join(errors)}")
+    return counts
 
 # ==============================
 # 市場資料更新模板 (Template Method)
@@ -6509,83 +6482,23 @@ def update_market_data(market_name, fetch_func, parse_func, silent_header=False)
         print_flush(f"  -> 日期: {trade_date}")
         print_flush("  -> 正在寫入資料庫: ", end="")
         
-        new_count = 0
-        update_count = 0
-        skip_count = 0
-        updated_codes = set()
+        # 1. 解析資料
+        quotes = []
+        for idx, item in enumerate(data_list):
+            if idx % 100 == 0:
+                print_flush(".", end="")
+            parsed = parse_func(item)
+            if parsed:
+                quotes.append(parsed)
         
-        with db_manager.get_connection() as conn:
-            cur = conn.cursor()
-            conn.execute("PRAGMA synchronous = OFF;")
-            
-            for idx, item in enumerate(data_list):
-                if idx % 100 == 0:
-                    print_flush(".", end="")
-                
-                # 1. 解析資料
-                parsed = parse_func(item)
-                if not parsed:
-                    continue
-                
-                code, name, open_price, high, low, close, vol, amount = parsed
-                
-                # 2. 檢查舊資料
-                cur.execute("SELECT close, amount FROM stock_history WHERE code=? AND date_int=?", (code, date_int))
-                existing = cur.fetchone()
-                
-                # 衛語句：資料存在且一致 (且 amount 不為空)
-                # 如果資料庫中 amount 為空但新資料有 amount，則強制更新
-                need_update = False
-                if existing:
-                    if existing[0] != close:
-                        need_update = True
-                    elif (existing[1] is None or existing[1] == 0) and (amount is not None and amount > 0):
-                        need_update = True
-                    else:
-                        skip_count += 1
-                        continue
-                
-                if existing is None:
-                    new_count += 1
-                else:
-                    update_count += 1
-                
-                updated_codes.add(code)
-                
-                # 3. 取得前日收盤價 (計算漲跌幅用)
-                cur.execute("""
-                    SELECT close, volume FROM stock_history 
-                    WHERE code=? AND date_int<? 
-                    ORDER BY date_int DESC LIMIT 1
-                """, (code, date_int))
-                
-                prev = cur.fetchone()
-                pc, pv = (prev[0], prev[1]) if prev else (close, vol)
-                
-                # 4. 寫入歷史資料 (含 amount)
-                cur.execute("""
-                    INSERT OR REPLACE INTO stock_history 
-                    (code, date_int, open, high, low, close, volume, amount)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (code, date_int, open_price, high, low, close, vol, amount))
-                
-                # 5. 寫入快照資料 (改用 UPSERT 以保留 PE/Yield 等資料)
-                cur.execute("""
-                    INSERT INTO stock_snapshot (code, name, date, close, volume, close_prev, vol_prev, amount)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(code) DO UPDATE SET
-                        name=excluded.name,
-                        date=excluded.date,
-                        close=excluded.close,
-                        volume=excluded.volume,
-                        close_prev=excluded.close_prev,
-                        vol_prev=excluded.vol_prev,
-                        amount=excluded.amount
-                """, (code, name, trade_date, close, vol, pc, pv, amount))
-            
-            conn.commit()
-            
-            # [已移除] 不再每次都同步 Supabase，改由 step8_sync_supabase 統一處理
+        # 2. 整日行情於單一交易內批次寫入 (暫存表 + 集合式 UPSERT，見 core/quote_ingest.py)
+        from core.quote_ingest import ingest_daily_quotes
+        result = db_manager.run_transaction(
+            lambda conn: ingest_daily_quotes(conn, date_int, trade_date, quotes))
+        new_count, update_count, skip_count = result.new, result.updated, result.skipped
+        updated_codes = result.codes
+        
+        # [已移除] 不再每次都同步 Supabase，改由 step8_sync_supabase 統一處理
             
         print_flush(f"\n✓ {market_name} 更新: 新增 {new_count} 筆 | 更新 {update_count} 筆 | 跳過 {skip_count} 筆")
         return updated_codes
@@ -6629,6 +6542,31 @@ def _parse_tpex_item(item):
     )
 
 # TWSE 輔助函式
+def _mi_index_stock_rows(data):
+    """MI_INDEX 回應中的 Table 8 (每日收盤行情)，轉成 OpenAPI 欄位格式 (供 _parse_twse_item)"""
+    stock_data = []
+    for table in data.get('tables', []):
+        title = table.get('title', '')
+        if '每日收盤行情' in title:
+            # 格式: [代號, 名稱, 成交股數, 成交筆數, 成交金額, 開盤價, 最高價, 最低價, 收盤價, ...]
+            for row in table.get('data', []):
+                if len(row) >= 9:
+                    code = str(row[0]).strip()
+                    # 只保留 4 碼普通股
+                    if len(code) == 4 and code.isdigit():
+                        stock_data.append({
+                            'Code': code,
+                            'Name': str(row[1]).strip(),
+                            'TradeVolume': str(row[2]).replace(',', ''),
+                            'TradeValue': str(row[4]).replace(',', ''),
+                            'OpeningPrice': str(row[5]).replace(',', '').replace('--', '0'),
+                            'HighestPrice': str(row[6]).replace(',', '').replace('--', '0'),
+                            'LowestPrice': str(row[7]).replace(',', '').replace('--', '0'),
+                            'ClosingPrice': str(row[8]).replace(',', '').replace('--', '0'),
+                        })
+            break
+    return stock_data
+
 def _fetch_twse_data():
     """獲取 TWSE 上市股票今日行情 (使用 MI_INDEX 網頁版 API - 更即時)"""
     headers = {
@@ -6653,28 +6591,7 @@ def _fetch_twse_data():
         if len(trade_date) == 8:
             trade_date = f"{trade_date[:4]}-{trade_date[4:6]}-{trade_date[6:]}"
         
-        # 找到 Table 8: 每日收盤行情
-        stock_data = []
-        for table in data.get('tables', []):
-            title = table.get('title', '')
-            if '每日收盤行情' in title:
-                # 格式: [代號, 名稱, 成交股數, 成交筆數, 成交金額, 開盤價, 最高價, 最低價, 收盤價, ...]
-                for row in table.get('data', []):
-                    if len(row) >= 9:
-                        code = str(row[0]).strip()
-                        # 只保留 4 碼普通股
-                        if len(code) == 4 and code.isdigit():
-                            stock_data.append({
-                                'Code': code,
-                                'Name': str(row[1]).strip(),
-                                'TradeVolume': str(row[2]).replace(',', ''),
-                                'TradeValue': str(row[4]).replace(',', ''),
-                                'OpeningPrice': str(row[5]).replace(',', '').replace('--', '0'),
-                                'HighestPrice': str(row[6]).replace(',', '').replace('--', '0'),
-                                'LowestPrice': str(row[7]).replace(',', '').replace('--', '0'),
-                                'ClosingPrice': str(row[8]).replace(',', '').replace('--', '0'),
-                            })
-                break
+        stock_data = _mi_index_stock_rows(data)
         
         if stock_data:
             return trade_date, stock_data
@@ -6730,7 +6647,7 @@ def _fetch_and_update_tpex_valuation():
     print_flush("\n[Step 6] 更新 TPEx 估值資料 (PE/Yield/PB)...")
     try:
         url = "https://www.tpex.org.tw/web/stock/aftertrading/peratio_analysis/pera_result.php?l=zh-tw&o=json"
-        res = requests.get(url, timeout=30, verify=False)
+        res = fetch_url(url, timeout=30)
         data = res.json()
         
         # TPEx 格式變異多，嘗試不同欄位
@@ -6778,7 +6695,7 @@ def _fetch_and_update_twse_valuation():
     print_flush("\n[Step 6] 更新 TWSE 估值資料 (PE/Yield/PB)...")
     try:
         url = "https://openapi.twse.com.tw/v1/exchangeReport/BWIBBU_d"
-        res = requests.get(url, timeout=30, verify=False)
+        res = fetch_url(url, timeout=30)
         data = res.json()
         
         updates = []
@@ -6813,6 +6730,7 @@ def step3_download_twse_daily(silent_header=False):
     return updated
 
 MIN_DATA_COUNT = 450 # 450筆
+GAP_CHECK_DAYS = 60  # 逐日缺漏檢查的交易日數
     
 def step4_check_data_gaps():
     """步驟4: 檢查數據缺失 (含金額、法人、估值、集保) - 支援上市日期判斷"""
@@ -6831,33 +6749,14 @@ def step4_check_data_gaps():
         except:
             pass
 
-        # 1. 檢查歷史資料筆數與金額缺失 (只有 volume > 0 時 amount 為 0/NULL 才算缺失)
-        print_flush("正在分析歷史資料與金額...")
-        sql = """
-            SELECT code, 
-                   COUNT(*) as total_cnt,
-                   SUM(CASE WHEN volume > 0 AND (amount IS NULL OR amount = 0) THEN 1 ELSE 0 END) as missing_amount_cnt,
-                   MIN(date_int) as min_date
-            FROM stock_history 
-            GROUP BY code
-        """
-        rows = cur.execute(sql).fetchall()
-        
-        # 2. 檢查法人資料
-        print_flush("正在分析法人資料...")
-        try:
-            inst_rows = cur.execute("SELECT code, COUNT(*) FROM institutional_investors GROUP BY code").fetchall()
-            inst_map = {r[0]: r[1] for r in inst_rows}
-        except:
-            inst_map = {}  # 表格可能不存在
-
-        # 3. 檢查融資融券資料
-        print_flush("正在分析融資融券資料...")
-        try:
-            margin_rows = cur.execute("SELECT code, COUNT(*) FROM margin_data GROUP BY code").fetchall()
-            margin_map = {r[0]: r[1] for r in margin_rows}
-        except:
-            margin_map = {}
+        # 1~3. 歷史筆數、金額缺失、法人、融資融券：由缺漏位元索引回答 (增量更新，不再全表 GROUP BY)
+        print_flush("正在更新缺漏索引 (歷史/金額/法人/融資融券)...")
+        from core.gap_index import refresh_gap_index, TradingCalendar, ANCHOR
+        gaps = db_manager.run_transaction(refresh_gap_index)
+        rows = [(code, gaps.count(ANCHOR, code), gaps.count('amount_missing', code),
+                 gaps.first_date(ANCHOR, code)) for code in gaps.codes(ANCHOR)]
+        inst_map = gaps.bitmaps.get('institutional_investors', {})
+        margin_map = gaps.bitmaps.get('margin_data', {})
 
         # 4. 檢查估值與集保資料 (從 stock_snapshot)
         print_flush("正在分析估值與集保資料...")
@@ -6968,6 +6867,22 @@ def step4_check_data_gaps():
     except:
         max_db_date = 0
 
+    # 近期逐日缺漏 (交易日曆 & ~有資料)
+    recent_gaps = {}
+    if max_db_date:
+        try:
+            end_dt = datetime.strptime(str(max_db_date), '%Y%m%d')
+            start_int = int((end_dt - timedelta(days=GAP_CHECK_DAYS * 7 // 5 + 14)).strftime('%Y%m%d'))
+            calendar = TradingCalendar(start_int, max_db_date, is_market_holiday)
+            recent = calendar.last_days(GAP_CHECK_DAYS)
+            if recent:
+                calendar = TradingCalendar(recent[0], max_db_date, is_market_holiday)
+            for dataset in ('stock_history', 'institutional_investors', 'margin_data'):
+                if dataset in gaps.bitmaps:
+                    recent_gaps[dataset] = gaps.missing_by_date(dataset, calendar)
+        except Exception as e:
+            print_flush(f"⚠ 逐日缺漏分析失敗: {e}")
+
     # 顯示統計資訊
     print_flush("\n" + "="*60)
     print_flush("【資料庫統計資訊】")
@@ -6983,6 +6898,14 @@ def step4_check_data_gaps():
         print_flush(f"資料區間: {min_d_str[:4]}-{min_d_str[4:6]}-{min_d_str[6:]} 至 {max_d_str[:4]}-{max_d_str[4:6]}-{max_d_str[6:]}")
     print_flush("-" * 60)
 
+    labels = {'stock_history': '歷史行情', 'institutional_investors': '法人', 'margin_data': '融資融券'}
+    for dataset, by_date in recent_gaps.items():
+        if by_date:
+            cells = sum(len(c) for c in by_date.values())
+            worst = sorted(by_date.items(), key=lambda kv: -len(kv[1]))[:3]
+            detail = ', '.join(f"{d}({len(c)}檔)" for d, c in worst)
+            print_flush(f"近 {GAP_CHECK_DAYS} 交易日{labels[dataset]}缺漏: {len(by_date)} 天 / {cells} 檔日 (最多: {detail})")
+    
     # 顯示結果
     if not any([count_gaps, amount_gaps, inst_gaps, margin_gaps, valuation_gaps, tdcc_gaps]):
         print_flush(f"✓ 所有股票資料皆充足 (>= {MIN_DATA_COUNT} 筆或符合上市天數, 金額/法人/融資券/估值/集保皆完整)")
@@ -7080,6 +7003,20 @@ def step5_clean_delisted():
     except Exception as e:
         print_flush(f"❌ 清理失敗: {e}")
 
+def _gap_dates_to_fetch(dataset, start_int, min_ratio=0.5):
+    """
+    缺漏位元索引中 start_int 起值得整日重抓的日期 (多數股票缺該類資料的交易日)
+    整日完全沒有資料的日期原本就會回補；這裡補上「只抓到一部分市場」的日期。失敗時回傳空集合
+    """
+    try:
+        from core.gap_index import refresh_gap_index, TradingCalendar
+        gaps = db_manager.run_transaction(lambda conn: refresh_gap_index(conn, ['stock_history', dataset]))
+        calendar = TradingCalendar(start_int, int(datetime.now().strftime("%Y%m%d")), is_market_holiday)
+        return set(gaps.dates_to_fetch(dataset, calendar, min_ratio))
+    except Exception as e:
+        logger.warning(f"缺漏索引查詢失敗 ({dataset}): {e}")
+        return set()
+
 def step3_5_download_institutional(days=60, silent_header=False):
     """步驟3.5: 下載三大法人買賣超資料 (Refactored using InstitutionalFetcher)"""
     if not silent_header:
@@ -7141,6 +7078,9 @@ def step3_5_download_institutional(days=60, silent_header=False):
             check_start = int(dates_to_check[-1].strftime("%Y%m%d"))
             cur.execute("SELECT DISTINCT date_int FROM institutional_investors WHERE date_int >= ?", (check_start,))
             existing_dates = {r[0] for r in cur.fetchall()}
+        
+        # 只抓到部分股票的日期同樣整日重抓
+        existing_dates -= _gap_dates_to_fetch('institutional_investors', check_start)
             
         # 3. 找出缺漏日期
         today_int_real = int(datetime.now().strftime("%Y%m%d"))
@@ -7168,8 +7108,6 @@ def step3_5_download_institutional(days=60, silent_header=False):
             date_str = dt.strftime("%Y%m%d")
             print_flush(f"\r[{i+1}/{len(missing_dates)}] 處理 {dt.strftime('%Y-%m-%d')} ... ", end="")
             
-            time.sleep(random.uniform(2.0, 4.0))
-            
             data_list = fetcher.fetch_all(date_str)
             if data_list:
                 _save_institutional_data(data_list)
@@ -7394,6 +7332,9 @@ def step3_7_fetch_margin_data(days=60, silent_header=False):
                 existing_dates = {r[0] for r in cur.fetchall()}
             except:
                 existing_dates = set()
+        
+        # 只抓到部分股票的日期同樣整日重抓
+        existing_dates -= _gap_dates_to_fetch('margin_data', check_start)
                 
         # 3. 找出缺漏日期
         current_hour = datetime.now().hour
@@ -7456,8 +7397,6 @@ def step3_7_fetch_margin_data(days=60, silent_header=False):
             else:
                 print_flush("⚠ 無資料")
             
-            time.sleep(1) # 避免過快
-            
         print_flush("")
         
     except Exception as e:
@@ -7578,9 +7517,6 @@ def _fetch_and_update_daily_data(conn, date_int, stocks):
     from datetime import datetime
     import time
     
-    cur = conn.cursor()
-    fixed_by_crawl = 0
-    fixed_by_prev = 0
     
     try:
         date_str = str(date_int)
@@ -7591,7 +7527,7 @@ def _fetch_and_update_daily_data(conn, date_int, stocks):
         # 抓取 TWSE 資料
         crawled_data = {}
         try:
-            resp = requests.get(url_twse, headers=headers, timeout=15, verify=False)
+            resp = fetch_url(url_twse, headers=headers, timeout=15)
             data = resp.json()
             if data.get('stat') == 'OK':
                 for table in data.get('tables', []):
@@ -7615,7 +7551,7 @@ def _fetch_and_update_daily_data(conn, date_int, stocks):
             roc_date = f"{d_obj.year - 1911}/{d_obj.month:02d}/{d_obj.day:02d}"
             url_tpex = f"https://www.tpex.org.tw/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php?l=zh-tw&d={roc_date}&o=json"
             
-            resp = requests.get(url_tpex, headers=headers, timeout=15, verify=False)
+            resp = fetch_url(url_tpex, headers=headers, timeout=15)
             data = resp.json()
             
             if data.get('aaData'):
@@ -7632,43 +7568,11 @@ def _fetch_and_update_daily_data(conn, date_int, stocks):
                             except: pass
         except: pass
         
-        # 更新資料
-        for code, old_close, old_volume, old_amount in stocks:
-            if code in crawled_data:
-                cdata = crawled_data[code]
-                new_close = cdata.get('close') or old_close
-                new_volume = cdata.get('volume') or old_volume
-                new_amount = cdata.get('amount') or old_amount
-                
-                # 計算補齊
-                if new_volume and new_close and not new_amount:
-                    new_amount = int(new_volume * new_close)
-                if new_amount and new_close and not new_volume:
-                    new_volume = int(new_amount / new_close) if new_close > 0 else 0
-                if new_amount and new_volume and not new_close:
-                    new_close = round(new_amount / new_volume, 2) if new_volume > 0 else 0
-                
-                if new_close and new_volume and new_amount:
-                    cur.execute("UPDATE stock_history SET close=?, volume=?, amount=? WHERE code=? AND date_int=?",
-                               (new_close, new_volume, new_amount, code, date_int))
-                    fixed_by_crawl += 1
-            else:
-                # 沒抓到，用前一天估算
-                cur.execute("""
-                    SELECT close FROM stock_history 
-                    WHERE code = ? AND date_int < ? AND close > 0
-                    ORDER BY date_int DESC LIMIT 1
-                """, (code, date_int))
-                prev = cur.fetchone()
-                if prev and prev[0] > 0:
-                    prev_close = prev[0]
-                    if old_volume and old_volume > 0:
-                        est_amount = int(prev_close * old_volume)
-                        cur.execute("UPDATE stock_history SET close=?, amount=? WHERE code=? AND date_int=?",
-                                   (prev_close, est_amount, code, date_int))
-                        fixed_by_prev += 1
-        
-        time.sleep(0.3)
+        # 更新資料 (單一交易批次寫入；沒抓到者以前日收盤估算，見 core/quote_ingest.py)
+        from core.quote_ingest import repair_day_quotes
+        fixed_by_crawl, fixed_by_prev = conn.run_transaction(
+            lambda wconn: repair_day_quotes(wconn, date_int, stocks, crawled_data))
+        
         return fixed_by_crawl, fixed_by_prev
         
     except Exception as e:
@@ -7750,6 +7654,97 @@ def _auto_fix_missing_amount(crawl=True):
     except Exception as e:
         print_flush(f"  ⚠ 自動修復失敗: {e}")
 
+def _tpex_day_rows(data):
+    """TPEx 每日收盤行情 (stk_wn1430) 轉成 OpenAPI 欄位格式 (供 _parse_tpex_item)"""
+    rows = data.get('aaData') or next((t.get('data') for t in data.get('tables', []) if t.get('data')), [])
+    # 格式: [代號, 名稱, 收盤, 漲跌, 開盤, 最高, 最低, 均價, 成交股數, 成交金額, ...]
+    items = []
+    for row in rows:
+        if len(row) >= 10:
+            clean = [str(v).replace(',', '').strip() for v in row]
+            items.append({
+                'SecuritiesCompanyCode': clean[0], 'CompanyName': clean[1],
+                'Close': clean[2], 'Open': clean[4], 'High': clean[5], 'Low': clean[6],
+                'TradingShares': clean[8], 'TransactionAmount': clean[9],
+            })
+    return items
+
+def _fetch_market_day_quotes(date_int):
+    """
+    下載某一天的全市場行情 (TWSE MI_INDEX + TPEx 每日收盤行情)，各一次請求
+    :return: [(code, name, open, high, low, close, volume, amount)]；兩市場都失敗時回傳 None
+    """
+    quotes = []
+    ok = False
+    date_str = str(date_int)
+    twse_url = f"https://www.twse.com.tw/exchangeReport/MI_INDEX?response=json&date={date_str}&type=ALLBUT0999"
+    roc_date = f"{int(date_str[:4]) - 1911}/{date_str[4:6]}/{date_str[6:]}"
+    tpex_url = f"https://www.tpex.org.tw/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php?l=zh-tw&d={roc_date}&o=json"
+    
+    for url, extract, parse in ((twse_url, _mi_index_stock_rows, _parse_twse_item),
+                                (tpex_url, _tpex_day_rows, _parse_tpex_item)):
+        try:
+            data = http_get(url, timeout=30)
+            items = extract(data) if isinstance(data, dict) else []
+        except Exception as e:
+            logger.debug(f"全市場行情下載失敗 ({date_int}): {e}")
+            continue
+        ok = ok or bool(items)
+        for item in items:
+            parsed = parse(item)
+            if parsed and parsed[5]:        # 無收盤價 (當日未成交) 不寫入
+                quotes.append(parsed)
+    return quotes if ok else None
+
+def _backfill_history_by_date(lookback_days=None):
+    """
+    依缺漏位元索引規劃回補：同一天缺漏的股票夠多時整天下載全市場檔 (上市 + 上櫃各一次請求)，
+    日期並行下載 (限速由全域抓取層負責)；零星缺漏回傳給逐檔回補
+    :return: (已更新代號, 逐檔回補 {代號: [缺漏日期]})
+    """
+    from core.gap_index import refresh_gap_index, TradingCalendar
+    from core.backfill_planner import plan_backfill, run_date_jobs
+    from core.quote_ingest import ingest_daily_quotes
+    
+    lookback_days = lookback_days or Config.HISTORY_DAYS_LOOKBACK
+    end_int = int(get_latest_market_date().replace('-', ''))
+    end_dt = datetime.strptime(str(end_int), "%Y%m%d")
+    start_int = int((end_dt - timedelta(days=lookback_days)).strftime("%Y%m%d"))
+    
+    gaps = db_manager.run_transaction(
+        lambda conn: refresh_gap_index(conn, ['stock_history', 'amount_missing']))
+    plan = plan_backfill(gaps, TradingCalendar(start_int, end_int, is_market_holiday))
+    if not plan.by_date and not plan.per_stock:
+        return set(), {}
+    
+    print_flush(f"回補規劃: 依日期 {len(plan.by_date)} 天 + 逐檔 {len(plan.per_stock)} 檔 "
+                f"(約 {plan.requests} 次請求，逐檔需 {plan.naive_requests} 次)")
+    updated = set()
+    written_dates = []
+    
+    def apply_day(date_int, rows, codes):
+        wanted = set(codes)
+        trade_date = f"{str(date_int)[:4]}-{str(date_int)[4:6]}-{str(date_int)[6:]}"
+        result = db_manager.run_transaction(lambda conn: ingest_daily_quotes(
+            conn, date_int, trade_date, [q for q in rows if q[0] in wanted], update_snapshot=False))
+        updated.update(result.codes)
+        if result.new + result.updated:
+            written_dates.append(date_int)
+        return result.new + result.updated
+    
+    def progress(done, total, date_int, written):
+        print_flush(f"\r  [依日期回補] {done}/{total} {date_int}: {written} 筆   ", end="")
+    
+    outcome = run_date_jobs(plan.by_date, _fetch_market_day_quotes, apply_day,
+                            progress=progress) if plan.by_date else None
+    if outcome:
+        print_flush(f"\n✓ 依日期回補: {len(outcome['done'])} 天 / {outcome['written']} 筆"
+                    + (f" (失敗 {len(outcome['failed'])} 天)" if outcome['failed'] else ""))
+    if written_dates:
+        # 回補的日期可能早於 market_breadth 自動比對的最近幾天，從最早一天起重算
+        refresh_market_breadth(rebuild_from=min(written_dates))
+    return updated, plan.per_stock
+
 def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, skip_institutional=False):
     """步驟6: 驗證資料完整性與回補 (含 amount 與法人資料)"""
     print_flush("\n[Step 6] 驗證資料完整性與回補...")
@@ -7758,6 +7753,14 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
     # 如果 skip_downloads=True (如一鍵更新)，則不執行爬蟲修復
     _auto_fix_missing_amount(crawl=not skip_downloads)
     
+    # 0.5 依日期整批回補 (每天一個全市場行情檔)；剩下的零星缺漏併入下方逐檔回補
+    date_updated, per_stock_gaps = set(), {}
+    if not skip_downloads and Config.DATE_BACKFILL_ENABLED:
+        try:
+            date_updated, per_stock_gaps = _backfill_history_by_date()
+        except Exception as e:
+            print_flush(f"⚠ 依日期回補失敗: {e}")
+    
     if not skip_downloads and not skip_institutional:
         # 檢查缺失狀況
         has_tdcc_gaps = False
@@ -7888,10 +7891,17 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
 
             # If we reached here, data is considered complete
             pass
+        
+        # 全市場檔無法補齊的零星缺漏 (依日期回補規劃剩下的)
+        task_codes = {t[0] for t in tasks}
+        for code, dates in per_stock_gaps.items():
+            if code not in task_codes and code in data:
+                tasks.append((code, data[code]['name'], history_stats.get(code, {}).get('count', 0),
+                              f"缺 {len(dates)} 天"))
     
     if not tasks:
         print_flush(f"✓ 所有股票資料完整 (筆數充足且無缺失金額/收盤價)")
-        return set()
+        return date_updated
 
     # 讀取進度
     progress = load_progress()
@@ -7930,6 +7940,7 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
     
     success_count = 0
     updated_codes = set()
+    earliest_written = None
     
     with tracker:
         latest_date = get_latest_market_date()
@@ -7981,6 +7992,9 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
                     with db_manager.get_connection() as conn:
                         cur = conn.cursor()
                         
+                        # 原本就有的日期只是覆寫，市場寬度只需從真正補上的最早日期重算
+                        existing = {r[0] for r in cur.execute(
+                            "SELECT date_int FROM stock_history WHERE code = ?", (code,)).fetchall()}
                         records = []
                         for d in fetched_data:
                             date_int = int(d.date.replace('-', '').replace('/', ''))
@@ -7999,6 +8013,10 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
                         conn.commit()
                         success_count += 1
                         updated_codes.add(code)
+                        added = [r[1] for r in records if r[1] not in existing]
+                        if added:
+                            first = min(added)
+                            earliest_written = first if earliest_written is None else min(earliest_written, first)
                         
                         if code in failed_stocks:
                             failed_stocks.remove(code)
@@ -8014,238 +8032,160 @@ def step6_verify_and_backfill(data=None, resume=False, skip_downloads=False, ski
             # 儲存進度
             if (i + 1) % 10 == 0:
                 save_progress(last_idx=i + 1, failed_stocks=list(failed_stocks))
-                
-            time.sleep(1)  # 避免過快請求
             
     # 完成後清除進度
     if os.path.exists(PROGRESS_FILE):
         os.remove(PROGRESS_FILE)
         
     print_flush(f"\n✓ 回補完成 - 成功: {success_count}")
-    return updated_codes
+    if earliest_written is not None:
+        refresh_market_breadth(rebuild_from=earliest_written)
+    return updated_codes | date_updated
+
 
 
+# 雲端同步專案 (與 backend/services/db.py 相同，推送與拉取共用)
+SYNC_SUPABASE_URL = "https://awayhkvoawonroactdpg.supabase.co"
+SYNC_SUPABASE_KEY = "sb_secret_CorHfc7EGXSgBNO1-Y0RLg_lR_drOSv"
+
+# 雲端同步表: (表名, 每次讀取列數, 去除空值欄位, 進度區間)；依序上傳，stock_meta 需先於其他表
+# 每次讀取的列數由並行上傳器依位元組大小再切批 (core/cloud_uploader)，浮水印於整段上傳成功後推進
+SUPABASE_SYNC_TABLES = (
+    ('stock_meta', 5000, False, (30, 32)),
+    ('institutional_investors', 20000, False, (32, 35)),
+    ('stock_history', 20000, True, (35, 90)),
+    ('stock_snapshot', 5000, True, (90, 95)),
+)
 
 def step8_sync_supabase(progress_callback=None):
-    """步驟8: 同步資料到 Supabase (完整歷史)"""
+    """
+    步驟8: 同步資料到 Supabase [優化: 變更追蹤增量同步]
+    觸發器記錄每列異動 (core/change_tracking)，只上傳上次成功同步後新增/修改的列；
+    首次同步全表上傳一次。批次失敗時停止該表並保留浮水印，下次從失敗批次續傳。
+    :return: {'synced': {表: (模式, 筆數)}, 'failed': {表: 錯誤訊息}, 'snapshot': 欄式快照版本}；無法連線時回傳 None
+    """
     # [Modified] 強制啟用同步，忽略 ENABLE_CLOUD_SYNC 檢查
     # if not ENABLE_CLOUD_SYNC:
     #     print_flush("\n[Step 8] 同步資料到 Supabase (已停用 - 請檢查 ENABLE_CLOUD_SYNC)")
     #     return
 
-    if not HAS_SUPABASE:
-        print_flush("❌ 未安裝 supabase 套件，無法同步 (pip install supabase)")
-        return
-
-    print_flush("\n[Step 8] 同步資料到 Supabase...")
-    
-    # Supabase 設定 (從 backend/services/db.py 複製，確保可用)
-    url = "https://awayhkvoawonroactdpg.supabase.co"
-    key = "sb_secret_CorHfc7EGXSgBNO1-Y0RLg_lR_drOSv"
+    print_flush("\n[Step 8] 同步資料到 Supabase (增量)...")
+    from core.change_tracking import ensure_change_tracking, sync_table, pending_changes, SyncBatchError
+    from core.cloud_uploader import PostgrestUploader
     
+    result = {'synced': {}, 'failed': {}}
+    uploader = PostgrestUploader(SYNC_SUPABASE_URL, SYNC_SUPABASE_KEY)
     try:
-        supabase: Client = create_client(url, key)
-        
         with db_manager.get_connection() as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            
-            # ==========================================
-            # 0. 同步 stock_meta (基礎資料)
-            # ==========================================
-            cur.execute("SELECT COUNT(*) FROM stock_meta")
-            total_meta = cur.fetchone()[0]
-            
-            if total_meta > 0:
-                print_flush(f"正在同步股票清單 ({total_meta} 筆)...")
-                BATCH_SIZE = 1000
-                total_batches = math.ceil(total_meta / BATCH_SIZE)
-                
-                cur.execute("SELECT * FROM stock_meta")
-                
-                success_count = 0
-                for i in range(total_batches):
-                    rows = cur.fetchmany(BATCH_SIZE)
-                    if not rows: break
-                    
-                    data = [dict(row) for row in rows]
-                    try:
-                        supabase.table("stock_meta").upsert(data).execute()
-                        success_count += len(data)
-                        if (i+1) % 5 == 0 or (i+1) == total_batches:
-                            print(f"\r  進度: {i+1}/{total_batches}", end="")
-                    except Exception as e:
-                        print_flush(f"\n⚠ stock_meta 上傳失敗 (Batch {i}): {e}")
-                print_flush(f"\n✓ 股票清單同步完成 ({success_count}/{total_meta})")
-            
-            # ==========================================
-            # 1. 同步 institutional_investors
-            # ==========================================
-            cur.execute("SELECT COUNT(*) FROM institutional_investors")
-            total = cur.fetchone()[0]
-            
-            if total > 0:
-                print_flush(f"正在同步法人資料 ({total} 筆)...")
-                BATCH_SIZE = 2000
-                total_batches = math.ceil(total / BATCH_SIZE)
-                
-                cur.execute("SELECT * FROM institutional_investors")
-                
-                success_count = 0
-                for i in range(total_batches):
-                    rows = cur.fetchmany(BATCH_SIZE)
-                    if not rows: break
-                    
-                    data = [dict(row) for row in rows]
-                    try:
-                        supabase.table("institutional_investors").upsert(data).execute()
-                        success_count += len(data)
-                        if (i+1) % 5 == 0 or (i+1) == total_batches:
-                            print(f"\r  進度: {i+1}/{total_batches} ({(i+1)/total_batches*100:.1f}%)", end="")
-                            if progress_callback:
-                                p = 30 + int(((i + 1) / total_batches) * 5)
-                                progress_callback(p, f"正在同步法人資料 ({i+1}/{total_batches})...")
-                    except Exception as e:
-                        if "Could not find the table" in str(e):
-                            print_flush(f"\n❌ 錯誤: 表格不存在，請先執行 update_supabase_schema_v2.sql")
-                            return
-                        print_flush(f"\n⚠ 上傳失敗 (Batch {i}): {e}")
-                print_flush(f"\n✓ 法人資料同步完成 ({success_count}/{total})")
-            else:
-                print_flush("法人資料為空，跳過")
-
-            # ==========================================
-            # 2. 同步 stock_history (完整歷史)
-            # ==========================================
-            cur.execute("SELECT COUNT(*) FROM stock_history")
-            total_hist = cur.fetchone()[0]
+            existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+            tables = [t for t in SUPABASE_SYNC_TABLES if t[0] in existing]
+            ensure_change_tracking(conn, [t[0] for t in tables])
+            conn.commit()
             
-            if total_hist > 0:
-                print_flush(f"\n正在同步歷史股價資料 ({total_hist} 筆)...")
-                # 歷史資料量大，使用較大 Batch 但需注意 Timeout
-                BATCH_SIZE = 2000 
-                total_batches = math.ceil(total_hist / BATCH_SIZE)
-                
-                # 依日期排序，確保最近的資料先被看到 (或依需求)
-                # 這裡依 code, date_int 排序以保持一致性
-                # [Modified] 移除 ORDER BY 以加速讀取
-                if progress_callback:
-                    progress_callback(32, "正在讀取歷史股價資料 (這可能需要一點時間)...")
-                cur.execute("SELECT * FROM stock_history")
+            for table, batch_size, drop_nulls, (p_start, p_end) in tables:
+                pending = pending_changes(conn, table)
+                if pending is None:
+                    total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    print_flush(f"正在同步 {table} (首次全表上傳 {total} 筆)...")
+                else:
+                    total = pending
+                    print_flush(f"正在同步 {table} ({pending} 筆變更)...")
+                
+                stats_log = []
+                
+                def upload(table, records, drop_nulls=drop_nulls, stats_log=stats_log):
+                    # 失敗時拋出 UploadError，sync_table 不推進浮水印 (浮水印即為此路徑的重試佇列)
+                    stats_log.append(uploader.upload(table, records, drop_nulls=drop_nulls))
+                
+                def on_batch(table, synced, mode, total=total, p_start=p_start, p_end=p_end, stats_log=stats_log):
+                    ratio = min(synced / total, 1.0) if total else 1.0
+                    sent = sum(st.sent_rows for st in stats_log)
+                    elapsed = sum(st.elapsed for st in stats_log)
+                    rate = sent / elapsed if elapsed else 0.0
+                    print(f"\r  進度: {synced}/{total} ({ratio * 100:.1f}%) - {rate:.0f} 筆/秒", end="")
+                    if progress_callback:
+                        progress_callback(p_start + int(ratio * (p_end - p_start)),
+                                          f"正在同步 {table} ({synced}/{total}, {rate:.0f} 筆/秒)...",
+                                          {'table': table, 'synced': synced, 'total': total,
+                                           'rows_per_sec': round(rate, 1), 'failed_rows': 0})
                 
-                success_count = 0
-                for i in range(total_batches):
-                    rows = cur.fetchmany(BATCH_SIZE)
-                    if not rows: break
-                    
-                    data = [dict(row) for row in rows]
-                    try:
-                        if progress_callback and (i % 5 == 0):
-                            p = 35 + int(((i + 1) / total_batches) * 55)
-                            progress_callback(p, f"正在同步歷史股價資料 ({i+1}/{total_batches})...")
-                        
-                        # 忽略空值欄位以減少傳輸量 (Supabase 會用 NULL)
-                        clean_data = []
-                        for d in data:
-                            clean_d = {k: v for k, v in d.items() if v is not None}
-                            clean_data.append(clean_d)
-                            
-                        supabase.table("stock_history").upsert(clean_data).execute()
-                        success_count += len(data)
-                        
-                        # 每 10 批顯示一次進度
-                        if (i+1) % 10 == 0 or (i+1) == total_batches:
-                            print(f"\r  進度: {i+1}/{total_batches} ({(i+1)/total_batches*100:.1f}%) - {success_count} 筆", end="")
-                            
-                    except Exception as e:
-                        if "Could not find the table" in str(e):
-                            print_flush(f"\n❌ 錯誤: stock_history 表格不存在，請先執行 update_supabase_schema_v2.sql")
-                            return
-                        # 某些批次失敗不應中斷全部，但要記錄
-                        # print_flush(f"\n⚠ 上傳失敗 (Batch {i}): {e}")
-                        pass
-                        
-                print_flush(f"\n✓ 歷史資料同步完成 ({success_count}/{total_hist})")
-            else:
-                print_flush("歷史資料為空，跳過")
-            
-            # ==========================================
-            # 3. 同步 stock_snapshot (快照資料)
-            # ==========================================
-            cur.execute("SELECT COUNT(*) FROM stock_snapshot")
-            total_snap = cur.fetchone()[0]
+                try:
+                    mode, synced = sync_table(conn, table, upload, batch_size, False, progress=on_batch)
+                except SyncBatchError as e:
+                    result['failed'][table] = str(e.cause)
+                    print_flush(f"\n⚠ {table} 上傳失敗 (已完成 {e.synced} 筆，下次從此處續傳): {e.cause}")
+                    if progress_callback:
+                        progress_callback(p_end, f"{table} 上傳失敗: {e.cause}",
+                                          {'table': table, 'synced': e.synced,
+                                           'failed_rows': getattr(e.cause, 'failed_rows', 0)})
+                    if "Could not find the table" in str(e.cause) or "does not exist" in str(e.cause):
+                        print_flush(f"❌ 錯誤: {table} 表格不存在，請先執行 update_supabase_schema_v2.sql")
+                    continue
+                result['synced'][table] = (mode, synced)
+                label = "全表" if mode == 'seed' else "增量"
+                print_flush(f"\n✓ {table} 同步完成 ({label} {synced} 筆)")
             
-            if total_snap > 0:
-                print_flush(f"\n正在同步快照資料 ({total_snap} 筆)...")
-                BATCH_SIZE = 500
-                total_batches = math.ceil(total_snap / BATCH_SIZE)
-                
-                cur.execute("SELECT * FROM stock_snapshot")
-                
-                success_count = 0
-                for i in range(total_batches):
-                    rows = cur.fetchmany(BATCH_SIZE)
-                    if not rows: break
-                    
-                    # 清理空值
-                    clean_data = []
-                    for row in rows:
-                        d = dict(row)
-                        clean_d = {k: v for k, v in d.items() if v is not None}
-                        clean_data.append(clean_d)
-                    
-                    try:
-                        supabase.table("stock_snapshot").upsert(clean_data).execute()
-                        success_count += len(clean_data)
-                        if (i+1) % 5 == 0 or (i+1) == total_batches:
-                            print(f"\r  進度: {i+1}/{total_batches} ({(i+1)/total_batches*100:.1f}%)", end="")
-                    except Exception as e:
-                        if "relation" in str(e) and "does not exist" in str(e):
-                            print_flush(f"\n❌ 表格不存在，請先執行 supabase_stock_snapshot.sql")
-                            break
-                        pass
-                
-                print_flush(f"\n✓ 快照資料同步完成 ({success_count}/{total_snap})")
-            else:
-                print_flush("快照資料為空，跳過")
+            if Config.SNAPSHOT_EXPORT_ENABLED:
+                result['snapshot'] = publish_cloud_snapshot(conn)
             
     except Exception as e:
         print_flush(f"❌ 同步失敗: {e}")
+        result['failed']['*'] = str(e)
+    finally:
+        uploader.close()
+    return result
 
 
+def publish_cloud_snapshot(conn, store=None):
+    """[優化] 發佈全市場欄式快照 (core/snapshot_export)；雲端後端依版本載入記憶體，個股/掃描免查 Supabase"""
+    from core.snapshot_export import SupabaseStorageStore, publish_snapshot
+    if store is None:
+        store = SupabaseStorageStore(SYNC_SUPABASE_URL, SYNC_SUPABASE_KEY, Config.SNAPSHOT_BUCKET)
+    try:
+        manifest = publish_snapshot(conn, store)
+    except Exception as e:
+        print_flush(f"⚠ 欄式快照發佈失敗 (雲端後端改查 Supabase): {e}")
+        return None
+    print_flush(f"✓ 欄式快照 {manifest['version']} ({manifest['rows']} 檔, {manifest['bytes'] / 1024:.0f} KB)")
+    return manifest['version']
+
+
+def step8_pull_supabase(progress_callback=None):
+    """
+    從 Supabase 增量拉取到本地 SQLite [優化: keyset 分頁 + 高水位]
+    只拉取本地 date_int 高水位之後的列 (core/cloud_pull)，經單一寫入者寫入；
+    受影響的股票只重建其 stock_snapshot 列並重算指標，不需重新爬取 TWSE/TPEx。
+    :return: {'pulled': {表: 筆數}, 'failed': {表: 錯誤訊息}, 'codes': 受影響股票數}
+    """
+    print_flush("\n[Step 8] 從 Supabase 拉取資料 (增量)...")
+    from core.cloud_pull import PostgrestReader, pull_all, rebuild_snapshot_rows
+    
+    def on_page(table, pulled):
+        print(f"\r  {table}: 已拉取 {pulled} 筆", end="")
+        if progress_callback:
+            progress_callback(10, f"正在拉取 {table} ({pulled} 筆)...")
+    
+    start_time = time.time()
+    with PostgrestReader(SYNC_SUPABASE_URL, SYNC_SUPABASE_KEY) as reader:
+        with db_manager.get_connection() as conn:
+            result = pull_all(conn, reader, progress=on_page)
+            codes = result['codes']
+            if codes:
+                if progress_callback:
+                    progress_callback(60, f"重建 {len(codes)} 檔股票快照...")
+                rebuild_snapshot_rows(conn, codes)
+    print_flush(f"\n✓ 拉取完成: {result['pulled']} ({time.time() - start_time:.1f} 秒)")
+    for table, error in result['failed'].items():
+        print_flush(f"⚠ {table} 拉取失敗 (已寫入的部分保留，下次從新高水位續拉): {error}")
+    
+    if codes:
+        if progress_callback:
+            progress_callback(70, f"重算 {len(codes)} 檔股票指標...")
+        data = {code: info for code, info in step4_load_data().items() if code in codes}
+        step7_calc_indicators(data, force=True, incremental=Config.INCREMENTAL_INDICATORS, source="sync_pull")
+    return {'pulled': result['pulled'], 'failed': result['failed'], 'codes': len(codes)}
 
 
-def _build_history_query(limit_days=None):
-    """建構歷史資料查詢語句 (Extract Method)"""
-    if limit_days:
-        return """
-            SELECT * FROM (
-                SELECT 
-                    CAST(date_int/10000 AS TEXT) || '-' || 
-                    SUBSTR('0'||CAST((date_int/100)%100 AS TEXT),-2) || '-' ||
-                    SUBSTR('0'||CAST(date_int%100 AS TEXT),-2) as date,
-                    open, high, low, close, volume, amount,
-                    tdcc_count, large_shareholder_pct,
-                    foreign_buy, trust_buy, dealer_buy
-                FROM stock_history 
-                WHERE code = ? 
-                ORDER BY date_int DESC
-                LIMIT ?
-            ) ORDER BY date ASC
-        """
-    else:
-        return """
-            SELECT 
-                CAST(date_int/10000 AS TEXT) || '-' || 
-                SUBSTR('0'||CAST((date_int/100)%100 AS TEXT),-2) || '-' ||
-                SUBSTR('0'||CAST(date_int%100 AS TEXT),-2) as date,
-                open, high, low, close, volume, amount,
-                tdcc_count, large_shareholder_pct,
-                foreign_buy, trust_buy, dealer_buy
-            FROM stock_history 
-            WHERE code = ? 
-            ORDER BY date_int ASC
-        """
 
 
 # ==============================
@@ -8284,13 +8224,11 @@ def _fetch_and_prepare_data(code, limit_days, conn, preloaded_df):
     except:
         pass
 
-    # 2. 獲取歷史資料
+    # 2. 獲取歷史資料 ([優化] 整數日期 + NumPy 欄位，不在 SQL 內組日期字串)
     def execute_query(connection):
-        query = _build_history_query(limit_days)
-        params = [code]
-        if limit_days:
-            params.append(limit_days + 250) # 多抓一些以計算 MA200
-        return pd.read_sql_query(query, connection, params=params)
+        from core.history_access import fetch_history_arrays
+        limit = limit_days + 250 if limit_days else None  # 多抓一些以計算 MA200
+        return pd.DataFrame(fetch_history_arrays(connection, code, limit))
 
     if preloaded_df is not None:
         df = preloaded_df.copy()
@@ -8305,9 +8243,13 @@ def _fetch_and_prepare_data(code, limit_days, conn, preloaded_df):
     if df.empty or len(df) < 20:
         return None, None
 
-    # 3. 資料清洗與映射
-    df['date'] = pd.to_datetime(df['date'])
-    df = df.sort_values('date').reset_index(drop=True)
+    # 3. 資料清洗與映射 (date_int 已依日期遞增，僅在未排序時排序；日期延後到需要時才轉換)
+    if 'date_int' in df.columns:
+        if not df['date_int'].is_monotonic_increasing:
+            df = df.sort_values('date_int').reset_index(drop=True)
+    else:
+        df['date'] = pd.to_datetime(df['date'])
+        df = df.sort_values('date').reset_index(drop=True)
     
     # 映射籌碼數據
     df['total_shareholders'] = df['tdcc_count'].fillna(0).astype(int) if 'tdcc_count' in df.columns else 0
@@ -8440,8 +8382,12 @@ def _calc_six_dim_indicators(df):
     df['Fib_0618'] = (roll_high_60 - (diff_60 * 0.618)).round(2)
     
     # Weekly/Monthly Resampling (Simplified)
-    df['date_idx'] = df['date']
-    df.set_index('date_idx', inplace=True)
+    # [優化] 只有重取樣需要 DatetimeIndex，由 date_int 向量化轉換
+    if 'date_int' in df.columns:
+        from core.history_access import date_ints_to_datetime64
+        df.index = pd.DatetimeIndex(date_ints_to_datetime64(df['date_int'].values))
+    else:
+        df.index = pd.DatetimeIndex(df['date'])
     weekly_df = df.resample('W').agg({'open': 'first', 'close': 'last'})
     monthly_df = df.resample('M').agg({'open': 'first', 'close': 'last'})
     df['weekly_open'] = weekly_df['open'].reindex(df.index, method='ffill')
@@ -8454,19 +8400,37 @@ def _calc_six_dim_indicators(df):
     
     return df
 
+def _rolling_vp_values(df, start_index, window=20):
+    """每列 (自 start_index 起) 的 VP (POC, VP_upper, VP_lower)，NaN 轉 None 並四捨五入至 2 位"""
+    import numpy as np
+    from core.volume_profile import rolling_volume_profile
+    # 只需 start_index 之後的列，往前多取 window-1 列作為視窗
+    offset = max(0, start_index - window + 1)
+    tail = df.iloc[offset:]
+    series = rolling_volume_profile(tail['high'].values, tail['low'].values,
+                                    tail['close'].values, tail['volume'].values, window=window)
+    pad = [None] * offset
+    return tuple(pad + [None if np.isnan(x) else float(np.round(x, 2)) for x in arr] for arr in series)
+
 def _format_indicators_result(df, snapshot_data, display_days):
     """[Helper] 格式化輸出結果"""
     import pandas as pd
     
+    from core.history_access import format_date_int
+    
     indicators_list = []
     start_index = 0 if not display_days else max(0, len(df) - display_days)
+    has_date_int = 'date_int' in df.columns
+    
+    # [優化] 20 日 VP 序列一次計算 (取代逐列切片呼叫 calculate_vp_scheme3)
+    vp_poc, vp_upper, vp_lower = _rolling_vp_values(df, start_index, window=20)
     
     for i in range(start_index, len(df)):
         row = df.iloc[i]
         prev_row = df.iloc[i-1] if i > 0 else row
         
         indicators = {
-            'date': row['date'].strftime('%Y-%m-%d'),
+            'date': format_date_int(row['date_int']) if has_date_int else row['date'].strftime('%Y-%m-%d'),
             'open': row['open'],
             'high': row['high'],
             'low': row['low'],
@@ -8558,12 +8522,9 @@ def _format_indicators_result(df, snapshot_data, display_days):
             'RS': float(row['RS']) if pd.notnull(row['RS']) else None,
         }
         
-        current_window = df.iloc[max(0, i-19):i+1]
-        vp = IndicatorCalculator.calculate_vp_scheme3(current_window, lookback=20)
-        
-        indicators['POC'] = vp['POC']
-        indicators['VP_upper'] = vp['VP_upper']
-        indicators['VP_lower'] = vp['VP_lower']
+        indicators['POC'] = vp_poc[i]
+        indicators['VP_upper'] = vp_upper[i]
+        indicators['VP_lower'] = vp_lower[i]
         
         indicators['VSBC_Upper'] = row['VSBC_Upper']
         indicators['VSBC_Lower'] = row['VSBC_Lower']
@@ -8663,9 +8624,46 @@ def process_single_stock_calculation(code, name, preloaded_df, conn):
         return None
 
 
-def step7_calc_indicators(data=None, force=False, batch_size=500):
-    """[Step 7] 計算技術指標 (多進程並行版)"""
+def step7_calc_indicators(data=None, force=False, batch_size=500, incremental=False, verify=False,
+                          vectorized=None, source="step7"):
+    """
+    [Step 7] 計算技術指標 (多進程並行版)
+    :param force: 全部重算 (多進程模式不從上次進度續算、增量模式捨棄既有狀態重新建檔；向量化模式本來就每次全量計算)
+    :param incremental: True 時改用增量引擎，只推進最新交易日
+    :param verify: 增量/向量化模式下抽樣與逐檔全量重算比對
+    :param vectorized: True 時以全市場矩陣一次計算 (None=依 Config.VECTORIZED_INDICATORS)
+    :param source: 資料版本戳記的來源標記
+    指標寫入後以全市場型態引擎更新 pattern_morning_star / pattern_evening_star，並增量更新 market_breadth 與法人前綴和，
+    再重算 scan_results 並改寫資料版本戳記 (任何入口重算指標後，API 都讀到新結果)
+    :return: 實際寫入指標的股票代號清單
+    """
+    if vectorized is None:
+        vectorized = Config.VECTORIZED_INDICATORS
+    if incremental:
+        written = step7_calc_indicators_incremental(data, batch_size=batch_size, verify=verify, force=force)
+    elif vectorized:
+        written = step7_calc_indicators_vectorized(data, batch_size=batch_size, verify=verify)
+    else:
+        written = _step7_calc_indicators_pool(data, force=force, batch_size=batch_size)
+    # 沒有寫入任何指標 (已是最新或寫入失敗) 時衍生表與掃描結果不變，資料版本戳記也不改寫
+    if not written:
+        print_flush("  -> 無指標寫入，略過型態、市場寬度、法人前綴和與掃描結果更新")
+        return written
+    update_candlestick_patterns(written)
+    refresh_market_breadth()
+    refresh_inst_flow_rollup()
+    update_scan_results()
+    bump_api_data_version(source)
+    return written
+
+
+def _step7_calc_indicators_pool(data=None, force=False, batch_size=500):
+    """
+    [Step 7] 計算技術指標 (多進程並行版)
+    :return: 寫入指標的股票代號 (續算時含上次中斷前已寫入者，其後續更新尚未執行)
+    """
     from multiprocessing import Pool
+    from core.shared_history import SharedHistoryBlock, prepare_pool
     
     print_flush("\n[Step 7] 計算技術指標 (多進程加速)...")
     
@@ -8674,14 +8672,14 @@ def step7_calc_indicators(data=None, force=False, batch_size=500):
     
     if not data:
         print_flush("❌ 無股票資料可計算")
-        return {}
+        return []
     
     stocks = [(code, info['name']) for code, info in data.items()]
     total = len(stocks)
     
     if total == 0:
         print_flush("❌ 無股票需要計算指標")
-        return {}
+        return []
     
     # 讀取進度
     progress = load_progress()
@@ -8689,38 +8687,48 @@ def step7_calc_indicators(data=None, force=False, batch_size=500):
     if not force and progress.get('calc_last_idx', 0) > 0:
         start_idx = progress['calc_last_idx']
         print_flush(f"⚡ 偵測到上次進度，從第 {start_idx+1} 筆繼續計算...")
+    written = [code for code, _ in stocks[:start_idx]]
     
     tracker = ProgressTracker(total_lines=3)
     start_time = time.time()
     
     # 使用 Config.MAX_WORKERS 避免記憶體不足
     num_processes = Config.MAX_WORKERS
+    use_shared = Config.SHARED_MEMORY_HANDOFF
     print_flush(f"啟動 {num_processes} 個進程並行計算...")
     
-    with tracker:
+    # [優化] 進程池整個 Step 7 只建立一次 (不再每批重建)
+    if use_shared:
+        prepare_pool()
+    with tracker, Pool(processes=num_processes) as pool:
         for batch_start in range(start_idx, total, batch_size):
             batch_end = min(batch_start + batch_size, total)
             batch_stocks = stocks[batch_start:batch_end]
             
             pending_updates = []
+            block = None
             
             with db_manager.get_connection() as conn:
                 conn.execute("PRAGMA synchronous = OFF;")
                 cur = conn.cursor()
                 
-                # 1. 批次載入歷史資料 (單線程 I/O)
+                # 1. 批次載入歷史資料 (單線程 I/O) 並準備並行任務
                 batch_codes = [s[0] for s in batch_stocks]
-                history_map = batch_load_history(batch_codes, limit_days=Config.CALC_LOOKBACK_DAYS, conn=conn)
-                
-                # 2. 準備並行任務
-                tasks = []
-                for code, name in batch_stocks:
-                    tasks.append((code, name, history_map.get(code)))
+                if use_shared:
+                    # [優化] 整批歷史寫入共享區塊，任務只傳 (code, offset, length)，不再 pickle DataFrame
+                    block = SharedHistoryBlock(batch_load_history_arrays(
+                        batch_codes, conn=conn, limit_days=Config.CALC_LOOKBACK_DAYS))
+                    tasks = [block.task(code, name) or (code, name, None, 0, 0) for code, name in batch_stocks]
+                    worker = _worker_calc_indicators_shared
+                else:
+                    history_map = batch_load_history(batch_codes, limit_days=Config.CALC_LOOKBACK_DAYS, conn=conn)
+                    tasks = [(code, name, history_map.get(code)) for code, name in batch_stocks]
+                    worker = _worker_calc_indicators
                 
-                # 3. 多進程並行計算 (CPU Bound)
+                # 2. 多進程並行計算 (CPU Bound)
                 # 使用 imap 保持順序並更新進度
-                with Pool(processes=num_processes) as pool:
-                    for i, res in enumerate(pool.imap(_worker_calc_indicators, tasks, chunksize=20)):
+                try:
+                    for i, res in enumerate(pool.imap(worker, tasks, chunksize=20)):
                         current_idx = batch_start + i
                         
                         if res:
@@ -8738,41 +8746,16 @@ def step7_calc_indicators(data=None, force=False, batch_size=500):
                                 f'進度: {current_idx+1}/{total} (批次: {batch_start//batch_size + 1})',
                                 f'速度: {avg_speed:.1f} 檔/秒 | 預估剩餘: {int(remaining/60)}分{int(remaining%60)}秒'
                             )
+                finally:
+                    if block is not None:
+                        block.close()
                 
-                # 4. 批次寫入 (單線程 I/O)
+                # 3. 批次寫入 (單線程 I/O)
                 if pending_updates:
                     try:
-                        cur.executemany("""
-                            UPDATE stock_snapshot SET
-                                ma3=?, ma20=?, ma60=?, ma120=?, ma200=?,
-                                wma3=?, wma20=?, wma60=?, wma120=?, wma200=?,
-                                mfi14=?, vwap20=?, chg14_pct=?, rsi=?, macd=?, signal=?,
-                                vp_poc=?, vp_upper=?, vp_lower=?,
-                                month_k=?, month_d=?,
-                                daily_k=?, daily_d=?,
-                                week_k=?, week_d=?,
-                                ma3_prev=?, ma20_prev=?, ma60_prev=?, ma120_prev=?, ma200_prev=?,
-                                wma3_prev=?, wma20_prev=?, wma60_prev=?, wma120_prev=?, wma200_prev=?,
-                                mfi14_prev=?, vwap20_prev=?, chg14_pct_prev=?,
-                                month_k_prev=?, month_d_prev=?,
-                                daily_k_prev=?, daily_d_prev=?,
-                                week_k_prev=?, week_d_prev=?,
-                                close_prev=?, vol_prev=?,
-                                smi=?, svi=?, nvi=?, pvi=?, clv=?,
-                                smart_score=?, smi_signal=?, svi_signal=?, nvi_signal=?, vsa_signal=?,
-                                smi_prev=?, svi_prev=?, nvi_prev=?, smart_score_prev=?,
-                                vol_div_signal=?, weekly_nvi_signal=?,
-                                div_3day_bull=?, div_3day_bear=?,
-                                vol_ma3=?, pvi_prev=?,
-                                vwap60=?, bbw=?, fib_0618=?,
-                                weekly_close=?, weekly_open=?,
-                                monthly_close=?, monthly_open=?,
-                                vwap200=?, mansfield_rs=?,
-                                adl=?, rs=?,
-                                vsbc=?, vsbc_pct=?, vsbc_prev=?
-                            WHERE code=?
-                        """, pending_updates)
+                        cur.executemany(_STEP7_SNAPSHOT_UPDATE_SQL, pending_updates)
                         conn.commit()
+                        written.extend(update[-1] for update in pending_updates)
                         save_progress(batch_end - 1)
                     except Exception as e:
                         tracker.update_lines(f"寫入錯誤: {e}", "", "")
@@ -8780,7 +8763,313 @@ def step7_calc_indicators(data=None, force=False, batch_size=500):
 
     print_flush(f"\n[Step 7] 計算完成! 總耗時: {int(time.time() - start_time)} 秒")
     clear_progress()
-    return data
+    return written
+
+
+# ==============================
+# Step 7 增量模式 (core.incremental_indicators)
+# ==============================
+_INCREMENTAL_BAR_COLS = ('date_int', 'open', 'high', 'low', 'close', 'volume')
+
+
+def _history_to_bars(df):
+    """歷史 DataFrame 轉為增量引擎的 6 x N 陣列 (剔除 OHLCV 不完整的 K 棒)"""
+    import numpy as np
+    bars = df[list(_INCREMENTAL_BAR_COLS)].to_numpy(dtype=np.float64).T
+    return bars[:, np.isfinite(bars).all(axis=0)]
+
+
+def _load_indicator_states(conn, codes):
+    """讀取 indicator_state，回傳 {code: IndicatorState}"""
+    from core.incremental_indicators import IndicatorState
+    placeholders = ','.join(['?'] * len(codes))
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT code, date_int, n_bars, window, carry
+        FROM indicator_state WHERE code IN ({placeholders})
+    """, list(codes))
+    states = {}
+    for row in cur.fetchall():
+        try:
+            states[row[0]] = IndicatorState.from_row(row)
+        except Exception:
+            continue  # 狀態毀損視同未建檔，稍後重新建檔
+    return states
+
+
+def _load_new_bars(conn, states):
+    """讀取各股「狀態最後一根 (含) 之後」的 K 棒，回傳 {code: 6 x N 陣列}"""
+    import numpy as np
+    if not states:
+        return {}
+    placeholders = ','.join(['?'] * len(states))
+    since = min(st.date_int for st in states.values())
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT code, {', '.join(_INCREMENTAL_BAR_COLS)}
+        FROM stock_history
+        WHERE code IN ({placeholders}) AND date_int >= ?
+        ORDER BY code, date_int ASC
+    """, list(states) + [since])
+    
+    rows_by_code = {}
+    for row in cur.fetchall():
+        rows_by_code.setdefault(row[0], []).append(row[1:])
+    
+    result = {}
+    for code, rows in rows_by_code.items():
+        bars = np.array(rows, dtype=np.float64).T
+        bars = bars[:, np.isfinite(bars).all(axis=0)]
+        result[code] = bars[:, bars[0] >= states[code].date_int]
+    return result
+
+
+def _seed_indicator_state(code, history_df):
+    """以全量模式相同的回溯視窗建檔，回傳 (state, 最新一日輸出)"""
+    from core import incremental_indicators as inc
+    # [Guard Clause] 與全量模式一致: 少於 20 筆不計算
+    if history_df is None or len(history_df) < inc.MIN_BARS:
+        return None, None
+    bars = _history_to_bars(history_df.iloc[-Config.CALC_LOOKBACK_DAYS:])
+    if bars.shape[1] < inc.MIN_BARS:
+        return None, None
+    # 先建檔至前一日，再推進最後一根以取得 *_prev 欄位
+    state = inc.seed_state(code, bars[:, :-1])
+    return state, inc.advance(state, bars[:, -1])
+
+
+def _advance_indicator_state(state, new_bars):
+    """
+    推進新增 K 棒，回傳最新一日輸出
+    :return: None=已是最新, False=狀態與歷史不一致需重新建檔
+    """
+    import numpy as np
+    from core import incremental_indicators as inc
+    # [Guard Clause] 狀態最後一根必須仍存在且未被改寫 (更早日期的回補由 history_changes 偵測)
+    if new_bars is None or new_bars.shape[1] == 0 or int(new_bars[0, 0]) != state.date_int:
+        return False
+    if not np.allclose(new_bars[:, 0], state.bars[:, -1]):
+        return False
+    
+    latest = None
+    for i in range(1, new_bars.shape[1]):
+        latest = inc.advance(state, new_bars[:, i])
+    return latest
+
+
+def _verify_indicator_outputs(codes, outputs):
+    """抽樣比對增量/向量化輸出與逐檔全量重算，列出不一致欄位"""
+    import random
+    from core.incremental_indicators import compare_with_full
+    
+    sample = random.sample(codes, min(len(codes), Config.INCREMENTAL_VERIFY_SAMPLE))
+    if not sample:
+        return []
+    print_flush(f"\n[驗證] 抽樣 {len(sample)} 檔與全量重算比對...")
+    
+    with db_manager.get_connection() as conn:
+        history_map = batch_load_history(sample, limit_days=Config.CALC_LOOKBACK_DAYS, conn=conn)
+    report = []
+    for code in sample:
+        df = history_map.get(code)
+        full = calculate_stock_history_indicators(
+            code, display_days=2, limit_days=Config.CALC_LOOKBACK_DAYS, preloaded_df=df)
+        if not full:
+            continue
+        full_latest = dict(full[0])
+        full_latest['VSBC'], full_latest['VSBC_pct'], full_latest['VSBC_prev'] = _calc_vsbc_latest(df)
+        full_prev = full[1] if len(full) > 1 else None
+        for field_name, inc_val, full_val in compare_with_full(outputs[code], full_latest, full_prev):
+            report.append((code, field_name, inc_val, full_val))
+    
+    if not report:
+        print_flush(f"✓ 計算結果與全量重算一致 ({len(sample)} 檔)")
+        return report
+    
+    print_flush(f"⚠ 發現 {len(report)} 個不一致欄位:")
+    print_flush(f"{'代碼':<6} {'欄位':<16} {'增量':>14} {'全量':>14}")
+    for code, field_name, inc_val, full_val in report[:50]:
+        print_flush(f"{code:<6} {field_name:<16} {str(inc_val):>14} {str(full_val):>14}")
+    return report
+
+
+def step7_calc_indicators_incremental(data=None, batch_size=500, verify=False, force=False):
+    """
+    [Step 7] 增量計算技術指標
+    每檔股票的滾動狀態保存在 indicator_state，每日只推進新增的 K 棒；
+    無狀態的股票，以及 stock_history 在狀態日期 (含) 之前有異動者 (日期回補、
+    repair_day_quotes 改寫，由 history_changes 紀錄比對) 以全量視窗重新建檔，
+    否則視窗與累積型指標 (NVI/PVI/ADL) 會從錯誤的歷史繼續推進。
+    :param force: 捨棄既有狀態，data 內全部股票重新建檔
+    :return: 寫入指標的股票代號清單
+    """
+    from core import incremental_indicators as inc
+    from core.history_changes import ensure_history_changes, latest_seq, get_cursor, set_cursor, changed_codes
+    
+    print_flush("\n[Step 7] 增量計算技術指標...")
+    
+    if data is None:
+        data = step4_load_data()
+    
+    if not data:
+        print_flush("❌ 無股票資料可計算")
+        return []
+    
+    codes = list(data.keys())
+    total = len(codes)
+    start_time = time.time()
+    stats = {'advanced': 0, 'seeded': 0, 'current': 0}
+    outputs = {}
+    written = []
+    
+    with db_manager.get_connection() as conn:
+        conn.execute(inc.INDICATOR_STATE_SCHEMA)
+        conn.commit()
+    
+    # 上次推進後 stock_history 的異動；尚無游標 (首次啟用) 時無從得知，既有狀態全部重新建檔
+    def _history_cursor(conn):
+        ensure_history_changes(conn)
+        return latest_seq(conn), get_cursor(conn, 'indicator_state')
+    upto_seq, after_seq = db_manager.run_transaction(_history_cursor)
+    with db_manager.get_connection() as conn:
+        rewritten = changed_codes(conn, after_seq, upto_seq) if after_seq is not None else None
+    write_failed = False
+    
+    tracker = ProgressTracker(total_lines=2)
+    with tracker:
+        for batch_start in range(0, total, batch_size):
+            batch_codes = codes[batch_start:batch_start + batch_size]
+            pending_updates = []
+            pending_states = []
+            
+            with db_manager.get_connection() as conn:
+                # 1. 推進既有狀態
+                states = {} if force else _load_indicator_states(conn, batch_codes)
+                new_bars_map = _load_new_bars(conn, states)
+                reseed_codes = [c for c in batch_codes if c not in states]
+                
+                for code, state in states.items():
+                    if rewritten is None or rewritten.get(code, state.date_int + 1) <= state.date_int:
+                        reseed_codes.append(code)
+                        continue
+                    latest = _advance_indicator_state(state, new_bars_map.get(code))
+                    if latest is False:
+                        reseed_codes.append(code)
+                        continue
+                    if latest is None:
+                        stats['current'] += 1
+                        continue
+                    stats['advanced'] += 1
+                    outputs[code] = latest
+                    pending_states.append(state.to_row())
+                
+                # 2. 無狀態 / 不一致者以全量視窗建檔
+                if reseed_codes:
+                    history_map = batch_load_history(reseed_codes, limit_days=Config.CALC_LOOKBACK_DAYS, conn=conn)
+                    for code in reseed_codes:
+                        state, latest = _seed_indicator_state(code, history_map.get(code))
+                        if state is None:
+                            continue
+                        stats['seeded'] += 1
+                        outputs[code] = latest
+                        pending_states.append(state.to_row())
+                
+                # 3. 組成快照更新 (與全量模式共用 SQL)
+                for code in batch_codes:
+                    latest = outputs.get(code)
+                    if latest is None or latest.get('date_int') is None:
+                        continue
+                    vsbc_values = (latest.get('VSBC'), latest.get('VSBC_pct'), latest.get('VSBC_prev'))
+                    pending_updates.append(_build_snapshot_update_tuple(latest, code, vsbc_values))
+                
+                # 4. 批次寫入
+                try:
+                    if pending_updates:
+                        conn.executemany(_STEP7_SNAPSHOT_UPDATE_SQL, pending_updates)
+                    if pending_states:
+                        conn.executemany(inc.INDICATOR_STATE_UPSERT, pending_states)
+                    conn.commit()
+                    written.extend(update[-1] for update in pending_updates)
+                except Exception as e:
+                    write_failed = True
+                    tracker.update_lines(f"寫入錯誤: {e}", "")
+                    time.sleep(1)
+            
+            done = min(batch_start + batch_size, total)
+            tracker.update_lines(
+                f'進度: {done}/{total}',
+                f"推進: {stats['advanced']} | 建檔: {stats['seeded']} | 已最新: {stats['current']}"
+            )
+    
+    # 全部寫入成功才推進游標，失敗的批次下次仍會依異動紀錄重新建檔；
+    # 本次未處理 (不在 data 內) 但歷史有異動的股票刪除狀態，下次改為建檔
+    def _advance_cursor(conn):
+        if rewritten is None:
+            stale = [row[0] for row in conn.execute("SELECT code FROM indicator_state") if row[0] not in data]
+        else:
+            stale = [code for code in rewritten if code not in data]
+        conn.executemany("DELETE FROM indicator_state WHERE code = ?", [(code,) for code in stale])
+        set_cursor(conn, 'indicator_state', upto_seq)
+    if not write_failed and upto_seq is not None:
+        db_manager.run_transaction(_advance_cursor)
+    
+    print_flush(f"\n[Step 7] 增量計算完成! 推進 {stats['advanced']} 檔, 建檔 {stats['seeded']} 檔, "
+                f"已最新 {stats['current']} 檔, 耗時 {time.time() - start_time:.1f} 秒")
+    
+    if verify:
+        _verify_indicator_outputs(list(outputs), outputs)
+    return written
+
+
+def step7_calc_indicators_vectorized(data=None, batch_size=500, verify=False):
+    """
+    [Step 7] 計算技術指標 (全市場矩陣向量化版)
+    一次讀取 stock_history 為 (股票 x 交易日) 陣列，沿時間軸一次算出全市場指標，
+    免除逐檔 DataFrame 與多進程 pickle/IPC 開銷；寫入沿用全量模式的 UPDATE。
+    :return: 寫入指標的股票代號清單
+    """
+    from core.market_matrix import load_market_matrix, snapshot_indicators
+    
+    print_flush("\n[Step 7] 計算技術指標 (全市場向量化)...")
+    
+    if data is None:
+        data = step4_load_data()
+    
+    if not data:
+        print_flush("❌ 無股票資料可計算")
+        return []
+    
+    codes = list(data.keys())
+    start_time = time.time()
+    
+    with db_manager.get_connection() as conn:
+        # 1. 一次載入全市場矩陣 (價格立方體優先，否則單次查詢)
+        cube = get_price_cube(conn)
+        matrix = cube.market_matrix(codes) if cube is not None else load_market_matrix(conn, codes)
+        print_flush(f"  -> 載入矩陣: {matrix.shape[0]} 檔 x {matrix.shape[1]} 日 ({time.time() - start_time:.1f} 秒)")
+        
+        # 2. 向量化計算
+        outputs = snapshot_indicators(matrix, lookback=Config.CALC_LOOKBACK_DAYS)
+        pending_updates = [
+            _build_snapshot_update_tuple(latest, code, (latest['VSBC'], latest['VSBC_pct'], latest['VSBC_prev']))
+            for code, latest in outputs.items()
+        ]
+        
+        # 3. 批次寫入
+        written = []
+        try:
+            for i in range(0, len(pending_updates), batch_size):
+                conn.executemany(_STEP7_SNAPSHOT_UPDATE_SQL, pending_updates[i:i + batch_size])
+            conn.commit()
+            written = list(outputs)
+        except Exception as e:
+            print_flush(f"❌ 寫入錯誤: {e}")
+    
+    print_flush(f"[Step 7] 計算完成! {len(written)}/{len(codes)} 檔, 總耗時: {time.time() - start_time:.1f} 秒")
+    
+    if verify:
+        _verify_indicator_outputs(list(outputs), outputs)
+    return written
 
 
 def scan_mfi_mode(indicators_data, order='asc', min_volume=0):
@@ -9974,6 +10263,24 @@ class CloudSync:
             "Prefer": "resolution=merge-duplicates"
         }
 
+    @staticmethod
+    def get_uploader():
+        """
+        並行上傳器 (core/cloud_uploader)；失敗批次寫入 DB 旁的 cloud_retry/ 佇列，
+        並先重送上次留下的佇列
+        """
+        from core.cloud_uploader import PostgrestUploader
+        retry_dir = os.path.join(os.path.dirname(os.path.abspath(Config.DB_PATH)), 'cloud_retry')
+        uploader = PostgrestUploader(SUPABASE_URL, SUPABASE_KEY, retry_dir=retry_dir, verify=False)
+        try:
+            if uploader.retry_queue_files():
+                stats = uploader.replay_retry_queue()
+                print_flush(f"☁ 重送上次失敗的批次: {stats.summary()}")
+        except Exception:
+            uploader.close()    # 呼叫端拿不到上傳器，由此關閉
+            raise
+        return uploader
+
     @staticmethod
     def upload_stock_list():
         """上傳股票清單到雲端"""
@@ -10044,45 +10351,40 @@ class CloudSync:
                     return False
                 
                 total_dates = len(dates)
-                
-                for idx, date in enumerate(dates):
-                    print_flush(f"正在處理日期: {date} ({idx+1}/{total_dates})")
+                # 上傳器以 with 區塊管理，任何一天失敗拋出例外時也會關閉連線池
+                with CloudSync.get_uploader() as uploader:
+                    for idx, date in enumerate(dates):
+                        print_flush(f"正在處理日期: {date} ({idx+1}/{total_dates})")
                     
-                    # 從 stock_snapshot 取得最新指標資料
-                    df = pd.read_sql_query("SELECT * FROM stock_snapshot WHERE date=?", conn, params=(date,))
+                        # 從 stock_snapshot 取得最新指標資料
+                        df = pd.read_sql_query("SELECT * FROM stock_snapshot WHERE date=?", conn, params=(date,))
                     
-                    def clean_value(x):
-                        if isinstance(x, bytes):
-                            try:
-                                return int.from_bytes(x, byteorder='little')
-                            except:
-                                return str(x)
-                        return x
-
-                    for col in df.columns:
-                        if df[col].dtype == 'object':
-                            df[col] = df[col].apply(clean_value)
+                        def clean_value(x):
+                            if isinstance(x, bytes):
+                                try:
+                                    return int.from_bytes(x, byteorder='little')
+                                except:
+                                    return str(x)
+                            return x
+
+                        for col in df.columns:
+                            if df[col].dtype == 'object':
+                                df[col] = df[col].apply(clean_value)
                             
-                    vol_cols = ['volume', 'vol_prev', 'volume_prev']
+                        vol_cols = ['volume', 'vol_prev', 'volume_prev']
                     
-                    for col in vol_cols:
-                        if col in df.columns:
-                            df[col] = pd.to_numeric(df[col], errors='coerce')
-                            df[col] = df[col].astype('Int64')
-                            df[col] = df[col].apply(lambda x: int(x) if pd.notnull(x) else None)
+                        for col in vol_cols:
+                            if col in df.columns:
+                                df[col] = pd.to_numeric(df[col], errors='coerce')
+                                df[col] = df[col].astype('Int64')
+                                df[col] = df[col].apply(lambda x: int(x) if pd.notnull(x) else None)
 
-                    records = df.to_dict(orient='records')
-                    
-                    batch_size = 500
-                    total_recs = len(records)
+                        records = df.to_dict(orient='records')
                     
-                    for i in range(0, total_recs, batch_size):
-                        batch = records[i:i+batch_size]
-                        url = f"{SUPABASE_URL}/rest/v1/stock_data"
-                        response = requests.post(url, headers=CloudSync.get_headers(), json=batch, verify=False)
-                        
-                        if response.status_code not in [200, 201]:
-                            print_flush(f"⚠ 上傳失敗 ({date} 批次 {i}): {response.text}")
+                        # 並行上傳 (依 JSON 大小分批；失敗批次進入重試佇列)
+                        stats = uploader.upload("stock_data", records)
+                        if stats.failed_rows:
+                            print_flush(f"⚠ 上傳失敗 ({date}): {stats.failed_rows} 筆已寫入重試佇列")
             
             print_flush("\n✓ 數據上傳完成")
             return True
@@ -10177,80 +10479,53 @@ class CloudSync:
                 cur.execute("SELECT COUNT(*) FROM stock_history")
                 total_count = cur.fetchone()[0]
                 
-                # 分頁讀取與上傳
-                batch_size = 2000 # 本地讀取批次
-                upload_batch_size = 500 # 上傳批次
-                offset = 0
-                success_count = 0
-                fail_count = 0
-                last_error = ""
-                
                 start_time = time.time()
                 
-                while offset < total_count:
-                    cur.execute(f"""
-                        SELECT code, date_int, open, high, low, close, volume, amount 
-                        FROM stock_history 
-                        LIMIT {batch_size} OFFSET {offset}
-                    """)
-                    rows = cur.fetchall()
-                    if not rows:
-                        break
-                        
-                    # 轉換資料格式
-                    upload_data = []
-                    for r in rows:
-                        d_str = str(r[1])
-                        date_fmt = f"{d_str[:4]}-{d_str[4:6]}-{d_str[6:]}"
-                        upload_data.append({
-                            "code": r[0],
-                            "date": date_fmt,
-                            "open": r[2],
-                            "high": r[3],
-                            "low": r[4],
-                            "close": r[5],
-                            "volume": r[6],
-                            "amount": r[7]
-                        })
-                    
-                    # 分批上傳到 Supabase
-                    for i in range(0, len(upload_data), upload_batch_size):
-                        batch = upload_data[i:i+upload_batch_size]
-                        
-                        # [Fix] 加入 on_conflict=code,date 以解決 409 錯誤
-                        # 當 PK 不是 (code, date) 但有唯一約束時，必須明確指定
-                        url = f"{SUPABASE_URL}/rest/v1/stock_data?on_conflict=code,date"
-                        
-                        try:
-                            headers = CloudSync.get_headers()
-                            headers["Prefer"] = "resolution=merge-duplicates"
-                            
-                            res = requests.post(url, headers=headers, json=batch, verify=False, timeout=30)
-                            if res.status_code not in [200, 201]:
-                                fail_count += len(batch)
-                                last_error = f"[{res.status_code}] {res.text[:50]}..."
-                            else:
-                                success_count += len(batch)
-                                last_error = ""
-                        except Exception as e:
-                            fail_count += len(batch)
-                            last_error = str(e)[:50]
-                            
-                    offset += batch_size
-                    
-                    # 簡化進度顯示 (移除進度條)
-                    percent = int(offset / total_count * 100)
+                # 游標逐段讀取 (不再 LIMIT/OFFSET 重掃)，交給並行上傳器依 JSON 大小分批
+                cur.execute("""
+                    SELECT code, date_int, open, high, low, close, volume, amount 
+                    FROM stock_history
+                """)
+                
+                def history_rows():
+                    while True:
+                        rows = cur.fetchmany(2000)
+                        if not rows:
+                            return
+                        for r in rows:
+                            d_str = str(r[1])
+                            yield {
+                                "code": r[0],
+                                "date": f"{d_str[:4]}-{d_str[4:6]}-{d_str[6:]}",
+                                "open": r[2],
+                                "high": r[3],
+                                "low": r[4],
+                                "close": r[5],
+                                "volume": r[6],
+                                "amount": r[7]
+                            }
+                
+                def show_progress(stats):
+                    d = stats.as_dict()
+                    done = d['sent_rows'] + d['failed_rows']
+                    percent = int(done / total_count * 100) if total_count else 100
                     
                     # ANSI Escape Codes
                     UP = "\033[2A" # 上移2行
                     CLR = "\033[K" # 清除行
                     
-                    status_line = f"狀態: 成功 {success_count} | 失敗 {fail_count}"
-                    if last_error:
-                        status_line += f" | ⚠ {last_error}"
+                    status_line = f"狀態: 成功 {d['sent_rows']} | 失敗 {d['failed_rows']} | {d['rows_per_sec']:.0f} 筆/秒"
+                    if d['queued_batches']:
+                        status_line += f" | ⚠ {d['queued_batches']} 批已寫入重試佇列"
                         
-                    print(f"{UP}{CLR}【全量上傳】進度: {percent}% ({offset}/{total_count})")
+                    print(f"{UP}{CLR}【全量上傳】進度: {percent}% ({done}/{total_count})")
                     print(f"{CLR}{status_line}")
+                
+                # [Fix] on_conflict=code,date 以解決 409 錯誤 (PK 不是 (code, date) 但有唯一約束)
+                with CloudSync.get_uploader() as uploader:
+                    stats = uploader.upload("stock_data", history_rows(), on_conflict="code,date",
+                                            progress=show_progress)
+                print_flush(f"\n  {stats.summary()} (耗時 {time.time() - start_time:.0f} 秒)")
                     
             print_flush("\n✓ 歷史資料上傳完成")
             
@@ -10344,19 +10619,16 @@ def add_ma(df):
     return df
 
 def calc_vp_poc(df, window=60, bins=30):
-    """計算 Volume Profile POC (Point of Control)"""
+    """計算 Volume Profile POC (Point of Control)，與快照 VP 共用 core.volume_profile 引擎"""
     import numpy as np
+    from core.volume_profile import latest_volume_profile
     sub = df.tail(window)
     if len(sub) < 2:
         return df['close'].iloc[-1]
-        
-    hist, edges = np.histogram(
-        sub['close'],
-        bins=bins,
-        weights=sub['volume']
-    )
-    i = hist.argmax()
-    return (edges[i] + edges[i+1]) / 2
+    
+    poc, _, _ = latest_volume_profile(sub['high'].values, sub['low'].values, sub['close'].values,
+                                      sub['volume'].values, window=window, price_levels=bins)
+    return float(poc) if np.isfinite(poc) else df['close'].iloc[-1]
 
 # ==============================
 # 2️⃣ VSBC 序列計算 (供後續使用)
@@ -10823,183 +11095,71 @@ def scan_2560_strategy():
 
 
 def scan_candlestick_patterns():
-    """K 線型態掃描 (晨星/夜星) - 詳細漏斗版"""
-def scan_candlestick_patterns():
-    """K 線型態掃描 (晨星/夜星) - Table-Driven Refactored"""
-    
-    # --- Helper Functions ---
-    def _check_morning_star(c0, c1, c2, o0, o1, o2, v0, v1, range0, range2, body0, body1, body2):
-        # Returns (passed, step_reached)
-        # Step 1: T-2 Long Black
-        if not ((c2 < o2) and (body2 > range2 * 0.6)):
-            return False, 0
-        
-        # Step 2: T-1 Star
-        if not ((body1 < body2 * 0.3) and (c1 < c2)):
-            return False, 1
-            
-        # Step 3: T Long Red
-        mid_point_2 = (o2 + c2) / 2
-        if not ((c0 > o0) and (c0 > mid_point_2) and (body0 > range0 * 0.6)):
-            return False, 2
-            
-        # Step 4: Volume Surge
-        if not (v0 > v1 * 1.3):
-            return False, 3
-            
-        return True, 4
-
-    def _check_evening_star(c0, c1, c2, o0, o1, o2, range0, range2, body0, body1, body2):
-        # T-2 Long Red
-        if not ((c2 > o2) and (body2 > range2 * 0.6)):
-            return False
-        # T-1 Star
-        if not ((body1 < body2 * 0.3) and (c1 > c2)):
-            return False
-        # T Long Black
-        mid_point_2 = (o2 + c2) / 2
-        if not ((c0 < o0) and (c0 < mid_point_2) and (body0 > range0 * 0.6)):
-            return False
-        return True
+    """K 線型態掃描 - 全市場向量化 (型態定義見 core/candle_patterns 登記表)"""
+    from core.candle_patterns import MAX_BARS, PATTERNS, evaluate, recent_candles
+    import numpy as np
 
     limit, min_vol = get_user_scan_params()
     print_flush(f"\n正在掃描 K 線型態 (成交量 > {min_vol} 張)...")
-    print_flush("篩選條件: 晨星(T-2長黑, T-1星線, T長紅, 爆量), 夜星(反之)")
+    print_flush(f"型態: {', '.join(p.label for p in PATTERNS.values())}")
     
     with db_manager.get_connection() as conn:
         cur = conn.cursor()
         cur.execute("SELECT code, name FROM stock_snapshot")
         stocks = cur.fetchall()
-        
-    codes = [s[0] for s in stocks]
-    history_map = batch_load_history(codes, limit_days=10) 
-    
-    morning_stars = []
-    evening_stars = []
     
-    # Counters
-    count_total = len(stocks)
-    count_vol = 0
-    # Morning Star Funnel
-    ms_funnel = [0, 0, 0, 0] # Steps 1-4
-    count_m_final = 0
-    count_e_final = 0
+    codes = [s[0] for s in stocks]
+    names = dict(stocks)
+    # [優化] 每檔只讀最近幾根 K 棒，所有型態以 (股票 x K 棒) 矩陣一次評估
+    candles = recent_candles(batch_load_history_arrays(codes, limit_days=MAX_BARS), codes)
+    volume_ok = candles.v() >= min_vol * 1000
+    results = evaluate(candles, mask=volume_ok, confirm=True)
     
-    for code, name in stocks:
-        df = history_map.get(code)
-        if df is None or len(df) < 5:
-            continue
-            
-        try:
-            # 1. Volume Filter
-            vol = df['volume'].iloc[-1]
-            if vol < min_vol * 1000:
-                continue
-            count_vol += 1
-            
-            # Prepare Data
-            c = df['close'].values[-3:]
-            o = df['open'].values[-3:]
-            h = df['high'].values[-3:]
-            l = df['low'].values[-3:]
-            v = df['volume'].values[-2:] # v0, v1
-            
-            c0, c1, c2 = c[2], c[1], c[0]
-            o0, o1, o2 = o[2], o[1], o[0]
-            h0, h1, h2 = h[2], h[1], h[0]
-            l0, l1, l2 = l[2], l[1], l[0]
-            v0, v1 = v[1], v[0]
-            
-            range0 = h0 - l0
-            range2 = h2 - l2
-            body0 = abs(c0 - o0)
-            body1 = abs(c1 - o1)
-            body2 = abs(c2 - o2)
-            
-            # Check Morning Star
-            passed_m, step_m = _check_morning_star(c0, c1, c2, o0, o1, o2, v0, v1, range0, range2, body0, body1, body2)
-            if step_m >= 1: ms_funnel[0] += 1
-            if step_m >= 2: ms_funnel[1] += 1
-            if step_m >= 3: ms_funnel[2] += 1
-            if passed_m:
-                ms_funnel[3] += 1
-                count_m_final += 1
-                
-                # Calculate Metrics
-                df = add_vsbc_columns(df)
-                t = df.iloc[-1]
-                vsbc_val = t['vsbc'] if 'vsbc' in t else 0
-                try: poc = calc_vp_poc(df)
-                except: poc = df['close'].mean()
-                
-                recent_60 = df.iloc[-60:]
-                h60 = recent_60['high'].max()
-                l60 = recent_60['low'].min()
-                diff = h60 - l60
-                fib_0618 = h60 - (diff * 0.618)
-                current_ratio = (h60 - c0) / diff if diff > 0 else 0
-                
-                morning_stars.append({
-                    'code': code, 'name': name,
-                    'close': c0, 'close_prev': c1,
-                    'pattern': '早晨之星',
-                    'volume': v0,
-                    'vol_ratio': v0/v1 if v1>0 else 1,
-                    'vsbc_lower': vsbc_val,
-                    'vsbc_upper': poc,
-                    'fib_val': fib_0618,
-                    'fib_ratio': current_ratio
-                })
-
-            # Check Evening Star
-            passed_e = _check_evening_star(c0, c1, c2, o0, o1, o2, range0, range2, body0, body1, body2)
-            if passed_e:
-                count_e_final += 1
-                # Calculate Metrics (Duplicate logic, could be extracted)
-                df = add_vsbc_columns(df) # Idempotent?
-                t = df.iloc[-1]
-                vsbc_val = t['vsbc'] if 'vsbc' in t else 0
-                try: poc = calc_vp_poc(df)
-                except: poc = df['close'].mean()
-                
-                recent_60 = df.iloc[-60:]
-                h60 = recent_60['high'].max()
-                l60 = recent_60['low'].min()
-                diff = h60 - l60
-                fib_0618 = h60 - (diff * 0.618)
-                current_ratio = (h60 - c0) / diff if diff > 0 else 0
-                
-                evening_stars.append({
-                    'code': code, 'name': name,
-                    'close': c0, 'close_prev': c1,
-                    'pattern': '黃昏之星',
-                    'volume': v0,
-                    'vol_ratio': v0/v1 if v1>0 else 1,
-                    'vsbc_lower': vsbc_val,
-                    'vsbc_upper': poc,
-                    'fib_val': fib_0618,
-                    'fib_ratio': current_ratio
-                })
-
-        except Exception:
-            continue
-            
-    # Summary
+    # Summary (漏斗: 每一步為前面所有步驟的累積結果)
     print_flush("\n" + "="*60)
-    print_flush("[篩選過程] K線型態 (晨星/夜星)")
+    print_flush("[篩選過程] K線型態")
     print_flush("="*60)
-    print_flush(f"總股數: {count_total}")
+    print_flush(f"總股數: {len(stocks)}")
     print_flush("─"*60)
-    print_flush(f"✓ 成交量 >= {min_vol}張        → {count_vol} 檔")
-    print_flush(f"✓ [第1階] T-2: 長黑 K (實體 > 0.6 * 總長)   → {ms_funnel[0]} 檔")
-    print_flush(f"✓ [第2階] T-1: 星線 (實體 < 0.3 * T-2實體)  → {ms_funnel[1]} 檔")
-    print_flush(f"✓ [第3階] T: 長紅 K (收盤 > T-2實體中點)    → {ms_funnel[2]} 檔")
-    print_flush(f"✓ [第4階] 第三根陽線若爆量 (>1.3倍)         → {ms_funnel[3]} 檔")
-    print_flush(f"✓ 綜合評分 >= 以上都符合 (晨星)             → {count_m_final} 檔")
-    if count_e_final > 0:
-        print_flush(f"✓ 黃昏之星 (額外篩選)                       → {count_e_final} 檔")
+    print_flush(f"✓ 成交量 >= {min_vol}張        → {int(volume_ok.sum())} 檔")
+    for result in results.values():
+        print_flush(f"[{result.pattern.label}]")
+        for step, (label, count) in enumerate(result.funnel, 1):
+            print_flush(f"  ✓ [第{step}階] {label:<28} → {count} 檔")
     print_flush("─"*60)
     
+    # 命中股票才載入較長歷史計算 VSBC / POC / 60 日費波那契 (需至少 60 根，型態判斷的 MAX_BARS 不夠)
+    hit_codes = [codes[i] for i in np.flatnonzero(np.any([r.hits for r in results.values()], axis=0))]
+    history_map = batch_load_history(hit_codes, limit_days=150) if hit_codes else {}
+    
+    def pattern_item(code, label):
+        df = history_map.get(code)
+        if df is None or len(df) < 2:
+            return None
+        c0, c1 = df['close'].iloc[-1], df['close'].iloc[-2]
+        v0, v1 = df['volume'].iloc[-1], df['volume'].iloc[-2]
+        df = add_vsbc_columns(df)
+        t = df.iloc[-1]
+        vsbc_val = t['vsbc'] if 'vsbc' in t else 0
+        try: poc = calc_vp_poc(df)
+        except: poc = df['close'].mean()
+        
+        recent_60 = df.iloc[-60:]
+        h60 = recent_60['high'].max()
+        l60 = recent_60['low'].min()
+        diff = h60 - l60
+        return {
+            'code': code, 'name': names.get(code, ''),
+            'close': c0, 'close_prev': c1,
+            'pattern': label,
+            'volume': v0,
+            'vol_ratio': v0/v1 if v1>0 else 1,
+            'vsbc_lower': vsbc_val,
+            'vsbc_upper': poc,
+            'fib_val': h60 - (diff * 0.618),
+            'fib_ratio': (h60 - c0) / diff if diff > 0 else 0
+        }
+    
     # Output
     def candle_extra(code, item):
         ratio = item.get('fib_ratio', 0)
@@ -11012,17 +11172,25 @@ def scan_candlestick_patterns():
             fib_str = f"{ratio:.2f}({close:.0f})"
         return [fib_str]
 
-    if morning_stars:
-        display_scan_results_v2(morning_stars, "早晨之星 (底部反轉)", limit=limit,
-                                extra_headers=["費波那契"],
-                                extra_func=candle_extra)
-    
-    if evening_stars:
-        display_scan_results_v2(evening_stars, "黃昏之星 (頂部反轉)", limit=limit,
-                                extra_headers=["費波那契"],
-                                extra_func=candle_extra)
-    
-    if not morning_stars and not evening_stars:
+    found = False
+    for result in results.values():
+        pattern = result.pattern
+        items = []
+        for i in np.flatnonzero(result.hits):
+            try:
+                item = pattern_item(codes[i], pattern.label)
+            except Exception:
+                item = None
+            if item:
+                items.append(item)
+        if items:
+            found = True
+            trend = "多方訊號" if pattern.direction == 'bull' else "空方訊號"
+            display_scan_results_v2(items, f"{pattern.label} ({trend})", limit=limit,
+                                    extra_headers=["費波那契"],
+                                    extra_func=candle_extra)
+    
+    if not found:
         print_flush("\n沒有符合條件的股票。")
 
 
@@ -11639,7 +11807,8 @@ def data_management_menu():
         'b': step10_check_gaps,
         'c': step11_verify_backfill,
         'd': step12_calc_indicators,
-        'e': step8_sync_supabase
+        'e': step8_sync_supabase,
+        'f': _handle_incremental_indicator_verify
     }
     
     while True:
@@ -11661,6 +11830,7 @@ def data_management_menu():
         print_flush("[c] Step 11: 驗證一致性並補漏")
         print_flush("[d] Step 12: 計算技術指標 (含 VSBC)")
         print_flush("[e] 同步資料到 Supabase")
+        print_flush("[f] 增量計算技術指標 (抽樣比對全量重算)")
         print_flush("-" * 60)
         print_flush("[0] 返回主選單")
         
@@ -11693,6 +11863,13 @@ def _handle_step6_with_resume():
     step6_verify_and_backfill(resume=resume)
 
 
+def _handle_incremental_indicator_verify():
+    """增量計算技術指標並抽樣比對全量重算 (含快取清除)"""
+    step7_calc_indicators(incremental=True, verify=True)
+    
+    if GLOBAL_INDICATOR_CACHE:
+        GLOBAL_INDICATOR_CACHE.clear()
+
 def _handle_step7_with_cache_clear():
     """步驟7：計算技術指標（含快取清除）"""
     step7_calc_indicators()
@@ -12201,7 +12378,7 @@ def _check_api_connection_status():
     
     for name, url in endpoints:
         try:
-            resp = requests.get(url, timeout=5, verify=False)
+            resp = fetch_url(url, timeout=5)
             status = "正常" if resp.status_code == 200 else f"異常 ({resp.status_code})"
             print_flush(f"✓ {name}: {status}")
         except Exception as e: